@@ -46,7 +46,7 @@ from osqpipe.models import Filetype, Genome, Library, \
     Status, Lane
 from osqpipe.pipeline.alignmentqc import AlignmentCrossCorrReport
 
-from osqutil.samtools import BamToBedConverter, count_bam_reads, identify_bwa_algorithm
+from osqpipe.pipeline.bampy import PysamBamToBedConverter, BamStats
 from osqpipe.pipeline.alignment import AlignmentHandler
 
 ###############################################################################
@@ -130,11 +130,12 @@ class AlignProcessingManager(object):
       LOGGER.debug("Retrieved cached chromosome sizes file %s", fnchrlen)
     return (fnchrlen, False)
 
-  def check_bam_vs_lane_fastq(self, bam, relaxed=False):
+  def check_bam_vs_lane_fastq(self, bam, relaxed=False, stats=None):
     '''
     Quick check that the number of reads in the bam file being saved
     is identical to the number of (passed PF) reads in the input fastq
-    file. Returns the number of reads in the bam file.
+    file. Returns the number of reads in the bam file. A precomputed
+    BamStats object may be passed in to avoid rereading the bam file.
     '''
     (code, facility, lanenum, _pipeline) = parse_repository_filename(bam)
     try:
@@ -145,7 +146,9 @@ class AlignProcessingManager(object):
       LOGGER.error("Unexpected lane in filename, not found in repository.")
       sys.exit("Unable to find lane in repository")
 
-    numreads = count_bam_reads(bam)
+    if stats is None:
+      stats = BamStats.from_bam(bam)
+    numreads = stats.read_count
     if numreads != lane.total_passedpf:
       message = ("Number of reads in bam file is differs from that in "
                  + "fastq file: %d (bam) vs %d (fastq)")
@@ -234,7 +237,9 @@ class AlignProcessingManager(object):
     if not re.search(genome, in_fn):
       LOGGER.warning("Filename does not match expected genome (%s) and so database loading may fail." % genome)
 
-    numreads = self.check_bam_vs_lane_fastq(in_fn, relaxed)
+    # Read counts and @PG header info, gathered in a single pass.
+    stats    = BamStats.from_bam(in_fn)
+    numreads = self.check_bam_vs_lane_fastq(in_fn, relaxed, stats)
 
     # Set aligner, later passed as argument to AlignmentHandler.
     if aligner is None:
@@ -254,7 +259,7 @@ class AlignProcessingManager(object):
     else:
       
       if aligner == 'bwa':
-        params = identify_bwa_algorithm(in_fn)
+        params = stats.bwa_algorithm()
       elif aligner == 'tophat':
 
         aligner = [ 'bowtie2', 'tophat2', 'samtools' ]
@@ -295,8 +300,8 @@ class AlignProcessingManager(object):
     wigs      = []
     bedgraphs = []
     bigwigs   = []
-    bamToBed = BamToBedConverter(tc1         = genome == 'tc1',
-                                 chrom_sizes = chrom_sizes)
+    bamToBed = PysamBamToBedConverter(tc1         = genome == 'tc1',
+                                      chrom_sizes = chrom_sizes)
     for outBed in bamToBed.convert(in_fn, bed_fn):
       beds.append(outBed)
 
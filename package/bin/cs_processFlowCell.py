@@ -30,7 +30,7 @@ import django
 django.setup()
 
 # All script code moved into our main pipeline library namespace.
-from osqpipe.pipeline.flowcell import FlowCellProcess
+from osqpipe.pipeline.flowcell import FlowCellProcess, INTERNAL_DEMUX
 
 ###############################################################################
 
@@ -82,14 +82,22 @@ if __name__ == '__main__':
                       + ' be used when certain. It will not overwrite'
                       + ' previously-entered adapter metadata.')
 
+  PARSER.add_argument('--internal-demux', dest='internalDemux', action='store_true',
+                      help='Demultiplex using the internal streaming demultiplexer'
+                      + ' rather than demuxIllumina. This avoids unzipping and'
+                      + ' rezipping the fastq files.')
+
   ARGS = PARSER.parse_args()
 
+  DEMUX_ARGS = { 'demux_prog' : INTERNAL_DEMUX } if ARGS.internalDemux else {}
+
   PROC = FlowCellProcess(test_mode        = ARGS.testMode,
                          db_library_check = ARGS.checkForLibInDB,
                          force_primary    = ARGS.forcePrimary,
                          force_all        = ARGS.forceAll,
                          trust_lims_adapters = ARGS.trustAdapt,
-                         force_download   = ARGS.forceDownload)
+                         force_download   = ARGS.forceDownload,
+                         **DEMUX_ARGS)
 
   PROC.run(ARGS.run, ARGS.flowLane, destdir = ARGS.destdir)
 
@@ -21,8 +21,12 @@
 '''
 Script to automatically dump a core set of library and lane annotation
 out to CSV format for sharing with collaborators (via e.g. Dropbox).
+Parquet and Arrow output is also available, if the pyarrow package
+is installed.
 '''
 
+import time
+
 from osqutil.setup_logs import configure_logging
 from logging import INFO
 LOGGER = configure_logging(level=INFO)
@@ -31,11 +35,26 @@ LOGGER = configure_logging(level=INFO)
 import django
 django.setup()
 
-from osqpipe.models import Lane, Library
+from django.db import connection
+from django.db.models import Prefetch
+from django.test.utils import CaptureQueriesContext
+
+from osqpipe.models import Lane, Library, Lanefile, QCfile, Alignment, Alnfile,\
+    Characteristic, DataProvenance, ExternalRecord, SourceTreatment
 from osqutil.config import Config
 
 CONFIG = Config()
 
+# The number of objects fetched (along with all their related objects)
+# at a time. This bounds memory usage; the number of queries is fixed
+# per chunk.
+DEFAULT_CHUNK_SIZE = 2000
+
+# The sample characteristic categories reported in the output.
+CHARACTERISTIC_CATEGORIES = ('Diagnosis', 'TumourGrade')
+
+OUTPUT_FORMATS = ('csv', 'parquet', 'arrow')
+
 def lane_list_filetypes(lane):
   '''
   Return a string listing the available filetypes associated with the
@@ -90,17 +109,17 @@ def lane_sample_characteristics(lane, category):
   Return a string listing the Characteristics with the specified
   category linked to the sample in this lane.
   '''
-  listing = [ u"%s" % (char.value,)
-              for char in lane.library.sample.characteristics.filter(category=category) ]
-  return _helper_listing_to_string(listing)
+  return library_sample_characteristics(lane.library, category)
 
 def library_sample_characteristics(library, category):
   '''
   Return a string listing the Characteristics with the specified
   category linked to the sample in this library.
   '''
+  # Filtering in python makes use of any prefetched characteristics.
   listing = [ u"%s" % (char.value,)
-              for char in library.sample.characteristics.filter(category=category) ]
+              for char in library.sample.characteristics.all()
+              if char.category == category ]
   return _helper_listing_to_string(listing)
 
 def library_projects(library, skipdefault=True):
@@ -111,7 +130,8 @@ def library_projects(library, skipdefault=True):
   '''
   prjs = library.projects.all()
   if skipdefault:
-    prjs = prjs.exclude(code=CONFIG.defaultproject)
+    prjs = [ project for project in prjs
+             if project.code != CONFIG.defaultproject ]
   listing = [ u"%s" % (project.name,) for project in prjs ]
   return _helper_listing_to_string(listing)
 
@@ -122,8 +142,9 @@ def lane_aln_programs(lane):
   '''
   listing = []
   for aln in lane.alignment_set.all():
+    provenance = sorted(aln.provenance.all(), key=lambda prov: prov.rank_index)
     listing += [ u"%s(%s)" % (prov.program.program, prov.program.version)
-                 for prov in aln.provenance.all().order_by('rank_index') ]
+                 for prov in provenance ]
   return _helper_listing_to_string(listing)
 
 def lane_public_accessions(lane):
@@ -154,6 +175,21 @@ def _helper_listing_to_string(listing):
 
   return u','.join(listing)
 
+def iterate_in_chunks(queryset, chunk_size=DEFAULT_CHUNK_SIZE):
+  '''
+  Generator yielding the objects in queryset, in order, while
+  fetching only chunk_size of them (and their prefetched relations)
+  at a time. QuerySet.iterator() cannot be used for this because it
+  ignores prefetch_related.
+  '''
+  ids = list(queryset.values_list('id', flat=True))
+  for start in range(0, len(ids), chunk_size):
+    chunk   = ids[start:start + chunk_size]
+    objects = dict( (obj.id, obj) for obj in queryset.filter(id__in=chunk) )
+    for objid in chunk:
+      if objid in objects: # Skips any deleted in the meantime.
+        yield objects[objid]
+
 def _helper_optional_value(value, attr=None):
   if value is not None:
     if attr is not None:
@@ -167,12 +203,13 @@ class RepositoryDumper(object):
   '''
   Base class defining some simple behaviours of RepositoryDumper objects.
   '''
-  __slots__ = ('mapping', 'separator', 'objects')
+  __slots__ = ('mapping', 'separator', 'objects', 'chunk_size')
 
-  def __init__(self, separator="\t"):
-    self.mapping   = []
-    self.separator = separator
-    self.objects   = []
+  def __init__(self, separator="\t", chunk_size=DEFAULT_CHUNK_SIZE):
+    self.mapping    = []
+    self.separator  = separator
+    self.objects    = []
+    self.chunk_size = chunk_size
 
   def header_string(self):
     '''
@@ -181,19 +218,35 @@ class RepositoryDumper(object):
     '''
     return self.separator.join([ elem[0] for elem in self.mapping ])
 
+  def object_to_row(self, obj):
+    '''
+    Returns a list of unicode strings representing the passed object,
+    one per output column.
+    '''
+    return [ unicode(elem[1](obj)) for elem in self.mapping ]
+
   def object_to_string(self, lane):
     '''
     Returns a string representing the passed lane object, ready for
     writing to output file.
     '''
-    return self.separator.join([ elem[1](lane) for elem in self.mapping ])
+    return self.separator.join(self.object_to_row(lane))
+
+  def rows(self):
+    '''
+    Generator method which iterates through each dumped object,
+    yielding its output row. Objects are retrieved from the database
+    in chunks.
+    '''
+    for obj in iterate_in_chunks(self.objects, self.chunk_size):
+      yield self.object_to_row(obj)
 
   def format(self):
     '''
     Generator method which iterates through each dumped object and formats it for output.
     '''
-    for obj in self.objects:
-      yield self.object_to_string(obj) + u'\n'
+    for row in self.rows():
+      yield self.separator.join(row) + u'\n'
 
 class RepositoryLaneDumper(RepositoryDumper):
   '''
@@ -251,27 +304,41 @@ class RepositoryLaneDumper(RepositoryDumper):
       ('Accessions',             lambda x: lane_public_accessions(x)),
     ]
 
-    # This is broadly aping the approach in osqpipe.views to improve
-    # performance and reduce overall load on the database. It's
-    # maybe not perfect but it's a good place to start. Note that we
-    # filter out virtual lanes (where passedpf=NULL).
+    # Every relation used by the mapping above is either joined or
+    # prefetched, with Prefetch querysets matching the filtering and
+    # ordering applied by the helper functions; the number of queries
+    # is therefore fixed per chunk of lanes. Note that we filter out
+    # virtual lanes (where passedpf=NULL).
     lanes = Lane.objects\
-        .select_related('facility', 'library')\
-        .prefetch_related('library__genome','library__libtype',
-                          'library__factor','library__antibody',
-                          'library__sample',
-                          'library__sample__tissue',
-                          'library__sample__source',
-                          'library__sample__source__strain',
-                          'library__sample__source__sex',
-                          'library__adapter',
-                          'lanefile_set', 'lanefile_set__filetype',
-                          'laneqc_set', 'laneqc_set__qcfile_set',
-                          'laneqc_set__qcfile_set__filetype',
-                          'alignment_set', 'alignment_set__alnfile_set',
-                          'alignment_set__alnfile_set__filetype',
-                          'alignment_set__genome',
-                          'alignment_set__provenance__program')\
+        .select_related('facility',
+                        'library__libtype',
+                        'library__factor',
+                        'library__antibody',
+                        'library__condition',
+                        'library__adapter',
+                        'library__adapter2',
+                        'library__sample__tissue',
+                        'library__sample__source__strain',
+                        'library__sample__source__sex')\
+        .prefetch_related(
+          Prefetch('library__sample__source__sourcetreatment_set',
+                   queryset=SourceTreatment.objects.select_related('agent', 'dose_unit')),
+          Prefetch('library__sample__characteristics',
+                   queryset=Characteristic.objects\
+                     .filter(category__in=CHARACTERISTIC_CATEGORIES)),
+          Prefetch('lanefile_set',
+                   queryset=Lanefile.objects.select_related('filetype')),
+          Prefetch('laneqc_set__qcfile_set',
+                   queryset=QCfile.objects.select_related('filetype')),
+          Prefetch('alignment_set',
+                   queryset=Alignment.objects.select_related('genome')),
+          Prefetch('alignment_set__alnfile_set',
+                   queryset=Alnfile.objects.select_related('filetype')),
+          Prefetch('alignment_set__provenance',
+                   queryset=DataProvenance.objects.select_related('program')\
+                     .order_by('rank_index')),
+          Prefetch('external_records',
+                   queryset=ExternalRecord.objects.filter(is_public=True)))\
         .exclude(passedpf__isnull=True)\
         .order_by('library__extra__code_text_prefix',
                   'library__extra__code_numeric_suffix')
@@ -329,22 +396,30 @@ class RepositoryLibraryDumper(RepositoryDumper):
       ('Comment',                lambda x: _helper_optional_value(x.comment)),
     ]
 
-    # This is broadly aping the approach in osqpipe.views to improve
-    # performance and reduce overall load on the database. It's
-    # maybe not perfect but it's a good place to start. Note that we
-    # filter out virtual lanes (where passedpf=NULL).
+    # As for RepositoryLaneDumper, the number of queries is fixed per
+    # chunk of libraries. Note that we filter out libraries having
+    # only virtual lanes (where passedpf=NULL).
     libraries = Library.objects\
-        .prefetch_related('genome','libtype',
-                          'factor','antibody',
-                          'sample',
-                          'sample__tissue',
-                          'sample__source',
-                          'sample__source__strain',
-                          'sample__source__sex',
-                          'adapter',
-                          'lane_set')\
-        .filter(lane__passedpf__gte=1)\
-        .distinct()\
+        .select_related('libtype',
+                        'factor',
+                        'antibody',
+                        'condition',
+                        'adapter',
+                        'adapter2',
+                        'sample__tissue',
+                        'sample__source__strain',
+                        'sample__source__sex',
+                        'sample__source__mother',
+                        'sample__source__father',
+                        'sample__source__species')\
+        .prefetch_related(
+          Prefetch('sample__source__sourcetreatment_set',
+                   queryset=SourceTreatment.objects.select_related('agent', 'dose_unit')),
+          Prefetch('sample__characteristics',
+                   queryset=Characteristic.objects\
+                     .filter(category__in=CHARACTERISTIC_CATEGORIES)),
+          'projects')\
+        .filter(id__in=Lane.objects.filter(passedpf__gte=1).values('library'))\
         .order_by('extra__code_text_prefix',
                   'extra__code_numeric_suffix')
 
@@ -356,6 +431,91 @@ class RepositoryLibraryDumper(RepositoryDumper):
 
     self.objects = libraries
 
+def write_delimited(dumper, filename):
+  '''
+  Write the dump to a delimited text file, one row at a time.
+  '''
+  count = 0
+  with open(filename, 'w') as outfh:
+    outfh.write(dumper.header_string() + "\n")
+    for rowstr in dumper.format():
+      outfh.write(rowstr.encode('utf-8'))
+      count += 1
+  return count
+
+def write_arrow(dumper, filename, fmt='parquet'):
+  '''
+  Write the dump to a Parquet or Arrow (IPC file format) file; each
+  chunk of objects becomes a row group or record batch. All columns
+  are strings, as in the delimited output.
+  '''
+  try:
+    import pyarrow
+    import pyarrow.parquet
+  except ImportError, _err:
+    raise StandardError("The pyarrow package is required for %s output." % fmt)
+
+  names  = [ elem[0] for elem in dumper.mapping ]
+  schema = pyarrow.schema([ pyarrow.field(name, pyarrow.string()) for name in names ])
+  if fmt == 'parquet':
+    writer = pyarrow.parquet.ParquetWriter(filename, schema)
+    write  = writer.write_table
+  else:
+    sink   = pyarrow.OSFile(filename, 'wb')
+    writer = pyarrow.RecordBatchFileWriter(sink, schema)
+    write  = writer.write_batch
+
+  def flush(rows):
+    columns = [ pyarrow.array([ row[num] for row in rows ], type=pyarrow.string())
+                for num in range(len(names)) ]
+    if fmt == 'parquet':
+      write(pyarrow.Table.from_arrays(columns, names=names))
+    else:
+      write(pyarrow.RecordBatch.from_arrays(columns, names))
+
+  count = 0
+  rows  = []
+  try:
+    for row in dumper.rows():
+      rows.append(row)
+      if len(rows) == dumper.chunk_size:
+        flush(rows)
+        count += len(rows)
+        rows   = []
+    if len(rows) > 0:
+      flush(rows)
+      count += len(rows)
+  finally:
+    writer.close()
+    if fmt != 'parquet':
+      sink.close()
+  return count
+
+def _write_output(dumper, filename, fmt):
+  if fmt == 'csv':
+    return write_delimited(dumper, filename)
+  else:
+    return write_arrow(dumper, filename, fmt)
+
+def dump_repository(dumper, filename, fmt='csv', benchmark=False):
+  '''
+  Write the output of dumper to filename in the requested
+  format. With benchmark=True, the number of database queries and
+  the time taken are logged.
+  '''
+  if fmt not in OUTPUT_FORMATS:
+    raise ValueError("Unsupported output format: %s" % fmt)
+
+  if not benchmark:
+    return _write_output(dumper, filename, fmt)
+
+  start = time.time()
+  with CaptureQueriesContext(connection) as queries:
+    count = _write_output(dumper, filename, fmt)
+  LOGGER.info("Dumped %d rows to %s in %.1f seconds using %d database queries.",
+              count, filename, time.time() - start, len(queries))
+  return count
+
 if __name__ == '__main__':
 
   from argparse import ArgumentParser
@@ -375,17 +535,28 @@ if __name__ == '__main__':
                       help='Only dump out data which has been linked to those libraries'
                       + 'specifically marked for release in the repository.')
 
+  PARSER.add_argument('-f', '--format', dest='format', type=str, default='csv',
+                      choices=OUTPUT_FORMATS,
+                      help='The output format. Parquet and Arrow output require'
+                      + ' the pyarrow package. The default is csv.')
+
+  PARSER.add_argument('--chunk-size', dest='chunksize', type=int,
+                      default=DEFAULT_CHUNK_SIZE,
+                      help='The number of objects retrieved from the database at a'
+                      + ' time (default %d).' % DEFAULT_CHUNK_SIZE)
+
+  PARSER.add_argument('--benchmark', dest='benchmark', action='store_true',
+                      help='Report the number of database queries and the time taken.')
+
   ARGS = PARSER.parse_args()
 
   if ARGS.bylib:
     DUMPER = RepositoryLibraryDumper(project=ARGS.project,
-                                     releaseworthy=ARGS.releaseworthy)
+                                     releaseworthy=ARGS.releaseworthy,
+                                     chunk_size=ARGS.chunksize)
   else:
     DUMPER = RepositoryLaneDumper(project=ARGS.project,
-                                  releaseworthy=ARGS.releaseworthy)
+                                  releaseworthy=ARGS.releaseworthy,
+                                  chunk_size=ARGS.chunksize)
 
-  with open(ARGS.output, 'w') as outfh:
-    outfh.write(DUMPER.header_string() + "\n")
-    for lanestr in DUMPER.format():
-      outfh.write(lanestr.encode('utf-8'))
-    
+  dump_repository(DUMPER, ARGS.output, fmt=ARGS.format, benchmark=ARGS.benchmark)
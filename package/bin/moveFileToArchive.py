@@ -76,8 +76,8 @@ if __name__ == '__main__':
 
   PARSER.add_argument('-C', '--copy_wait_archive', dest='copy_wait_archive', action='store_true',
                       help='Force archiving in following 3 stages: 1) copy files'
-                      + ' to the archive, 2) wait for 5 minutes for the file system'
-                      + ' to pick up the existence of the files, 3) checks md5sums'
+                      + ' to the archive, 2) wait for the file system to pick up'
+                      + ' the existence of the files (at the expected size), 3) checks md5sums'
                       + ' and register files as  archived. The option was implemented'
                       + ' to overcome a feature of CRI Archive which occasionally'
                       + ' reports files missing even after 30s since creation.')
@@ -96,6 +96,29 @@ if __name__ == '__main__':
   PARSER.add_argument('--days-delay', dest='archive_lag', type=int, default=7,
                       help='The number of days to wait before archiving a new file (default=7).')
 
+  PARSER.add_argument('-t', '--transfers', dest='transfers', type=int, default=4,
+                      help='The maximum number of concurrent file transfers'
+                      + ' to the archive (default=4).')
+
+  PARSER.add_argument('--transfers-per-host', dest='transfers_per_host', type=int,
+                      default=2, help='The maximum number of concurrent file'
+                      + ' transfers to any one archive host (default=2).')
+
+  PARSER.add_argument('--batch-size', dest='transfer_batch_size', type=int,
+                      default=20, help='The maximum number of files copied to'
+                      + ' a remote archive in a single rsync call (default=20).')
+
+  CACHE_GROUP = PARSER.add_mutually_exclusive_group()
+
+  CACHE_GROUP.add_argument('--trust-cache', dest='trust_cache', action='store_true',
+                           help='Reuse cached md5 sums for files which have not'
+                           + ' changed (same size, mtime and inode) since they'
+                           + ' were last checksummed.')
+
+  CACHE_GROUP.add_argument('--verify', dest='trust_cache', action='store_false',
+                           help='Reread every file to verify its md5 sum, refreshing'
+                           + ' the checksum cache (default).')
+
   PARSER.add_argument('--debug', dest='debug', action='store_true',
                       help='Set logging level to DEBUG.')
 
@@ -111,7 +134,11 @@ if __name__ == '__main__':
                             force_delete      = ARGS.force_delete,
                             force_md5_check   = ARGS.force_md5_check,
                             force_overwrite   = ARGS.force_overwrite,
-                            archive_lag       = ARGS.archive_lag)
+                            archive_lag       = ARGS.archive_lag,
+                            trust_cache       = ARGS.trust_cache,
+                            transfers         = ARGS.transfers,
+                            transfers_per_host  = ARGS.transfers_per_host,
+                            transfer_batch_size = ARGS.transfer_batch_size)
 
   ARCHIVER.run_archival(ARGS.files)
 
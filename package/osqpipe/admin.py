@@ -272,6 +272,13 @@ class LibraryNameMapAdmin(admin.ModelAdmin):
   fields        = ('limsname', 'libname')
   search_fields = ('limsname', 'libname')
 
+#############################################
+@admin.register(FlowcellRun)
+class FlowcellRunAdmin(admin.ModelAdmin):
+  list_display  = ('flowcell', 'run_folder', 'date')
+  fields        = ('flowcell', 'run_folder')
+  search_fields = ('flowcell', 'run_folder')
+
 #############################################
 @admin.register(Libtype)
 class LibtypeAdmin(admin.ModelAdmin):
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqpipe python package.
+#
+# The osqpipe python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqpipe python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqpipe python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('osqpipe', '0017_library_release_worthy'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FlowcellRun',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('flowcell', models.CharField(unique=True, max_length=32)),
+                ('run_folder', models.CharField(max_length=255)),
+                ('date', models.DateField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'flowcell_run',
+            },
+        ),
+    ]
@@ -30,6 +30,7 @@ from django.contrib.auth.models import User
 # This stanza to manage REST API authentication tokens (see
 # below). Also the project-library ManyToManyField relationship (m2m_changed).
 from django.conf import settings
+from django.core.cache import cache
 from django.db.models.signals import post_save, m2m_changed
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
@@ -969,6 +970,21 @@ class LibraryNameMap(models.Model):
   class Meta:
     db_table = u'library_name_map'
 
+class FlowcellRun(models.Model):
+  '''
+  Persistent index of flowcell IDs to LIMS run folders, maintained
+  from the LIMS run history by the upstream_lims module.
+  '''
+  flowcell     = models.CharField(max_length=32, unique=True)
+  run_folder   = models.CharField(max_length=255)
+  date         = models.DateField(auto_now_add=True)
+
+  def __unicode__(self):
+    return "%s == %s" % (self.flowcell, self.run_folder)
+
+  class Meta:
+    db_table = u'flowcell_run'
+
 class Peakcalling(DataProcess):
   code         = models.CharField(max_length=128, unique=True)
   factor_align = models.ForeignKey(Alignment, on_delete=models.PROTECT,
@@ -1046,3 +1062,56 @@ def protect_frozen_m2m(sender, instance, action, reverse, model, pk_set, **kwarg
       for pkid in list(pk_set):
         if model.objects.get(id=pkid).is_frozen:
           raise ValidationError("Attempt to change a frozen project instance.")
+
+####################################################################################
+# Cache the set of projects of which each user is a member, as this is
+# consulted on every page view and file download. The cache entries
+# are discarded whenever project membership changes, but only in the
+# cache of the process making the change. Unless a shared cache
+# backend is configured (see README.rst), other processes continue
+# to grant access to removed members for up to this many seconds.
+
+PROJECT_MEMBERSHIP_TIMEOUT = getattr(settings, 'OSQPIPE_PROJECT_MEMBERSHIP_TIMEOUT', 30)
+
+def _membership_cache_key(user_id):
+  return 'osqpipe.project_ids.%d' % user_id
+
+def user_project_ids(user):
+  '''
+  Return a frozenset of the IDs of the projects of which user is a
+  member.
+  '''
+  if not user.is_authenticated():
+    return frozenset()
+  key = _membership_cache_key(user.pk)
+  ids = cache.get(key)
+  if ids is None:
+    ids = frozenset(Project.objects.filter(people=user).values_list('id', flat=True))
+    cache.set(key, ids, PROJECT_MEMBERSHIP_TIMEOUT)
+  return ids
+
+@receiver(m2m_changed, sender=Project.people.through)
+def invalidate_project_membership(sender, instance, action, reverse, model, pk_set, **kwargs):
+  '''
+  Signal receiver to discard the cached project IDs of any user whose
+  project membership has changed.
+  '''
+  if reverse:
+
+    # instance is user; model is project.
+    user_ids = [ instance.pk ]
+
+  elif action == 'pre_clear':
+
+    # instance is project; the affected users are only known beforehand.
+    instance._cleared_people = list(instance.people.values_list('id', flat=True))
+    user_ids = instance._cleared_people
+
+  elif action == 'post_clear':
+    user_ids = getattr(instance, '_cleared_people', [])
+
+  else:
+    user_ids = pk_set or []
+
+  if action in ('post_add', 'post_remove', 'pre_clear', 'post_clear'):
+    cache.delete_many([ _membership_cache_key(uid) for uid in user_ids ])
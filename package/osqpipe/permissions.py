@@ -21,7 +21,8 @@
 Custom project-level permissions.
 '''
 
-from .models import Project, Library, Lane, Alignment, Sample, MergedAlignment
+from .models import Project, Library, Lane, Alignment, Sample, MergedAlignment,\
+    user_project_ids
 from rest_framework import permissions
 
 class IsProjectMember(permissions.BasePermission):
@@ -36,30 +37,25 @@ class IsProjectMember(permissions.BasePermission):
     if request.method not in permissions.SAFE_METHODS:
       return False
 
-    # Access permissions are only allowed to project members.
-    if type(obj) is Project:
-      return request.user in obj.people.all()
-    elif type(obj) is Library:
-      return request.user in [ person
-                               for prj in obj.projects.all()
-                               for person in prj.people.all() ]
-    elif type(obj) is Lane:
-      return request.user in [ person
-                               for prj in obj.library.projects.all()
-                               for person in prj.people.all() ]
-    elif type(obj) is Alignment:
-      return request.user in [ person
-                               for prj in obj.lane.library.projects.all()
-                               for person in prj.people.all() ]
-    elif type(obj) is MergedAlignment:
-      return request.user in [ person
-                               for aln in obj.alignments.all()
-                               for prj in aln.lane.library.projects.all()
-                               for person in prj.people.all() ]
-    elif type(obj) is Sample:
-      return request.user in [ person
-                               for lib in obj.library_set.all()
-                               for prj in lib.projects.all()
-                               for person in prj.people.all() ]
+    # Access permissions are only allowed to project members. Given
+    # the user's cached project memberships, each check is at most a
+    # single query, however the object was retrieved. Note that
+    # isinstance is needed here since querysets using defer() or
+    # only() return instances of a dynamically created subclass.
+    project_ids = user_project_ids(request.user)
+    if isinstance(obj, Project):
+      return obj.pk in project_ids
+    elif isinstance(obj, Library):
+      objects = Library.objects.filter(projects__in=project_ids)
+    elif isinstance(obj, Lane):
+      objects = Lane.objects.filter(library__projects__in=project_ids)
+    elif isinstance(obj, Alignment):
+      objects = Alignment.objects.filter(lane__library__projects__in=project_ids)
+    elif isinstance(obj, MergedAlignment):
+      objects = MergedAlignment.objects\
+          .filter(alignments__lane__library__projects__in=project_ids)
+    elif isinstance(obj, Sample):
+      objects = Sample.objects.filter(library__projects__in=project_ids)
     else:
       return False
+    return objects.filter(pk=obj.pk).exists()
@@ -33,7 +33,7 @@ from osqutil.utilities import is_zipped, parse_repository_filename, \
     checksum_file, rezip_file, set_file_permissions, transfer_file
 from ..models import Filetype, Lane, Alignment, Alnfile, Facility, \
     Genome, Program, DataProvenance
-from osqutil.samtools import BamToBedConverter
+from .bampy import PysamBamToBedConverter
 from osqutil.config import Config
 
 from osqutil.progsum import ProgramSummary
@@ -411,7 +411,7 @@ class AlignmentHandler(object):
     and data provenance info is passed in via the class attributes
     prog and params.
     '''
-    bam_to_bed = BamToBedConverter(tc1=tc1, chrom_sizes=chrom_sizes)
+    bam_to_bed = PysamBamToBedConverter(tc1=tc1, chrom_sizes=chrom_sizes)
     base       = os.path.splitext(bam)[0]
     
     bedtype = Filetype.objects.get(code='bed')
@@ -28,14 +28,16 @@ import sys
 import time
 import datetime
 import re
+import threading
 
 from subprocess import Popen, PIPE
 from shutil import copy2
+from multiprocessing.pool import ThreadPool
 
 from django.db import transaction
 from ..models import ArchiveLocation, Lanefile, Alnfile, \
     QCfile, AlnQCfile, Peakfile, MergedAlnfile, Datafile
-from osqutil.utilities import checksum_file, bash_quote
+from osqutil.utilities import checksum_file, checksum_files, bash_quote
 
 from osqutil.config import Config
 from osqutil.setup_logs import configure_logging
@@ -44,82 +46,45 @@ LOGGER = configure_logging('archive')
 CONFIG = Config()
 
 ################################################################################
-def _archive_file_via_scp(fobj, attempts = 1, sleeptime = 2):
+def _archive_host_args(arch):
   '''
-  A wrapper for scp allowing multiple attempts for the transfer in case
-  of recoverable error.
+  Return the ssh options and user@host string for a remote archive.
   '''
-  unrecoverable = [ 'No such file or directory',
-                    'Failed to add the host to the list of known hosts',
-                    'Operation not permitted' ]
-
-  arch = fobj.archive
-  if arch is None:
-    raise ValueError("Attempting to transfer file to null archive location.")
-
-  # NOTE: We may still need to double-quote spaces the destination
-  # passed to scp. Double-quoting brackets ([]) does not work, though.
-  host_archdir = os.path.join(arch.host_path, fobj.libcode)
-  dest = os.path.join(host_archdir,
-                      os.path.basename(fobj.repository_file_path))
-
-  cmd = 'scp -p -o StrictHostKeyChecking=no'
+  sshopts = 'ssh -o StrictHostKeyChecking=no'
   if arch.host_port is not None:
-    cmd += ' -P %s' % str(arch.host_port)
-
-  # Assume we're copying from the main repository to the archive.
-  # Note that we need quoting of e.g. file paths containing
-  # spaces.
-  cmd += ' %s' % bash_quote(fobj.original_repository_file_path)
-
-  # Double-quote the destination, as it has to get past (a) our local
-  # bash, and (b) the bash on the destination machine.
+    sshopts += ' -p %s' % str(arch.host_port)
   if arch.host_user is not None:
-    cmd += ' %s@%s:%s' % (arch.host_user, arch.host, bash_quote(bash_quote(dest)))
+    hoststr = '%s@%s' % (arch.host_user, arch.host)
   else:
-    cmd += ' %s:%s' % (arch.host, bash_quote(bash_quote(dest)))
-
-  start_time = time.time()
+    hoststr = arch.host
+  return (sshopts, hoststr)
 
-  while attempts > 0:
-    subproc = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
-    (stdout, stderr) = subproc.communicate()
-    retcode = subproc.wait()
-    if stdout is not None:
-      sys.stdout.write(stdout)
-    if stderr is not None:
-      sys.stderr.write(stderr)
-    if retcode != 0:
-      for mesg in unrecoverable:
-        if mesg in stderr:
-          LOGGER.error(stderr)
-          attempts = 0
-          break
-      attempts -= 1
-      if attempts <= 0:
-        break
-      LOGGER.warning(\
-        'Transfer failed with error code: %s\nTrying again (max %d times)',
-        stderr, attempts)
-      time.sleep(sleeptime)
-    else:
-      break
-
-  if retcode !=0:
-    raise StandardError("ERROR. Failed to transfer file. Command was:\n   %s\n"
-                        % (" ".join(cmd),) )
-
-  time_diff = time.time() - start_time
-  LOGGER.info("Copying to archive (scp) completed in %d seconds.", time_diff)
+def _archive_files_via_rsync(arch, srcs, destdir):
+  '''
+  Copy a batch of files into a single archive host directory using
+  one rsync (i.e., one ssh connection). Returns a tuple of (retcode,
+  stderr). Remote paths are passed with --protect-args so that they
+  need no quoting for the remote shell.
+  '''
+  (sshopts, hoststr) = _archive_host_args(arch)
+  cmd = [ 'rsync', '--times', '--perms', '--protect-args', '-e', sshopts ] \
+      + list(srcs) + [ '%s:%s/' % (hoststr, destdir) ]
+  LOGGER.debug(" ".join(cmd))
+  subproc = Popen(cmd, stdout=PIPE, stderr=PIPE)
+  (stdout, stderr) = subproc.communicate()
+  if stdout:
+    sys.stdout.write(stdout)
+  if stderr:
+    sys.stderr.write(stderr)
+  return (subproc.returncode, stderr)
 
-def _create_archive_dir_on_host(fobj):
+def _create_archive_dir_on_host(arch, folder):
   '''
   Create folder in foreign host over ssh.
   '''
-  arch = fobj.archive
   if arch is None:
     raise ValueError("Attempting to transfer file to null archive location.")
-  folder = bash_quote(os.path.join(arch.host_path, fobj.libcode))
+  folder = bash_quote(folder)
 
   # The ssh command expects double quoting (one for our bash prompt,
   # one for the server).
@@ -145,43 +110,174 @@ def _create_archive_dir_on_host(fobj):
         + (" (cmd=\"%s\").\nSTDOUT: %s\nSTDERR: %s\n"
         % (" ".join(cmd), stdout, stderr)) )
 
-def _copy_file_to_archive(fobj):
+def _copy_files_to_local_archive(pairs):
   '''
-  Copies the file to its currently configured archive location.
+  Copy (source, destination) file pairs to an archive mounted on the
+  current server. Partially copied files are removed on failure so
+  that a subsequent run will copy them again.
   '''
-  archpath = fobj.repository_file_path
+  for (src, dest) in pairs:
+    archdir = os.path.dirname(dest)
+    if not os.path.exists(archdir):
+      LOGGER.info("Creating dir for the file in archive.")
+      try:
+        os.makedirs(archdir)
+      except OSError, _err:
+        if not os.path.isdir(archdir): # Another worker may have got there first.
+          raise
+
+    # The advantage of shutil.copy2 over copy is that it tries to
+    # keep the file metadata. Equivalent to 'cp -p source
+    # destination'
+    try:
+      copy2(src, dest)
+    except (IOError, OSError), _err:
+      if os.path.exists(dest):
+        os.unlink(dest)
+      raise
 
-  if all([ getattr(fobj.archive, key) is not None
-           for key in ('host', 'host_path') ]):
+def _wait_for_archive_files(expected, timeout=30*60, interval=15):
+  '''
+  Poll the archive file system until every file in the expected dict
+  (archive path -> size in bytes) is visible with the expected
+  size, or until timeout seconds have passed. Returns the list of
+  paths which have not yet appeared.
+  '''
+  pending    = dict(expected)
+  start_time = time.time()
+  while True:
+    for (archpath, size) in pending.items():
+      if os.path.exists(archpath) and os.path.getsize(archpath) == size:
+        del pending[archpath]
+    if len(pending) == 0:
+      LOGGER.info("All %d copied files visible in archive after %d seconds.",
+                  len(expected), time.time() - start_time)
+      break
+    if time.time() - start_time > timeout:
+      LOGGER.warning("%d copied files still not visible in archive after"
+                     + " %d seconds.", len(pending), timeout)
+      break
+    LOGGER.debug("Waiting for %d files to appear in the archive.", len(pending))
+    time.sleep(interval)
 
-    # Remote archive, file transfer via scp.
-    LOGGER.info("Creating dir for the file in archive.")
+  return sorted(pending.keys())
 
-    # Raises StandardError upon failure to create dir.
-    _create_archive_dir_on_host(fobj)
+################################################################################
+class ArchiveTransferScheduler(object):
+  '''
+  Runs batches of archive file transfers using a bounded pool of
+  worker threads, with a separate limit on the number of concurrent
+  transfers to any one host. Each job is a tuple of (archive, target
+  directory, list of (source, destination) pairs). Remote archives are
+  copied with one rsync per job; failed transfers are retried with
+  exponential backoff unless the error is clearly unrecoverable.
+
+  Note that jobs must not touch the database; all paths should be
+  resolved by the caller beforehand.
+  '''
 
-    LOGGER.info("Copying %s to the archive.", fobj)
+  __slots__ = ('transfers', 'per_host', 'attempts', 'sleeptime', '_host_locks',
+               '_lock')
 
-    # Raises StandardError upon failure to transfer.
-    _archive_file_via_scp(fobj)
+  UNRECOVERABLE = ( 'No such file or directory',
+                    'Failed to add the host to the list of known hosts',
+                    'Operation not permitted' )
+
+  def __init__(self, transfers=4, per_host=2, attempts=3, sleeptime=2):
+    self.transfers  = max(1, int(transfers))
+    self.per_host   = max(1, int(per_host))
+    self.attempts   = attempts
+    self.sleeptime  = sleeptime
+    self._host_locks = {}
+    self._lock       = threading.Lock()
+
+  @staticmethod
+  def _is_remote(arch):
+    return all([ getattr(arch, key) is not None
+                 for key in ('host', 'host_path') ])
+
+  def _host_semaphore(self, arch):
+    '''
+    Return the semaphore limiting concurrent transfers to this
+    archive's host.
+    '''
+    if self._is_remote(arch):
+      key = (arch.host, arch.host_user, arch.host_port)
+    else:
+      key = None  # local file system.
+    with self._lock:
+      if key not in self._host_locks:
+        self._host_locks[key] = threading.BoundedSemaphore(self.per_host)
+      return self._host_locks[key]
 
-  else:
+  def _run_job(self, job):
+    '''
+    Run a single transfer job, returning None on success or an error
+    message on failure. Exceptions are trapped here so that a single
+    failure does not abort the remaining transfers.
+    '''
+    (arch, destdir, pairs) = job
+    with self._host_semaphore(arch):
+      start_time = time.time()
+      try:
+        if self._is_remote(arch):
+          self._run_remote_job(arch, destdir, pairs)
+        else:
+          _copy_files_to_local_archive(pairs)
+      except StandardError, err:
+        return str(err)
 
-    # Local archive, mounted on current server.
-    archdir = os.path.split(archpath)[0]
+    LOGGER.info("Copied %d files to archive directory %s in %d seconds.",
+                len(pairs), destdir, time.time() - start_time)
+    return None
 
-    if not os.path.exists(archdir):
-      LOGGER.info("Creating dir for the file in archive.")
-      os.makedirs(archdir)
+  def _run_remote_job(self, arch, destdir, pairs):
+    '''
+    Transfer a batch of files to a single remote archive directory,
+    retrying with exponential backoff.
+    '''
+    # Raises StandardError upon failure to create dir.
+    _create_archive_dir_on_host(arch, destdir)
+
+    srcs     = [ src for (src, _dest) in pairs ]
+    attempts = self.attempts
+    delay    = self.sleeptime
+    while True:
+      (retcode, stderr) = _archive_files_via_rsync(arch, srcs, destdir)
+      if retcode == 0:
+        return
+      attempts -= 1
+      if attempts <= 0 or any([ mesg in stderr for mesg in self.UNRECOVERABLE ]):
+        raise StandardError("Failed to transfer %d files to %s:%s (rsync"
+                            " exit code %d): %s"
+                            % (len(srcs), arch.host, destdir, retcode, stderr))
+      LOGGER.warning("Transfer to %s failed with error code %d; retrying in"
+                     + " %d seconds (%d attempts left).",
+                     arch.host, retcode, delay, attempts)
+      time.sleep(delay)
+      delay *= 2
+
+  def run(self, jobs):
+    '''
+    Run all the transfer jobs, returning a list of (job, error
+    message) tuples for those which failed.
+    '''
+    jobs = list(jobs)
+    if len(jobs) == 0:
+      return []
 
-    # The advantage of shutil.copy2 over copy is that it tries to
-    # keep the file metadata. Equivalent to 'cp -p source
-    # destination'
-    LOGGER.info("Copying file to the archive.")
-    start_time = time.time()
-    copy2(fobj.original_repository_file_path, archpath)
-    time_diff = time.time() - start_time
-    LOGGER.info("Copying to archive completed in %d seconds.", time_diff)
+    pool = ThreadPool(min(self.transfers, len(jobs)))
+    try:
+      errors = pool.map(self._run_job, jobs)
+    finally:
+      pool.close()
+      pool.join()
+
+    failed = [ (job, err) for (job, err) in zip(jobs, errors) if err is not None ]
+    for (job, err) in failed:
+      LOGGER.error("Archive transfer to %s failed: %s", job[1], err)
+
+    return failed
 
 def _get_files_for_filetype(filetype, not_archived=False):
   '''
@@ -272,15 +368,26 @@ class ArchiveManager(object):
     archive_lag: A time in days which files will stay in the main repository
                  before being archived. Default behaviour is to archive as
                  soon as possible, but this is not always desirable.
+    trust_cache: Use cached MD5 sums (see osqutil.checksum_cache) for files
+                 whose size, mtime and inode are unchanged since they were
+                 last checksummed. The default is to reread every file.
+    transfers: The maximum number of concurrent transfers to the archive.
+    transfers_per_host: The maximum number of concurrent transfers to any
+                        one archive host.
+    transfer_batch_size: The maximum number of files copied to a remote
+                         archive directory in a single rsync call.
   '''
 
   __slots__ = ('filetype', 'archive', 'copy_only', 'copy_wait_archive',
-               'force_delete', 'force_md5_check', 'force_overwrite', 'archive_lag')
+               'force_delete', 'force_md5_check', 'force_overwrite', 'archive_lag',
+               'trust_cache', 'transfers', 'transfers_per_host',
+               'transfer_batch_size')
 
   def __init__(self, filetype=None, archive=CONFIG.default_archive,
                copy_only=False, copy_wait_archive=True,
                force_delete=False, force_md5_check=False,
-               force_overwrite=False, archive_lag=None):
+               force_overwrite=False, archive_lag=None, trust_cache=False,
+               transfers=4, transfers_per_host=2, transfer_batch_size=20):
     self.filetype          = filetype
     self.archive           = ArchiveLocation.objects.get(name=archive)
     self.copy_only         = copy_only
@@ -289,6 +396,10 @@ class ArchiveManager(object):
     self.force_md5_check   = force_md5_check
     self.force_overwrite   = force_overwrite
     self.archive_lag       = archive_lag
+    self.trust_cache       = trust_cache
+    self.transfers         = transfers
+    self.transfers_per_host  = transfers_per_host
+    self.transfer_batch_size = transfer_batch_size
 
   def _set_archive_location(self, fobj, warn=True):
     '''
@@ -322,25 +433,62 @@ class ArchiveManager(object):
     # calling code, which may choose to discard the archive information.
     return (fobj, already_in_archive)
 
-  def _copy_file_to_archive_disk(self, fobj):
+  def _copy_files_to_archive_disk(self, fobjs):
     '''
-    Just copy the file to its designated archive disk location; make
-    no changes to the database.
+    Just copy the files to their designated archive disk locations;
+    make no changes to the database. Files are grouped by target
+    directory into batches which are then transferred concurrently.
+    Returns a dict of archive path -> expected file size for all the
+    files copied.
     '''
-    # Check if file in archive (both on db and on disk).
-    (fobj, _previously_archived) = self._set_archive_location(fobj, warn=False)
-    archpath = fobj.repository_file_path
+    batches   = {}
+    expected  = {}
+    archpaths = {}
+    for fobj in fobjs:
+
+      # Check if file in archive (both on db and on disk).
+      (fobj, _previously_archived) = self._set_archive_location(fobj, warn=False)
+      archpath = fobj.repository_file_path
 
-    # Copy file to archive. In case remote host is provided, scp via
-    # remote host. Otherwise copy.
-    if self.force_overwrite or not os.path.exists(archpath):
-      LOGGER.warning("Copying file %s to archive location %s.",
-                     fobj, fobj.archive)
-      _copy_file_to_archive(fobj)
+      # Copy file to archive. In case remote host is provided, rsync
+      # via remote host. Otherwise copy.
+      if self.force_overwrite or not os.path.exists(archpath):
+        LOGGER.warning("Copying file %s to archive location %s.",
+                       fobj, fobj.archive)
+        arch = fobj.archive
+        src  = fobj.original_repository_file_path
+        if ArchiveTransferScheduler._is_remote(arch):
+          destdir = os.path.join(arch.host_path, fobj.libcode)
+          dest    = os.path.join(destdir, os.path.basename(archpath))
+        else:
+          destdir = os.path.dirname(archpath)
+          dest    = archpath
+        batches.setdefault((arch.id, destdir), (arch, []))[1].append((src, dest))
+        expected[archpath] = os.path.getsize(src)
+        archpaths[dest]    = archpath
+
+    jobs = []
+    for ((_archid, destdir), (arch, pairs)) in sorted(batches.items()):
+      for start in range(0, len(pairs), self.transfer_batch_size):
+        jobs.append((arch, destdir, pairs[start:start+self.transfer_batch_size]))
+
+    LOGGER.info("Copying %d files to archive in %d batches.",
+                len(expected), len(jobs))
+    scheduler = ArchiveTransferScheduler(transfers=self.transfers,
+                                         per_host=self.transfers_per_host)
+    start_time = time.time()
+    failed = scheduler.run(jobs)
+    LOGGER.info("Copying to archive completed in %d seconds.",
+                time.time() - start_time)
 
-    # N.B. we do *not* want to make fobj available to the caller as we
+    # Files which failed to transfer will not be waited for.
+    for (job, _err) in failed:
+      for (_src, dest) in job[2]:
+        del expected[archpaths[dest]]
+
+    # N.B. we do *not* want to make fobjs available to the caller as we
     # are likely not within a transaction.
-    return
+    return expected
 
   @transaction.atomic
   def _register_file_in_archive(self, fobj):
@@ -368,7 +516,7 @@ class ArchiveManager(object):
       if not os.path.exists(archpath):
         raise ArchiveError("Error: File has not yet appeared in the archive: %s" % fobj)
 
-      checksum = checksum_file(archpath) # archive path
+      checksum = checksum_file(archpath, trust_cache=self.trust_cache) # archive path
 
       if checksum == fobj.checksum:
         LOGGER.info("Md5 sum in repository and for %s are identical.", archpath)
@@ -415,6 +563,14 @@ class ArchiveManager(object):
     # If file has been in Archive for long enough or force_delete,
     # delete the source.
     files_deleted = 0
+
+    # Checksum all the archived copies up front; this is done
+    # concurrently since it is by far the slowest part of this sweep.
+    archpaths = [ fobj.repository_file_path for fobj in fobjs
+                  if os.path.exists(fobj.original_repository_file_path)
+                  and os.path.exists(fobj.repository_file_path) ]
+    checksums = checksum_files(archpaths, trust_cache=self.trust_cache)
+
     for fobj in fobjs:
 
       archpath = fobj.repository_file_path
@@ -437,8 +593,11 @@ class ArchiveManager(object):
       # IN THE REPOSITORY!
       if os.path.exists(repopath):
         if os.path.exists(archpath):
-          checksum = checksum_file(archpath)
-          if checksum != fobj.checksum:
+          checksum = checksums.get(archpath)
+          if checksum is None:
+            LOGGER.error("Unable to checksum archived file %s. Can not delete"
+                         + " the file!", archpath)
+          elif checksum != fobj.checksum:
             LOGGER.error(\
               "Error: Archive file checksum (%s) not same as in repository (%s)."
               + " Can not delete the file!", checksum, fobj.checksum)
@@ -492,7 +651,7 @@ class ArchiveManager(object):
     else:
       copy2(archpath, repopath)
 
-    checksum = checksum_file(repopath)
+    checksum = checksum_file(repopath, trust_cache=self.trust_cache)
 
     # Another manual investigation type error.
     if checksum != fobj.checksum:
@@ -539,16 +698,14 @@ class ArchiveManager(object):
       # filesystem to catch up with reality (due to latency in the
       # system), we first copy everything across as a batch job before
       # we even think about touching the database.
-      for fobj in fobjs:
-        LOGGER.info("Copying \'%s\' to archive.", fobj)
-        self._copy_file_to_archive_disk(fobj)
-
-      # Wait for files copied to archive to become visible in the
-      # file system.
-      if self.copy_wait_archive:
-        LOGGER.info("Copying finished. Waiting 5 minutes for"
+      expected = self._copy_files_to_archive_disk(fobjs)
+
+      # Wait for files copied to archive to become visible (with the
+      # correct size) in the file system.
+      if self.copy_wait_archive and len(expected) > 0:
+        LOGGER.info("Copying finished. Waiting for"
                       + " file system to register copied files.")
-        time.sleep(5*60)
+        _wait_for_archive_files(expected)
 
       # Check files copied successfully, and enter archive information
       # in the database.
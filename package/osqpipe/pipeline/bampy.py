@@ -26,12 +26,59 @@ maintainability.
 
 import os
 import re
+import json
+import multiprocessing
 import pysam
+from collections import OrderedDict
 from contextlib import contextmanager
 from logging import INFO
+from osqutil.samtools import BamToBedConverter, bwa_algorithm_from_command
 from osqutil.setup_logs import configure_logging
 LOGGER = configure_logging('bampy', level=INFO)
 
+# The default maximum number of output files held open at once by
+# Bamfile.split_by_chromosome in stream mode.
+SPLIT_MAX_OPEN = 256
+
+def _write_reference(bam, refname, outfile, index=False):
+  '''
+  Write out the reads for a single reference of an indexed bam file,
+  optionally indexing the output.
+  '''
+  LOGGER.info("Writing out reads for reference %s...", str(refname))
+  out = pysam.AlignmentFile(outfile, 'wb', header=bam.header)
+  try:
+    for read in bam.fetch(reference=refname):
+      out.write(read)
+  finally:
+    out.close()
+  if index:
+    pysam.index(outfile)
+
+def _split_reference_worker(args):
+  '''
+  Process pool worker function for Bamfile.split_by_chromosome in
+  parallel mode.
+  '''
+  (filename, refname, outfile, index) = args
+  bam = pysam.AlignmentFile(filename, 'rb')
+  try:
+    _write_reference(bam, refname, outfile, index)
+  finally:
+    bam.close()
+  return outfile
+
+def _parse_tally_suffix(suffix, sep=':'):
+  '''
+  Return the read count from the 'count_N' suffix of a reaper/tally
+  read ID, or None if the suffix does not match this format.
+  '''
+  tally = suffix.split('_')
+  if sep != ':' or ':' in suffix or len(tally) != 2 or tally[0] != 'count' \
+        or not tally[1].isdigit():
+    return None
+  return int(tally[1])
+
 class Bamfile(pysam.AlignmentFile):
 
   '''
@@ -64,68 +111,377 @@ class Bamfile(pysam.AlignmentFile):
     '''
     return os.path.exists("%s.bai" % self.filename)
 
-  def split_by_chromosome(self, pattern=None):
+  def is_coordinate_sorted(self):
+    '''
+    True if the bam header declares the file to be coordinate-sorted.
+    '''
+    return self.header.get('HD', {}).get('SO') == 'coordinate'
+
+  def chromosome_filename(self, refname):
+    '''
+    Return the name of the output file used by split_by_chromosome
+    for the given reference.
+    '''
+    return "%s_%s.bam" % (self.basename(), str(refname))
+
+  def split_by_chromosome(self, pattern=None, mode='serial', processes=None,
+                          max_open=SPLIT_MAX_OPEN, index=True):
     '''
     Split reads by chromosome, writing out new bam files to disk and
     returning new Bamfile objects. Takes an optional pattern argument
     to enable filtering, e.g. for those genomes with many small
-    scaffolds.
+    scaffolds. The mode argument selects how the file is read:
+
+      serial:   one indexed fetch per reference, in turn.
+      stream:   a single pass through the file, routing reads to
+                per-reference writers. For unsorted input, at most
+                max_open output files are held open at once; a
+                reference evicted from the set of open writers is
+                written in parts which are concatenated at the end.
+      parallel: indexed fetches of each reference, fanned out
+                across a pool of processes (default: one per CPU).
+
+    The serial and parallel modes create a .bai index for the input
+    file if it has none. Since only coordinate-sorted files can be
+    indexed, unsorted input is always split in stream mode. Unless
+    index is False, .bai index files are created for the outputs
+    (coordinate-sorted input only).
     '''
-    bamlist = []
     if pattern is not None:
-        pattern = re.compile(pattern)
-    for refname in self.references:
-      if pattern is not None:
-        if not pattern.match(refname):
+      pattern = re.compile(pattern)
+    refnames = [ refname for refname in self.references
+                 if pattern is None or pattern.match(refname) ]
+    outfiles = [ self.chromosome_filename(refname) for refname in refnames ]
+
+    if not self.is_coordinate_sorted():
+      if index:
+        LOGGER.warning("Bam file %s is not coordinate-sorted; output files"
+                       + " will not be indexed.", self.filename)
+        index = False
+      if mode in ('serial', 'parallel'):
+        LOGGER.info("Bam file %s cannot be indexed; splitting in stream mode.",
+                    self.filename)
+        mode = 'stream'
+
+    if mode == 'stream':
+      self._split_stream(refnames, outfiles, max_open)
+      if index:
+        for outfile in outfiles:
+          pysam.index(outfile)
+    elif mode in ('serial', 'parallel'):
+      if not self.has_index_file():
+        LOGGER.info("Indexing bam file %s...", self.filename)
+        pysam.index(self.filename)
+      if mode == 'parallel' and len(refnames) > 1:
+        if processes is None:
+          processes = multiprocessing.cpu_count()
+        processes = min(processes, len(refnames))
+        jobs = [ (self.filename, refname, outfile, index)
+                 for (refname, outfile) in zip(refnames, outfiles) ]
+        pool = multiprocessing.Pool(processes)
+        try:
+          pool.map(_split_reference_worker, jobs,
+                   chunksize=max(1, len(jobs) // (processes * 4)))
+        finally:
+          pool.close()
+          pool.join()
+      else:
+        # A fresh handle is needed to pick up any index created above.
+        bam = pysam.AlignmentFile(self.filename, 'rb')
+        try:
+          for (refname, outfile) in zip(refnames, outfiles):
+            _write_reference(bam, refname, outfile, index)
+        finally:
+          bam.close()
+    else:
+      raise ValueError("Unrecognised split mode: %s" % mode)
+
+    return [ Bamfile(filename=outfile) for outfile in outfiles ]
+
+  def _split_stream(self, refnames, outfiles, max_open):
+    '''
+    Write the reads for each of refnames to the corresponding outfiles
+    in a single pass through this file.
+    '''
+    wanted  = dict( (self.get_tid(refname), outfile)
+                    for (refname, outfile) in zip(refnames, outfiles) )
+    writers = OrderedDict() # tid -> open AlignmentFile, least recently used first.
+    if self.is_coordinate_sorted():
+      max_open = 1 # Each reference is finished when the next one starts.
+    parts   = dict( (tid, []) for tid in wanted )
+
+    LOGGER.info("Splitting bam file %s by reference in a single pass...",
+                self.filename)
+    self.reset()
+    try:
+      for read in self.fetch(until_eof=True):
+        tid = read.reference_id
+        if tid not in wanted:
           continue
-      LOGGER.info("Writing out reads for reference %s...", str(refname))
-      self.reset()
-      outfile = "%s_%s.bam" % (self.basename(), str(refname))
-      out = pysam.AlignmentFile(outfile, 'wb', header=self.header)
-      for read in self.fetch(reference=refname):
+        out = writers.pop(tid, None)
+        if out is None:
+          if len(writers) >= max_open:
+            (_oldtid, oldout) = writers.popitem(last=False)
+            oldout.close()
+          part = "%s.part%d" % (wanted[tid], len(parts[tid]) + 1)
+          parts[tid].append(part)
+          out = pysam.AlignmentFile(part, 'wb', header=self.header)
+        writers[tid] = out
         out.write(read)
-      out.reset()
-      bamlist.append(Bamfile(filename=outfile))
-      
-    return bamlist
+    finally:
+      for out in writers.itervalues():
+        out.close()
+
+    for (tid, outfile) in wanted.iteritems():
+      if len(parts[tid]) == 0:
+        pysam.AlignmentFile(outfile, 'wb', header=self.header).close()
+      elif len(parts[tid]) == 1:
+        os.rename(parts[tid][0], outfile)
+      else:
+        LOGGER.debug("Concatenating %d parts of %s", len(parts[tid]), outfile)
+        pysam.cat('-o', outfile, *parts[tid])
+        for part in parts[tid]:
+          os.unlink(part)
 
-  def expand_tallied_reads(self, outfile, keep_multi=False):
+  def expand_tallied_reads(self, outfile, keep_multi=False, threads=1,
+                           count_tag=None):
     '''
     Expand a bam file containing reaper/tally output, using the format
     from the Odom Lab sequencing pipeline, into a bam file in which
     all reads are represented by their own individual records. If the
     keep_multi flag is set as True, multi-mapping reads will be kept.
     Note that this can be misleading as multi-mapping reads are no
-    longer distributed randomly between mapped loci.
+    longer distributed randomly between mapped loci. The threads
+    argument sets the number of BGZF compression threads used to
+    write the output. If count_tag is set (e.g. 'XC'), records are not
+    duplicated; instead the tally count is stored in the given
+    integer tag of each record, for downstream tools which accept
+    weighted reads.
     '''
     LOGGER.info("Expanding tallied bam file %s", self.filename)
     self.reset()
-    out = pysam.AlignmentFile(outfile, 'wb', header=self.header)
-    for read in self.fetch(until_eof=True): # All reads in file, in order.
-
-      # If mapping_quality is zero, we assume this means it's
-      # multi-mapping (this is the bwa default).
-      if not keep_multi and read.mapping_quality == 0:
-        continue
-      readparts = read.query_name.split(':')
-      if len(readparts) == 2:
-        tally = readparts[1].split('_')
-        if len(tally) == 2 and tally[0] == 'count':
-          count = int(tally[1])
+    out = pysam.AlignmentFile(outfile, 'wb', header=self.header, threads=threads)
+    counts  = {} # Cache of parsed 'count_N' suffixes; these recur heavily.
+    nreads  = 0
+    written = 0
+    try:
+      for read in self.fetch(until_eof=True): # All reads in file, in order.
+
+        # If mapping_quality is zero, we assume this means it's
+        # multi-mapping (this is the bwa default).
+        if not keep_multi and read.mapping_quality == 0:
+          continue
+        nreads += 1
+        (base_name, sep, suffix) = read.query_name.partition(':')
+        count = counts.get(suffix)
+        if count is None:
+          count = _parse_tally_suffix(suffix, sep)
+          if count is None:
+            raise StandardError(\
+              "Found read ID not matching expected tally output format: %s" % read.query_name)
+          counts[suffix] = count
+
+        if count_tag is not None:
+          read.set_tag(count_tag, count, 'i')
+          out.write(read)
+          written += 1
         else:
-          raise StandardError(\
-            "Found read ID not matching expected tally output format: %s" % read.query_name)
-      else:
-        raise StandardError(\
-          "Found read ID not matching expected tally output format: %s" % read.query_name)
-      base_name = readparts[0] + ':read_'
-      for n in range(count):
-        read.query_name = base_name + str(n+1)
-        out.write(read)
+          base_name += ':read_'
+          for n in xrange(1, count + 1):
+            read.query_name = base_name + str(n)
+            out.write(read)
+          written += count
+    finally:
+      out.close()
 
-    out.close()
+    LOGGER.info("Wrote %d records for %d tallied reads to %s",
+                written, nreads, outfile)
     return Bamfile(filename=outfile)
 
+class PysamBamToBedConverter(BamToBedConverter):
+
+  '''
+  BamToBedConverter which reads alignments directly via pysam rather
+  than parsing samtools view output, using the threads argument to
+  enable multithreaded BGZF decompression. Output is identical to
+  that of the parent class (including the tc1 chr21 split and the
+  removal of overhanging reads).
+  '''
+
+  __slots__ = ('threads',)
+
+  def __init__(self, tc1=False, chrom_sizes=None, threads=4):
+    super(PysamBamToBedConverter, self).__init__(tc1=tc1,
+                                                 chrom_sizes=chrom_sizes)
+    self.threads = threads
+
+  def _iter_alignments(self, in_fn):
+    bam = pysam.AlignmentFile(in_fn, 'rb', threads=self.threads)
+    try:
+      for read in bam.fetch(until_eof=True):
+
+        # samtools view prints '*' for a missing SEQ field, which the
+        # samtools-based converter counts as a length of one.
+        yield (read.flag, read.reference_name, read.reference_start,
+               read.query_name, read.mapping_quality, read.query_length or 1)
+    finally:
+      bam.close()
+
+class BamStats(object):
+
+  '''
+  Summary read counts and @PG header information for a bam file,
+  gathered in a single pass over the file. The counts follow samtools
+  flagstat conventions for QC-passed reads: records flagged as
+  failing QC (0x200) are counted only in qcfail, and excluded from
+  all the other counts. Total includes secondary and supplementary
+  records; the paired, read1, read2 and properly_paired counts
+  include primary records only. Uniquely mapped reads are mapped
+  primary records with non-zero mapping quality (the bwa convention
+  for multi-mapping reads). Where a .bai index is present the mapped
+  and unmapped totals are taken from it, less any QC-failed records.
+
+  Use BamStats.for_file() to take advantage of the cache file stored
+  alongside the bam (<bam>.stats), which is discarded automatically
+  if the bam file size or modification time changes.
+  '''
+
+  __slots__ = ('total', 'secondary', 'supplementary', 'mapped', 'unmapped',
+               'unique', 'paired', 'read1', 'read2', 'properly_paired',
+               'qcfail', 'programs')
+
+  COUNTS = ('total', 'secondary', 'supplementary', 'mapped', 'unmapped',
+            'unique', 'paired', 'read1', 'read2', 'properly_paired',
+            'qcfail')
+
+  def __init__(self, **kwargs):
+    for key in self.COUNTS:
+      setattr(self, key, kwargs.get(key, 0))
+    self.programs = kwargs.get('programs', [])
+
+  @property
+  def primary(self):
+    '''
+    The number of primary alignment records.
+    '''
+    return self.total - self.secondary - self.supplementary
+
+  @property
+  def read_count(self):
+    '''
+    The number of QC-passed reads in the file, discarding
+    supplementary alignments (introduced by bwa mem and other more
+    recent alignment algorithms). This is the number returned by
+    osqutil.samtools.count_bam_reads.
+    '''
+    return self.total - self.supplementary
+
+  def bwa_algorithm(self):
+    '''
+    Identify whether bwa aln or bwa mem was used, based on the first
+    @PG header line with a command line (as
+    osqutil.samtools.identify_bwa_algorithm).
+    '''
+    for program in self.programs:
+      if 'CL' in program:
+        return bwa_algorithm_from_command(program['CL'])
+    return 'aln'
+
+  @classmethod
+  def from_bam(cls, filename, threads=2):
+    '''
+    Gather statistics for a bam file by reading it once.
+    '''
+    LOGGER.info("Gathering read statistics for bam file %s", filename)
+    stats = cls()
+    with Bamfile(filename=filename, threads=threads) as bam:
+      stats.programs = [ dict(prog) for prog in bam.header.get('PG', []) ]
+
+      use_index = bam.has_index_file()
+      if use_index:
+        stats.mapped   = bam.mapped
+        stats.unmapped = bam.unmapped
+
+      for read in bam.fetch(until_eof=True):
+        flag = read.flag
+        if flag & 0x200:
+          stats.qcfail += 1
+          if use_index:
+            if flag & 0x4:
+              stats.unmapped -= 1
+            else:
+              stats.mapped -= 1
+          continue
+        stats.total += 1
+        if not use_index:
+          if flag & 0x4:
+            stats.unmapped += 1
+          else:
+            stats.mapped += 1
+        if flag & 0x100:
+          stats.secondary += 1
+          continue
+        if flag & 0x800:
+          stats.supplementary += 1
+          continue
+        if not flag & 0x4 and read.mapping_quality > 0:
+          stats.unique += 1
+        if flag & 0x1:
+          stats.paired += 1
+          if flag & 0x40:
+            stats.read1 += 1
+          if flag & 0x80:
+            stats.read2 += 1
+          if flag & 0x2 and not flag & 0x4:
+            stats.properly_paired += 1
+
+    return stats
+
+  @classmethod
+  def for_file(cls, filename, cache=True, threads=2):
+    '''
+    Return the statistics for a bam file, reading them from the
+    <bam>.stats cache file if it is still valid. Otherwise the bam is
+    read and (if cache is True) the cache file rewritten.
+    '''
+    cachefile = "%s.stats" % filename
+    fstat     = os.stat(filename)
+    if cache and os.path.exists(cachefile):
+      try:
+        with open(cachefile) as cachefd:
+          data = json.load(cachefd)
+        if (data['size'], data['mtime']) == (fstat.st_size, fstat.st_mtime) \
+              and all([ key in data['stats'] for key in cls.COUNTS ]):
+          LOGGER.debug("Using cached bam statistics from %s", cachefile)
+          return cls(**dict( (str(key), value) for (key, value)
+                             in data['stats'].iteritems() ))
+        LOGGER.info("Discarding out-of-date bam statistics file %s", cachefile)
+      except (ValueError, KeyError, TypeError), err:
+        LOGGER.warning("Unable to read bam statistics file %s: %s",
+                       cachefile, err)
+
+    stats = cls.from_bam(filename, threads=threads)
+
+    if cache:
+      try:
+        with open(cachefile, 'w') as cachefd:
+          json.dump({ 'size'  : fstat.st_size,
+                      'mtime' : fstat.st_mtime,
+                      'stats' : stats.as_dict() }, cachefd)
+      except IOError, err:
+        LOGGER.warning("Unable to write bam statistics file %s: %s",
+                       cachefile, err)
+
+    return stats
+
+  def as_dict(self):
+    '''
+    Return the statistics as a simple dict.
+    '''
+    data = dict( (key, getattr(self, key)) for key in self.COUNTS )
+    data['programs'] = self.programs
+    return data
+
 @contextmanager
 def open_bamfile(filename, index=True, *args, **kwargs):
   '''
@@ -146,5 +502,5 @@ if __name__ == '__main__':
   # This is purely here as test code; do not use this as a production script!
   import sys
   with open_bamfile(filename=sys.argv[1]) as bam:
-    bam.split_by_chromosome()
+    bam.split_by_chromosome(mode='stream', index=True)
   
@@ -31,15 +31,16 @@ import stat
 import grp
 from pipes import quote
 from distutils import spawn
-from socket import getfqdn, socket, AF_UNIX, SOCK_STREAM, gethostname
+from socket import getfqdn, gethostname
 from getpass import getuser
-from tempfile import NamedTemporaryFile
 
 from osqutil.utilities import bash_quote, sanitize_samplename, \
   BamPostProcessor
 from osqutil.progsum import ProgramSummary
 from osqutil.cluster import make_bam_name_without_extension, \
   ClusterJobRunner, ClusterJobSubmitter, DesktopJobSubmitter
+from osqutil.jobtracker import ClusterJobTracker, ClusterJobError, DONE
+from osqutil.sshpool import remote_multiplex_options
 from osqutil.config import Config
 
 from osqutil.setup_logs import configure_logging
@@ -805,7 +806,11 @@ class ClusterJobManager(object):
     '''
     myhost = getfqdn()
     myuser = getuser()
-    sshcmd = "scp"
+
+    # The scp and touch calls (and those of any other jobs returning
+    # files from the same cluster node) share one ssh connection.
+    sshopts = remote_multiplex_options()
+    sshcmd = "scp %s" % sshopts
 
     # Transferring the files back to localhost requires an appropriate
     # passwordless ssh key to be given access on our localhost. The
@@ -823,7 +828,7 @@ class ClusterJobManager(object):
                + bash_quote(bash_quote(self.local_workdir + r'/%s' % outfile)) + r'\"')
 
     if donefile:
-      sshcmd += " && ssh"
+      sshcmd += " && ssh %s" % sshopts
       if self.ssh_key is not None:
         sshcmd += " -i %s" % self.ssh_key
       sshcmd += (r' %s@%s touch ' % (myuser, myhost)
@@ -835,51 +840,31 @@ class ClusterJobManager(object):
 
     return sshcmd
 
-  def wait_on_cluster(self, jobs, cleanup_cmd=None):
+  def wait_on_cluster(self, jobs, cleanup_cmd=None, interval=None, timeout=None):
     '''
-    Wait for the alignment jobs running on the cluster to contact a
-    designated socket file location to indicate that the jobs have
-    finished.
+    Wait for the jobs running on the cluster to finish, polling the
+    scheduler for their state. The optional cleanup_cmd is submitted
+    to the cluster once the jobs have finished, whether or not they
+    succeeded. Returns a dict of JobStatus objects keyed by job
+    ID. Raises ClusterJobError if any job did not complete
+    successfully, or on timeout (interval and timeout are in seconds,
+    defaulting to the cluster_poll_interval and cluster_wait_timeout
+    config options).
     '''
-    # Set up a job to notify localhost that the cluster is finished.
-    with NamedTemporaryFile() as sobj:
-      socketfile = sobj.name
-
-    # The nc utility is pretty commonly installed; if it is not, this
-    # will not work.
-    LOGGER.info("Submitting monitor job to the cluster.")
-    cmd = "ssh"
-    if self.ssh_key is not None:
-      cmd += " -i %s" % self.ssh_key
-    cmd += (" %s@%s 'echo OK | nc -U %s'"
-            % (getuser(), getfqdn(), socketfile))
-    monjob = self.submitter.submit_command(cmd, depend_jobs=jobs,
-                                         auto_requeue=False)
+    tracker  = ClusterJobTracker(self.runner, interval=interval, timeout=timeout)
+    statuses = tracker.wait(jobs)
 
     # Optional clean-up job, typically used to delete temporary files.
     if cleanup_cmd is not None:
       LOGGER.info("Submitting clean-up job to the cluster.")
-      self.submitter.submit_command(cleanup_cmd,
-                                    depend_jobs=[monjob],
-                                    auto_requeue=False)
-
-    # Set up a socket server and wait for the cluster to get back to us.
-    LOGGER.info("Waiting on a reply from the cluster...")
-    sock = socket(AF_UNIX, SOCK_STREAM)
-    sock.bind(socketfile)
-    sock.listen(1)
-    (conn, _addr) = sock.accept()
-
-    message = ''
-    while 1:
-      data = conn.recv(1024)
-      if not data:
-        break
-      message += data
-    conn.close()
-    os.unlink(socketfile)
-
-    LOGGER.info("Cluster reply received: %s", message)
-
-    return
+      self.submitter.submit_command(cleanup_cmd, auto_requeue=False)
+
+    failed = [ str(jobid) for (jobid, status) in sorted(statuses.iteritems())
+               if status.state != DONE ]
+    if failed:
+      raise ClusterJobError("Cluster jobs did not complete successfully: %s"
+                            % ", ".join(failed))
+    LOGGER.info("All cluster jobs completed successfully.")
+
+    return statuses
 
@@ -24,10 +24,13 @@ import sys
 import os
 import os.path
 import re
+import time
+from multiprocessing.pool import ThreadPool
 
 from osqutil.utilities import build_incoming_fastq_name, unzip_file, \
-    set_file_permissions, checksum_file
+    set_file_permissions
 from .upstream_lims import Lims
+from .lims_client import get_lims_client
 from ..models import Library, Lane
 from osqutil.config import Config
 
@@ -42,9 +45,11 @@ class FQFileFetcher(object):
   '''Class used to query the LIMS for fastq files associated with a
   given flowcell and download them to a destination directory.'''
 
-  __slots__ = ('destination', 'lims', 'targets', 'test_mode', 'conf', 'unprocessed_only','force_download')
+  __slots__ = ('destination', 'lims', 'targets', 'test_mode', 'conf', 'unprocessed_only','force_download',
+               'threads')
 
-  def __init__(self, destination, lims=None, test_mode=False, unprocessed_only=False, force_download=False):
+  def __init__(self, destination, lims=None, test_mode=False, unprocessed_only=False, force_download=False,
+               threads=None):
 
     self.conf        = Config()
     self.test_mode   = test_mode
@@ -52,6 +57,9 @@ class FQFileFetcher(object):
     self.destination = destination
     self.force_download = force_download
     self.targets = set()    
+    if threads is None:
+      threads = get_lims_client().threads
+    self.threads = threads
     if lims is None:
       lims = Lims()
     if not lims.running():
@@ -73,6 +81,16 @@ class FQFileFetcher(object):
       LOGGER.error("Destination '%s' does not exist.", self.destination)
       return
 
+    target = self._download_target(lfile, libname)
+    if target is not None:
+      self._download_fqfile((lfile, target))
+
+  def _download_target(self, lfile, libname):
+    '''
+    Return the local file name to which a LimsFile object should be
+    downloaded, or None if it should be skipped.
+    '''
+
     filename = lfile.uri.split('/')[-1]
     LOGGER.info("LIMS File: %s", filename)
 
@@ -155,39 +173,76 @@ class FQFileFetcher(object):
     if os.path.exists(target):
       raise StandardError("Download location '%s' exists. Cannot overwrite." % target)
 
+    return target
+
+  def _download_fqfile(self, job):
+    '''
+    Download a single (LimsFile, target) job, verifying the MD5
+    checksum against that given by the LIMS as the file is
+    written. Returns the size of the downloaded file.
+    '''
+    (lfile, target) = job
+
     # We download these over http now.
     LOGGER.debug("Downloading LIMS file ID %s to %s", lfile.lims_id, target)
     if not self.test_mode:
 
       # This is actually the preferred download mechanism.
       try:
-        self.lims.get_file_by_uri(lfile.uri, target)
+        self.lims.get_file_by_uri(lfile.uri, target, md5sum=lfile.md5sum)
 
       # Fall back to download via LIMS API, if supported.
       except Exception, err:
         if lfile.lims_id is not None:
-          self.lims.get_file_by_id(lfile.lims_id, target)
+          self.lims.get_file_by_id(lfile.lims_id, target, md5sum=lfile.md5sum)
         else:
           raise err
 
       set_file_permissions(self.conf.group, target)
 
     if not os.path.exists(target) and not self.test_mode:
-      LOGGER.error("Failed to retrieve file '%s'", dst)
-    else:
-
-      # Compare the md5sum against those available in upstream LIMS.
-      if not self.test_mode and lfile.md5sum is not None:
-        md5 = checksum_file(target, unzip=False)
-        if md5 != lfile.md5sum:
-          raise StandardError("File md5sum (%s) disagrees with upstream LIMS (%s): %s"
-                              % (md5, lfile.md5sum, target))
+      LOGGER.error("Failed to retrieve file '%s'", os.path.basename(target))
+      return 0
 
     # Files are typically still compressed at this stage. This should
     # be handled seamlessly by downstream code.
     self.targets.add(target)
     LOGGER.info("Downloaded file to %s", target)
 
+    return os.path.getsize(target) if os.path.exists(target) else 0
+
+  def _download_fqfiles(self, lfiles, libname, label):
+    '''
+    Download a list of LimsFile objects for a given library name
+    concurrently, reporting the overall throughput for the lane.
+    '''
+    jobs = [ (lfile, self._download_target(lfile, libname)) for lfile in lfiles ]
+    jobs = [ job for job in jobs if job[1] is not None ]
+    if len(jobs) == 0:
+      return
+
+    # Several LIMS files may map to the same target (e.g. r_3 and r_4
+    # both become flowpair 2). Downloaded one at a time, the second
+    # would find the first in place; concurrently, both would write
+    # the same file, so we refuse before starting.
+    seen = set()
+    for (_lfile, target) in jobs:
+      if target in seen:
+        raise StandardError("Download location '%s' exists. Cannot overwrite." % target)
+      seen.add(target)
+
+    start = time.time()
+    pool  = ThreadPool(max(1, min(self.threads, len(jobs))))
+    try:
+      sizes = pool.map(self._download_fqfile, jobs)
+    finally:
+      pool.close()
+      pool.join()
+    elapsed = time.time() - start
+
+    LOGGER.info("Lane %s: downloaded %d files (%.1f MB) in %.1f seconds (%.1f MB/s).",
+                label, len(jobs), sum(sizes) / 1e6, elapsed,
+                sum(sizes) / 1e6 / max(elapsed, 1e-3))
 
   def retrieve_fqfiles(self, lane, libname):
     '''Given a Lane object and a library name, retrieve fastq files
@@ -228,8 +283,8 @@ class FQFileFetcher(object):
         if len(files) == 0:
           LOGGER.info("No Demultiplexed FASTQ files to retrieve for %s_%s",
                       lane.flowcell.fcid, libname)
-        for lfile in files:
-          self.retrieve_fqfile(lfile, libname)
+        self._download_fqfiles(files, libname,
+                               "%s_%d/%s" % (lane.flowcell.fcid, lane.lane, libname))
 
     else:
 
@@ -248,8 +303,8 @@ class FQFileFetcher(object):
       if len(files) == 0:
         LOGGER.info("No Lane FASTQ files to retrieve for %s_%d",
                     lane.flowcell.fcid, lane.lane)
-      for lfile in files:
-        self.retrieve_fqfile(lfile, libname)
+      self._download_fqfiles(files, libname,
+                             "%s_%d" % (lane.flowcell.fcid, lane.lane))
 
     return
 
@@ -27,11 +27,15 @@ import os.path
 import re
 from datetime import date
 from shutil import move
-from tempfile import mkstemp
+from tempfile import mkstemp, TemporaryFile
+from subprocess import Popen, STDOUT, CalledProcessError
+import time
 
 from osqutil.utilities import parse_incoming_fastq_name, call_subprocess, \
     checksum_file, parse_repository_filename, is_zipped, rezip_file, unzip_file, \
-    set_file_permissions, get_filename_libcode, bash_quote, transfer_file, dostring_to_dorange
+    set_file_permissions, get_filename_libcode, bash_quote, transfer_file, dostring_to_dorange, \
+    determine_readlength
+from osqutil.fastq_profile import profile_fastq
 from osqutil.config import Config
 from ..models import Filetype, Library, Lane, Lanefile, Facility, \
     Status, LibraryNameMap, Machine
@@ -96,21 +100,7 @@ def get_fastq_readlength(fobj):
   '''
   Figure out the read length from the passed models.LaneFile object.
   '''
-  if fobj.filetype.gzip:
-    from gzip import GzipFile
-    gen = lambda x: GzipFile(x)
-  else:
-    gen = lambda x: open(x)
-
-  # Currently just assumes that the second line is the first read, and
-  # that it is representative.
-  rlen = None
-  with gen(fobj.repository_file_path) as reader:
-    for _num in range(2):
-      line = reader.next()
-    rlen = len(line.rstrip('\n'))
-
-  return rlen
+  return determine_readlength(fobj.repository_file_path)
 
 def stem_filename(fname):
   '''
@@ -375,6 +365,9 @@ class GenericFileProcessor(object):
     '''
     Retrieve some lane metadata directly from the fastq file.
     '''
+    if flag == '-f':
+      return self.collect_fastq_info()
+
     # Newer versions of summarizeFile now optionally read from stdin
     # to allow us to read a gzipped fastq.
     cmd = ['summarizeFile']
@@ -434,6 +427,44 @@ class GenericFileProcessor(object):
     self.lane.seqsamplepf = "\n".join(goodreads[1:100])
     self.lane.seqsamplebad = "\n".join(badreads[1:100])
 
+  def collect_fastq_info(self):
+    '''
+    Retrieve lane metadata from the fastq file in a single streaming
+    pass, also filling in the lane read length.
+    '''
+    if self.test_mode:
+      return
+    try:
+      processes = int(CONFIG.fastq_profile_processes)
+    except AttributeError, _err:
+      processes = 1
+    profile = profile_fastq(self.files[0], processes=processes)
+    if profile.reads == 0:
+      LOGGER.warning("%s: no data", self.files[0])
+      self.collect_info_empty()
+      return
+
+    self.lane.reads      = profile.reads
+    self.lane.passedpf   = profile.passedpf
+    self.lane.readlength = profile.readlength
+    for keyword in ('qualmean','qualstdev','qualmeanpf','qualstdevpf'):
+      setattr(self.lane, keyword, getattr(profile, keyword))
+    LOGGER.info("%s: %d reads, estimated duplicate rate %.3f",
+                self.files[0], profile.reads, profile.duplicate_rate)
+
+    # As with summarizeFile, the fastq header is authoritative; the
+    # LIMS run folder is only used when the header carries no run.
+    if profile.runnumber is not None:
+      self.lane.runnumber = profile.runnumber
+    elif self.lims_fc is not None and self.lims_fc.run_number is not None:
+      self.lane.runnumber = self.lims_fc.run_number
+    if self.lane.runnumber is None:
+      LOGGER.error("No runnumber information parsed from file header.")
+      raise(Exception("Problem collecting information from file."))
+
+    self.lane.seqsamplepf  = "\n".join(profile.goodreads)
+    self.lane.seqsamplebad = "\n".join(profile.badreads)
+
   def collect_lims_info(self):
     '''
     Retrieve lane metadata from our upstream LIMS.
@@ -637,8 +668,9 @@ class GenericFileProcessor(object):
         # note that transfer_file exists should the the transfer fail, hence unlinking the file should be safe.
         os.unlink(disk_fname)
 
-        # Get the read length directly from the fastq file.
-        if fobj.filetype.code == 'fq':
+        # Get the read length directly from the fastq file, unless
+        # already found by collect_fastq_info.
+        if fobj.filetype.code == 'fq' and self.lane.readlength is None:
           try:
             self.lane.readlength = get_fastq_readlength(fobj)
           except IOError:       # no file.
@@ -962,20 +994,18 @@ class MiRFastqFileProc(GenericFileProcessor):
     '''
     return os.path.basename(stem_filename(fname)[0])
   
-  def trim_linkers(self, fname):
+  def _reaper_command(self, fname, base):
     '''
-    Remove linker sequences from the fastq file.
+    Build the reaper command used to remove linker sequences from the
+    fastq file. The output is written to <base>.lane.clean.
     '''
     # With the TruSeq kit we use, this should never be the case.
     assert self.library.linkerset is not None
-    
-    base    = self._derive_fastq_basename(fname)
-    outfile = base + '_scr.fa'
 
     # Read lengths of 50bp combined with an expected small RNA length
     # of 20bp and a cut-down 3' adapter sequence of 25bp implies we
     # would need a -3p-prefix offset of at least 5.
-    cmd = ('reaper',
+    return ('reaper',
 
            # Input formats and adapter sequences:
            '-i', fname, '-geom', 'no-bc',
@@ -998,7 +1028,15 @@ class MiRFastqFileProc(GenericFileProcessor):
            # Output format:
            '--nozip', '--noqc',
            '-format-clean', '>i%I_l%L_t%T%n%C%n')
-    
+
+  def trim_linkers(self, fname):
+    '''
+    Remove linker sequences from the fastq file.
+    '''
+    base    = self._derive_fastq_basename(fname)
+    outfile = base + '_scr.fa'
+    cmd     = self._reaper_command(fname, base)
+
     LOGGER.info("Running reaper on %s", fname)
     LOGGER.debug(" ".join(cmd))
     if not self.test_mode:
@@ -1007,6 +1045,19 @@ class MiRFastqFileProc(GenericFileProcessor):
     self.tempfiles.append("%s.lint" % base)
     return outfile
 
+  def _tally_command(self, fname, clust_fn):
+    '''
+    Build the (shell) tally command used to count exact matches in
+    the reaper output, discarding low-complexity reads.
+    '''
+    # tally seems to want to compress the outputs even when we don't
+    # want it to. FIXME at some point (note that using '-' to indicate
+    # STDOUT is also an undocumented tally feature, as far as I can
+    # tell). FIXME we may want to remove %L and %T; see whether
+    # Nenad's analysis pipeline uses either of them downstream.
+    return ('tally -o - -tri 35 -format ">smRNA_%I:count_%C length=%L;trinuc=%T%n%R%n" --fasta-in'
+            + ' -i %s | gzip -dc > %s' % (bash_quote(fname), bash_quote(clust_fn)))
+
   def cluster_exact_matches(self, fname, base=None):
     '''
     Run the tally binary to count exact matches and store reads with
@@ -1014,22 +1065,70 @@ class MiRFastqFileProc(GenericFileProcessor):
     '''
     if base is None:
       base = self._derive_fastq_basename(fname)
-      
-    clust_fn = base + ".fa"
 
-    # tally seems to want to compress the outputs even when we don't
-    # want it to. FIXME at some point (note that using '-' to indicate
-    # STDOUT is also an undocumented tally feature, as far as I can
-    # tell). FIXME we may want to remove %L and %T; see whether
-    # Nenad's analysis pipeline uses either of them downstream.
-    cmd = ('tally -o - -tri 35 -format ">smRNA_%I:count_%C length=%L;trinuc=%T%n%R%n" --fasta-in'
-           + ' -i %s | gzip -dc > %s' % (bash_quote(fname), clust_fn))
+    clust_fn = base + ".fa"
+    cmd = self._tally_command(fname, clust_fn)
     LOGGER.info("Running tally on %s", fname)
-    LOGGER.debug(" ".join(cmd))
+    LOGGER.debug(cmd)
     if not self.test_mode:
       call_subprocess(cmd, path=CONFIG.hostpath, shell=True)
     return clust_fn
 
+  def trim_and_cluster(self, fname, base=None):
+    '''
+    Remove linker sequences using reaper and count exact matches
+    using tally, in a single streaming pass. Reaper writes its output
+    to a named pipe which is read directly by tally, so no
+    intermediate fasta file is written.
+    '''
+    reaper_base = self._derive_fastq_basename(fname)
+    if base is None:
+      base = reaper_base
+    clust_fn = base + ".fa"
+    cmd      = self._reaper_command(fname, reaper_base)
+    fifo     = "%s.lane.clean" % reaper_base
+    tallycmd = self._tally_command(fifo, clust_fn)
+
+    LOGGER.info("Running reaper and tally on %s, collapsing exact matches into %s",
+                fname, clust_fn)
+    LOGGER.debug(" ".join(cmd))
+    LOGGER.debug(tallycmd)
+    self.tempfiles.append("%s.lint" % reaper_base)
+    if self.test_mode:
+      return clust_fn
+
+    if os.path.exists(fifo):
+      os.unlink(fifo)
+    os.mkfifo(fifo)
+    try:
+      with TemporaryFile() as errfd:
+        env   = dict(os.environ, PATH=CONFIG.hostpath)
+        tally = Popen(tallycmd, shell=True, stdout=errfd, stderr=STDOUT, env=env)
+        proc  = Popen(cmd, stdout=errfd, stderr=STDOUT, env=env)
+        proc.wait()
+
+        # If reaper fails before opening its output, we open the pipe
+        # for writing ourselves so that tally sees EOF rather than
+        # blocking forever. The open fails until tally is waiting,
+        # hence the retry loop.
+        while tally.poll() is None:
+          try:
+            os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+            break
+          except OSError, _err:
+            time.sleep(0.1)
+        tally.wait()
+
+        for (prog, command) in ((proc, " ".join(cmd)), (tally, tallycmd)):
+          if prog.returncode != 0:
+            errfd.seek(0)
+            LOGGER.error("reaper/tally output:\n%s", errfd.read())
+            raise CalledProcessError(prog.returncode, command)
+    finally:
+      os.unlink(fifo)
+
+    return clust_fn
+
   def post_process(self):
     '''
     Convert to phred QC scoring if required, collect metadata, strip
@@ -1045,12 +1144,9 @@ class MiRFastqFileProc(GenericFileProcessor):
     for fname in self.files:
       self.outfiles.append(fname)
       self.strip_bar_code(fname)
-      screened_fn = self.trim_linkers(fname)
-      cluster_fn = self.cluster_exact_matches(screened_fn,
-                                              self._derive_fastq_basename(fname))
+      cluster_fn = self.trim_and_cluster(fname)
       self.kick_off_alignment([cluster_fn])
       self.outfiles.append(cluster_fn)
-      self.tempfiles.append(screened_fn)
     return Status.objects.get(code='complete', authority=None)
 
 ###############################################################################
@@ -1085,11 +1181,9 @@ class MiRExportFileProc(MiRFastqFileProc):
       fastq_fn = self.export2fastq(fname)
       self.outfiles.append(fastq_fn)
       self.strip_bar_code(fastq_fn)
-      screened_fn = self.trim_linkers(fastq_fn)
-      cluster_fn = self.cluster_exact_matches(screened_fn,
-                                              stem_filename(fname)[0])
+      cluster_fn = self.trim_and_cluster(fastq_fn, stem_filename(fname)[0])
       self.outfiles.append(cluster_fn)
-      self.tempfiles.extend([screened_fn, fname])
+      self.tempfiles.append(fname)
     return Status.objects.get(code='complete', authority=None)
 
 ###############################################################################
@@ -1110,11 +1204,9 @@ class MiRQseqFileProc(MiRExportFileProc):
       fastq_fn = self.export2fastq(fname, '-q')
       self.outfiles.append(fastq_fn)
       self.strip_bar_code(fastq_fn)
-      screened_fn = self.trim_linkers(fastq_fn)
-      cluster_fn = \
-          self.cluster_exact_matches(screened_fn, stem_filename(fname)[0])
+      cluster_fn = self.trim_and_cluster(fastq_fn, stem_filename(fname)[0])
       self.outfiles.append(cluster_fn)
-      self.tempfiles.extend([screened_fn, fname])
+      self.tempfiles.append(fname)
     return Status.objects.get(code='complete', authority=None)
 
 ###############################################################################
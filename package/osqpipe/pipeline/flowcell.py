@@ -31,6 +31,7 @@ from osqutil.utilities import checksum_file, \
     munge_cruk_emails, unzip_file, rezip_file, is_zipped
 from .upstream_lims import Lims
 from osqutil.config import Config
+from osqutil.demux import BarcodeDemultiplexer
 from ..models import Library, Lane, Status, LibraryNameMap, User, Adapter, Facility, Machine
 
 from osqpipe.pipeline.smtp import send_email
@@ -41,6 +42,10 @@ from osqutil.setup_logs import configure_logging
 from logging import INFO, DEBUG
 LOGGER = configure_logging('flowcell')
 
+# Pass this as demux_prog to use the internal streaming demultiplexer
+# in place of an external program.
+INTERNAL_DEMUX = 'internal'
+
 ###############################################################################
 
 def demux_code(code):
@@ -94,18 +99,18 @@ class FlowCellProcess(object):
     else:
       LOGGER.setLevel(INFO)
 
-  def make_sample_sheet(self, libs, fname):
+  def _demux_outputs(self, libs, fname, suffix=''):
 
-    '''Given a dict of adapters (library code keys, adapter sequence
-    values) and the source fastq filename, write out a sample sheet
-    suitable for use with demuxIllumina.'''
+    '''Given a list of library codes and the source fastq filename,
+    return a dict of adapter sequence keys and demultiplexed output
+    filename values, registering the output files against each
+    library code.'''
 
+    # The internal demultiplexer reads gzipped files directly.
     (_limscodes, flowcell, flowlane, flowpair) = \
-        parse_incoming_fastq_name(fname)
-
-    sample_fn = "sampleSheet_%d.txt" % (os.getpid(),)
-    fdesc = open(sample_fn, 'w')
+        parse_incoming_fastq_name(os.path.basename(fname), ext=r'\.fq(\.gz)?')
 
+    outputs = {}
     for code in libs:
       try:
         lib = Library.objects.get(code=code)
@@ -114,18 +119,33 @@ class FlowCellProcess(object):
                             % code)
       if not lib.adapter:
         raise StandardError("Library has no adapter associated: %s." % code)
-      fname = build_incoming_fastq_name(code.lower(), flowcell,
-                                        flowlane, flowpair)
-      fdesc.write("%s %s\n" % (lib.adapter.sequence, fname))
+      outfn = build_incoming_fastq_name(code.lower(), flowcell,
+                                        flowlane, flowpair) + suffix
+      outputs[lib.adapter.sequence] = outfn
       if code not in self._demux_files:
         self._demux_files[code] = set()
-      self._demux_files[code].add(fname)
+      self._demux_files[code].add(outfn)
+
+    return outputs
+
+  def make_sample_sheet(self, libs, fname):
+
+    '''Given a list of library codes and the source fastq filename,
+    write out a sample sheet suitable for use with demuxIllumina.'''
+
+    sample_fn = "sampleSheet_%d.txt" % (os.getpid(),)
+    with open(sample_fn, 'w') as fdesc:
+      for (adapter, outfn) in self._demux_outputs(libs, fname).iteritems():
+        fdesc.write("%s %s\n" % (adapter, outfn))
 
-    fdesc.close()
     return sample_fn
 
   def demultiplex(self, codes, fname):
-    '''Actually run the demultiplexing, using demuxIllumina.'''
+    '''Actually run the demultiplexing, using either demuxIllumina or
+    the internal streaming demultiplexer.'''
+
+    if self.demux_prog == INTERNAL_DEMUX:
+      return self._demultiplex_internal(codes, fname)
 
     # look up adapters from database,
     # write sampleSheet file
@@ -154,6 +174,32 @@ class FlowCellProcess(object):
     # Delete the sample sheet.
     os.unlink(sheet)
 
+  def _demultiplex_internal(self, codes, fname):
+    '''Demultiplex a (possibly gzipped) fastq file in a single
+    streaming pass, writing gzipped output files directly. As with
+    demuxIllumina -d, barcodes are read from the read headers, so the
+    two files of a pair are split consistently. Unassigned reads are
+    kept in a separate "unmatched" file.'''
+
+    try:
+      mismatches = int(self.conf.demux_mismatches)
+    except AttributeError, _err:
+      mismatches = 1
+
+    outputs   = self._demux_outputs(codes, fname, suffix=self.conf.gzsuffix)
+    (_limscodes, flowcell, flowlane, flowpair) = \
+        parse_incoming_fastq_name(os.path.basename(fname), ext=r'\.fq(\.gz)?')
+    unmatched = build_incoming_fastq_name('unmatched', flowcell,
+                                          flowlane, flowpair) + self.conf.gzsuffix
+    demux   = BarcodeDemultiplexer(outputs, unmatched=unmatched,
+                                   max_mismatches=mismatches,
+                                   fmt='fastq', location='header', compress=True)
+    counts  = demux.run(fname)
+    LOGGER.info("lost %d reads (written to %s)", counts['unmatched'], unmatched)
+
+    for outfn in outputs.values() + [ unmatched ]:
+      set_file_permissions(self.conf.group, outfn)
+
   def run(self, run, flowlane=None, fcq=None, destdir=None):
     '''The main entry point for the class.'''
     multiplexed = {}
@@ -229,16 +275,19 @@ class FlowCellProcess(object):
             muxed_libs = multiplexed[flowlane]
             if len(muxed_libs) > 1:
 
-              # Demultiplex file if required. Here we unfortunately
-              # have to unzip the data, and we will rezip it
-              # following the process regardless of its input state.
-              if is_zipped(fname):
+              # Demultiplex file if required. For demuxIllumina we
+              # unfortunately have to unzip the data, and we will
+              # rezip it following the process regardless of its
+              # input state. The internal demultiplexer reads and
+              # writes gzipped files directly.
+              if is_zipped(fname) and self.demux_prog != INTERNAL_DEMUX:
                 fname = unzip_file(fname)
               LOGGER.info("Demultiplexing file %s for libraries: %s",
                           fname, ", ".join(muxed_libs))
               self.demultiplex(muxed_libs, fname)
               for lib in muxed_libs:
-                self.output_files += [ rezip_file(dmf) for dmf in self._demux_files[lib] ]
+                self.output_files += [ dmf if is_zipped(dmf) else rezip_file(dmf)
+                                       for dmf in self._demux_files[lib] ]
             else:
               LOGGER.info("File does not require demultiplexing: %s", fname)
               self.output_files.append(fname)
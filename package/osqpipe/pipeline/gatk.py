@@ -27,12 +27,14 @@ from time import time, sleep
 from subprocess import Popen, PIPE, STDOUT, CalledProcessError
 from shutil import copy
 from pipes import quote
+from collections import OrderedDict
 from django.db import transaction
 
 from ..models import Alnfile, Library, Alignment, MergedAlnfile, Genome, Lane
-from osqutil.samtools import count_bam_reads
+from .bampy import BamStats
 from osqutil.utilities import call_subprocess, checksum_file, \
     sanitize_samplename
+from osqutil.bamheader import BamHeaderEditor
 from osqutil.config import Config
 from .bwa_runner import ClusterJobManager
 
@@ -81,7 +83,7 @@ def check_bam_readcount(bam, maln, readcountdicts=None):
   '''
   expected = sum([ aln.lane.total_passedpf for aln in maln.alignments.all() ])
   if readcountdicts is None:
-    numreads = count_bam_reads(bam)
+    numreads = BamStats.from_bam(bam).read_count
   else:
     numreads = sum(readcountdicts[0].values())
 
@@ -118,63 +120,63 @@ def autocreate_alignment(rgroup, genome, readcounts):
 ################################################################################
 # Functions to update bam read group information in as lightweight a
 # manner as possible. These are dependent on samtools.
-def update_bam_readgroups(bam):
+def update_bam_readgroups(bam, verify_checksum=False):
   '''
   A lightweight method for updating bam read group information to
-  match the current repository annotation.
+  match the current repository annotation. If verify_checksum is
+  True, the repository file is checked against its stored checksum
+  (in the same pass over the file used to calculate the new one).
   '''
   # Support both the filename or an Alnfile/MergedAlnfile object being
   # passed.
   if issubclass(type(bam), MergedAlnfile):
-    _update_mergedalnfile_bam_readgroups(bam)
+    _update_mergedalnfile_bam_readgroups(bam, verify_checksum)
   elif issubclass(type(bam), Alnfile):
-    _update_alnfile_bam_readgroups(bam)
+    _update_alnfile_bam_readgroups(bam, verify_checksum)
   else:
     try:
       bam = Alnfile.objects.get(filename=bam)
-      _update_alnfile_bam_readgroups(bam)
+      _update_alnfile_bam_readgroups(bam, verify_checksum)
     except Alnfile.DoesNotExist:
       try:
         bam = MergedAlnfile.objects.get(filename=bam)
-        _update_mergedalnfile_bam_readgroups(bam)
+        _update_mergedalnfile_bam_readgroups(bam, verify_checksum)
       except MergedAlnfile.DoesNotExist:
         raise ValueError("Requested bam file does not exist in database as Alnfile or MergedAlnfile: %s" % bam)
 
-def _edit_bam_readgroup_data(bam, platform_unit=None, library=None, sample=None, center=None):
+def update_bam_readgroups_batch(bams, verify_checksum=True):
   '''
-  Fairly generic internal function which makes the actual readgroup
-  annotation changes. This function is deliberately agnostic about
-  where the annotation comes from; it is up to the caller to make that
-  decision. Note that it is assumed that the caller function is within
-  a transaction; this allows us to be sure that database-derived
-  annotation passed to this function will not change during the
-  procedure.
+  Run update_bam_readgroups over a list of bam files (filenames,
+  Alnfile or MergedAlnfile objects). Each file is updated in its own
+  transaction; failures are logged and do not stop the batch. Returns
+  a list of (bam, error) tuples for the files which failed.
+  '''
+  failures = []
+  for (num, bam) in enumerate(bams):
+    LOGGER.info("Updating read groups for bam file %d of %d: %s",
+                num + 1, len(bams), bam)
+    try:
+      update_bam_readgroups(bam, verify_checksum=verify_checksum)
+    except (ValueError, CalledProcessError, IOError, OSError), err:
+      LOGGER.error("Failed to update read groups for %s: %s", bam, err)
+      failures.append((bam, err))
+  LOGGER.info("Updated read groups for %d of %d bam files.",
+              len(bams) - len(failures), len(bams))
+  return failures
+
+def _edit_readgroup_header(header, platform_unit=None, library=None, sample=None, center=None):
+  '''
+  Return a copy of the bam header text with the @RG tags edited as
+  requested. Tag order is preserved.
   '''
-  if bam.filetype.code != 'bam':
-    raise ValueError("Function requires bam file, not %s (%s)"
-                     % (bam.filetype.code, bam.filename))
-
-  # First, extract the current file header.
-  LOGGER.info("Reading current bam file header.")
-  cmd = ('samtools', 'view', '-H', bam.repository_file_path)
-  subproc = Popen(cmd, stdout=PIPE, stderr=STDOUT)
-  header  = subproc.communicate()[0]
-  retcode = subproc.wait()
-
-  if retcode != 0:
-    raise CalledProcessError(retcode, " ".join(cmd))
-
-  if len(header) == 0:
-    raise ValueError("The bam file has no header information; is this actually a bam file?")
-
   newheader = []
   for line in header.split("\n"):
 
     # Make the actual changes here.
     if re.match('@RG', line):
       LOGGER.info("Editing @RG header line.")
-      fields = dict( field.split(':', 1) for field in line.split("\t")
-                     if not re.match('^@', field) )
+      fields = OrderedDict( field.split(':', 1) for field in line.split("\t")
+                            if not re.match('^@', field) )
       if platform_unit is not None:
         fields['PU'] = platform_unit
       if library is not None:
@@ -188,10 +190,13 @@ def _edit_bam_readgroup_data(bam, platform_unit=None, library=None, sample=None,
       newheader.append(newline)
     else:
       newheader.append(line)
-  newheader = "\n".join(newheader)
+  return "\n".join(newheader)
 
-  # Replace the old header with the edited version.
-  LOGGER.info("Replacing bam file header.")
+def _reheader_bam(bam, newheader):
+  '''
+  Replace the bam file header by rewriting the whole file using
+  samtools reheader. Returns the new file checksum.
+  '''
   tmpbam = "%s.reheader" % bam.repository_file_path
   move(bam.repository_file_path, tmpbam)
   cmd = 'samtools reheader - %s > %s' % (tmpbam, bam.repository_file_path)
@@ -205,12 +210,54 @@ def _edit_bam_readgroup_data(bam, platform_unit=None, library=None, sample=None,
 
   LOGGER.info("Correcting bam file checksum.")
   chksum = checksum_file(bam.repository_file_path, unzip=False)
+  os.unlink(tmpbam)
+  return chksum
+
+def _edit_bam_readgroup_data(bam, platform_unit=None, library=None, sample=None, center=None,
+                             verify_checksum=False):
+  '''
+  Fairly generic internal function which makes the actual readgroup
+  annotation changes. This function is deliberately agnostic about
+  where the annotation comes from; it is up to the caller to make that
+  decision. Note that it is assumed that the caller function is within
+  a transaction; this allows us to be sure that database-derived
+  annotation passed to this function will not change during the
+  procedure. Where possible only the leading header blocks of the bam
+  file are rewritten (see osqutil.bamheader); otherwise the whole
+  file is rewritten using samtools reheader.
+  '''
+  if bam.filetype.code != 'bam':
+    raise ValueError("Function requires bam file, not %s (%s)"
+                     % (bam.filetype.code, bam.filename))
+
+  # First, extract the current file header.
+  LOGGER.info("Reading current bam file header.")
+  editor = BamHeaderEditor(bam.repository_file_path)
+
+  if len(editor.text) == 0:
+    raise ValueError("The bam file has no header information; is this actually a bam file?")
+
+  newheader = _edit_readgroup_header(editor.text, platform_unit=platform_unit,
+                                     library=library, sample=sample, center=center)
+  if newheader == editor.text:
+    LOGGER.info("Bam file read groups are already up to date.")
+    return
+
+  # Replace the old header with the edited version.
+  LOGGER.info("Replacing bam file header.")
+  chksum = editor.replace(newheader,
+                          checksum=bam.checksum if verify_checksum else None)
+  if chksum is None:
+    if verify_checksum and checksum_file(bam.repository_file_path,
+                                         unzip=False) != bam.checksum:
+      raise ValueError("Stored bam checksum does not agree with that in the repository.")
+    LOGGER.info("Rewriting the whole bam file.")
+    chksum = _reheader_bam(bam, newheader)
   bam.checksum = chksum
   bam.save()
-  os.unlink(tmpbam)
 
 @transaction.atomic
-def _update_alnfile_bam_readgroups(bam):
+def _update_alnfile_bam_readgroups(bam, verify_checksum=False):
   '''
   Updates read group PU, LB, SM and CN tags based on the annotation
   stored in the database linked to this Alnfile.
@@ -218,13 +265,14 @@ def _update_alnfile_bam_readgroups(bam):
   bam = Alnfile.objects.get(id=bam.id)
   library = bam.alignment.lane.library
   _edit_bam_readgroup_data(bam,
-                           platform_unit = bam.alignment.lane.lanenum,
-                           library       = library.code,
-                           sample        = sanitize_samplename(library.sample.name),
-                           center        = bam.alignment.lane.facility.code)
+                           platform_unit   = bam.alignment.lane.lanenum,
+                           library         = library.code,
+                           sample          = sanitize_samplename(library.sample.name),
+                           center          = bam.alignment.lane.facility.code,
+                           verify_checksum = verify_checksum)
 
 @transaction.atomic
-def _update_mergedalnfile_bam_readgroups(bam):
+def _update_mergedalnfile_bam_readgroups(bam, verify_checksum=False):
   '''
   Updates read group SM tag based on the annotation stored in the
   database linked to this MergedAlnfile. Note that PN, LB and CN are
@@ -241,7 +289,8 @@ def _update_mergedalnfile_bam_readgroups(bam):
     raise ValueError("MergedAlnfile appears to be linked to multiple samples, please fix: %s"
                      % ",".join(samples))
   _edit_bam_readgroup_data(bam,
-                           sample = sanitize_samplename(list(samples)[0]))
+                           sample          = sanitize_samplename(list(samples)[0]),
+                           verify_checksum = verify_checksum)
 
 def _make_local_bamfile_name(fname, samplename, finalprefix):
   '''
@@ -284,7 +333,9 @@ class GATKPreprocessor(ClusterJobManager):
   def wait_on_cluster(self, finalbam, localbam, *args, **kwargs):
     '''
     Overridden wait_on_cluster which both waits on the cluster and
-    cleans up the input file if the outputs look reasonable.
+    cleans up the input file if the outputs look reasonable. A
+    ClusterJobError is raised, and nothing deleted, if the cluster
+    jobs fail.
     '''
     super(GATKPreprocessor, self).wait_on_cluster(*args, **kwargs)
     finaldone = "%s.done" % finalbam
@@ -169,7 +169,8 @@ class HiCUP(object):
             sshkey = None
             
         write_to_remote_file(conf_txt, self.hicup_conf_fname, self.conf.clusteruser,
-                             self.conf.cluster, append=False, sshkey=sshkey)
+                             self.conf.cluster, append=False, sshkey=sshkey,
+                             port=self.conf.clusterport)
         
     def run_hicup(self):
         
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqpipe python package.
+#
+# The osqpipe python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqpipe python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqpipe python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''HTTP client used to query the LIMS REST API. A single pooled
+session is shared between threads so that connections are reused;
+failed requests are retried with exponential backoff, and responses
+may be kept in an on-disk cache between invocations.'''
+
+import os
+import re
+import time
+import hashlib
+import sqlite3
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ChunkedEncodingError
+
+from osqutil.config import Config
+from osqutil.http_cache import ResponseCache
+from osqutil.checksum_cache import get_checksum_cache
+
+from osqutil.setup_logs import configure_logging
+LOGGER = configure_logging('lims_client')
+
+# Request timeout, in seconds.
+DEFAULT_TIMEOUT = 120
+
+# Number of retries for failed requests; the delay (in seconds)
+# before each retry doubles from DEFAULT_BACKOFF up to MAX_BACKOFF.
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 10
+MAX_BACKOFF     = 300
+
+# Number of concurrent requests (and pooled connections).
+DEFAULT_THREADS = 4
+
+# Seconds for which a cached response is used without revalidation.
+DEFAULT_CACHE_TTL = 300
+
+# Response codes indicating that a request may succeed if retried.
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Errors which may interrupt a download part way through.
+STREAM_ERRORS = (requests.ConnectionError, requests.Timeout,
+                 ChunkedEncodingError)
+
+# Chunk size (in bytes) used when streaming downloads to disk.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+def _expected_size(res, offset):
+  '''
+  Return the full size of the file being downloaded, as indicated by
+  the response headers, or None if this is not known.
+  '''
+  if res.status_code == 206:
+    match = re.search(r'/(\d+)$', res.headers.get('Content-Range', ''))
+    return None if match is None else int(match.group(1))
+  length = res.headers.get('Content-Length')
+  return None if length is None else offset + int(length)
+
+###############################################################################
+class LimsClient(object):
+
+  '''
+  Pooled HTTP client for the LIMS REST API. If cache is supplied (a
+  osqutil.http_cache.ResponseCache), responses retrieved via the
+  fetch method are cached; entries younger than ttl seconds are
+  returned directly, and older entries are revalidated using their
+  ETag or Last-Modified headers.
+  '''
+
+  __slots__ = ('session', 'timeout', 'retries', 'backoff', 'threads',
+               'cache', 'ttl')
+
+  def __init__(self, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES,
+               backoff=DEFAULT_BACKOFF, threads=DEFAULT_THREADS,
+               cache=None, ttl=DEFAULT_CACHE_TTL):
+    self.timeout = timeout
+    self.retries = retries
+    self.backoff = backoff
+    self.threads = threads
+    self.cache   = cache
+    self.ttl     = ttl
+
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=threads, pool_maxsize=threads)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+
+  def get(self, url, *args, **kwargs):
+    '''
+    Wrapper for requests.get() using the pooled session. Connection
+    errors, timeouts and server errors are retried; the final response
+    is returned, and any error status it carries must be handled by
+    the caller.
+    '''
+    kwargs.setdefault('timeout', self.timeout)
+    delay = self.backoff
+    for attempt in range(self.retries + 1):
+      try:
+        res = self.session.get(url, *args, **kwargs)
+      except (requests.ConnectionError, requests.Timeout), err:
+        if attempt == self.retries:
+          raise
+        problem = str(err)
+      else:
+        if res.status_code not in RETRY_STATUS or attempt == self.retries:
+          return res
+        problem = "status %d" % res.status_code
+        res.close()
+
+      LOGGER.warning("LIMS request failed (%s); retrying in %d seconds: %s",
+                     problem, delay, url)
+      time.sleep(delay)
+      delay = min(delay * 2, MAX_BACKOFF)
+
+  def fetch(self, url, ttl=None):
+    '''
+    Return the body of the response from url as a UTF-8 encoded
+    string, or None if the request was unsuccessful. The ttl argument
+    overrides the default cache time-to-live.
+    '''
+    if ttl is None:
+      ttl = self.ttl
+
+    cached  = None
+    headers = {}
+    if self.cache is not None:
+      cached = self.cache.lookup(url)
+      if cached is not None:
+        if cached.age() < ttl:
+          LOGGER.debug("Using cached LIMS response: %s", url)
+          return cached.body
+        headers = cached.conditional_headers()
+
+    res = self.get(url, headers=headers)
+    if res.status_code == 304 and cached is not None:
+      LOGGER.debug("Cached LIMS response is still valid: %s", url)
+      self.cache.touch(url)
+      return cached.body
+    if res.status_code != 200:
+      LOGGER.warning("LIMS request returned status %d: %s",
+                     res.status_code, url)
+      return None
+
+    body = res.text.encode('utf-8')
+    if self.cache is not None:
+      self.cache.store(url, body, res.headers.get('ETag'),
+                       res.headers.get('Last-Modified'))
+    return body
+
+  def download(self, url, local_filename, params=None, md5sum=None):
+    '''
+    Download url to local_filename. The data are written to a
+    temporary file alongside local_filename, which is renamed into
+    place once complete; a download interrupted part way through
+    (whether in this process or an earlier one) is resumed from where
+    it stopped using an HTTP Range request. The MD5 checksum is
+    calculated as the file is written and, if md5sum is supplied,
+    compared against it. Returns a tuple of (MD5 checksum, bytes
+    transferred, seconds taken).
+    '''
+    partial = "%s.part" % local_filename
+    md5     = hashlib.md5()
+    offset  = 0
+    if os.path.exists(partial):
+      with open(partial, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(DOWNLOAD_CHUNK_SIZE), ''):
+          md5.update(chunk)
+          offset += len(chunk)
+      LOGGER.info("Resuming download of %s from byte %d.", url, offset)
+
+    start       = time.time()
+    transferred = 0
+    delay       = self.backoff
+    for attempt in range(self.retries + 1):
+      headers = {} if offset == 0 else { 'Range' : 'bytes=%d-' % offset }
+      res = self.get(url, params=params, headers=headers, stream=True)
+      try:
+        if res.status_code == 206:
+          mode = 'ab'
+        elif res.status_code in (200, 416):
+
+          # The server either ignored the Range header or rejected
+          # it; either way we start again from scratch.
+          if offset > 0:
+            LOGGER.warning("Unable to resume download; restarting: %s", url)
+            (md5, offset) = (hashlib.md5(), 0)
+          if res.status_code == 416:
+            continue
+          mode = 'wb'
+        else:
+          LOGGER.error("Failed to download file: %s (%s)", url, res.reason)
+          raise StandardError("Unable to download LIMS file: %s (%s)"
+                              % (url, res.reason))
+
+        expected = _expected_size(res, offset)
+        try:
+          with open(partial, mode) as out:
+            for chunk in res.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+              out.write(chunk)
+              md5.update(chunk)
+              offset      += len(chunk)
+              transferred += len(chunk)
+        except STREAM_ERRORS, err:
+          problem = str(err)
+        else:
+          if expected is None or offset == expected:
+            break
+          problem = "received %d of %d bytes" % (offset, expected)
+      finally:
+        res.close()
+
+      if attempt == self.retries:
+        raise StandardError("Download of LIMS file failed (%s): %s"
+                            % (problem, url))
+      LOGGER.warning("Download interrupted (%s); resuming in %d seconds: %s",
+                     problem, delay, url)
+      time.sleep(delay)
+      delay = min(delay * 2, MAX_BACKOFF)
+    else:
+      raise StandardError("Unable to download LIMS file: %s" % url)
+
+    digest = md5.hexdigest()
+    if md5sum is not None and digest != md5sum:
+      os.unlink(partial)
+      raise StandardError("File md5sum (%s) disagrees with upstream LIMS (%s): %s"
+                          % (digest, md5sum, local_filename))
+    os.rename(partial, local_filename)
+
+    elapsed = time.time() - start
+    LOGGER.info("Downloaded %s: %.1f MB in %.1f seconds (%.1f MB/s).",
+                os.path.basename(local_filename), transferred / 1e6, elapsed,
+                transferred / 1e6 / max(elapsed, 1e-3))
+
+    # Record the checksum so that it need not be recalculated later.
+    cache = get_checksum_cache()
+    if cache is not None:
+      try:
+        cache.store(local_filename, digest, os.stat(local_filename), unzip=False)
+      except sqlite3.Error, err:
+        LOGGER.warning("Unable to store checksum for %s in cache: %s",
+                       local_filename, err)
+
+    return (digest, transferred, elapsed)
+
+  def fetch_all(self, urls, ttl=None):
+    '''
+    Fetch a list of urls concurrently, returning a list of response
+    bodies (or None for failed requests) in the same order.
+    '''
+    urls = list(urls)
+    if len(urls) < 2:
+      return [ self.fetch(url, ttl) for url in urls ]
+
+    pool = ThreadPool(min(self.threads, len(urls)))
+    try:
+      return pool.map(lambda url: self.fetch(url, ttl), urls)
+    finally:
+      pool.close()
+      pool.join()
+
+###############################################################################
+_CLIENT = None
+
+def get_lims_client():
+  '''
+  Return the LimsClient shared by this process, configured via the
+  optional lims_http_timeout, lims_http_retries, lims_fetch_threads,
+  lims_cache and lims_cache_ttl config options. Responses are only
+  cached if lims_cache (an sqlite database file) is set.
+  '''
+  global _CLIENT
+  if _CLIENT is None:
+    conf    = Config()
+    options = {}
+    for (key, option) in (('timeout', 'lims_http_timeout'),
+                          ('retries', 'lims_http_retries'),
+                          ('threads', 'lims_fetch_threads'),
+                          ('ttl',     'lims_cache_ttl')):
+      try:
+        options[key] = int(getattr(conf, option))
+      except AttributeError, _err:
+        pass
+    try:
+      options['cache'] = ResponseCache(conf.lims_cache)
+    except AttributeError, _err:
+      pass
+    _CLIENT = LimsClient(**options)
+
+  return _CLIENT
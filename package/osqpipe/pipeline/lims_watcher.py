@@ -71,14 +71,16 @@ class LimsWatcher(object):
 
     # Default is a 3-day sliding window.
     root = get_lims_run_history(self.conf.lims_rest_uri, window)
+    self.lims.record_flowcells(root)
 
     newlanes = []
 
-    for run_elem in root.findall('.//run'):
+    # If a run has a file, it must have a runFolder. Run details are
+    # retrieved concurrently.
+    run_ids = [ run_elem.find('./runFolder').text
+                for run_elem in root.findall('.//run') ]
 
-      # If a run has a file, it must have a runFolder.
-      run_id = run_elem.find('./runFolder').text
-      lims_fc = self.lims.load_run(run_id)
+    for lims_fc in self.lims.load_runs(run_ids):
       for limslane in lims_fc.iter_lanes():
         if any(x in emails for x in limslane.user_emails):
 
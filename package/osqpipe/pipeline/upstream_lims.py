@@ -25,14 +25,14 @@ import re
 import os.path
 import weakref
 from datetime import date, timedelta
-from time import sleep
 import xml.etree.ElementTree as ET
 
-import requests
-
 from osqutil.config import Config
 from osqutil.utilities import munge_cruk_emails
-from ..models import LibraryNameMap, User
+from django.db import transaction, IntegrityError
+from django.db.models import Max
+from ..models import LibraryNameMap, User, FlowcellRun
+from .lims_client import get_lims_client
 
 from osqutil.setup_logs import configure_logging
 from logging import INFO, DEBUG
@@ -40,28 +40,22 @@ LOGGER = configure_logging('lims')
 
 CONFIG = Config()
 
+# The number of days of LIMS run history searched for a given
+# flowcell ID.
+HISTORY_DAYS = 378
+
+# Overlap (in days) between successive updates of the flowcell index.
+INDEX_OVERLAP_DAYS = 2
+
 ###############################################################################
-def http_download_file(url, local_filename, params=None):
+def http_download_file(url, local_filename, params=None, md5sum=None):
   '''
-  Download a remote file URL to a local filename. Returns the local
-  filename on success.
+  Download a remote file URL to a local filename, resuming any
+  previously interrupted download. If md5sum is supplied, the
+  download is checked against it. Returns the local filename on
+  success.
   '''
-  # See http://stackoverflow.com/a/16696317 for the original source.
-
-  if params is None:
-    params = {}
-
-  # Read large files in chunks using stream = True parameter
-  res = robust_http_get(url, stream = True, params=params)
-  if res.status_code is not 200:
-    LOGGER.error("Failed to download file: %s (%s)", str(params), res.reason)
-    raise StandardError("Unable download LIMS file: %s (%s)"
-                        % (str(params), res.reason))
-  with open(local_filename, 'wb') as outfh:
-    for chunk in res.iter_content(chunk_size=1024):
-      if chunk: # filter out keep-alive new chunks
-        outfh.write(chunk)
-        outfh.flush()
+  get_lims_client().download(url, local_filename, params=params, md5sum=md5sum)
   return local_filename
 
 def get_lims_run_history(url, since):
@@ -71,16 +65,11 @@ def get_lims_run_history(url, since):
   '''
   LOGGER.debug("Querying LIMS for runs since %s", since)
   history_url = "%s/publishedRunsByPublishDate?start=%s" % (url, since)
-  res = robust_http_get(history_url)
-  if res.status_code is not 200:
+  body = get_lims_client().fetch(history_url)
+  if body is None:
     LOGGER.error("Failed to retrieve runs since date %s.", since)
     raise StandardError("Unable to retrieve LIMS run history: %s" % history_url)
-  try:
-    root = ET.fromstring(res.text.encode('utf-8'))
-  except ET.ParseError, err:
-    LOGGER.error("LIMS query returned bad XML.")
-    raise StandardError("Bad XML in response from LIMS query: %s" % err)
-  return root
+  return _parse_lims_xml(body)
 
 def get_lims_run_details(url, run_id):
   '''
@@ -88,16 +77,28 @@ def get_lims_run_details(url, run_id):
   running the query response through xml.etree.ElementTree.fromstring.
   '''
   LOGGER.info("Querying LIMS for run: %s", run_id)
-  res = robust_http_get("%s/fullDetailsOfRun?runId=%s" % (url, run_id))
-  if res.status_code is not 200:
+  body = get_lims_client().fetch(run_details_url(url, run_id))
+  if body is None:
     LOGGER.error("Failed to retrieve detail for %s.", run_id)
     raise StandardError("Unable to retrieve LIMS run detail.")
-  try:
-    root = ET.fromstring(res.text.encode('utf-8'))
-  except ET.ParseError, err:
-    LOGGER.error("LIMS query returned bad XML.")
-    raise StandardError("Bad XML in response from LIMS query: %s" % err)
-  return root
+  return _parse_lims_xml(body)
+
+def get_lims_runs_details(url, run_ids):
+  '''
+  Query the LIMS for fullDetailsOfRun for a list of run IDs,
+  concurrently. Returns a list of parsed responses in the same order
+  as run_ids.
+  '''
+  LOGGER.info("Querying LIMS for %d runs", len(run_ids))
+  bodies = get_lims_client().fetch_all([ run_details_url(url, run_id)
+                                         for run_id in run_ids ])
+  roots = []
+  for (run_id, body) in zip(run_ids, bodies):
+    if body is None:
+      LOGGER.error("Failed to retrieve detail for %s.", run_id)
+      raise StandardError("Unable to retrieve LIMS run detail.")
+    roots.append(_parse_lims_xml(body))
+  return roots
 
 def runs_containing_samples(url, libcode):
   '''
@@ -105,12 +106,25 @@ def runs_containing_samples(url, libcode):
   running the query response through xml.etree.ElementTree.fromstring.
   '''
   LOGGER.info("Querying LIMS for library: %s", libcode)
-  res = robust_http_get("%s/runsContainingSamples?sampleName=%s" % (url, libcode))
-  if res.status_code is not 200:
+  body = get_lims_client().fetch("%s/runsContainingSamples?sampleName=%s"
+                                 % (url, libcode))
+  if body is None:
     LOGGER.error("Failed to retrieve runs for library %s.", libcode)
     raise StandardError("Unable to retrieve run listing from LIMS.")
+  return _parse_lims_xml(body)
+
+def run_details_url(url, run_id):
+  '''
+  Return the fullDetailsOfRun query URL for a given run ID.
+  '''
+  return "%s/fullDetailsOfRun?runId=%s" % (url, run_id)
+
+def _parse_lims_xml(body):
+  '''
+  Parse a LIMS response body using xml.etree.ElementTree.fromstring.
+  '''
   try:
-    root = ET.fromstring(res.text.encode('utf-8'))
+    root = ET.fromstring(body)
   except ET.ParseError, err:
     LOGGER.error("LIMS query returned bad XML.")
     raise StandardError("Bad XML in response from LIMS query: %s" % err)
@@ -119,19 +133,33 @@ def runs_containing_samples(url, libcode):
 def robust_http_get(url, *args, **kwargs):
   '''
   Wrapper function to requests.get() which handles failure a little
-  more gracefully.
+  more gracefully. Requests share the pooled connections of the
+  process-wide LimsClient, and are retried with exponential backoff.
   '''
-  res = requests.get(url, *args, **kwargs)
-  if res.status_code is not 200:
-    # Sleep for five minutes, then retry once. This may become more
-    # involved at a later date.
-    LOGGER.warning("Response not OK from url; retrying: %s", url)
-    sleep(300)
-    res = requests.get(url, *args, **kwargs)
-
   # Any errors on the final retry need to be detected and reported by
   # the caller.
-  return res
+  return get_lims_client().get(url, *args, **kwargs)
+
+def index_flowcells(mapping):
+  '''
+  Add the flowcell to run ID mappings in the mapping dict to the
+  persistent flowcell index, skipping flowcells already listed.
+  Returns the number of flowcells newly added.
+  '''
+  known = set(FlowcellRun.objects.filter(flowcell__in=mapping.keys())
+              .values_list('flowcell', flat=True))
+  new   = [ FlowcellRun(flowcell=flowcell, run_folder=run_folder)
+            for (flowcell, run_folder) in mapping.iteritems()
+            if flowcell not in known ]
+  try:
+    with transaction.atomic():
+      FlowcellRun.objects.bulk_create(new)
+  except IntegrityError, _err:
+    # Another process has indexed some of these in the meantime.
+    return sum([ FlowcellRun.objects.get_or_create(flowcell=obj.flowcell,
+                                                   defaults={'run_folder' : obj.run_folder})[1]
+                 for obj in new ])
+  return len(new)
 
 ###############################################################################
 
@@ -457,20 +485,34 @@ class Lims(object):
 
   def run_id_from_flowcell(self, flowcell, requery=False):
     '''
-    Runs a set of queries, up to a currently hard-coded time limit
-    of about one month in the past, to map a flowcell ID onto a more
-    canonical run ID.
+    Map a flowcell ID onto a more canonical run ID. The persistent
+    flowcell index is consulted first, and updated from the most
+    recent run history if necessary; failing that (or if requery is
+    set), a set of queries is run, up to a time limit of about a year
+    in the past.
     '''
     # Check there isn't already some cached data for this flowcell ID.
     if flowcell in self._fcid_mapping and not requery:
       LOGGER.debug("Returning cached run_id for flowcell: %s", flowcell)
       return self._fcid_mapping[flowcell]
 
+    # Next, try the persistent index, bringing it up to date if the
+    # flowcell is not (yet) listed.
+    if not requery:
+      runid = self._indexed_run_id(flowcell)
+      if runid is None:
+        self.update_flowcell_index()
+        runid = self._indexed_run_id(flowcell)
+      if runid is not None:
+        self._fcid_mapping[flowcell] = runid
+        return runid
+
+    # Failing that, search back through the run history directly.
     runid = None
     fib   = [1, 1]
 
     # We limit our historical searches to just the last year or so.
-    while fib[1] < 378:
+    while fib[1] < HISTORY_DAYS:
 
       # Retrieve the run listing for the last fib[1] days. Note that
       # we may want to consider using completeRunsByFinishDate here
@@ -479,6 +521,10 @@ class Lims(object):
       since = date.today() - timedelta( fib[1] )
       root  = get_lims_run_history(self.uri, since)
 
+      # Record every flowcell in the listing, so that later lookups
+      # for other flowcells in this window need not requery.
+      self.record_flowcells(root)
+
       # XPath query to retrieve the run by flowcell ID.
       run_elem = root.find(".//flowcell[flowcellId='%s']/.." % flowcell)
       if run_elem is not None:
@@ -499,9 +545,59 @@ class Lims(object):
       raise StandardError("Unable to retrieve flowcell Run ID.")
 
     self._fcid_mapping[flowcell] = runid
+    FlowcellRun.objects.update_or_create(flowcell=flowcell,
+                                         defaults={'run_folder' : runid})
 
     return runid
 
+  @staticmethod
+  def _indexed_run_id(flowcell):
+    '''
+    Return the run ID for a flowcell from the persistent index, or
+    None if it is not listed.
+    '''
+    try:
+      return FlowcellRun.objects.get(flowcell=flowcell).run_folder
+    except FlowcellRun.DoesNotExist, _err:
+      return None
+
+  def update_flowcell_index(self, days=None):
+    '''
+    Add the runs published in the last number of days to the
+    persistent flowcell index. By default only runs published since
+    the index was last extended are retrieved, or (for an empty
+    index) those from the full period searched by
+    run_id_from_flowcell. Returns the number of flowcells added.
+    '''
+    if days is None:
+      latest = FlowcellRun.objects.aggregate(Max('date'))['date__max']
+      if latest is None:
+        days = HISTORY_DAYS
+      else:
+        days = (date.today() - latest).days + INDEX_OVERLAP_DAYS
+    since = date.today() - timedelta(days)
+    return self.record_flowcells(get_lims_run_history(self.uri, since))
+
+  def record_flowcells(self, root):
+    '''
+    Add the flowcell to run ID mappings from a run history listing
+    to our cache and to the persistent index. Returns the number of
+    flowcells newly added to the index.
+    '''
+    found = {}
+    for run_elem in root.findall('.//run'):
+      fcid   = run_elem.find('./flowcell/flowcellId')
+      folder = run_elem.find('./runFolder')
+      if fcid is not None and folder is not None:
+        found.setdefault(fcid.text, folder.text)
+        self._fcid_mapping.setdefault(fcid.text, folder.text)
+
+    added = index_flowcells(found)
+    if added > 0:
+      LOGGER.info("Added %d flowcells to the flowcell index.", added)
+
+    return added
+
   def load_run(self, run_id, requery=False):
     '''
     Retrieve the full details for a given run ID. This method will
@@ -514,9 +610,38 @@ class Lims(object):
       return LimsFlowCell(self._run_details[run_id])
 
     root = get_lims_run_details(self.uri, run_id)
+    return self._parse_run(run_id, root, self._user_emails())
+
+  def load_runs(self, run_ids, requery=False):
+    '''
+    Retrieve the full details for a list of run IDs, returning a list
+    of LimsFlowCell objects in the same order. Runs not already cached
+    are queried concurrently.
+    '''
+    wanted = [ run_id for run_id in set(run_ids)
+               if requery or run_id not in self._run_details ]
+    if len(wanted) > 0:
+      roots  = get_lims_runs_details(self.uri, wanted)
+      emails = self._user_emails()
+      for (run_id, root) in zip(wanted, roots):
+        self._parse_run(run_id, root, emails)
+
+    return [ LimsFlowCell(self._run_details[run_id]) for run_id in run_ids ]
+
+  @staticmethod
+  def _user_emails():
+    '''
+    Return the (munged) email addresses of our active users.
+    '''
     people = User.objects.filter(is_active=True)
-    emails = munge_cruk_emails([x.email.lower() for x in people])
+    return munge_cruk_emails([x.email.lower() for x in people])
 
+  def _parse_run(self, run_id, root, emails):
+    '''
+    Extract the run details from a parsed fullDetailsOfRun response,
+    caching them and returning a LimsFlowCell object. Only samples
+    belonging to the supplied user emails are recorded.
+    '''
     # Now we pull out various bits of information and cache them for
     # later.
     run_elem = root.find('.//run')
@@ -671,7 +796,7 @@ class Lims(object):
 
     return LimsFlowCell(run)
 
-  def get_file_by_id(self, file_lims_id, local_filename):
+  def get_file_by_id(self, file_lims_id, local_filename, md5sum=None):
     '''
     Download a LIMS file (using its LIMS ID) to a local
     filename. Returns the local filename on success. Typically only
@@ -680,15 +805,16 @@ class Lims(object):
     download_uri = "%s/downloadFile" % self.uri
     return http_download_file(download_uri,
                             local_filename,
-                            {'fileLimsId':file_lims_id})
+                            {'fileLimsId':file_lims_id},
+                            md5sum=md5sum)
 
-  def get_file_by_uri(self, uri, local_filename):
+  def get_file_by_uri(self, uri, local_filename, md5sum=None):
     '''
     Download a LIMS file (using its quoted URI) to a local
     filename. Returns the local filename on success. This is currently
     the preferred transfer mechanism.
     '''
-    return http_download_file(uri, local_filename)
+    return http_download_file(uri, local_filename, md5sum=md5sum)
 
 ###############################################################################
 
@@ -18,53 +18,136 @@
 # along with the osqpipe python package.  If not, see
 # <http://www.gnu.org/licenses/>.
 
-'''Utility functions used to generate quality plots.'''
+'''Utility functions used to generate quality plots. Each plot is
+rendered once per lane and kept in httptmpdir under a name derived
+from the lane ID and a hash of the plotted values, so that it is
+reused until the underlying data change. The total size of
+httptmpdir is kept within the limit set by the optional
+httptmp_max_mb config option, by discarding the least recently used
+files.'''
 
-import sys
 import os
-import time
+import re
+import hashlib
+import tempfile
 
-from Gnuplot import Gnuplot
+import numpy
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 from osqutil.config import Config
 CONFIG = Config()
 
+from osqutil.setup_logs import configure_logging
+LOGGER = configure_logging('qualplot')
+
+# Default limit on the total size of httptmpdir, in megabytes.
+DEFAULT_TMPDIR_MAX_MB = 200
+
+# Names of cached plot files; these never change content.
+CACHED_PLOT_RE = re.compile(r'^qualplot_\d+_n?pf_[0-9a-f]{16}\.png$')
+
 ############################################################
-def plot_qv(base, means, stdevs):
+def plot_qv(filename, means, stdevs):
   '''
-  Generate a quality plot and return the URL to the output file.
+  Generate a quality plot of the per-cycle means (with standard
+  deviations as error bars), writing it to filename as a PNG.
   '''
-  filename = "%s/%s" % (CONFIG.httptmpdir, base)
-  url      = "%s/%s" % (CONFIG.httptmpurl, base)
-
-  # There's almost certainly a prettier way to do this in the Gnuplot
-  # package; this is a straight port from piping commands to the
-  # gnuplot program (Update FIXME seems like gnuplotlib is the way to
-  # go, or move to something completely unrelated to gnuplot like
-  # matplotlib or seaborn):
-  g = Gnuplot()
-  g('set terminal png size 400,300')
-  g("set output \"%s\"" % filename)
-  g("plot [0:%d] [-1:41] \"-\" with errorbars notitle," % (len(means)+1,)
-    + " \"-\" with linespoints notitle")
-  for i in range(len(means)):
-    g("%d %f %f" % (i+1, means[i], stdevs[i]))
-  g("e")
-  for i in range(len(means)):
-    g("%d %f %f" % (i+1, means[i], stdevs[i]))
-  g("e")
-  g("set output")
-  return url
+  means  = numpy.asarray(means,  dtype=float)
+  stdevs = numpy.asarray(stdevs, dtype=float)
+  cycles = numpy.arange(1, len(means) + 1)
+
+  # The pyplot interface is avoided as it keeps global state, which
+  # is not safe in a multithreaded web server.
+  fig    = Figure(figsize=(4, 3), dpi=100)
+  canvas = FigureCanvasAgg(fig)
+  axes   = fig.add_subplot(1, 1, 1)
+  axes.errorbar(cycles, means, yerr=stdevs, fmt='none', ecolor='red', capsize=2)
+  axes.plot(cycles, means, marker='+', color='green')
+  axes.set_xlim(0, len(means) + 1)
+  axes.set_ylim(-1, 41)
+  fig.tight_layout()
+
+  # Written to a temporary file first so that concurrent requests
+  # never see a partial image.
+  (fdesc, tmpname) = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                      prefix='.qualplot', suffix='.png')
+  try:
+    with os.fdopen(fdesc, 'wb') as out:
+      canvas.print_png(out)
+    os.chmod(tmpname, 0644)
+    os.rename(tmpname, filename)
+  except:
+    os.unlink(tmpname)
+    raise
+
+def cached_qualplot(lane, label, means, stdevs, tmpdir=None):
+  '''
+  Return the name of the file in tmpdir (by default, httptmpdir)
+  holding the quality plot for the given lane values, rendering it
+  first if necessary. Returns None if there are no values to plot.
+  '''
+  if not means:
+    return None
+  if tmpdir is None:
+    tmpdir = CONFIG.httptmpdir
+
+  digest = hashlib.sha1()
+  digest.update(numpy.asarray(means,  dtype=float).tostring())
+  digest.update(numpy.asarray(stdevs, dtype=float).tostring())
+  base     = "qualplot_%d_%s_%s.png" % (lane.id, label, digest.hexdigest()[:16])
+  filename = os.path.join(tmpdir, base)
+
+  if os.path.exists(filename):
+    os.utime(filename, None) # Marks the file as recently used.
+  else:
+    LOGGER.debug("Rendering quality plot %s", base)
+    plot_qv(filename, means, stdevs)
+    evict_tmpfiles(tmpdir)
+
+  return base
+
+def evict_tmpfiles(tmpdir=None, max_bytes=None):
+  '''
+  Delete the least recently used (i.e., modified) files in tmpdir
+  until the total size is within max_bytes. The defaults are taken
+  from the httptmpdir and httptmp_max_mb config options.
+  '''
+  if tmpdir is None:
+    tmpdir = CONFIG.httptmpdir
+  if max_bytes is None:
+    try:
+      max_bytes = int(CONFIG.httptmp_max_mb) * 1024 * 1024
+    except AttributeError, _err:
+      max_bytes = DEFAULT_TMPDIR_MAX_MB * 1024 * 1024
+
+  files = []
+  for fname in os.listdir(tmpdir):
+    path = os.path.join(tmpdir, fname)
+    try:
+      stat = os.stat(path)
+    except OSError, _err:
+      continue # Deleted by another process.
+    if os.path.isfile(path) and not fname.startswith('.'):
+      files.append((stat.st_mtime, stat.st_size, path))
+
+  total = sum([ size for (_mtime, size, _path) in files ])
+  for (_mtime, size, path) in sorted(files):
+    if total <= max_bytes:
+      break
+    try:
+      os.unlink(path)
+      total -= size
+      LOGGER.debug("Evicted temporary file %s", path)
+    except OSError, _err:
+      pass
 
 def plot_pfqual_values(lane):
   '''Plot quality values for reads passing vendor check ("passed filter").'''
-  base = "qualplot%d_%dpf.png" % (os.getpid(), int(time.time()))
-  return plot_qv(base, lane.qualmeanpf, lane.qualstdevpf)
+  return cached_qualplot(lane, 'pf', lane.qualmeanpf, lane.qualstdevpf)
 
 def plot_all_qual_values(lane):
   '''Plot quality values for all reads.'''
-  base = "qualplot%d_%dnpf.png" % (os.getpid(), int(time.time()))
-  return plot_qv(base, lane.qualmean, lane.qualstdev)
+  return cached_qualplot(lane, 'npf', lane.qualmean, lane.qualstdev)
 
 ############################################################
-
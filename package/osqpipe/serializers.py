@@ -25,6 +25,40 @@ from rest_framework import serializers
 from .models import Project, Library, Source, Sample, Lane, Lanefile, \
   Alignment, Alnfile, MergedAlignment, MergedAlnfile
 
+def requested_fields(request):
+  '''
+  Return the set of field names listed (comma-separated) in the
+  fields query parameter of an API request, or None if all fields
+  are wanted.
+  '''
+  if request is None:
+    return None
+  param = request.query_params.get('fields')
+  if not param:
+    return None
+  return set([ x.strip() for x in param.split(',') if x.strip() ])
+
+class SparseFieldsMixin(object):
+  '''
+  Mixin restricting the top-level serializer output to the fields
+  requested via the fields query parameter, e.g. ?fields=code,lane_set.
+  '''
+  def __init__(self, *args, **kwargs):
+    super(SparseFieldsMixin, self).__init__(*args, **kwargs)
+    fields = requested_fields(self.context.get('request'))
+    if fields is not None:
+      for name in set(self.fields.keys()) - fields:
+        self.fields.pop(name)
+
+class DataProcessLinkField(serializers.HyperlinkedRelatedField):
+  '''
+  Hyperlinked field for Alignment and MergedAlignment objects, whose
+  __unicode__ methods run several queries of their own (provenance,
+  lanes, genome). The links are labelled by primary key instead.
+  '''
+  def get_name(self, obj):
+    return unicode(obj.pk)
+
 class SourceSerializer(serializers.ModelSerializer):
   '''
   General Source-related metadata.
@@ -46,7 +80,7 @@ class SampleSerializer(serializers.ModelSerializer):
     model     = Sample
     fields    = ('name', 'source', 'tissue')
 
-class ProjectSerializer(serializers.ModelSerializer):
+class ProjectSerializer(SparseFieldsMixin, serializers.ModelSerializer):
   '''
   The top-level Project serializer.
   '''
@@ -59,7 +93,7 @@ class ProjectSerializer(serializers.ModelSerializer):
     model     = Project
     fields    = ('code', 'url', 'description', 'libraries')
 
-class LibrarySerializer(serializers.ModelSerializer):
+class LibrarySerializer(SparseFieldsMixin, serializers.ModelSerializer):
   '''
   Library serialization.
   '''
@@ -88,7 +122,7 @@ class LanefileSerializer(serializers.ModelSerializer):
     model  = Lanefile
     fields = ('filename_on_disk','checksum','filetype','download')
 
-class LaneSerializer(serializers.ModelSerializer):
+class LaneSerializer(SparseFieldsMixin, serializers.ModelSerializer):
   '''
   A bridging serializer between Library and Lanefile.
   '''
@@ -97,9 +131,9 @@ class LaneSerializer(serializers.ModelSerializer):
   facility = serializers.StringRelatedField()
   status   = serializers.StringRelatedField()
   lanefile_set = LanefileSerializer(read_only=True, many=True)
-  alignment_set = serializers.HyperlinkedRelatedField(many=True,
-                                                      view_name='api:alignment-detail',
-                                                      read_only=True)
+  alignment_set = DataProcessLinkField(many=True,
+                                       view_name='api:alignment-detail',
+                                       read_only=True)
   
   class Meta:
     model = Lane
@@ -118,17 +152,26 @@ class MergedAlnfileSerializer(serializers.ModelSerializer):
     model  = MergedAlnfile
     fields = ('filename_on_disk','checksum','filetype','download')
 
-class MergedAlignmentSerializer(serializers.ModelSerializer):
+class MergedAlignmentSerializer(SparseFieldsMixin, serializers.ModelSerializer):
   '''
   A bridging serializer between Sample and MergedAlnfile.
   '''
-  genome   = serializers.StringRelatedField()
+  genome   = serializers.SerializerMethodField()
   mergedalnfile_set = MergedAlnfileSerializer(read_only=True, many=True)
 
   class Meta:
     model = MergedAlignment
     fields = ('genome','mergedalnfile_set',)
 
+  def get_genome(self, obj):
+    '''
+    Return the genome code via the (typically prefetched) source
+    alignments, avoiding the validation queries run by
+    MergedAlignment.genome.
+    '''
+    genomes = set([ unicode(aln.genome) for aln in obj.alignments.all() ])
+    return genomes.pop() if len(genomes) == 1 else None
+
 class AlnfileSerializer(serializers.ModelSerializer):
   '''
   This Alnfile serializer links back to the main UI file download view.
@@ -140,15 +183,15 @@ class AlnfileSerializer(serializers.ModelSerializer):
     model  = Alnfile
     fields = ('filename_on_disk','checksum','filetype','download')
 
-class AlignmentSerializer(serializers.ModelSerializer):
+class AlignmentSerializer(SparseFieldsMixin, serializers.ModelSerializer):
   '''
   A bridging serializer between Lane and Alnfile.
   '''
   genome   = serializers.StringRelatedField()
   alnfile_set = AlnfileSerializer(read_only=True, many=True)
-  mergedalignment_set = serializers.HyperlinkedRelatedField(many=True,
-                                                            view_name='api:mergedalignment-detail',
-                                                            read_only=True)
+  mergedalignment_set = DataProcessLinkField(many=True,
+                                             view_name='api:mergedalignment-detail',
+                                             read_only=True)
   
   class Meta:
     model = Alignment
@@ -24,7 +24,38 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import os
+import re
+import shutil
+import gzip
+import hashlib
+import json
+import tempfile
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from datetime import date
+import xml.etree.ElementTree as ET
+
+import pysam
+
+from django.test import TestCase, SimpleTestCase
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from rest_framework.test import APIClient
+
+from osqutil.http_cache import ResponseCache
+from .pipeline.lims_client import LimsClient
+from .pipeline.upstream_lims import Lims, index_flowcells
+from .pipeline import flowcell
+from .pipeline.flowcell import FlowCellProcess, INTERNAL_DEMUX
+from .pipeline.bampy import Bamfile, BamStats
+from .qualplot import cached_qualplot, evict_tmpfiles, CACHED_PLOT_RE
+from .models import Species, Genome, Tissue, Source, Sample, Libtype, \
+    Library, Project, Machine, Facility, Status, Filetype, Lane, Lanefile, \
+    Alignment, Alnfile, MergedAlignment, MergedAlnfile, Adapter, FlowcellRun, \
+    user_project_ids
 
 
 class SimpleTest(TestCase):
@@ -33,3 +64,620 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+# Contents of the files served by FakeLimsHandler.
+FILE_DATA = ''.join([ chr((num * 7919) % 251) for num in range(3000000) ])
+
+
+# The maximum number of database queries allowed for each API
+# endpoint, whatever the number of records returned.
+QUERY_BUDGETS = {
+    'project'         : 2,
+    'library'         : 2,
+    'lane'            : 3,
+    'alignment'       : 3,
+    'mergedalignment' : 3,
+}
+
+
+class ApiQueryCountTest(TestCase):
+    """
+    Checks that the API list and detail views run a fixed number of
+    queries, so that N+1 query patterns are caught.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user('tester', 'tester@example.com', 'pw')
+        self.other = User.objects.create_user('other', 'other@example.com', 'pw')
+        self.project = Project.objects.create(code='test', name='Test', lab='odom')
+        self.project.people.add(self.user)
+        species = Species.objects.get(scientific_name='Mus musculus') # From migration 0003.
+        self.cv = {
+            'genome'   : Genome.objects.create(code='mm10', species=species),
+            'tissue'   : Tissue.objects.create(name='liver'),
+            'source'   : Source.objects.create(name='mouse'),
+            'libtype'  : Libtype.objects.create(code='chip', name='ChIP-Seq'),
+            'machine'  : Machine.objects.create(code='HWI-1', platform='Illumina', name='hiseq'),
+            'facility' : Facility.objects.create(code='CRI', name='CRUK-CI'),
+            'status'   : Status.objects.create(code='complete', description='Complete'),
+            'fastq'    : Filetype.objects.create(code='fq', name='fastq', suffix='fq'),
+            'bam'      : Filetype.objects.create(code='bam', name='bam', suffix='bam'),
+        }
+        self.api = APIClient()
+        self.api.force_authenticate(user=self.user)
+
+    def _add_library(self, num):
+        cv  = self.cv
+        sample = Sample.objects.create(name='sample%d' % num, tissue=cv['tissue'],
+                                       source=cv['source'])
+        lib = Library.objects.create(code='do%d' % num, genome=cv['genome'],
+                                     sample=sample, libtype=cv['libtype'])
+        lib.projects.add(self.project)
+        merged = MergedAlignment.objects.create()
+        for flowlane in (1, 2):
+            lane = Lane.objects.create(library=lib, machine=cv['machine'],
+                                       flowcell='FC%d' % num, flowlane=flowlane,
+                                       rundate=date.today(), lanenum=flowlane,
+                                       facility=cv['facility'], status=cv['status'])
+            for read in (1, 2):
+                Lanefile.objects.create(filename='do%d_%d_%d.fq' % (num, flowlane, read),
+                                        checksum='0', filetype=cv['fastq'], lane=lane)
+            aln = Alignment.objects.create(genome=cv['genome'], total_reads=10,
+                                           mapped=5, lane=lane)
+            Alnfile.objects.create(filename='do%d_%d.bam' % (num, flowlane),
+                                   checksum='0', filetype=cv['bam'], alignment=aln)
+            merged.alignments.add(aln)
+        MergedAlnfile.objects.create(filename='do%d.bam' % num, checksum='0',
+                                     filetype=cv['bam'], alignment=merged)
+        return lib
+
+    def test_list_budgets(self):
+        for num in range(6):
+            self._add_library(num)
+            for (name, budget) in QUERY_BUDGETS.iteritems():
+                with self.assertNumQueries(budget):
+                    resp = self.api.get(reverse('api:%s-list' % name))
+                self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.data['results']), 6)
+
+    def test_detail_budgets(self):
+        lib = self._add_library(1)
+        lane = lib.lane_set.all()[0]
+        aln = lane.alignment_set.all()[0]
+        objects = {
+            'project'         : self.project,
+            'library'         : lib,
+            'lane'            : lane,
+            'alignment'       : aln,
+            'mergedalignment' : aln.mergedalignment_set.all()[0],
+        }
+        user_project_ids(self.user)
+        for (name, obj) in objects.iteritems():
+            url = reverse('api:%s-detail' % name, args=(obj.pk,))
+            checks = 0 if name == 'project' else 1 # Permission check.
+            with self.assertNumQueries(QUERY_BUDGETS[name] + checks):
+                resp = self.api.get(url)
+            self.assertEqual(resp.status_code, 200)
+
+            other = APIClient()
+            other.force_authenticate(user=self.other)
+            self.assertEqual(other.get(url).status_code, 404)
+
+            if name == 'mergedalignment':
+                self.assertEqual(resp.data['genome'], 'mm10')
+
+    def test_deferred_lane_detail(self):
+        # LaneViewSet defers fields, so the permission check sees a
+        # Lane subclass rather than Lane itself.
+        lane = self._add_library(1).lane_set.all()[0]
+        resp = self.api.get(reverse('api:lane-detail', args=(lane.pk,)))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data['flowlane'], lane.flowlane)
+        self.assertEqual(len(resp.data['alignment_set']), 1)
+
+    def test_sparse_fields(self):
+        self._add_library(1)
+        with self.assertNumQueries(2):
+            resp = self.api.get(reverse('api:lane-list'), { 'fields' : 'flowcell,flowlane,lanefile_set' })
+        self.assertEqual(sorted(resp.data['results'][0].keys()),
+                         ['flowcell', 'flowlane', 'lanefile_set'])
+        self.assertEqual(len(resp.data['results'][0]['lanefile_set']), 2)
+
+    def test_pagination(self):
+        for num in range(3):
+            self._add_library(num)
+        url   = reverse('api:lane-list')
+        codes = []
+        while url is not None:
+            resp = self.api.get(url, { 'page_size' : 4 } if len(codes) == 0 else {})
+            codes += [ (x['library'], x['flowlane']) for x in resp.data['results'] ]
+            url = resp.data['next']
+        self.assertEqual(len(codes), 6)
+        self.assertEqual(len(set(codes)), 6)
+
+    def test_membership_cache(self):
+        self.assertEqual(user_project_ids(self.user), set([self.project.id]))
+        with self.assertNumQueries(0):
+            user_project_ids(self.user)
+        other = Project.objects.create(code='other', name='Other', lab='odom')
+        other.people.add(self.user)
+        self.assertEqual(user_project_ids(self.user), set([self.project.id, other.id]))
+        other.people.clear()
+        self.assertEqual(user_project_ids(self.user), set([self.project.id]))
+        self.user.project_set.remove(self.project)
+        self.assertEqual(user_project_ids(self.user), set())
+
+    def test_download_permission(self):
+        lib = self._add_library(1)
+        lfile = Lanefile.objects.filter(lane__library=lib)[0]
+        url = reverse('api:lanefile-download', args=(lfile.id,))
+        user_project_ids(self.user)
+        with self.assertNumQueries(2): # File, then permission check.
+            resp = self.api.get(url)
+        self.assertEqual(resp.status_code, 404) # Not present on disk.
+
+        other = APIClient()
+        other.force_authenticate(user=self.other)
+        self.assertEqual(other.get(url).status_code, 302)
+
+    def test_manifest(self):
+        for num in range(3):
+            self._add_library(num)
+        url = reverse('api:project-manifest', args=('TEST',))
+        with self.assertNumQueries(4): # Project, then one per file class.
+            resp = self.api.get(url)
+            lines = ''.join(resp.streaming_content).splitlines()
+        self.assertEqual(resp.status_code, 200)
+        records = [ json.loads(line) for line in lines ]
+        self.assertEqual(len(records), 21)
+        self.assertEqual(len([ x for x in records if x['merged'] ]), 3)
+        fastqs = [ x for x in records if x['filetype'] == 'fastq' ]
+        self.assertEqual(len(fastqs), 12)
+        self.assertEqual(fastqs[0]['library'], 'do0')
+        self.assertTrue(fastqs[0]['download'].endswith(
+            reverse('api:lanefile-download', args=(Lanefile.objects.order_by('id')[0].id,))))
+
+        other = APIClient()
+        other.force_authenticate(user=self.other)
+        self.assertEqual(other.get(url).status_code, 404)
+
+
+class RunningLims(object):
+    """
+    Stands in for the upstream LIMS, which demultiplexing never queries.
+    """
+    def running(self):
+        return True
+
+
+class InternalDemultiplexTest(TestCase):
+    """
+    Runs a header-indexed fastq file through the internal demultiplexer.
+    """
+    def setUp(self):
+        self.pwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+
+        # The configured group is site-specific, so file permissions
+        # are left alone here.
+        self.set_file_permissions = flowcell.set_file_permissions
+        flowcell.set_file_permissions = lambda group, path: None
+
+        species = Species.objects.get(scientific_name='Mus musculus') # From migration 0003.
+        genome = Genome.objects.create(code='mm10', species=species)
+        sample = Sample.objects.create(name='sample',
+                                       tissue=Tissue.objects.create(name='liver'),
+                                       source=Source.objects.create(name='mouse'))
+        libtype = Libtype.objects.create(code='chip', name='ChIP-Seq')
+        for (code, seq) in (('do1', 'ACGTAC'), ('do2', 'TTGGCA')):
+            adapter = Adapter.objects.create(code='a%s' % code, sequence=seq, protocol='x')
+            Library.objects.create(code=code, genome=genome, sample=sample,
+                                   libtype=libtype, adapter=adapter)
+
+    def tearDown(self):
+        flowcell.set_file_permissions = self.set_file_permissions
+        os.chdir(self.pwd)
+        shutil.rmtree(self.tmpdir)
+
+    def _sequences(self, fname):
+        with gzip.open(fname) as handle:
+            return [ line.strip() for (num, line) in enumerate(handle) if num % 4 == 1 ]
+
+    def test_demultiplex(self):
+        fname = 'do1,do2.FC1.s_1.r_1.fq.gz'
+        with gzip.open(fname, 'wb') as out:
+            # All the read sequences start with the same bases.
+            for (num, code) in enumerate(['ACGTAC', 'TTGGCA', 'ACGTAA', 'GGGGGG']):
+                out.write("@M1:5:FC1:1:1:1:%d 1:N:0:%s\nACGTACGTAC%d\n+\nIIIIIIIIIII\n"
+                          % (num, code, num))
+        proc = FlowCellProcess(lims=RunningLims(), demux_prog=INTERNAL_DEMUX)
+        proc.demultiplex(['do1', 'do2'], fname)
+        self.assertEqual(self._sequences('do1.FC1.s_1.r_1.fq.gz'),
+                         ['ACGTACGTAC0', 'ACGTACGTAC2'])
+        self.assertEqual(self._sequences('do2.FC1.s_1.r_1.fq.gz'), ['ACGTACGTAC1'])
+        self.assertEqual(self._sequences('unmatched.FC1.s_1.r_1.fq.gz'), ['ACGTACGTAC3'])
+
+
+class FlowcellIndexTest(TestCase):
+
+    HISTORY = """<runs>
+<run><flowcell><flowcellId>FC1</flowcellId></flowcell><runFolder>run1</runFolder></run>
+<run><flowcell><flowcellId>FC2</flowcellId></flowcell><runFolder>run2</runFolder></run>
+<run><runFolder>run3</runFolder></run>
+</runs>"""
+
+    def test_record_flowcells(self):
+        lims = Lims.__new__(Lims) # Avoids querying the LIMS.
+        lims._fcid_mapping = {}
+        self.assertEqual(lims.record_flowcells(ET.fromstring(self.HISTORY)), 2)
+        self.assertEqual(lims._fcid_mapping, { 'FC1' : 'run1', 'FC2' : 'run2' })
+        self.assertEqual(Lims._indexed_run_id('FC2'), 'run2')
+        self.assertEqual(lims.record_flowcells(ET.fromstring(self.HISTORY)), 0)
+        self.assertEqual(FlowcellRun.objects.count(), 2)
+
+    def test_concurrent_insert(self):
+        FlowcellRun.objects.create(flowcell='FC1', run_folder='run1')
+
+        # Simulate another process indexing FC1 after our check.
+        FlowcellRun.objects.filter = lambda **kwargs: FlowcellRun.objects.none()
+        try:
+            added = index_flowcells({ 'FC1' : 'other', 'FC2' : 'run2' })
+        finally:
+            del FlowcellRun.objects.filter
+        self.assertEqual(added, 1)
+        self.assertEqual(dict(FlowcellRun.objects.values_list('flowcell', 'run_folder')),
+                         { 'FC1' : 'run1', 'FC2' : 'run2' })
+
+
+class FakeLimsHandler(BaseHTTPRequestHandler):
+    """
+    Serves fullDetailsOfRun responses with an ETag; the first request
+    for a run ID ending in 'flaky' fails with a 503 status. Paths
+    under /files/ serve FILE_DATA, honouring Range requests; the
+    first request for a file ending in 'broken' is cut short.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, self.headers.get('If-None-Match')))
+            attempt = server.requests.count((self.path, None))
+        etag = '"%s"' % self.path
+        if self.path.startswith('/files/'):
+            self._send_file(attempt)
+        elif self.path.endswith('flaky') and attempt == 1:
+            self._respond(503, '')
+        elif self.headers.get('If-None-Match') == etag:
+            self._respond(304, '')
+        else:
+            self._respond(200, '<run><runFolder>%s</runFolder></run>'
+                          % self.path.split('=')[-1], etag)
+
+    def _respond(self, status, body, etag=None):
+        self.send_response(status)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_file(self, attempt):
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        start = 0 if match is None else int(match.group(1))
+        self.send_response(200 if start == 0 else 206)
+        if start > 0:
+            self.send_header('Content-Range', 'bytes %d-%d/%d'
+                             % (start, len(FILE_DATA) - 1, len(FILE_DATA)))
+        self.send_header('Content-Length', str(len(FILE_DATA) - start))
+        self.end_headers()
+        if self.path.endswith('broken') and attempt == 1:
+            self.wfile.write(FILE_DATA[start:start + 1000000])
+            self.close_connection = 1
+        else:
+            self.wfile.write(FILE_DATA[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeLimsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class LimsClientTest(SimpleTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = FakeLimsServer(('127.0.0.1', 0), FakeLimsHandler)
+        self.server.lock     = threading.Lock()
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.uri = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def _client(self, ttl):
+        cache = ResponseCache(os.path.join(self.tmpdir, 'lims.sqlite'))
+        return LimsClient(timeout=5, retries=2, backoff=0, cache=cache, ttl=ttl)
+
+    def test_fetch_all(self):
+        urls = [ '%s/fullDetailsOfRun?runId=run%d' % (self.uri, num)
+                 for num in range(6) ] + [ '%s/fullDetailsOfRun?runId=flaky' % self.uri ]
+        bodies = self._client(ttl=300).fetch_all(urls)
+        self.assertEqual(bodies[2], '<run><runFolder>run2</runFolder></run>')
+        self.assertEqual(bodies[6], '<run><runFolder>flaky</runFolder></run>')
+        self.assertEqual(len(self.server.requests), 8)
+
+        # A new client (as in a later cron job) uses the on-disk cache.
+        self.assertEqual(self._client(ttl=300).fetch_all(urls), bodies)
+        self.assertEqual(len(self.server.requests), 8)
+
+        # Stale entries are revalidated rather than downloaded again.
+        self.assertEqual(self._client(ttl=0).fetch_all(urls), bodies)
+        self.assertEqual(len(self.server.requests), 15)
+        self.assertTrue(all([ etag is not None
+                              for (_path, etag) in self.server.requests[8:] ]))
+
+    def test_failure(self):
+        client = LimsClient(timeout=5, retries=1, backoff=0)
+        self.assertEqual(client.fetch('%s/fullDetailsOfRun?runId=flaky' % self.uri),
+                         '<run><runFolder>flaky</runFolder></run>')
+        client = LimsClient(timeout=5, retries=0, backoff=0)
+        self.assertEqual(client.fetch('%s/a/flaky' % self.uri), None)
+
+    def test_download(self):
+        client = LimsClient(timeout=5, retries=1, backoff=0)
+        target = os.path.join(self.tmpdir, 'test.fq.gz')
+        md5sum = hashlib.md5(FILE_DATA).hexdigest()
+
+        # An interrupted download is resumed.
+        (digest, size, _secs) = client.download('%s/files/broken' % self.uri, target,
+                                                md5sum=md5sum)
+        self.assertEqual((digest, size), (md5sum, len(FILE_DATA)))
+        self.assertFalse(os.path.exists('%s.part' % target))
+        with open(target, 'rb') as handle:
+            self.assertEqual(handle.read(), FILE_DATA)
+
+        # As is one left over from an earlier process.
+        os.unlink(target)
+        with open('%s.part' % target, 'wb') as out:
+            out.write(FILE_DATA[:12345])
+        (digest, size, _secs) = client.download('%s/files/test' % self.uri, target)
+        self.assertEqual((digest, size), (md5sum, len(FILE_DATA) - 12345))
+        self.assertEqual(self.server.requests[-1][0], '/files/test')
+
+        # Checksum failures leave no trace.
+        os.unlink(target)
+        self.assertRaises(StandardError, client.download, '%s/files/test' % self.uri,
+                          target, md5sum='0' * 32)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+
+class BamStatsTest(SimpleTestCase):
+
+    # (flag, mapq) for each record, including one QC-failed read.
+    RECORDS = [ (0x1 | 0x2 | 0x20 | 0x40, 60),   # read1, proper pair
+                (0x1 | 0x2 | 0x10 | 0x80, 0),    # read2, proper pair, multi
+                (0x1 | 0x2 | 0x40 | 0x100, 0),   # secondary
+                (0x1 | 0x2 | 0x40 | 0x800, 60),  # supplementary
+                (0x200, 60),                     # mapped but QC-failed
+                (0x4, 0) ]                       # unmapped
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.bam = os.path.join(self.tmpdir, 'test.bam')
+        header = { 'HD': { 'VN': '1.0', 'SO': 'coordinate' },
+                   'SQ': [ { 'SN': 'chr1', 'LN': 1000 } ],
+                   'PG': [ { 'ID': 'bwa', 'PN': 'bwa', 'CL': 'bwa mem ref.fa r.fq' } ] }
+        with pysam.AlignmentFile(self.bam, 'wb', header=header) as out:
+            for (num, (flag, mapq)) in enumerate(self.RECORDS):
+                read = pysam.AlignedSegment()
+                read.query_name = 'read%d' % num
+                read.query_sequence = 'ACGTACGTAC'
+                read.query_qualities = pysam.qualitystring_to_array('IIIIIIIIII')
+                read.flag = flag
+                if not flag & 0x4:
+                    read.reference_id = 0
+                    read.reference_start = 100 + num
+                    read.mapping_quality = mapq
+                    read.cigarstring = '10M'
+                else:
+                    read.reference_id = -1
+                    read.reference_start = -1
+                out.write(read)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _check(self, stats):
+        self.assertEqual(stats.qcfail, 1)
+        self.assertEqual(stats.total, 5)
+        self.assertEqual(stats.read_count, 4)
+        self.assertEqual(stats.primary, 3)
+        self.assertEqual((stats.mapped, stats.unmapped), (4, 1))
+        self.assertEqual((stats.paired, stats.read1, stats.read2), (2, 1, 1))
+        self.assertEqual((stats.properly_paired, stats.unique), (2, 1))
+        self.assertEqual(stats.bwa_algorithm(), 'mem')
+
+    def test_qcfail(self):
+        self._check(BamStats.from_bam(self.bam))
+        pysam.index(self.bam)
+        self._check(BamStats.from_bam(self.bam))
+
+    def test_cache(self):
+        stats = BamStats.for_file(self.bam)
+        self._check(stats)
+        self.assertEqual(BamStats.for_file(self.bam).as_dict(), stats.as_dict())
+
+        # Cache files predating the qcfail count are discarded.
+        cachefile = "%s.stats" % self.bam
+        with open(cachefile) as cachefd:
+            data = json.load(cachefd)
+        del data['stats']['qcfail']
+        data['stats']['total'] = 6
+        with open(cachefile, 'w') as cachefd:
+            json.dump(data, cachefd)
+        self._check(BamStats.for_file(self.bam))
+
+
+class SplitByChromosomeTest(SimpleTestCase):
+
+    REFS = ('chr1', 'chr2', 'chrM')
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write_bam(self, name, sort_order):
+        """
+        Write three reads to each reference, either coordinate-sorted
+        or interleaved between references.
+        """
+        fname = os.path.join(self.tmpdir, name)
+        header = { 'HD': { 'VN': '1.0', 'SO': sort_order },
+                   'SQ': [ { 'SN': ref, 'LN': 1000 } for ref in self.REFS ] }
+        reads = [ (tid, pos) for tid in range(len(self.REFS)) for pos in range(3) ]
+        if sort_order != 'coordinate':
+            reads.sort(key=lambda x: (x[1], x[0]))
+        with pysam.AlignmentFile(fname, 'wb', header=header) as out:
+            for (tid, pos) in reads:
+                read = pysam.AlignedSegment()
+                read.query_name = '%s_%d' % (self.REFS[tid], pos)
+                read.query_sequence = 'ACGTACGTAC'
+                read.query_qualities = pysam.qualitystring_to_array('IIIIIIIIII')
+                read.reference_id = tid
+                read.reference_start = 100 * (pos + 1)
+                read.mapping_quality = 60
+                read.cigarstring = '10M'
+                out.write(read)
+        return fname
+
+    def _check_split(self, sort_order, mode):
+        fname = self._write_bam('%s_%s.bam' % (sort_order, mode), sort_order)
+        with Bamfile(fname) as bam:
+            parts = bam.split_by_chromosome(pattern=r'chr\d', mode=mode, processes=2)
+        self.assertEqual([ os.path.basename(part.filename) for part in parts ],
+                         [ '%s_%s_%s.bam' % (sort_order, mode, ref) for ref in ('chr1', 'chr2') ])
+        for (ref, part) in zip(('chr1', 'chr2'), parts):
+            names = [ read.query_name for read in part.fetch(until_eof=True) ]
+            part.close()
+            self.assertEqual(names, [ '%s_%d' % (ref, pos) for pos in range(3) ])
+            self.assertEqual(os.path.exists('%s.bai' % part.filename),
+                             sort_order == 'coordinate')
+
+    def test_serial(self):
+        self._check_split('coordinate', 'serial')
+        self._check_split('unsorted', 'serial')
+
+    def test_stream(self):
+        self._check_split('coordinate', 'stream')
+        self._check_split('unsorted', 'stream')
+
+    def test_parallel(self):
+        self._check_split('coordinate', 'parallel')
+        self._check_split('unsorted', 'parallel')
+
+
+class ExpandTalliedReadsTest(SimpleTestCase):
+
+    # (read ID, mapq); zero mapping quality marks a multi-mapping read.
+    RECORDS = [ ('smRNA_1:count_3', 60),
+                ('smRNA_2:count_2', 0),
+                ('smRNA_3:count_1', 60) ]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.bam = self._write_bam('tallied.bam', self.RECORDS)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write_bam(self, name, records):
+        fname = os.path.join(self.tmpdir, name)
+        header = { 'HD': { 'VN': '1.0', 'SO': 'unsorted' },
+                   'SQ': [ { 'SN': 'chr1', 'LN': 1000 } ] }
+        with pysam.AlignmentFile(fname, 'wb', header=header) as out:
+            for (num, (name, mapq)) in enumerate(records):
+                read = pysam.AlignedSegment()
+                read.query_name = name
+                read.query_sequence = 'ACGTACGTAC'
+                read.query_qualities = pysam.qualitystring_to_array('IIIIIIIIII')
+                read.reference_id = 0
+                read.reference_start = 100 * (num + 1)
+                read.mapping_quality = mapq
+                read.cigarstring = '10M'
+                out.write(read)
+        return fname
+
+    def _expand(self, **kwargs):
+        outfile = os.path.join(self.tmpdir, 'expanded.bam')
+        with Bamfile(self.bam) as bam:
+            bam.expand_tallied_reads(outfile, **kwargs).close()
+        with Bamfile(outfile) as out:
+            return [ read for read in out.fetch(until_eof=True) ]
+
+    def test_expand(self):
+        for threads in (1, 2):
+            reads = self._expand(threads=threads)
+            self.assertEqual([ read.query_name for read in reads ],
+                             [ 'smRNA_1:read_1', 'smRNA_1:read_2', 'smRNA_1:read_3',
+                               'smRNA_3:read_1' ])
+            self.assertEqual(len(self._expand(keep_multi=True, threads=threads)), 6)
+
+    def test_count_tag(self):
+        for threads in (1, 2):
+            reads = self._expand(count_tag='XC', threads=threads)
+            self.assertEqual([ (read.query_name, read.get_tag('XC')) for read in reads ],
+                             [ ('smRNA_1:count_3', 3), ('smRNA_3:count_1', 1) ])
+            reads = self._expand(keep_multi=True, count_tag='XC', threads=threads)
+            self.assertEqual(sum([ read.get_tag('XC') for read in reads ]), 6)
+
+    def test_bad_read_id(self):
+        self.bam = self._write_bam('bad.bam', [ ('smRNA_1', 60) ])
+        self.assertRaises(StandardError, self._expand)
+
+
+class QualplotTest(SimpleTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_cached_plots(self):
+        means  = [ 30.0 + (num % 5) for num in range(50) ]
+        stdevs = [ 2.5 ] * 50
+        base = cached_qualplot(Lane(id=7), 'pf', means, stdevs, tmpdir=self.tmpdir)
+        self.assertTrue(CACHED_PLOT_RE.match(base))
+        self.assertTrue(base.startswith('qualplot_7_pf_'))
+        path = os.path.join(self.tmpdir, base)
+        with open(path, 'rb') as handle:
+            self.assertEqual(handle.read(8), '\x89PNG\r\n\x1a\n')
+
+        # Unchanged values reuse the existing plot; new values do not.
+        os.utime(path, (0, 0))
+        self.assertEqual(cached_qualplot(Lane(id=7), 'pf', means, stdevs,
+                                         tmpdir=self.tmpdir), base)
+        self.assertNotEqual(os.stat(path).st_mtime, 0)
+        other = cached_qualplot(Lane(id=7), 'pf', means[1:], stdevs[1:],
+                                tmpdir=self.tmpdir)
+        self.assertNotEqual(other, base)
+        self.assertEqual(cached_qualplot(Lane(id=7), 'pf', [], [],
+                                         tmpdir=self.tmpdir), None)
+
+        # Eviction removes the least recently used files first.
+        os.utime(path, (0, 0))
+        evict_tmpfiles(self.tmpdir,
+                       max_bytes=os.stat(os.path.join(self.tmpdir, other)).st_size)
+        self.assertEqual(os.listdir(self.tmpdir), [other])
@@ -34,7 +34,8 @@ router.register(r'alignments', views.AlignmentViewSet, base_name='alignment')
 router.register(r'mergedalignments', views.MergedAlignmentViewSet, base_name='mergedalignment')
 
 # REST API file download links. This can be extended as necessary to
-# Alnfile, QCfile etc.
+# Alnfile, QCfile etc. The project manifest lists every such link for
+# a given project.
 restdownloadurls = [
   url(r'^download/lanefile/(?P<pk>\d+)$',
       views.RESTFileDownloadView.as_view(),
@@ -51,6 +52,10 @@ restdownloadurls = [
       name='mergedalnfile-download',
       kwargs={'cls': 'mergedalnfile'}
     ),
+  url(r'^projects/(?P<code>[^/]+)/manifest/$',
+      views.ProjectManifestView.as_view(),
+      name='project-manifest',
+    ),
 ]
 
 # Repository app URLs.
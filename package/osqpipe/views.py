@@ -19,6 +19,7 @@
 
 import os
 import re
+import json
 
 from urllib import urlencode
 
@@ -26,7 +27,9 @@ from django.conf import settings
 from django.utils import timezone
 from datetime import timedelta
 
-from django.http import Http404, HttpResponse
+from django.http import Http404, HttpResponse, HttpResponseNotModified,\
+    StreamingHttpResponse
+from django.utils.cache import patch_cache_control
 from django.utils.translation import ugettext as _
 from django.shortcuts import get_object_or_404, redirect
 from django.views.generic.edit import FormMixin
@@ -34,7 +37,8 @@ from collections import OrderedDict
 
 from .models import Library, Project, Genome, Lane, Alnfile, Lanefile, QCfile,\
     AlnQCfile, Peakfile, MergedAlignment, MergedAlnfile, HistologyImagefile,\
-    Alignment, Sample
+    Alignment, Sample, user_project_ids
+from django.db.models import Prefetch
 from .forms import SimpleSearchForm, LibrarySearchForm, LibraryEditForm,\
     LibraryProjectPicker
 
@@ -44,8 +48,7 @@ from django.core.urlresolvers import reverse
 
 from django.contrib import messages
 
-from urlparse import urlparse # FIXME workaround for qualplot output
-from .qualplot import plot_pfqual_values, plot_all_qual_values
+from .qualplot import plot_pfqual_values, plot_all_qual_values, CACHED_PLOT_RE
 from osqutil.config import Config
 from mimetypes import guess_type
 
@@ -53,9 +56,10 @@ from .viewclasses import MyListView, MyDetailView, MyFormView, FilterMixin,\
   FormListView, RestrictedFileDownloadView
 
 from .serializers import ProjectSerializer, LibrarySerializer, LaneSerializer, \
-  AlignmentSerializer, MergedAlignmentSerializer
+  AlignmentSerializer, MergedAlignmentSerializer, requested_fields
 from .permissions import IsProjectMember
 from rest_framework import viewsets, permissions, authentication
+from rest_framework.pagination import CursorPagination
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.status import HTTP_400_BAD_REQUEST
@@ -121,7 +125,7 @@ class LibraryListView(FilterMixin, FormListView):
     self._project = get_object_or_404(Project, code=self.kwargs['project'])
 
     # Per-project user authorization.
-    if self.request.user not in self._project.people.all():
+    if self._project.id not in user_project_ids(self.request.user):
       return redirect('denied')
 
     return super(LibraryListView, self).get(request, *args, **kwargs)
@@ -218,7 +222,7 @@ class LibrarySearchView(MyFormView):
     project = get_object_or_404(Project, code=self.kwargs['project'])
 
     # Per-project user authorization. This might be overkill for a search form.
-    if self.request.user not in project.people.all():
+    if project.id not in user_project_ids(self.request.user):
       return redirect('denied')
 
     # Probably not actually necessary, this is just defensive. It does
@@ -263,9 +267,8 @@ class LibraryEditView(MyFormView):
     self.object = get_object_or_404(self.model, code=self.kwargs['slug'])
 
     # Per-project user authorization.
-    allowed_users = [ person for project in self.object.projects.all()
-                             for person  in project.people.all() ]
-    if self.request.user not in allowed_users:
+    if not self.object.projects\
+          .filter(id__in=user_project_ids(self.request.user)).exists():
       return redirect('denied')
 
     # Hard links to edit pages will set the parent breadcrumbs
@@ -299,9 +302,8 @@ class LibraryDetailView(FormMixin, MyDetailView):
     self.object = get_object_or_404(self.model, code=self.kwargs['slug'])
 
     # Per-project user authorization.
-    allowed_users = [ person for project in self.object.projects.all()
-                             for person  in project.people.all() ]
-    if self.request.user not in allowed_users:
+    if not self.object.projects\
+          .filter(id__in=user_project_ids(self.request.user)).exists():
       return redirect('denied')
 
     self.request.session['session_library'] = self.object.code
@@ -409,9 +411,8 @@ class LaneDetailView(MyDetailView):
     object = get_object_or_404(self.model, id=self.kwargs['pk'])
 
     # Per-project user authorization.
-    allowed_users = [ person for project in object.library.projects.all()
-                             for person  in project.people.all() ]
-    if self.request.user not in allowed_users:
+    if not object.library.projects\
+          .filter(id__in=user_project_ids(self.request.user)).exists():
       return redirect('denied')
 
     self.request.session['session_lane'] = object.pk
@@ -430,10 +431,8 @@ class SampleDetailView(MyDetailView):
     object = get_object_or_404(self.model, id=self.kwargs['pk'])
 
     # Per-project user authorization.
-    allowed_users = [ person for library in object.library_set.all()
-                             for project in library.projects.all()
-                             for person  in project.people.all() ]
-    if self.request.user not in allowed_users:
+    if not Project.objects.filter(libraries__sample=object,
+                                  id__in=user_project_ids(self.request.user)).exists():
       return redirect('denied')
 
     self.request.session['session_sample'] = object.pk
@@ -448,11 +447,8 @@ class QualplotDetailView(LaneDetailView):
   def get_context_data(self, *args, **kwargs):
     '''Add extra context to control the view.'''
     context = super(QualplotDetailView, self).get_context_data(*args, **kwargs)
-    lane    = get_object_or_404(self.model, id=self.kwargs['pk'])
-    url = urlparse(plot_all_qual_values(lane))
-    context['qualplot_file_all'] = url.path.split("/")[-1]
-    url = urlparse(plot_pfqual_values(lane))
-    context['qualplot_file_pf']  = url.path.split("/")[-1]
+    context['qualplot_file_all'] = plot_all_qual_values(self.object)
+    context['qualplot_file_pf']  = plot_pfqual_values(self.object)
     return context
 
 class FileDownloadMixin(object):      
@@ -463,38 +459,50 @@ class FileDownloadMixin(object):
   def get(self, request, *args, **kwargs):
     cls = self.kwargs['cls']
 
+    # Each file class has a lookup path to its projects, and the
+    # related objects needed to locate the file on disk.
     if cls == 'alnfile':
-      model = Alnfile
-      libraryrel = lambda x: x.alignment.lane.library
+      model    = Alnfile
+      projects = 'alignment__lane__library__projects'
+      related  = ('alignment__lane__library',)
     elif cls == 'lanefile':
-      model = Lanefile
-      libraryrel = lambda x: x.lane.library
+      model    = Lanefile
+      projects = 'lane__library__projects'
+      related  = ('lane__library',)
     elif cls == 'qcfile':
-      model = QCfile
-      libraryrel = lambda x: x.laneqc.lane.library
+      model    = QCfile
+      projects = 'laneqc__lane__library__projects'
+      related  = ('laneqc__lane__library',)
     elif cls == 'alnqcfile':
-      model = AlnQCfile
-      libraryrel = lambda x: x.alignmentqc.alignment.lane.library
+      model    = AlnQCfile
+      projects = 'alignmentqc__alignment__lane__library__projects'
+      related  = ('alignmentqc__alignment__lane__library',)
     elif cls == 'peakfile':
-      model = Peakfile
-      libraryrel = lambda x: x.peakcalling.factor_align.lane.library
+      model    = Peakfile
+      projects = 'peakcalling__factor_align__lane__library__projects'
+      related  = ('peakcalling__factor_align__lane__library',)
     elif cls == 'mergedalnfile':
-      model = MergedAlnfile
-      libraryrel = lambda x: x.alignment.alignments.all()[0].lane.library # First alignment determines access FIXME.
+      model    = MergedAlnfile
+      projects = 'alignment__alignments__lane__library__projects'
+      related  = ()
     elif cls == 'histologyimagefile':
-      model = HistologyImagefile
-      libraryrel = lambda x: x.sample.library_set.all()[0] # First library determines access FIXME.
+      model    = HistologyImagefile
+      projects = 'sample__library__projects'
+      related  = ()
     else:
       raise ValueError("Unrecognised file class for download: %s" % (cls))
 
-    fobj = get_object_or_404(model, id=self.kwargs['pk'])
+    fobj = get_object_or_404(model.objects.select_related('filetype', 'archive', *related),
+                             id=self.kwargs['pk'])
     filepath = fobj.repository_file_path
 
-    # Per-project user authorization.
-    library = libraryrel(fobj)
-    allowed_users = [ person for project in library.projects.all()
-                             for person  in project.people.all() ]
-    if self.request.user not in allowed_users:
+    # Per-project user authorization. Given the user's cached project
+    # memberships this is a single query (or none at all, for users
+    # with no projects). Merged files are accessible to members of any
+    # project containing one of their constituent libraries.
+    allowed = model.objects.filter(id=fobj.id, **{ '%s__in' % projects :
+                                                     user_project_ids(self.request.user) })
+    if not allowed.exists():
       return redirect('denied')
 
     # File not found is a standard 404 situation. We could conceivably
@@ -543,10 +551,20 @@ class TempfileDownloadView(RestrictedFileDownloadView):
     if not os.path.exists(filepath):
       raise Http404(_(u"Requested temporary file not found: %s" % (fname,)))
 
+    # Cached plots are named by their content, so browsers may keep
+    # them indefinitely.
+    cacheable = CACHED_PLOT_RE.match(fname) is not None
+    etag      = '"%s"' % fname
+    if cacheable and request.META.get('HTTP_IF_NONE_MATCH') == etag:
+      return HttpResponseNotModified()
+
     mtype    = guess_type(fname)
     response = HttpResponse(content_type=mtype[0])
     response['Content-Encoding'] = mtype[1]
     response['X-Sendfile']       = smart_str(filepath)
+    if cacheable:
+      response['ETag'] = etag
+      patch_cache_control(response, private=True, max_age=365 * 24 * 60 * 60)
 
     return response
 
@@ -604,9 +622,50 @@ obtain_expiring_auth_token = ObtainExpiringAuthToken.as_view()
 #
 # Actual API views start here.
 #
+class ApiCursorPagination(CursorPagination):
+  '''
+  Cursor-based pagination for the API list views. Unlike offset
+  pagination this needs no count query, and remains stable while
+  records are being added.
+  '''
+  page_size             = 100
+  page_size_query_param = 'page_size'
+  max_page_size         = 1000
+  ordering              = 'id'
+
+def user_libraries(user):
+  '''
+  Return a subquery selecting the IDs of all libraries to which the
+  user has access. Filtering on this rather than joining through to
+  the project members avoids the need for DISTINCT queries.
+  '''
+  return Library.objects.filter(projects__people=user).values('id')
+
 class SessionAuthViewSet(viewsets.ReadOnlyModelViewSet):
+  '''
+  Base class for the API viewsets. The select_related and
+  prefetch_related attributes map each serializer field onto the
+  related lookups needed to render it; these are only applied for the
+  fields actually requested (see the fields query parameter).
+  '''
   authentication_classes = ( ExpiringTokenAuthentication,
                              authentication.SessionAuthentication, )
+  pagination_class = ApiCursorPagination
+  select_related   = {}
+  prefetch_related = {}
+
+  def optimise_queryset(self, queryset):
+    '''
+    Add the related lookups needed by the requested fields to queryset.
+    '''
+    fields = requested_fields(self.request)
+    for (field, lookups) in self.select_related.iteritems():
+      if fields is None or field in fields:
+        queryset = queryset.select_related(*lookups)
+    for (field, lookups) in self.prefetch_related.iteritems():
+      if fields is None or field in fields:
+        queryset = queryset.prefetch_related(*lookups)
+    return queryset
 
 class ProjectViewSet(SessionAuthViewSet):
   '''
@@ -615,9 +674,12 @@ class ProjectViewSet(SessionAuthViewSet):
   serializer_class = ProjectSerializer
   permission_classes = ( permissions.IsAuthenticated,
                          IsProjectMember )
+  prefetch_related = {
+    'libraries' : (Prefetch('libraries', queryset=Library.objects.only('code')),),
+  }
 
   def get_queryset(self):
-    return Project.objects.filter(people=self.request.user)
+    return self.optimise_queryset(Project.objects.filter(people=self.request.user))
 
 class LibraryViewSet(SessionAuthViewSet):
   '''
@@ -626,9 +688,23 @@ class LibraryViewSet(SessionAuthViewSet):
   serializer_class = LibrarySerializer
   permission_classes = ( permissions.IsAuthenticated,
                          IsProjectMember )
+  select_related = {
+    'libtype'  : ('libtype',),
+    'factor'   : ('factor',),
+    'adapter'  : ('adapter',),
+    'adapter2' : ('adapter2',),
+    'sample'   : ('sample__tissue', 'sample__source__sex',
+                  'sample__source__strain', 'sample__source__species'),
+  }
+  prefetch_related = {
+    # Lane.__unicode__ (used to label the links) needs these.
+    'lane_set' : (Prefetch('lane_set',
+                           queryset=Lane.objects.select_related('library', 'facility')),),
+  }
 
   def get_queryset(self):
-    return Library.objects.filter(projects__people=self.request.user).distinct()
+    return self.optimise_queryset(
+      Library.objects.filter(id__in=user_libraries(self.request.user)))
 
 class LaneViewSet(SessionAuthViewSet):
   '''
@@ -637,9 +713,24 @@ class LaneViewSet(SessionAuthViewSet):
   serializer_class = LaneSerializer
   permission_classes = ( permissions.IsAuthenticated,
                          IsProjectMember )
+  select_related = {
+    'library'  : ('library',),
+    'machine'  : ('machine',),
+    'facility' : ('facility',),
+    'status'   : ('status__authority',),
+  }
+  prefetch_related = {
+    'lanefile_set'  : (Prefetch('lanefile_set',
+                                queryset=Lanefile.objects.select_related('filetype')),),
+    'alignment_set' : ('alignment_set',),
+  }
 
   def get_queryset(self):
-    return Lane.objects.filter(library__projects__people=self.request.user).distinct()
+    # The bulky per-cycle quality arrays are never serialized.
+    return self.optimise_queryset(
+      Lane.objects.filter(library__in=user_libraries(self.request.user))\
+        .defer('seqsamplepf', 'seqsamplebad', 'qualmeanpf', 'qualstdevpf',
+               'qualmean', 'qualstdev'))
 
 class AlignmentViewSet(SessionAuthViewSet):
   '''
@@ -648,10 +739,18 @@ class AlignmentViewSet(SessionAuthViewSet):
   serializer_class = AlignmentSerializer
   permission_classes = ( permissions.IsAuthenticated,
                          IsProjectMember )
+  select_related = {
+    'genome' : ('genome',),
+  }
+  prefetch_related = {
+    'alnfile_set'         : (Prefetch('alnfile_set',
+                                      queryset=Alnfile.objects.select_related('filetype')),),
+    'mergedalignment_set' : ('mergedalignment_set',),
+  }
 
   def get_queryset(self):
-    return Alignment.objects\
-        .filter(lane__library__projects__people=self.request.user).distinct()
+    return self.optimise_queryset(
+      Alignment.objects.filter(lane__library__in=user_libraries(self.request.user)))
 
 class MergedAlignmentViewSet(SessionAuthViewSet):
   '''
@@ -660,10 +759,18 @@ class MergedAlignmentViewSet(SessionAuthViewSet):
   serializer_class = MergedAlignmentSerializer
   permission_classes = ( permissions.IsAuthenticated,
                          IsProjectMember )
+  prefetch_related = {
+    'genome'            : (Prefetch('alignments',
+                                    queryset=Alignment.objects.select_related('genome')),),
+    'mergedalnfile_set' : (Prefetch('mergedalnfile_set',
+                                    queryset=MergedAlnfile.objects.select_related('filetype')),),
+  }
 
   def get_queryset(self):
-    return MergedAlignment.objects\
-        .filter(alignments__lane__library__projects__people=self.request.user).distinct()
+    merged = MergedAlignment.objects\
+        .filter(alignments__lane__library__in=user_libraries(self.request.user))
+    return self.optimise_queryset(
+      MergedAlignment.objects.filter(pk__in=merged.values('pk')))
 
 class RESTFileDownloadView(FileDownloadMixin, APIView):
   '''
@@ -672,4 +779,56 @@ class RESTFileDownloadView(FileDownloadMixin, APIView):
   authentication_classes = ( ExpiringTokenAuthentication,
                              authentication.SessionAuthentication, )
 
+class ProjectManifestView(APIView):
+  '''
+  Streams a JSON-lines manifest of every downloadable file in a
+  project, one object per line, so that clients can synchronise a
+  whole project without walking the library, lane and alignment
+  records one request at a time.
+  '''
+  authentication_classes = ( ExpiringTokenAuthentication,
+                             authentication.SessionAuthentication, )
+  permission_classes = ( permissions.IsAuthenticated, )
+
+  def get(self, request, code, *args, **kwargs):
+
+    # Projects to which the user has no access are simply not found.
+    project   = get_object_or_404(Project, code__iexact=code, people=request.user)
+    libraries = Library.objects.filter(projects=project).values('id')
+    merged    = MergedAlignment.objects\
+        .filter(alignments__lane__library__in=libraries).values('pk')
+
+    # Each queryset is paired with its download view and whether it
+    # holds merged files (which belong to no single library).
+    sources = (
+      (Lanefile.objects.filter(lane__library__in=libraries)\
+         .select_related('filetype', 'archive', 'lane__library'),
+       'api:lanefile-download', False),
+      (Alnfile.objects.filter(alignment__lane__library__in=libraries)\
+         .select_related('filetype', 'archive', 'alignment__lane__library'),
+       'api:alnfile-download', False),
+      (MergedAlnfile.objects.filter(alignment__in=merged)\
+         .select_related('filetype', 'archive'),
+       'api:mergedalnfile-download', True),
+    )
+
+    def manifest():
+      for (queryset, viewname, is_merged) in sources:
+        for fobj in queryset.order_by('id').iterator():
+          try:
+            size = os.path.getsize(fobj.repository_file_path)
+          except OSError, _err:
+            size = None # Archive unavailable; the client must fall back to checksums.
+          record = { 'filename_on_disk' : fobj.filename_on_disk,
+                     'library'          : None if is_merged else fobj.libcode,
+                     'checksum'         : fobj.checksum,
+                     'size'             : size,
+                     'filetype'         : fobj.filetype.name,
+                     'merged'           : is_merged,
+                     'download'         : request.build_absolute_uri(
+                                            reverse(viewname, args=(fobj.id,))) }
+          yield json.dumps(record) + "\n"
+
+    return StreamingHttpResponse(manifest(), content_type='application/x-ndjson')
+
 ################################################################################
@@ -67,7 +67,7 @@ setup(
     'psycopg2',
     'fuzzy',
     'pysam',
-    'gnuplot-py', # N.B. package not on PyPI, so can't be auto-installed.
+    'matplotlib<3', # Quality plots; later releases require python 3.
     'requests',
     'beautifulsoup4',
     'lxml', 
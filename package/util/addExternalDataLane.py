@@ -45,9 +45,10 @@ from django.db import transaction
 from osqutil.config import Config
 from osqutil.utilities import set_file_permissions, is_zipped,\
     rezip_file, unzip_file, checksum_file
+from osqutil.fastq_profile import profile_fastq
 from osqpipe.pipeline.laneqc import LaneFastQCReport
 from osqpipe.pipeline.alignment import count_reads
-from osqutil.samtools import BamToBedConverter
+from osqpipe.pipeline.bampy import PysamBamToBedConverter
 from osqutil.progsum import ProgramSummary
 
 ################################################################################
@@ -80,46 +81,6 @@ class ExternalDataHandler(object):
     else:
       self.genome = Genome.objects.get(code=genome)
 
-  def open_fastq(self, fastq):
-    '''
-    Return a file handle for a fastq file, transparently handling
-    gzipped files.
-    '''
-    if is_zipped(fastq):
-      from gzip import GzipFile
-      gen = lambda x: GzipFile(x)
-    else:
-      gen = lambda x: open(x)
-    return gen(fastq)
-
-  def fastq_readlength(self, fastq):
-    '''
-    Guess the length of the reads in the fastq file. Assumes that the
-    first read in the file is representative.
-    '''
-    # Currently just assumes that the second line is the first read, and
-    # that it is representative.
-    LOGGER.info("Finding read length from fastq file %s...", fastq)
-    rlen = None
-    with self.open_fastq(fastq) as reader:
-      for _num in range(2):
-        line = reader.next()
-      rlen = len(line.rstrip('\n'))
-
-    return rlen
-
-  def fastq_readcount(self, fastq):
-    '''
-    Count the number of reads in the fastq file.
-    '''
-    LOGGER.info("Counting reads in fastq file %s...", fastq)
-    lcount = 0
-    with self.open_fastq(fastq) as reader:
-      for line in reader:
-        lcount += 1
-
-    return lcount/4
-
   def create_unsaved_lane(self, fastqs):
     '''
     Gather statistics from the fastq files and generate a Lane object
@@ -148,9 +109,15 @@ class ExternalDataHandler(object):
       raise ValueError("Can only process either one or two fastq files per lane.")
 
     # Assumes the first fastq is representative.
-    lane.readlength   = self.fastq_readlength(fastqs[0])
-    lane.reads        = self.fastq_readcount(fastqs[0])
-    lane.passedpf     = lane.reads # This is a bit of an assumption FIXME?
+    LOGGER.info("Profiling fastq file %s...", fastqs[0])
+    profile = profile_fastq(fastqs[0])
+    lane.readlength   = profile.readlength
+    lane.reads        = profile.reads
+    lane.passedpf     = profile.passedpf
+    lane.qualmean     = profile.qualmean
+    lane.qualstdev    = profile.qualstdev
+    lane.qualmeanpf   = profile.qualmeanpf
+    lane.qualstdevpf  = profile.qualstdevpf
 
     lanefiles = dict()
     if self.keepfastq:
@@ -190,7 +157,7 @@ class ExternalDataHandler(object):
       LOGGER.warning("Unable to find chromosome sizes file %s. BED file reads will be untrimmed.",
                      chrom_sizes)
       chrom_sizes = None
-    bam2bed = BamToBedConverter(chrom_sizes=chrom_sizes)
+    bam2bed = PysamBamToBedConverter(chrom_sizes=chrom_sizes)
     bambase = os.path.splitext(bam)[0]
     bed_fn  = bambase + bedtype.suffix
     beds = bam2bed.convert(bam, bed_fn)
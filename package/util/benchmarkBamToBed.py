@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqpipe python package.
+#
+# The osqpipe python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqpipe python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqpipe python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+A script to benchmark the samtools view-based bam to bed conversion
+against the pysam-based streaming converter, confirming that both
+produce identical output. Typically run on a large (e.g. 100M read)
+bam file.
+'''
+
+import os
+import time
+import resource
+import tempfile
+import shutil
+
+from osqutil.samtools import BamToBedConverter
+from osqutil.utilities import checksum_file
+from osqpipe.pipeline.bampy import PysamBamToBedConverter
+
+################################################################################
+
+def _cpu_seconds():
+  '''
+  Total user+system CPU time used by this process and its children.
+  '''
+  usage = [ resource.getrusage(who) for who in
+            (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN) ]
+  return sum([ use.ru_utime + use.ru_stime for use in usage ])
+
+def time_conversion(converter, bam, bed):
+  '''
+  Run a single conversion, returning the output files, wall-clock
+  seconds and CPU seconds.
+  '''
+  start_wall = time.time()
+  start_cpu  = _cpu_seconds()
+  beds = converter.convert(bam, bed)
+  return (beds, time.time() - start_wall, _cpu_seconds() - start_cpu)
+
+def run_benchmark(bam, tc1=False, chrom_sizes=None, threads=4):
+  '''
+  Run both converters on the bam file and report timings.
+  '''
+  workdir = tempfile.mkdtemp()
+  try:
+    converters = [ ('samtools view', BamToBedConverter(tc1=tc1,
+                                                       chrom_sizes=chrom_sizes)),
+                   ('pysam (%d threads)' % threads,
+                    PysamBamToBedConverter(tc1=tc1, chrom_sizes=chrom_sizes,
+                                           threads=threads)) ]
+    md5s = []
+    for (num, (label, converter)) in enumerate(converters):
+      bed = os.path.join(workdir, 'benchmark%d.bed' % num)
+      (beds, wall, cpu) = time_conversion(converter, bam, bed)
+      nlines = sum([ sum(1 for _line in open(fname)) for fname in beds ])
+      print "%-20s wall=%8.1fs cpu=%8.1fs bed_records=%d (%.0f records/s)" \
+          % (label, wall, cpu, nlines, nlines / wall if wall > 0 else 0)
+      md5s.append([ checksum_file(fname, unzip=False) for fname in beds ])
+
+    if all([ sums == md5s[0] for sums in md5s ]):
+      print "Output bed files are identical."
+    else:
+      print "WARNING: output bed files differ between converters!"
+
+  finally:
+    shutil.rmtree(workdir)
+
+################################################################################
+
+if __name__ == '__main__':
+
+  from argparse import ArgumentParser
+
+  P = ArgumentParser(description='Benchmark samtools- and pysam-based bam to'
+                     + ' bed conversion.')
+
+  P.add_argument('bam', metavar='<bam file>', type=str,
+                 help='The bam file to convert.')
+
+  P.add_argument('-c', '--chrom-sizes', dest='chrom_sizes', type=str,
+                 help='Chromosome sizes file, used to remove overhanging reads.')
+
+  P.add_argument('--tc1', dest='tc1', action='store_true',
+                 help='Split chr21 reads into a separate bed file.')
+
+  P.add_argument('-t', '--threads', dest='threads', type=int, default=4,
+                 help='Number of BGZF decompression threads for pysam (default=4).')
+
+  ARGS = P.parse_args()
+
+  run_benchmark(ARGS.bam, tc1=ARGS.tc1, chrom_sizes=ARGS.chrom_sizes,
+                threads=ARGS.threads)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqpipe python package.
+#
+# The osqpipe python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqpipe python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqpipe python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+A script to benchmark the duplicate read summary modes of
+cs_summarizeDuplicateReads.py, reporting throughput and peak memory
+for each and confirming that the dict and spill modes produce
+identical histograms. Each mode is run in a separate child process
+so that peak memory is measured independently.
+'''
+
+import os
+import time
+import resource
+from multiprocessing import Process, Queue
+
+from cs_summarizeDuplicateReads import load_reads_fq, load_reads_spill, \
+    estimate_dups_hll, make_histo, make_histo_spill, count_dups
+
+################################################################################
+
+def _run_mode(mode, fname, memory, tmpdir, queue):
+  '''
+  Child process function; puts a dict of results on the queue.
+  '''
+  start = time.time()
+  histo = None
+  with open(os.devnull, 'w') as devnull:
+    if mode == 'hll':
+      (dups, total, _adap) = estimate_dups_hll(fname)
+    else:
+      if mode == 'spill':
+        (counter, total, _adap) = load_reads_spill(fname, memory*1024*1024,
+                                                   tmpdir)
+        histo = make_histo_spill(counter, devnull)
+      else:
+        (reads, total, _adap) = load_reads_fq(fname)
+        histo = make_histo(reads, devnull)
+      dups = count_dups(histo)
+  queue.put({ 'wall'    : time.time() - start,
+              'reads'   : total,
+              'dups'    : dups,
+              'maxrss'  : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              'buckets' : list(histo.iterBuckets()) if histo else None })
+
+def run_benchmark(fname, modes=('dict', 'spill', 'hll'), memory=1024, tmpdir=None):
+  '''
+  Run each mode on the fastq file and report timings and peak memory.
+  '''
+  results = {}
+  for mode in modes:
+    queue = Queue()
+    proc  = Process(target=_run_mode, args=(mode, fname, memory, tmpdir, queue))
+    proc.start()
+    res = queue.get()
+    proc.join()
+    results[mode] = res
+    print "%-6s wall=%8.1fs reads=%d (%.0f reads/s) duplicates=%d peak_rss=%.1fMB" \
+        % (mode, res['wall'], res['reads'],
+           res['reads'] / res['wall'] if res['wall'] > 0 else 0,
+           res['dups'], res['maxrss'] / 1024.0)
+
+  if 'dict' in results and 'spill' in results:
+    if results['dict']['buckets'] == results['spill']['buckets']:
+      print "dict and spill histograms are identical."
+    else:
+      print "WARNING: dict and spill histograms differ!"
+
+################################################################################
+
+if __name__ == '__main__':
+
+  from argparse import ArgumentParser
+
+  P = ArgumentParser(description='Benchmark duplicate read summary modes.')
+
+  P.add_argument('fastq', metavar='<fastq file>', type=str,
+                 help='The fastq file to summarise.')
+
+  P.add_argument('-m', '--modes', dest='modes', type=str, default='dict,spill,hll',
+                 help='Comma-separated list of modes to run (default=dict,spill,hll).')
+
+  P.add_argument('--memory', dest='memory', type=int, default=1024,
+                 help='Memory budget (MB) for spill mode (default=1024).')
+
+  P.add_argument('--tmpdir', dest='tmpdir', type=str,
+                 help='Directory for spill mode run files.')
+
+  ARGS = P.parse_args()
+
+  run_benchmark(ARGS.fastq, modes=ARGS.modes.split(','), memory=ARGS.memory,
+                tmpdir=ARGS.tmpdir)
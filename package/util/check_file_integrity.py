@@ -34,6 +34,7 @@ import django
 # from osqpipe.models import Lane, Status, Library, Facility, Machine, Adapter, ArchiveLocation
 from osqpipe.models import Lane, Library, Lanefile, QCfile, LaneQC, Filetype
 from osqutil.utilities import parse_repository_filename, sanitize_samplename
+from osqpipe.pipeline.bampy import BamStats
 
 # set up config
 DBCONF = Config()
@@ -110,10 +111,26 @@ class IntegrityCheck(object):
 
         return (r1count, r2count, rcount, mapped_percent, properly_paired_percent)
 
+    def bam_read_stats(self, fname):
+
+        '''Returns the same values as parse_bam_flagstat, computed directly from
+        the bam file in a single pass (cached in fname.stats for subsequent runs).'''
+
+        stats = BamStats.for_file(fname)
+
+        mapped_percent = properly_paired_percent = ""
+        if stats.total > 0:
+            mapped_percent = "%.2f" % (100.0 * stats.mapped / stats.total)
+        if stats.paired > 0:
+            properly_paired_percent = "%.2f" % (100.0 * stats.properly_paired / stats.paired)
+
+        return (stats.read1, stats.read2, stats.paired, mapped_percent, properly_paired_percent)
+
     def check_bam_integrity(self, merged_bam=False):
 
         '''Compares number of reads in bam with number of reads in associated lane.
-        Expects precomputed fn.bam.flagstat in path of fn.'''
+        Uses precomputed fn.bam.flagstat in path of fn where available; otherwise
+        the bam file itself is read.'''
 
         nr_of_reads = 0
         for lane in self.lanes:
@@ -128,7 +145,10 @@ class IntegrityCheck(object):
 
         # Parse flagstat
         fn_flagstat = self.fn + '.flagstat'
-        (r1count, r2count, rcount, mapped_percent, properly_paired_percent) = self.parse_bam_flagstat(fn_flagstat)
+        if os.path.exists(fn_flagstat):
+            (r1count, r2count, rcount, mapped_percent, properly_paired_percent) = self.parse_bam_flagstat(fn_flagstat)
+        else:
+            (r1count, r2count, rcount, mapped_percent, properly_paired_percent) = self.bam_read_stats(self.fn)
 
         # Compare number of reads with content of flagstat info for the bam.
         if r1count != nr_of_reads:
@@ -203,10 +223,10 @@ if __name__ == '__main__':
                       help='Filename.', nargs='+')
 
   PARSER.add_argument('-B', '--merged_bam', dest='merged_bam', action='store_true',
-                      help='Merged bam file(s) across all lanes for the library. Expects <filename>.flagstat in the same path. Checks if number of reads in file(s) equals to reads for the library.')
+                      help='Merged bam file(s) across all lanes for the library. Uses <filename>.flagstat in the same path if present. Checks if number of reads in file(s) equals to reads for the library.')
 
   PARSER.add_argument('-b', '--bam', dest='bam', action='store_true',
-                      help='Bam file(s). Expects <filename>.flagstat in the same path. Checks if number of reads in file(s) is the same as for lane in repository.')
+                      help='Bam file(s). Uses <filename>.flagstat in the same path if present. Checks if number of reads in file(s) is the same as for lane in repository.')
 
 #  PARSER.add_argument('-c', '--code', dest='code', action='store_true',
 #                      help='Library code.')
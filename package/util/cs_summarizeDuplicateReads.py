@@ -18,10 +18,21 @@
 # along with the osqpipe python package.  If not, see
 # <http://www.gnu.org/licenses/>.
 
-'''Generate a histogram summarising duplicate reads.'''
+'''Generate a histogram summarising duplicate reads. By default all
+distinct read sequences are held in memory; for deep sequencing lanes
+the 'spill' mode stores 2-bit packed sequences in sorted runs on disk
+once a memory budget is exceeded, and the 'hll' mode gives a
+HyperLogLog estimate of the duplicate count only.'''
 
 import sys
 import os
+import string
+import struct
+import hashlib
+import math
+import heapq
+import tempfile
+from itertools import groupby
 
 from fastq import FastqIO
 from histogram import Histogram
@@ -33,6 +44,15 @@ LOGGER = configure_logging(level=DEBUG)
 ISATTY = False
 ADAPTER = 'GATCGGAAGAGCTCGTATGCCGTCTTCTGCT'
 
+# Translation table used in 2-bit packing of read sequences.
+DNA_DIGITS = string.maketrans('ACGT', '0123')
+
+# Approximate python overhead per packed sequence held in a list.
+KEY_OVERHEAD = 45
+
+# Run file record header: key length, read count.
+RUN_HEADER = struct.Struct('>HI')
+
 ################################################################################
 
 def init():
@@ -76,21 +96,188 @@ def load_reads_fq(fname):
   fdesc.close()
   return (reads, total, adap)
 
-def make_histo(reads):
-  '''Given a dict of reads keyed by sequence, create a Histogram
-  object summarising the distribution of duplicated reads.'''
+################################################################################
+
+def pack_sequence(seq):
+  '''Pack an ACGT read sequence into a length byte followed by two
+  bits per base. Sequences containing other characters (or longer
+  than 254bp) are stored verbatim following a 0xff marker byte.'''
+  if len(seq) == 0 or len(seq) > 254 or seq.translate(None, 'ACGT'):
+    return '\xff' + seq
+  nbytes = (len(seq) + 3) // 4
+  packed = '%0*x' % (nbytes * 2, int(seq.translate(DNA_DIGITS), 4))
+  return chr(len(seq)) + packed.decode('hex')
+
+def unpack_sequence(key):
+  '''Reverse the packing carried out by pack_sequence.'''
+  if key[0] == '\xff':
+    return key[1:]
+  digits = int(key[1:].encode('hex'), 16)
+  bases  = []
+  for _num in xrange(ord(key[0])):
+    bases.append('ACGT'[digits & 3])
+    digits >>= 2
+  return ''.join(reversed(bases))
+
+class SpillingCounter(object):
+  '''Memory-bounded counter of packed read sequences. Keys are held
+  in a flat list until max_bytes is reached, whereupon they are
+  sorted, collapsed to (key, count) pairs and written to a temporary
+  run file. The runs are merged when iterating over the counts.'''
+
+  __slots__ = ('max_bytes', 'tmpdir', '_keys', '_size', '_runs')
+
+  def __init__(self, max_bytes=1024*1024*1024, tmpdir=None):
+    self.max_bytes = max_bytes
+    self.tmpdir    = tmpdir
+    self._keys     = []
+    self._size     = 0
+    self._runs     = []
+
+  def add(self, key):
+    '''Add a single packed sequence.'''
+    self._keys.append(key)
+    self._size += len(key) + KEY_OVERHEAD
+    if self._size > self.max_bytes:
+      self._spill()
+
+  def _sorted_counts(self):
+    self._keys.sort()
+    for (key, group) in groupby(self._keys):
+      yield (key, sum(1 for _read in group))
+
+  def _spill(self):
+    LOGGER.debug("spilling %d reads to run file %d...",
+                 len(self._keys), len(self._runs) + 1)
+    run = tempfile.TemporaryFile(dir=self.tmpdir)
+    for (key, count) in self._sorted_counts():
+      run.write(RUN_HEADER.pack(len(key), count))
+      run.write(key)
+    run.seek(0)
+    self._runs.append(run)
+    self._keys = []
+    self._size = 0
+
+  @staticmethod
+  def _read_run(run):
+    while True:
+      header = run.read(RUN_HEADER.size)
+      if not header:
+        break
+      (keylen, count) = RUN_HEADER.unpack(header)
+      yield (run.read(keylen), count)
+    run.close()
+
+  def iter_counts(self):
+    '''Yield (packed sequence, count) tuples in sorted key order.'''
+    if not self._runs:
+      return self._sorted_counts()
+    if self._keys:
+      self._spill()
+    LOGGER.debug("merging %d run files...", len(self._runs))
+    merged = heapq.merge(*[ self._read_run(run) for run in self._runs ])
+    return ( (key, sum([ count for (_key, count) in group ]))
+             for (key, group) in groupby(merged, key=lambda x: x[0]) )
+
+def load_reads_spill(fname, max_bytes=1024*1024*1024, tmpdir=None):
+  '''Read the fastq file into a SpillingCounter. Also return a count
+  of adapter reads and a total read count.'''
+  LOGGER.debug("loading reads...")
+  counter = SpillingCounter(max_bytes=max_bytes, tmpdir=tmpdir)
+  total = 0
+  adap  = 0
+  fdesc = FastqIO(fname)
+  for seq in fdesc:
+    data = seq.seq
+    if data[0:len(ADAPTER)] == ADAPTER:
+      adap += 1
+    else:
+      counter.add(pack_sequence(data))
+      total += 1
+      if total % 100000 == 0 and ISATTY:
+        sys.stderr.write("%9d\r" % (total,))
+  fdesc.close()
+  return (counter, total, adap)
+
+class HyperLogLog(object):
+  '''Minimal HyperLogLog distinct-count estimator (2**precision
+  registers; standard error approximately 1.04/sqrt(2**precision)).'''
+
+  __slots__ = ('precision', 'registers')
+
+  def __init__(self, precision=14):
+    self.precision = precision
+    self.registers = bytearray(1 << precision)
+
+  def add(self, data):
+    '''Add an item to the estimator.'''
+    hashval = int(hashlib.md5(data).hexdigest()[:16], 16)
+    idx     = hashval >> (64 - self.precision)
+    rest    = hashval & ((1 << (64 - self.precision)) - 1)
+    rank    = (64 - self.precision) - rest.bit_length() + 1
+    if rank > self.registers[idx]:
+      self.registers[idx] = rank
+
+  def estimate(self):
+    '''Return the estimated number of distinct items added.'''
+    size  = len(self.registers)
+    alpha = 0.7213 / (1 + 1.079 / size)
+    raw   = alpha * size * size / sum([ 2.0 ** -reg for reg in self.registers ])
+    zeros = self.registers.count('\x00')
+    if raw <= 2.5 * size and zeros > 0:
+      return size * math.log(float(size) / zeros) # Linear counting.
+    return raw
+
+def estimate_dups_hll(fname, precision=14):
+  '''Estimate the number of duplicate reads using HyperLogLog. Returns
+  the estimated duplicate count, total read count and adapter count.'''
+  LOGGER.debug("estimating distinct reads...")
+  hll   = HyperLogLog(precision)
+  total = 0
+  adap  = 0
+  fdesc = FastqIO(fname)
+  for seq in fdesc:
+    data = seq.seq
+    if data[0:len(ADAPTER)] == ADAPTER:
+      adap += 1
+    else:
+      hll.add(data)
+      total += 1
+      if total % 100000 == 0 and ISATTY:
+        sys.stderr.write("%9d\r" % (total,))
+  fdesc.close()
+  return (max(0, total - int(round(hll.estimate()))), total, adap)
+
+################################################################################
+
+def make_histo_from_counts(counts, stream=sys.stdout):
+  '''Given an iterable of (sequence, count) tuples, create a
+  Histogram object summarising the distribution of duplicated
+  reads. Reads seen 1000 times or more are written to stream.'''
   LOGGER.debug("making histogram...")
   total = 0
   histo = Histogram()
-  for read in reads.iterkeys():
-    histo.add(reads[read])
-    if reads[read] >= 1000:
-      sys.stdout.write("%s\t%d\n" % (read, reads[read]))
+  for (read, count) in counts:
+    histo.add(count)
+    if count >= 1000:
+      stream.write("%s\t%d\n" % (read, count))
     total += 1
     if total % 100000 == 0 and ISATTY:
       sys.stderr.write("%9d\r" % (total,))
   return histo
 
+def make_histo(reads, stream=sys.stdout):
+  '''Given a dict of reads keyed by sequence, create a Histogram
+  object summarising the distribution of duplicated reads.'''
+  return make_histo_from_counts(reads.iteritems(), stream)
+
+def make_histo_spill(counter, stream=sys.stdout):
+  '''Given a SpillingCounter, create a Histogram object summarising
+  the distribution of duplicated reads.'''
+  return make_histo_from_counts(
+    ( (unpack_sequence(key), count) for (key, count) in counter.iter_counts() ),
+    stream)
+
 def count_dups(histo):
   '''Count the total duplicates from the output of make_histo.'''
   dups = 0
@@ -103,19 +290,54 @@ def perc(num, denom):
   pcnt = int(((float(num) / float(denom)) * 1000)) / 10.0
   return "%4.1f%%" % (pcnt,)
 
-def summarize(fname):
-  '''Generate a histogram summarising duplicate reads.'''
-  (reads, total, adap) = load_reads_fq(fname)
-  histo = make_histo(reads)
-  duplicates = count_dups(histo)
+def summarize(fname, mode='dict', memory=1024, tmpdir=None):
+  '''Generate a histogram summarising duplicate reads. The mode may
+  be 'dict' (all distinct reads in memory), 'spill' (packed reads,
+  spilled to disk beyond the memory budget in MB) or 'hll'
+  (HyperLogLog estimate only; no histogram).'''
+  histo = None
+  if mode == 'hll':
+    (duplicates, total, adap) = estimate_dups_hll(fname)
+  else:
+    if mode == 'spill':
+      (counter, total, adap) = load_reads_spill(fname, memory*1024*1024, tmpdir)
+      histo = make_histo_spill(counter)
+    else:
+      (reads, total, adap) = load_reads_fq(fname)
+      histo = make_histo(reads)
+    duplicates = count_dups(histo)
   sys.stdout.write("total %d\nduplicated %d (%s)\nadapter %d (%s)\n" % (
       total, duplicates, perc(duplicates, total),
       adap, perc(adap, total+adap)))
-  histo.dump(sys.stdout, includeEmpty=False)  
+  if histo is not None:
+    histo.dump(sys.stdout, includeEmpty=False)
 
 ################################################################################
 
 if __name__ == '__main__':
 
+  from argparse import ArgumentParser
+
+  PARSER = ArgumentParser(description='Generate a histogram summarising'
+                          + ' duplicate reads in a fastq file.')
+
+  PARSER.add_argument('fastq', metavar='<fastq file>', type=str,
+                      help='The fastq file to summarise.')
+
+  PARSER.add_argument('-m', '--mode', dest='mode', type=str, default='dict',
+                      choices=('dict', 'spill', 'hll'),
+                      help='Counting mode: dict (all distinct reads held in'
+                      + ' memory; the default), spill (2-bit packed reads,'
+                      + ' spilled to disk in sorted runs) or hll (HyperLogLog'
+                      + ' duplicate estimate only).')
+
+  PARSER.add_argument('--memory', dest='memory', type=int, default=1024,
+                      help='Memory budget (MB) for spill mode (default=1024).')
+
+  PARSER.add_argument('--tmpdir', dest='tmpdir', type=str,
+                      help='Directory for spill mode run files.')
+
+  ARGS = PARSER.parse_args()
+
   init()
-  summarize(sys.argv[1])
+  summarize(ARGS.fastq, mode=ARGS.mode, memory=ARGS.memory, tmpdir=ARGS.tmpdir)
@@ -22,10 +22,51 @@
 A script which can be used to expand an Odom Lab pipeline generated
 bam file, in which identical small RNA reads are compressed into a
 single record, into a more conventional bam file format (one read per
-record).
+record). With --benchmark, the expansion is timed using a single
+thread and then using the requested number of BGZF threads (and
+count tags, if requested), reporting throughput for each.
 '''
 
-from osqpipe.pipeline.bampy import open_bamfile
+import os
+import time
+import resource
+
+from osqpipe.pipeline.bampy import open_bamfile, Bamfile
+
+################################################################################
+
+def _cpu_seconds():
+  '''
+  Total user+system CPU time used by this process and its children.
+  '''
+  usage = [ resource.getrusage(who) for who in
+            (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN) ]
+  return sum([ use.ru_utime + use.ru_stime for use in usage ])
+
+def run_benchmark(infile, outfile, keep_multi=False, threads=4, count_tag=None):
+  '''
+  Time expand_tallied_reads using a single thread and then using the
+  given options, reporting wall-clock and CPU time and output
+  records per second.
+  '''
+  settings = [ ('1 thread', 1, None),
+               ('%d threads' % threads, threads, None) ]
+  if count_tag is not None:
+    settings.append(('%d threads, %s tag' % (threads, count_tag), threads, count_tag))
+
+  for (label, nthreads, tag) in settings:
+    with open_bamfile(infile) as bam:
+      start_wall = time.time()
+      start_cpu  = _cpu_seconds()
+      bam.expand_tallied_reads(outfile, keep_multi=keep_multi,
+                               threads=nthreads, count_tag=tag).close()
+      wall = time.time() - start_wall
+      cpu  = _cpu_seconds() - start_cpu
+    with Bamfile(filename=outfile) as out:
+      nrecs = sum(1 for _read in out.fetch(until_eof=True))
+    print "%-24s wall=%8.1fs cpu=%8.1fs records=%d (%.0f records/s, %.1f MB)" \
+        % (label, wall, cpu, nrecs, nrecs / wall if wall > 0 else 0,
+           os.path.getsize(outfile) / float(1024 * 1024))
 
 ################################################################################
 
@@ -46,8 +87,25 @@ if __name__ == '__main__':
                  help='Flag indicating that the script should keep any'
                  + ' multi-mapping reads in the final output.')
 
+  P.add_argument('--threads', dest='threads', type=int, default=1,
+                 help='Number of BGZF compression threads (default=1).')
+
+  P.add_argument('--count-tag', dest='count_tag', type=str,
+                 help='Write one record per tallied read, storing the read'
+                 + ' count in this integer tag (e.g. XC) rather than'
+                 + ' duplicating records.')
+
+  P.add_argument('--benchmark', dest='benchmark', action='store_true',
+                 help='Report expansion throughput for single- and'
+                 + ' multi-threaded output (the output file is overwritten'
+                 + ' by each run).')
+
   ARGS = P.parse_args()
 
-  with open_bamfile(ARGS.input) as bam:
-    bam.expand_tallied_reads(ARGS.output, keep_multi=ARGS.multi)
-    
+  if ARGS.benchmark:
+    run_benchmark(ARGS.input, ARGS.output, keep_multi=ARGS.multi,
+                  threads=ARGS.threads, count_tag=ARGS.count_tag)
+  else:
+    with open_bamfile(ARGS.input) as bam:
+      bam.expand_tallied_reads(ARGS.output, keep_multi=ARGS.multi,
+                               threads=ARGS.threads, count_tag=ARGS.count_tag)
@@ -25,9 +25,9 @@ paired sequencing fastq files.
 
 import re
 import os
-import gzip
 from osqpipe.pipeline.bwa_runner import ClusterJobManager
 from osqutil.utilities import is_zipped
+from osqutil.fastq_profile import profile_fastq
 from osqutil.setup_logs import configure_logging
 from logging import INFO, DEBUG
 LOGGER = configure_logging(level=INFO)
@@ -45,21 +45,11 @@ class GsnapManager(ClusterJobManager):
     self.outdir = outdir
 
   @staticmethod
-  def count_fastq_reads(fqfile, file_zipped=False):
+  def count_fastq_reads(fqfile):
     '''
     Count the number of reads in a fastq file.
     '''
-    if file_zipped:
-      fqfh = gzip.open(fqfile, 'rb')
-    else:
-      fqfh = open(fqfile, 'r')
-
-    count = 0
-    for _line in fqfh:
-      count +=1
-
-    fqfh.close()
-    return int(count / 4)
+    return profile_fastq(fqfile, quality=False, dup_sample=0).reads
 
   def submit_gsnap(self, files, genome, indexdir, number, queue, wait=False):
     '''
@@ -76,7 +66,7 @@ class GsnapManager(ClusterJobManager):
 
     if number is None:
       LOGGER.info("Counting reads in fastq input files...")
-      number = int((self.count_fastq_reads(files[0], use_gunzip) / 1e6) * 20)
+      number = int((self.count_fastq_reads(files[0]) / 1e6) * 20)
       LOGGER.info("Will start %d jobs on cluster.", number)
 
     libmatch = re.match(r'^(do\d+)_', os.path.basename(files[0]))
@@ -608,8 +608,7 @@ class LastzAligner(ClusterJobManager):
           self.align(from_2bits, to_2bits,
                      [ os.path.basename(x) for x in lavfiles ])
 
-      # Set up a notifier LSF job.
-      # Set up listening socket, wait for that nc command to run.
+      # Wait for the alignment jobs to finish.
       self.wait_on_cluster(jobs,
                            cleanup_cmd="rm %s" % " ".join(cluster2bits))
       self.retry_lavfile_scp()
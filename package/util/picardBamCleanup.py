@@ -40,7 +40,7 @@ django.setup()
 from osqpipe.models import Alnfile
 from osqutil.utilities import BamPostProcessor, call_subprocess, \
     set_file_permissions, checksum_file
-from osqutil.samtools import count_bam_reads
+from osqpipe.pipeline.bampy import BamStats
 
 from django.db import transaction
 
@@ -96,7 +96,7 @@ def run_picard(libcode, facility, lanenum=None, genome=None):
     os.unlink(postproc.rgadded_fn)
 
     # Quick sanity check on the output
-    newcount = count_bam_reads(newbam)
+    newcount = BamStats.from_bam(newbam).read_count
 
     # FIXME total_reads should be total reads in bam, not in fastq.
     oldcount = bam.alignment.total_reads
@@ -48,10 +48,8 @@ def process_smallrna_fastq(fastq, lane):
                           flowlane=lane.flowlane,
                           libcode=lane.library.code)
 
-  screened  = proc.trim_linkers(fastq.repository_file_path)
-  proc.tempfiles.append(screened)
-  clustered = proc.cluster_exact_matches(screened,
-                                         os.path.splitext(fastq.filename)[0])
+  clustered = proc.trim_and_cluster(fastq.repository_file_path,
+                                    os.path.splitext(fastq.filename)[0])
   proc.clean_up()
 
 def process_smallrna_lane(lane):
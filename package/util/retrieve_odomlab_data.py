@@ -42,6 +42,8 @@ import logging
 import gzip
 import hashlib
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
 
 # The following are used below to trap the warnings generated by the
@@ -62,6 +64,10 @@ LOGGER.setLevel(logging.INFO)
 # public internet domain, this should be set to True.
 VERIFY_SSL_CERT=False
 
+# Number of concurrent downloads when synchronising from a project
+# manifest.
+DEFAULT_WORKERS=4
+
 ################################################################################
 class ApiSession(requests.Session):
   '''
@@ -106,22 +112,51 @@ class ApiSession(requests.Session):
 
     return resp
 
-  def api_metadata(self, url):
-    resp = self.get(url)
+  def api_metadata(self, url, fields=None):
+    # The fields argument restricts the server response to just the
+    # listed fields, saving unnecessary database queries.
+    params = {} if fields is None else { 'fields': ",".join(fields) }
+    resp = self.get(url, params=params)
     if resp.status_code != 200:
       raise HTTPError("Unable to retrieve metadata: %s" % resp.reason)
     return json.loads(resp.content)
 
+  def api_list(self, url, fields=None):
+    # List views are paginated; follow the links to the later pages
+    # (these retain the original query parameters).
+    records = []
+    while url is not None:
+      page = self.api_metadata(url, fields)
+      if type(page) is list: # Older, unpaginated servers.
+        return records + page
+      records += page['results']
+      (url, fields) = (page['next'], None)
+    return records
+
+  def api_manifest(self, url):
+    # The manifest is streamed as JSON lines, one file per line, and
+    # is yielded as it arrives.
+    resp = self.get(url, stream=True)
+    if resp.status_code != 200:
+      raise HTTPError("Unable to retrieve project manifest: %s" % resp.reason)
+    for line in resp.iter_lines():
+      if line:
+        yield json.loads(line)
+
   def rest_download_file(self, url, local_filename):
 
-    # The stream=True parameter keeps memory usage low.
+    # The stream=True parameter keeps memory usage low. Data are
+    # written to a temporary file so that an interrupted download is
+    # never mistaken for a complete one.
     resp = self.get(url, stream=True)
     if resp.status_code != 200:
       raise HTTPError("Unable to download file: %s" % resp.reason)
-    with open(local_filename, 'wb') as outfh:
-      for chunk in resp.iter_content(chunk_size=1024):
+    partial = "%s.part" % local_filename
+    with open(partial, 'wb') as outfh:
+      for chunk in resp.iter_content(chunk_size=1024 * 1024):
         if chunk: # filter out keep-alive new chunks
           outfh.write(chunk)
+    os.rename(partial, local_filename)
     return local_filename
 
 ################################################################################
@@ -154,17 +189,23 @@ def confirm_file_checksum(fname, checksum, blocksize=65536):
     if hasher.hexdigest() != checksum:
       LOGGER.warning("Local file checksum disagrees with repository: %s",
                      fname)
+      return False
     else:
       LOGGER.info("Checksum good for file %s", fname)
+      return True
 
 class OdomDataRetriever(object):
 
   __slots__ = ('session', 'with_download', 'with_checksum', '_base_url',
-               '_projdirs', 'filetype', '_filename_processed', '_mergedfiles')
+               '_projdirs', 'filetype', '_filename_processed', '_mergedfiles',
+               'workers')
 
   def __init__(self, download=True, checksum=True,
                base_url='http://localhost:8000/repository', project_dirs=None,
-               filetype='fastq'):
+               filetype='fastq', workers=DEFAULT_WORKERS):
+
+    if workers < 1:
+      raise ValueError("The number of workers must be at least 1.")
 
     import getpass
     sys.stderr.write("Please enter your login credentials.\n")
@@ -176,6 +217,12 @@ class OdomDataRetriever(object):
                               username = username,
                               password = password )
 
+    # Allow one pooled connection per concurrent download.
+    self.workers = workers
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+
     self.with_download = download
     self.with_checksum = checksum
     self._base_url     = base_url
@@ -217,14 +264,15 @@ class OdomDataRetriever(object):
       
   def process_liburl(self, url):
 
-    libdict = self.session.api_metadata(url)
+    libdict = self.session.api_metadata(url, ('code', 'lane_set'))
     LOGGER.info("Retrieved metadata for library %s", libdict['code'])
     for laneurl in libdict['lane_set']:
       self.process_laneurl(laneurl)
 
   def process_laneurl(self, url):
 
-    lanedict = self.session.api_metadata(url)
+    lanedict = self.session.api_metadata(url, ('flowcell', 'flowlane',
+                                               'lanefile_set', 'alignment_set'))
     LOGGER.info("Retrieved metadata for lane %s (flowcell %s)",
                 lanedict['flowlane'], lanedict['flowcell'])
     for filedict in lanedict['lanefile_set']:
@@ -236,7 +284,8 @@ class OdomDataRetriever(object):
 
   def process_alnurl(self, url):
 
-    alndict = self.session.api_metadata(url)
+    alndict = self.session.api_metadata(url, ('genome', 'alnfile_set',
+                                             'mergedalignment_set'))
     LOGGER.debug("Retrieved metadata for aln against genome %s",
                  alndict['genome'])
     for filedict in alndict['alnfile_set']:
@@ -307,7 +356,7 @@ class OdomDataRetriever(object):
 
     # Now we retrieve some actual metadata.
     rootdict = self.session.api_metadata("%s/api/" % self._base_url)
-    projlist = self.session.api_metadata(rootdict['projects'])
+    projlist = self.session.api_list(rootdict['projects'], ('code', 'libraries'))
 
     if project is not None:
       projlist = [ proj for proj in projlist
@@ -319,6 +368,96 @@ class OdomDataRetriever(object):
     for url in liburls:
       self.process_liburl(url)
 
+  def _is_current(self, fname, filedict):
+    '''
+    Test whether a pre-existing local file matches the repository
+    copy described by a manifest entry. Uncompressed copies of
+    gzipped files cannot be compared by size, and so are only
+    checksummed.
+    '''
+    compressed = os.path.basename(fname) == os.path.basename(filedict['filename_on_disk'])
+    if compressed and filedict['size'] is not None \
+          and os.path.getsize(fname) != filedict['size']:
+      LOGGER.warning("Local file size disagrees with repository: %s", fname)
+      return False
+    if self.with_checksum:
+      return confirm_file_checksum(fname, filedict['checksum'])
+    return True
+
+  def sync_datafile(self, filedict):
+    '''
+    Download a single file listed in a project manifest unless an
+    up-to-date copy is already present. An out-of-date copy is
+    replaced in the directory where it was found (an uncompressed
+    copy being deleted once the download is confirmed). Returns False
+    if the download failed, True otherwise.
+    '''
+    dl_fname   = filedict['filename_on_disk']
+    found_file = self._file_found(dl_fname)
+    if found_file:
+      if self._is_current(found_file, filedict):
+        LOGGER.info("Skipping download of up-to-date file %s", found_file)
+        return True
+      dl_fname = os.path.join(os.path.dirname(found_file), os.path.basename(dl_fname))
+      LOGGER.warning("Replacing out-of-date file %s with %s", found_file, dl_fname)
+
+    if not self.with_download:
+      LOGGER.debug("Skipping download as directed: %s", dl_fname)
+      return True
+
+    LOGGER.info("Starting file download: %s", dl_fname)
+    try:
+      self.session.rest_download_file(filedict['download'], dl_fname)
+    except (HTTPError, requests.RequestException), err:
+      LOGGER.error("Unable to download file %s: %s", dl_fname, err)
+      return False
+    LOGGER.info("Completed file download: %s", dl_fname)
+
+    if not self._is_current(dl_fname, filedict):
+      return False
+    if found_file and found_file != dl_fname:
+      LOGGER.info("Deleting out-of-date file %s", found_file)
+      os.unlink(found_file)
+    return True
+
+  def synchronise_manifest(self, project=None):
+    '''
+    Synchronise files using the per-project manifests, which list
+    every downloadable file in a single request. Downloads then run
+    concurrently, using the configured number of workers.
+    '''
+    rootdict = self.session.api_metadata("%s/api/" % self._base_url)
+    projlist = self.session.api_list(rootdict['projects'], ('code',))
+
+    if project is not None:
+      projlist = [ proj for proj in projlist
+                   if proj['code'].lower() == project.lower() ]
+
+    pending = []
+    for proj in projlist:
+      url = "%s/api/projects/%s/manifest/" % (self._base_url, proj['code'])
+      for filedict in self.session.api_manifest(url):
+        if filedict['filetype'] != self.filetype \
+              or filedict['merged'] != self._mergedfiles \
+              or filedict['filename_on_disk'] in self._filename_processed:
+          continue
+        self._filename_processed.add(filedict['filename_on_disk'])
+        pending.append(filedict)
+      LOGGER.info("Retrieved manifest for project %s", proj['code'])
+
+    LOGGER.info("Synchronising %d file(s) using %d workers.",
+                len(pending), self.workers)
+    pool = ThreadPool(max(1, min(self.workers, len(pending))))
+    try:
+      results = pool.map(self.sync_datafile, pending)
+    finally:
+      pool.close()
+      pool.join()
+
+    failed = results.count(False)
+    if failed > 0:
+      LOGGER.error("%d file(s) failed to synchronise.", failed)
+
 if __name__ == '__main__':
 
   from argparse import ArgumentParser
@@ -351,11 +490,27 @@ if __name__ == '__main__':
                       default='fastq', choices=['fastq','bed','bam','mergedbam','tar'],
                       help='The type of file to download. The default is fastq.')
 
+  PARSER.add_argument('--manifest', dest='manifest', action='store_true',
+                      help='Synchronise using the project manifests, downloading'
+                      + ' files concurrently. Existing files are replaced unless'
+                      + ' their size and checksum match the repository copy.')
+
+  PARSER.add_argument('--workers', dest='workers', type=int, default=DEFAULT_WORKERS,
+                      help='The number of concurrent downloads in manifest mode.'
+                      + ' The default is %d.' % DEFAULT_WORKERS)
+
   ARGS = PARSER.parse_args()
 
+  if ARGS.workers < 1:
+    PARSER.error("--workers must be at least 1.")
+
   RETRIEVER = OdomDataRetriever(download = not ARGS.no_download,
                                 checksum = not ARGS.no_checksum,
                                 base_url = ARGS.baseurl,
                                 filetype = ARGS.filetype,
-                                project_dirs = ARGS.projdirs)
-  RETRIEVER.synchronise_datafiles(project  = ARGS.project)
+                                project_dirs = ARGS.projdirs,
+                                workers  = ARGS.workers)
+  if ARGS.manifest:
+    RETRIEVER.synchronise_manifest(project = ARGS.project)
+  else:
+    RETRIEVER.synchronise_datafiles(project  = ARGS.project)
@@ -25,6 +25,7 @@ extend the tag to include tumour number as well as mouse ID.
 '''
 
 import os
+import sys
 from logging import INFO
 from osqutil.setup_logs import configure_logging
 LOGGER = configure_logging(level=INFO)
@@ -33,10 +34,10 @@ LOGGER = configure_logging(level=INFO)
 import django
 django.setup()
 
-from osqpipe.models import Alnfile, Library
+from osqpipe.models import Alnfile, MergedAlnfile, Library
 from osqutil.utilities import checksum_file, call_subprocess, sanitize_samplename
 from osqutil.config import Config
-from osqpipe.pipeline.gatk import update_bam_readgroups
+from osqpipe.pipeline.gatk import update_bam_readgroups_batch
 
 from django.db import transaction
 from shutil import move
@@ -59,12 +60,10 @@ def update_repo_bamfile(bam, newfile):
   bam.save()
   os.unlink(deleteme)
 
-def update_library_bam_readgroups(libcode, update=False):
+def update_library_bam_readgroups(libcode):
   '''
   Add or Replace the read groups for all the bam files attached to a
-  given library. If update is False (the default), picard
-  AddOrReplaceReadGroups is used; if update is True then just the bam
-  file header is rewritten using an internal pipeline function.
+  given library, using picard AddOrReplaceReadGroups.
   '''
   lib  = Library.objects.get(code=libcode)
   bams = Alnfile.objects.filter(alignment__lane__library__code=libcode,
@@ -77,23 +76,40 @@ def update_library_bam_readgroups(libcode, update=False):
     checksum = checksum_file(bam.repository_file_path, unzip=False)
     if checksum != bam.checksum:
       raise ValueError("Stored bam checksum does not agree with that in the repository.")
-    if update:
-      LOGGER.debug("Rewriting bam file header: %s", bam.filename)
-      update_bam_readgroups(bam)
-    else:
-      tmpfile = "%s.update_rg" % (bam.filename,)
-      cmd = ('picard', 'AddOrReplaceReadGroups',
-             'INPUT=%s'  % bam.repository_file_path,
-             'OUTPUT=%s' % tmpfile,
-             'RGLB=%s'   % lib.code,
-             'RGSM=%s'   % sanitize_samplename(lib.sample.name),
-             'RGCN=%s'   % bam.alignment.lane.facility.code,
-             'RGPU=%d'   % int(bam.alignment.lane.lanenum),
-             'RGPL=illumina') + common_args
-
-      LOGGER.debug("Running command: %s", " ".join(cmd))
-      call_subprocess(cmd, path=os.environ['PATH'])
-      update_repo_bamfile(bam, tmpfile)
+    tmpfile = "%s.update_rg" % (bam.filename,)
+    cmd = ('picard', 'AddOrReplaceReadGroups',
+           'INPUT=%s'  % bam.repository_file_path,
+           'OUTPUT=%s' % tmpfile,
+           'RGLB=%s'   % lib.code,
+           'RGSM=%s'   % sanitize_samplename(lib.sample.name),
+           'RGCN=%s'   % bam.alignment.lane.facility.code,
+           'RGPU=%d'   % int(bam.alignment.lane.lanenum),
+           'RGPL=illumina') + common_args
+
+    LOGGER.debug("Running command: %s", " ".join(cmd))
+    call_subprocess(cmd, path=os.environ['PATH'])
+    update_repo_bamfile(bam, tmpfile)
+
+def update_bam_headers(libcodes, merged=False):
+  '''
+  Rewrite just the bam file headers for all the bam files attached to
+  the given libraries (requires the bam files to already have had
+  read groups added). If merged is True, merged bam files containing
+  these libraries are also updated. Stored checksums are verified in
+  the same pass over each file that calculates the new checksum.
+  Returns the number of files which could not be updated.
+  '''
+  bams = list(Alnfile.objects.filter(alignment__lane__library__code__in=libcodes,
+                                     filetype__code='bam'))
+  if merged:
+    bams += list(MergedAlnfile.objects.filter(
+      alignment__alignments__lane__library__code__in=libcodes,
+      filetype__code='bam').distinct())
+
+  failures = update_bam_readgroups_batch(bams, verify_checksum=True)
+  for (bam, err) in failures:
+    LOGGER.error("Not updated: %s (%s)", bam.filename, err)
+  return len(failures)
 
 if __name__ == '__main__':
 
@@ -103,14 +119,24 @@ if __name__ == '__main__':
        'Update bam file read groups and repository checksums to match'
                           + ' current HCC project best practice.')
 
-  PARSER.add_argument('-l', '--library', dest='library', type=str, required=True,
-                      help='The library code to process.')
+  PARSER.add_argument('-l', '--library', dest='libraries', type=str, nargs='+',
+                      required=True, help='The library code(s) to process.')
 
   PARSER.add_argument('-u', '--update', dest='update', action='store_true',
                       help='Update mode only (requires the bam files to already'
                       + ' have had read groups added). This is faster than the'
-                      + ' default alternative.')
+                      + ' default alternative, and usually rewrites only the'
+                      + ' start of each bam file.')
+
+  PARSER.add_argument('-m', '--merged', dest='merged', action='store_true',
+                      help='In update mode, also update the merged bam files'
+                      + ' containing these libraries.')
 
   ARGS = PARSER.parse_args()
 
-  update_library_bam_readgroups(ARGS.library, update=ARGS.update)
+  if ARGS.update:
+    if update_bam_headers(ARGS.libraries, merged=ARGS.merged) > 0:
+      sys.exit("Some bam files could not be updated; see log for details.")
+  else:
+    for libcode in ARGS.libraries:
+      update_library_bam_readgroups(libcode)
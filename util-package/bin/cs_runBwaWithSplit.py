@@ -94,6 +94,10 @@ if __name__ == '__main__':
   PARSER.add_argument('-d', '--debug', dest='debug', action='store_true',
                       help='Turn on debugging output.')
 
+  PARSER.add_argument('--dry-run', dest='dry_run', action='store_true',
+                      help='Split the input files and log the alignment job'
+                      + ' plans and commands without submitting any jobs.')
+
   ARGS = PARSER.parse_args()
 
   # Finding cs_runBwaWithSplit_Merge.py on this PATH is okay, since
@@ -107,6 +111,7 @@ if __name__ == '__main__':
                              nocc       = ARGS.nocc,
                              bwa_algorithm = ARGS.algorithm,
                              nosplit      = ARGS.nosplit,
+                             dry_run      = ARGS.dry_run,
                              merge_prog = spawn.find_executable('cs_runBwaWithSplit_Merge.py',
                                                                 path=os.environ['PATH']))
 
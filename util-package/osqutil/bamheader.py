@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqutil python package.
+#
+# The osqutil python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqutil python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqutil python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+In-place editing of bam file headers. A bam file is a series of
+BGZF blocks (independently deflated gzip members of up to 64kb); the
+header occupies the first few of these. Where a new header can be
+deflated into exactly the same number of bytes as the blocks holding
+the old one, those bytes are overwritten and the (possibly very
+large) remainder of the file is left untouched. Deflate permits empty
+stored blocks, which are used to pad the new blocks to the required
+size; where a new header will not fit, the first few blocks of
+records may be recompressed alongside it to make room.
+'''
+
+import os
+import struct
+import zlib
+import hashlib
+import sqlite3
+
+from .utilities import CHECKSUM_BLOCKSIZE, is_zipped
+from .checksum_cache import get_checksum_cache
+from .setup_logs import configure_logging
+
+LOGGER = configure_logging('bamheader')
+
+BGZF_MAGIC         = '\x1f\x8b\x08\x04'
+BGZF_HEADER_LENGTH = 18
+BGZF_FOOTER_LENGTH = 8
+BGZF_MAX_BLOCK     = 65536
+BGZF_MAX_DATA      = 0xff00 # As used by htslib.
+
+# The number of record blocks which may be recompressed to make room
+# for a new header.
+MAX_EXTRA_BLOCKS = 2
+
+# An empty, non-final deflate stored block (see RFC 1951). Inserted at
+# the start of a deflate stream, each one adds five bytes to the
+# stream without changing its content.
+DEFLATE_PAD = '\x00\x00\x00\xff\xff'
+
+# Deflate strategies tried when re-encoding (Z_RLE and Z_FIXED are
+# not exposed by the python 2 zlib module).
+DEFLATE_STRATEGIES = (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED, 3, 4,
+                      zlib.Z_HUFFMAN_ONLY)
+
+def _empty_fixed_blocks(count):
+  '''
+  Return a byte-aligned run of count empty fixed-Huffman deflate
+  blocks, the last of them final. Each block is ten bits long (a
+  header of BFINAL=0/1, BTYPE=01 and the seven-bit end-of-block code),
+  so runs of one to four blocks take two to five bytes.
+  '''
+  bits  = ([0, 1, 0] + [0] * 7) * (count - 1) + [1, 1, 0] + [0] * 7
+  bits += [0] * (-len(bits) % 8)
+  return ''.join([ chr(sum([ bit << num for (num, bit) in enumerate(bits[pos:pos+8]) ]))
+                   for pos in range(0, len(bits), 8) ])
+
+# Terminators for a sync-flushed deflate stream, covering every
+# length modulo the padding unit.
+DEFLATE_ENDS = [ _empty_fixed_blocks(count) for count in range(1, 5) ]
+
+################################################################################
+def _read_block(handle):
+  '''
+  Read the next BGZF block from handle, returning (raw block,
+  uncompressed data), or None at end of file.
+  '''
+  head = handle.read(BGZF_HEADER_LENGTH)
+  if len(head) == 0:
+    return None
+  if len(head) < BGZF_HEADER_LENGTH or head[:4] != BGZF_MAGIC \
+        or head[10:16] != '\x06\x00BC\x02\x00':
+    raise ValueError("Not a BGZF-compressed file (is this a bam file?)")
+  bsize = struct.unpack('<H', head[16:18])[0] + 1
+  rest  = handle.read(bsize - BGZF_HEADER_LENGTH)
+  if len(rest) != bsize - BGZF_HEADER_LENGTH:
+    raise ValueError("Truncated BGZF block.")
+  data = zlib.decompress(rest[:-BGZF_FOOTER_LENGTH], -15)
+  (crc, isize) = struct.unpack('<II', rest[-BGZF_FOOTER_LENGTH:])
+  if len(data) != isize or zlib.crc32(data) & 0xffffffff != crc:
+    raise ValueError("Corrupt BGZF block (CRC or length mismatch).")
+  return (head + rest, data)
+
+def _make_block(data, stream):
+  '''
+  Wrap a raw deflate stream in a BGZF block.
+  '''
+  bsize = BGZF_HEADER_LENGTH + len(stream) + BGZF_FOOTER_LENGTH
+  return (BGZF_MAGIC + '\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+          + struct.pack('<H', bsize - 1) + stream
+          + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+def _deflate_variants(data):
+  '''
+  Deflate data using a range of compression levels and
+  strategies. Returns a dict holding the shortest stream found for
+  each stream length modulo the padding unit. Streams which are
+  finished normally are the most compact; sync-flushed streams closed
+  by each of DEFLATE_ENDS ensure that every residue is represented.
+  '''
+  best = {}
+  for level in range(9, 0, -1):
+    for strategy in DEFLATE_STRATEGIES:
+      comp    = zlib.compressobj(level, zlib.DEFLATED, -15, 9, strategy)
+      body    = comp.compress(data)
+      streams = [ body + comp.copy().flush() ]
+      synced  = body + comp.flush(zlib.Z_SYNC_FLUSH)
+      streams += [ synced + end for end in DEFLATE_ENDS ]
+      for stream in streams:
+        resid = len(stream) % len(DEFLATE_PAD)
+        if resid not in best or len(stream) < len(best[resid]):
+          best[resid] = stream
+  return best
+
+def _encode_exact(data, size):
+  '''
+  Encode data as a series of BGZF blocks totalling exactly size
+  bytes. Returns the encoded string, or None if this is not possible.
+  '''
+  unit      = len(DEFLATE_PAD)
+  overhead  = BGZF_HEADER_LENGTH + BGZF_FOOTER_LENGTH
+  minblocks = max(1, -(-len(data) // BGZF_MAX_DATA))
+  for nblocks in range(minblocks, minblocks + 4):
+    step   = -(-len(data) // nblocks)
+    chunks = [ data[num:num+step] for num in range(0, len(data), step) ]
+
+    # Pick one stream per block such that the total falls short of
+    # size by a whole number of padding units, as cheaply as possible.
+    # Each entry maps a residue to (total length, streams).
+    combos = { 0 : (0, []) }
+    for chunk in chunks:
+      variants = _deflate_variants(chunk)
+      extended = {}
+      for (resid, (total, streams)) in combos.iteritems():
+        for stream in variants.itervalues():
+          newtotal = total + overhead + len(stream)
+          newresid = (resid + len(stream) + overhead) % unit
+          if newresid not in extended or newtotal < extended[newresid][0]:
+            extended[newresid] = (newtotal, streams + [stream])
+      combos = extended
+
+    if size % unit not in combos or combos[size % unit][0] > size:
+      continue
+    (total, streams) = combos[size % unit]
+    npad   = (size - total) // unit
+    blocks = []
+    for (chunk, stream) in zip(chunks, streams):
+      room  = (BGZF_MAX_BLOCK - overhead - len(stream)) // unit
+      pads  = min(npad, room)
+      npad -= pads
+      blocks.append(_make_block(chunk, DEFLATE_PAD * pads + stream))
+    if npad == 0:
+      return ''.join(blocks)
+  return None
+
+################################################################################
+class BamHeaderEditor(object):
+  '''
+  Reads the header of a bam file, and replaces it in place where
+  possible. The header SAM text is available as the text
+  attribute. The region attribute holds the raw leading BGZF blocks
+  which contain the header (these may also contain the start of the
+  alignment records, held in tail).
+  '''
+  __slots__ = ('fname', 'text', 'refs', 'region', 'tail')
+
+  def __init__(self, fname):
+    self.fname = fname
+    region = []
+    data   = ''
+    with open(fname, 'rb') as handle:
+      while True:
+        block = _read_block(handle)
+        if block is None:
+          raise ValueError("End of file reached before end of bam header.")
+        region.append(block[0])
+        data += block[1]
+        end = self._parse(data)
+        if end is not None:
+          break
+    self.region = ''.join(region)
+    self.tail   = data[end:]
+
+  def _parse(self, data):
+    '''
+    Parse the uncompressed bam header from the start of data. Returns
+    the offset of the end of the header, or None if data is
+    incomplete.
+    '''
+    if len(data) >= 4 and data[:4] != 'BAM\x01':
+      raise ValueError("Bam magic string not found in %s." % self.fname)
+    if len(data) < 8:
+      return None
+    l_text = struct.unpack('<i', data[4:8])[0]
+    pos    = 8 + l_text
+    if len(data) < pos + 4:
+      return None
+    n_ref = struct.unpack('<i', data[pos:pos+4])[0]
+    start = pos
+    pos  += 4
+    for _num in xrange(n_ref):
+      if len(data) < pos + 4:
+        return None
+      l_name = struct.unpack('<i', data[pos:pos+4])[0]
+      pos   += 4 + l_name + 4
+    if len(data) < pos:
+      return None
+    self.text = data[8:8+l_text]
+    self.refs = data[start:pos]
+    return pos
+
+  def _extend(self):
+    '''
+    Add the next BGZF block of the file to the header region, so that
+    any slack from recompressing its records can absorb a larger
+    header. Returns False if there are no more record blocks.
+    '''
+    with open(self.fname, 'rb') as handle:
+      handle.seek(len(self.region))
+      block = _read_block(handle)
+    if block is None or len(block[1]) == 0: # End of file, or the EOF marker block.
+      return False
+    self.region += block[0]
+    self.tail   += block[1]
+    return True
+
+  def encode(self, text):
+    '''
+    Return a replacement for the header region carrying the new
+    header text, or None if the new header cannot be fitted into the
+    same number of bytes. Up to MAX_EXTRA_BLOCKS following blocks are
+    added to the region if needed.
+    '''
+    header = 'BAM\x01' + struct.pack('<i', len(text)) + text + self.refs
+    extra  = 0
+    while True:
+      newregion = _encode_exact(header + self.tail, len(self.region))
+      if newregion is not None or extra == MAX_EXTRA_BLOCKS \
+            or not self._extend():
+        return newregion
+      extra += 1
+
+  def checksums(self, newregion, blocksize=CHECKSUM_BLOCKSIZE):
+    '''
+    Return the MD5 checksums of the file before and after replacement
+    of the header region by newregion. The body of the file is read
+    only once.
+    '''
+    old = hashlib.md5(self.region)
+    new = hashlib.md5(newregion)
+    with open(self.fname, 'rb') as handle:
+      handle.seek(len(self.region))
+      buf = handle.read(blocksize)
+      while len(buf) > 0:
+        old.update(buf)
+        new.update(buf)
+        buf = handle.read(blocksize)
+    return (old.hexdigest(), new.hexdigest())
+
+  def replace(self, text, checksum=None):
+    '''
+    Replace the header text in place. If checksum is supplied, it is
+    first compared against the MD5 checksum of the current file, and
+    a ValueError is raised if they differ. Returns the MD5 checksum of
+    the edited file, or None (leaving the file unchanged) if the new
+    header does not fit.
+    '''
+    newregion = self.encode(text)
+    if newregion is None:
+      LOGGER.info("New header does not fit in place in %s.", self.fname)
+      return None
+    (oldsum, newsum) = self.checksums(newregion)
+    if checksum is not None and oldsum != checksum:
+      raise ValueError("Stored checksum does not agree with that of %s."
+                       % self.fname)
+
+    # The original region is kept until the new one is safely written.
+    backup = "%s.hdrbak" % self.fname
+    with open(backup, 'wb') as out:
+      out.write(self.region)
+    with open(self.fname, 'r+b') as out:
+      out.write(newregion)
+      out.flush()
+      os.fsync(out.fileno())
+    os.unlink(backup)
+    LOGGER.info("Rewrote %d header bytes of %s in place.",
+                len(newregion), self.fname)
+
+    # Bam files are not treated as zipped (see is_zipped), so
+    # checksum_file gives the same result with or without unzip; the
+    # new checksum is cached under both keys.
+    cache = get_checksum_cache()
+    if cache is not None:
+      try:
+        fstat = os.stat(self.fname)
+        cache.store(self.fname, newsum, fstat, unzip=False)
+        if not is_zipped(self.fname):
+          cache.store(self.fname, newsum, fstat, unzip=True)
+      except sqlite3.Error, err:
+        LOGGER.warning("Unable to store checksum for %s in cache: %s",
+                       self.fname, err)
+
+    self.region = newregion
+    self.text   = text
+    return newsum
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqutil python package.
+#
+# The osqutil python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqutil python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqutil python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+A small on-disk cache of file MD5 checksums, keyed by file path and
+stat identity (size, mtime, inode). This allows repeated sweeps over
+unchanged files (e.g. the archive deletion checks) to skip
+rehashing. The cache is an sqlite database so that it can be used on
+hosts without access to the repository database.
+'''
+
+import os
+import time
+import sqlite3
+
+from .config import Config
+from .setup_logs import configure_logging
+
+LOGGER = configure_logging('checksum_cache')
+
+# Default maximum number of cached checksums.
+DEFAULT_MAX_ENTRIES = 500000
+
+################################################################################
+class ChecksumCache(object):
+
+  '''
+  Persistent store of file checksums. Entries are only returned if
+  the file's current size, mtime and inode match those recorded when
+  the checksum was calculated. The cache is bounded to max_entries;
+  the least recently accessed entries are evicted first.
+  '''
+
+  __slots__ = ('dbfile', 'max_entries', '_conn', '_pid')
+
+  def __init__(self, dbfile, max_entries=DEFAULT_MAX_ENTRIES):
+    self.dbfile      = dbfile
+    self.max_entries = int(max_entries)
+    self._conn       = None
+    self._pid        = None
+
+  @property
+  def conn(self):
+    '''
+    Lazily open the sqlite connection. We reconnect in child
+    processes since sqlite connections must not be shared across a
+    fork.
+    '''
+    if self._conn is None or self._pid != os.getpid():
+      self._conn = sqlite3.connect(self.dbfile, timeout=60)
+      self._pid  = os.getpid()
+      with self._conn:
+        self._conn.execute(
+          '''CREATE TABLE IF NOT EXISTS checksums (
+               path     TEXT    NOT NULL,
+               unzip    INTEGER NOT NULL,
+               size     INTEGER NOT NULL,
+               mtime    REAL    NOT NULL,
+               inode    INTEGER NOT NULL,
+               md5      TEXT    NOT NULL,
+               accessed REAL    NOT NULL,
+               PRIMARY KEY (path, unzip))''')
+        self._conn.execute(
+          '''CREATE INDEX IF NOT EXISTS checksums_accessed
+               ON checksums (accessed)''')
+    return self._conn
+
+  def lookup(self, fname, unzip=True):
+    '''
+    Return the cached checksum for fname, or None if there is no
+    entry or the file has changed since the checksum was recorded.
+    '''
+    path = os.path.abspath(fname)
+    fstat = os.stat(path)
+    with self.conn:
+      row = self.conn.execute(
+        '''SELECT size, mtime, inode, md5 FROM checksums
+             WHERE path=? AND unzip=?''', (path, int(unzip))).fetchone()
+      if row is None:
+        return None
+      if row[0:3] != (fstat.st_size, fstat.st_mtime, fstat.st_ino):
+        LOGGER.debug("Discarding stale cached checksum for %s.", path)
+        self.conn.execute('DELETE FROM checksums WHERE path=? AND unzip=?',
+                          (path, int(unzip)))
+        return None
+      self.conn.execute(
+        'UPDATE checksums SET accessed=? WHERE path=? AND unzip=?',
+        (time.time(), path, int(unzip)))
+    LOGGER.debug("Using cached checksum for %s.", path)
+    return str(row[3])
+
+  def store(self, fname, md5, fstat, unzip=True):
+    '''
+    Record the checksum for fname. The fstat argument should be the
+    os.stat result taken *before* the checksum was calculated, so
+    that any modification during hashing invalidates the entry.
+    '''
+    path = os.path.abspath(fname)
+    with self.conn:
+      self.conn.execute(
+        '''INSERT OR REPLACE INTO checksums
+             (path, unzip, size, mtime, inode, md5, accessed)
+             VALUES (?, ?, ?, ?, ?, ?, ?)''',
+        (path, int(unzip), fstat.st_size, fstat.st_mtime,
+         fstat.st_ino, md5, time.time()))
+      self._evict()
+
+  def _evict(self):
+    '''
+    Remove the least recently accessed entries until the cache is
+    back within its size limit.
+    '''
+    count = self.conn.execute('SELECT COUNT(*) FROM checksums').fetchone()[0]
+    if count > self.max_entries:
+      LOGGER.debug("Evicting %d entries from checksum cache.",
+                   count - self.max_entries)
+      self.conn.execute(
+        '''DELETE FROM checksums WHERE rowid IN
+             (SELECT rowid FROM checksums ORDER BY accessed ASC LIMIT ?)''',
+        (count - self.max_entries,))
+
+  def __len__(self):
+    return self.conn.execute('SELECT COUNT(*) FROM checksums').fetchone()[0]
+
+################################################################################
+_CACHES = {}
+
+def get_checksum_cache():
+  '''
+  Return the ChecksumCache configured via the checksum_cache (and
+  optionally checksum_cache_size) config options, or None if no cache
+  has been configured.
+  '''
+  conf = Config()
+  try:
+    dbfile = conf.checksum_cache
+  except AttributeError, _err:
+    return None
+
+  if dbfile not in _CACHES:
+    try:
+      max_entries = conf.checksum_cache_size
+    except AttributeError, _err:
+      max_entries = DEFAULT_MAX_ENTRIES
+    _CACHES[dbfile] = ChecksumCache(dbfile, max_entries)
+
+  return _CACHES[dbfile]
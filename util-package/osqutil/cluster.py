@@ -28,7 +28,6 @@ import sys
 import os
 import re
 import logging
-import glob
 import tempfile
 import uuid
 from subprocess import Popen, PIPE
@@ -41,6 +40,8 @@ from shutil import move
 from osqutil.utilities import call_subprocess, bash_quote, \
     is_zipped, is_bzipped, set_file_permissions, BamPostProcessor, \
     parse_repository_filename, write_to_remote_file
+from osqutil.sshpool import get_ssh_pool
+from osqutil.fastq_split import split_fastq, plan_fastq_chunks, write_manifest
 
 from osqutil.config import Config
 
@@ -212,7 +213,8 @@ class SbatchCommand(SimpleCommand):
     except AttributeError, _err:
       sshkey = None
     write_to_remote_file(cmd_text, fslurmfile, self.conf.clusteruser,
-                         self.conf.cluster, append=False, sshkey=sshkey)
+                         self.conf.cluster, append=False, sshkey=sshkey,
+                         port=self.conf.clusterport)
 
     # Create slurm command
     slurmcmd = 'sbatch %s' % fslurmfile
@@ -458,6 +460,15 @@ class RemoteJobRunner(JobRunner):
       raise StandardError("Remote host information not provided.")
     super(RemoteJobRunner, self).__init__(*args, **kwargs)
 
+  def _sshkey(self):
+    '''
+    Return the custom ssh key specified in our config, or None.
+    '''
+    try:
+      return self.conf.clustersshkey
+    except AttributeError, _err:
+      return None
+
   def run_command(self, cmd, wdir=None, path=None, command_builder=None, *args, **kwargs):
     '''
     Method used to run a command *directly* on the remote host. No
@@ -483,19 +494,12 @@ class RemoteJobRunner(JobRunner):
         path = ":".join(path)
       pathdef = "PATH=%s" % path
 
-    # Allow for custom ssh key specification in our config.
-    sshcmd = "ssh"
-    try:
-      sshkey = self.conf.clustersshkey
-      sshcmd += ' -i %s' % sshkey
-    except AttributeError, _err:
-      pass
+    # The ssh connection is shared with other calls to the same host.
+    sshcmd = get_ssh_pool().ssh_command(self.remote_user, self.remote_host,
+                                        self.remote_port, self._sshkey())
 
-    cmd = ("%s -p %s %s@%s \"source /etc/profile; cd %s && %s %s\""
+    cmd = ("%s \"source /etc/profile; cd %s && %s %s\""
            % (sshcmd,
-              str(self.remote_port),
-              self.remote_user,
-              self.remote_host,
               wdir,
               pathdef,
               re.sub(r'"', r'\"', cmd)))
@@ -541,35 +545,37 @@ class RemoteJobRunner(JobRunner):
     if len(filenames) != len(destnames):
       raise ValueError("If used, the length of the destnames list"
                                                                           + " must equal that of the filenames list.")
-    for i in range(0, len(filenames)):
-      fromfn = filenames[i]
-      destfn = destnames[i]
-      
-      destfile = os.path.join(self.transfer_wdir, destfn)
-      destfile = bash_quote(destfile)
-      
-      # Currently we assume that the same login credentials work for
-      # both the cluster and the data transfer host. Note that this
-      # needs an appropriate ssh key to be authorised on both the
-      # transfer host and the cluster host.
-      cmdbits = ['scp', '-P', str(self.remote_port)]
-      if same_permissions: # default is to use the configured umask.
-        cmdbits += ['-p']
-      try:
-        sshkey = self.conf.clustersshkey
-        cmdbits += ['-i', sshkey]
-      except AttributeError, _err:
-        pass
-
-      cmdbits += ['-q', bash_quote(fromfn),
-                  "%s@%s:%s" % (self.remote_user,
-                                self.transfer_host,
-                                quote(destfile))]
-      cmd = " ".join(cmdbits)
-
+    if len(filenames) == 0:
+      return
+
+    # Currently we assume that the same login credentials work for
+    # both the cluster and the data transfer host. Note that this
+    # needs an appropriate ssh key to be authorised on both the
+    # transfer host and the cluster host.
+    pool = get_ssh_pool()
+    if len(filenames) == 1:
+      destfile = bash_quote(os.path.join(self.transfer_wdir, destnames[0]))
+      cmd = " ".join((pool.scp_command(self.remote_user, self.transfer_host,
+                                       self.remote_port, self._sshkey(),
+                                       same_permissions),
+                      bash_quote(filenames[0]),
+                      "%s@%s:%s" % (self.remote_user,
+                                    self.transfer_host,
+                                    quote(destfile))))
       LOGGER.info(cmd)
       if not self.test_mode:
         call_subprocess(cmd, shell=True, path=self.conf.hostpath)
+      return
+
+    # Multiple files are sent together in a single transfer.
+    LOGGER.info("Copying %d files to %s:%s", len(filenames),
+                self.transfer_host, self.transfer_wdir)
+    if not self.test_mode:
+      pool.copy_files(filenames, destnames, self.remote_user,
+                      self.transfer_host, self.transfer_wdir,
+                      port=self.remote_port, sshkey=self._sshkey(),
+                      same_permissions=same_permissions,
+                      path=self.conf.hostpath)
 
   def remote_uncompress_file(self, fname, zipcommand='gzip'):
     '''
@@ -774,6 +780,310 @@ class DesktopJobSubmitter(RemoteJobRunner):
 ##############################################################################
 ##############################################################################
 
+PLACEHOLDER_RE = re.compile(r'\{(\w+)\}')
+
+class PipelineStage(object):
+  '''
+  A single command within a PipelineGraph. The command is a template
+  string (or a function taking the stage and returning one) in which
+  {in0}, {in1}... are replaced by the stage inputs, {out} by its
+  output (stages without consumers must write their own output file)
+  and {threads} by the number of threads allocated to the stage.
+  Stages with a non-zero weight share the threads of their pool in
+  proportion to their weights; other stages are single-threaded.
+  The memory attribute (MB) is available to command functions.
+  '''
+  __slots__ = ('name', 'command', 'inputs', 'weight', 'pool', 'memory',
+               'threads')
+
+  def __init__(self, name, command, inputs=(), weight=0, pool='main',
+               memory=None):
+    self.name    = name
+    self.command = command
+    self.inputs  = list(inputs)
+    self.weight  = weight
+    self.pool    = pool
+    self.memory  = memory
+    self.threads = 1
+
+  def render(self, fields):
+    '''
+    Return the command string, substituting the fields dict (plus
+    the thread count) into the template.
+    '''
+    fields = dict(fields, threads=self.threads)
+    template = self.command(self) if callable(self.command) else self.command
+    def _sub(matchobj):
+      if matchobj.group(1) not in fields:
+        raise ValueError("No value for {%s} in pipeline stage %s."
+                         % (matchobj.group(1), self.name))
+      return str(fields[matchobj.group(1)])
+    return PLACEHOLDER_RE.sub(_sub, template)
+
+class PipelineGraph(object):
+  '''
+  A set of streaming commands connected by their inputs and outputs,
+  rendered as a bash script. Each stage passes its output to a
+  single consumer; where possible this is done with an ordinary
+  shell pipe, with named pipes (created in workdir) used only for
+  the second and subsequent inputs of a stage. A source stage (one
+  without inputs) read by several consumers is run once for each of
+  them. The resulting pipe chains run concurrently; if any of them
+  fails the whole script is terminated with a non-zero exit status.
+
+  The pools argument is a dict of thread pool name -> number of
+  threads, shared between the stages assigned to each pool.
+  '''
+  __slots__ = ('prefix', 'pools', 'workdir', 'stages')
+
+  def __init__(self, prefix, pools=None, workdir=None):
+    self.prefix  = prefix
+    self.pools   = { 'main' : 1 } if pools is None else dict(pools)
+    self.workdir = workdir
+    self.stages  = []
+
+  def stage(self, name):
+    '''
+    Return the named stage.
+    '''
+    for stage in self.stages:
+      if stage.name == name:
+        return stage
+    raise KeyError("Pipeline stage not found: %s" % name)
+
+  def add_stage(self, name, command, inputs=(), weight=0, pool='main',
+                memory=None):
+    '''
+    Add a stage to the graph. Input stages must already have been
+    added, so the graph cannot contain cycles. Returns the new stage.
+    '''
+    if name in [ stage.name for stage in self.stages ]:
+      raise ValueError("Duplicate pipeline stage name: %s" % name)
+    for inp in inputs:
+      self.stage(inp)
+    if pool not in self.pools:
+      raise ValueError("Unknown thread pool for stage %s: %s" % (name, pool))
+    stage = PipelineStage(name, command, inputs, weight, pool, memory)
+    self.stages.append(stage)
+    return stage
+
+  def allocate_threads(self):
+    '''
+    Divide the threads of each pool between its weighted stages, in
+    proportion to their weights (minimum one thread each).
+    '''
+    for (pool, total) in self.pools.iteritems():
+      weighted = [ stage for stage in self.stages
+                   if stage.pool == pool and stage.weight > 0 ]
+      for stage in self.stages:
+        if stage.pool == pool and stage.weight <= 0:
+          stage.threads = 1
+      if not weighted:
+        continue
+      if total < len(weighted):
+        LOGGER.warning("Thread pool '%s' (%d threads) is oversubscribed by"
+                       + " %d stages.", pool, total, len(weighted))
+      wsum   = float(sum([ stage.weight for stage in weighted ]))
+      shares = [ total * stage.weight / wsum for stage in weighted ]
+      for (stage, share) in zip(weighted, shares):
+        stage.threads = max(1, int(share))
+      # Hand out any remaining threads by largest remainder.
+      spare = total - sum([ stage.threads for stage in weighted ])
+      order = sorted(range(len(weighted)),
+                     key=lambda x: shares[x] - int(shares[x]), reverse=True)
+      for num in order[:max(0, spare)]:
+        weighted[num].threads += 1
+
+  def _connections(self):
+    '''
+    Returns (nodes, links). The nodes list holds a (stage, copy name)
+    tuple for each command to be run; source stages read by several
+    consumers are run once per consumer, under separate copy
+    names. Each link is a (producer copy, consumer copy, input index,
+    fifo) tuple, where fifo is None for ordinary pipes.
+    '''
+    consumers = dict( (stage.name, 0) for stage in self.stages )
+    for stage in self.stages:
+      for inp in stage.inputs:
+        consumers[inp] += 1
+
+    nodes  = []
+    copies = {}
+    for stage in self.stages:
+      count = consumers[stage.name]
+      if count > 1 and stage.inputs:
+        raise ValueError("Only source stages can feed more than one"
+                         + " consumer: %s" % stage.name)
+      copies[stage.name] = [ stage.name ] if count < 2 else \
+          [ "%s.%d" % (stage.name, num + 1) for num in range(count) ]
+      nodes += [ (stage, copy) for copy in copies[stage.name] ]
+
+    # The first input of each stage is read from stdin; any others
+    # come through named pipes.
+    links = []
+    for stage in self.stages:
+      for (num, inp) in enumerate(stage.inputs):
+        copy = copies[inp].pop(0)
+        fifo = None
+        if num > 0:
+          fifo = bash_quote(os.path.join(self.workdir or '', "%s.%s.fifo"
+                                         % (self.prefix, copy)))
+        links.append((copy, stage.name, num, fifo))
+    return (nodes, links)
+
+  def _chains(self):
+    '''
+    Returns (chains, fifos), where each chain is a list of (stage,
+    copy name, fields) tuples to be joined by shell pipes.
+    '''
+    self.allocate_threads()
+    (nodes, links) = self._connections()
+    fields = dict( (copy, {}) for (_stage, copy) in nodes )
+    after  = {}
+    fifos  = []
+    for (pcopy, ccopy, num, fifo) in links:
+      if fifo is None:
+        fields[pcopy]['out']        = '/dev/stdout'
+        fields[ccopy]['in%d' % num] = '/dev/stdin'
+        after[pcopy] = ccopy
+      else:
+        fields[pcopy]['out']        = fifo
+        fields[ccopy]['in%d' % num] = fifo
+        fifos.append(fifo)
+
+    stages = dict( (copy, stage) for (stage, copy) in nodes )
+    heads  = set(after.values())
+    chains = []
+    for (stage, copy) in nodes:
+      if copy in heads:
+        continue
+      chain = [ (stage, copy, fields[copy]) ]
+      while copy in after:
+        copy = after[copy]
+        chain.append((stages[copy], copy, fields[copy]))
+      chains.append(chain)
+    return (chains, fifos)
+
+  def render(self):
+    '''
+    Return the pipeline as a bash script.
+    '''
+    (chains, fifos) = self._chains()
+    lines = [ '#!/bin/bash', 'set -o pipefail' ]
+    if fifos:
+      lines += [ 'cleanup() { rm -f %s; }' % " ".join(fifos),
+                 'trap cleanup EXIT',
+                 'mkfifo %s' % " ".join(fifos) ]
+    commands = [ " | ".join([ stage.render(flds) for (stage, _copy, flds) in chain ])
+                 for chain in chains ]
+    if len(commands) == 1:
+      lines += commands
+    else:
+      # Job control puts each chain in its own process group. A failed
+      # chain signals the script, which then kills the other chains
+      # (which might otherwise block forever on a named pipe).
+      lines += [ 'set -m',
+                 'trap \'for pid in $(jobs -p); do kill -- -$pid 2>/dev/null;'
+                 + ' done; exit 143\' TERM' ]
+      lines += [ '{ %s || kill $$; } &' % cmd for cmd in commands ]
+      lines += [ 'wait' ]
+    return "\n".join(lines) + "\n"
+
+  def plan(self):
+    '''
+    Return a human-readable description of the pipe topology and
+    thread allocation, for dry runs and logging.
+    '''
+    (chains, fifos) = self._chains()
+    lines = [ "Pipeline %s: %d concurrent chain(s), %d named pipe(s)"
+              % (self.prefix, len(chains), len(fifos)) ]
+    for (num, chain) in enumerate(chains):
+      desc = " | ".join([ "%s[%d]" % (copy, stage.threads)
+                          for (stage, copy, _flds) in chain ])
+      outs = [ flds['out'] for (_stage, _copy, flds) in chain[-1:]
+               if 'out' in flds ]
+      if outs:
+        desc += " > %s" % outs[0]
+      lines.append("  chain %d: %s" % (num + 1, desc))
+    for (pool, total) in sorted(self.pools.iteritems()):
+      used = sum([ stage.threads for stage in self.stages
+                   if stage.pool == pool and stage.weight > 0 ])
+      lines.append("  pool %s: %d of %d threads allocated" % (pool, used, total))
+    return "\n".join(lines)
+
+##############################################################################
+
+def readgroup_fields(fname, samplename=None):
+  '''
+  Return the read group for a repository bam file as a list of (tag,
+  value) tuples, in @RG header order. Dummy values are used where
+  fname does not follow the repository naming scheme.
+  '''
+  (libcode, facility, lanenum, _pipeline) = parse_repository_filename(fname)
+  if libcode is None:
+    LOGGER.warn("Applying dummy read group information to output bam.")
+    libcode  = os.path.basename(fname)
+    facility = 'Unknown'
+    lanenum  = 0
+  sample = samplename if samplename is not None else libcode
+
+  return [ ('ID', int(lanenum)), ('PL', 'illumina'), ('PU', int(lanenum)),
+           ('LB', libcode), ('SM', sample), ('CN', facility) ]
+
+# Ways of merging bam files and setting their read group (see build_merge_pipeline).
+MERGE_MODES = ('samtools', 'picard')
+
+def build_merge_pipeline(output_fn, input_fns, readgroup, threads=1,
+                         mode='samtools', samtools_prog='samtools', workdir=None):
+  '''
+  Return a PipelineGraph which merges the (coordinate-sorted) input
+  bam files into output_fn, giving all the records the single read
+  group described by readgroup, a list of (tag, value) tuples. A
+  single input file is not merged, just re-labelled.
+
+  In 'samtools' mode the uncompressed merge output is streamed into
+  samtools addreplacerg, which writes the @RG header line, tags each
+  record and compresses the output in a single multithreaded
+  pass. The 'picard' mode runs picard AddOrReplaceReadGroups on the
+  merge output followed by a separate samtools compression step, as
+  in earlier versions of the pipeline.
+  '''
+  if mode not in MERGE_MODES:
+    raise ValueError("Unknown bam merge mode: %s" % mode)
+
+  graph  = PipelineGraph(os.path.basename(output_fn), workdir=workdir,
+                         pools={ 'main' : threads })
+  inputs = []
+  source = bash_quote(input_fns[0])
+  if len(input_fns) > 1:
+    graph.add_stage('merge', "%s merge -u -@ {threads} - %s > {out}"
+                    % (samtools_prog, " ".join([ bash_quote(x) for x in input_fns ])),
+                    weight=1)
+    inputs = ['merge']
+    source = '{in0}'
+
+  if mode == 'samtools':
+
+    # Repeated -r options are joined with tabs by addreplacerg.
+    rgopts = " ".join([ "-r %s" % quote("%s:%s" % field) for field in readgroup ])
+    graph.add_stage('readgroup', "%s addreplacerg -@ {threads} -m overwrite_all %s"
+                    % (samtools_prog, rgopts)
+                    + " -O BAM -o %s %s" % (bash_quote(output_fn), source),
+                    inputs, weight=3)
+  else:
+    rgopts = " ".join([ "RG%s=%s" % (tag, quote(str(value)))
+                        for (tag, value) in readgroup ])
+    graph.add_stage('readgroup', "picard AddOrReplaceReadGroups"
+                    + " VALIDATION_STRINGENCY=SILENT COMPRESSION_LEVEL=0"
+                    + " INPUT=%s OUTPUT={out} %s" % (source, rgopts), inputs)
+    graph.add_stage('compress', "%s view -b -@ {threads} -o %s {in0}"
+                    % (samtools_prog, bash_quote(output_fn)), ['readgroup'],
+                    weight=3)
+  return graph
+
+##############################################################################
+##############################################################################
+
 class AlignmentManager(object):
   '''
   Parent class handling various functions required by scripts
@@ -781,11 +1091,12 @@ class AlignmentManager(object):
   (and merging their output) on the cluster.
   '''
   __slots__ = ('conf', 'samtools_prog', 'group', 'cleanup', 'loglevel',
-               'split_read_count', 'bsub', 'merge_prog', 'logfile', 'debug', 'threads', 'sortthreads','postprocess')
+               'split_read_count', 'bsub', 'merge_prog', 'logfile', 'debug', 'threads', 'sortthreads','postprocess',
+               'dry_run')
 
   def __init__(self, merge_prog=None, cleanup=False, group=None,
                split_read_count=1000000,
-               loglevel=logging.WARNING, debug=True):
+               loglevel=logging.WARNING, debug=True, dry_run=False):
 
     self.conf = Config()
 
@@ -802,6 +1113,7 @@ class AlignmentManager(object):
     self.cleanup       = cleanup
     self.group         = group
     self.debug         = debug    
+    self.dry_run       = dry_run # Log job commands without submitting them.
 
     if self.merge_prog is None:
       self.merge_prog = 'cs_runBwaWithSplit_Merge.py'
@@ -831,46 +1143,76 @@ class AlignmentManager(object):
     hdlr.setLevel(min(logger.getEffectiveLevel(), logging.WARN))
     logger.addHandler(hdlr)
         
-  def split_fq(self, fastq_fn):
+  def split_fastq_files(self, fastq_fns):
     '''
-    Splits fastq file to self.split_read_count reads per file using
-    linux command line split for speed.
-    In case compressed (gzip or bzip), the file will be uncompressed on fly.    
+    Splits one fastq file, or a pair of fastq files in lockstep, into
+    chunks of self.split_read_count*self.threads reads. Compressed
+    input is decompressed on the fly. The chunks are written
+    uncompressed unless the split_fastq_compresslevel config option
+    is set. Returns the split manifest, a list of FastqChunk tuples
+    (index, filenames, reads), which is also saved alongside the
+    first input file. In a dry run nothing is written or deleted;
+    the planned chunks are logged and returned.
     '''
-    LOGGER.info("Splitting %s (%d reads per split)", fastq_fn, (self.split_read_count*self.threads) )
+    chunk_reads = self.split_read_count * self.threads
+    LOGGER.info("Splitting %s (%d reads per split)",
+                ", ".join(fastq_fns), chunk_reads)
 
-    fastq_fn_suffix = fastq_fn + '-'
-    if fastq_fn.endswith('.gz'):
-      fastq_fn_suffix = fastq_fn.rstrip('.gz') + '-'
-      cmd = 'gunzip -c %s | split -l %d - %s' % ( quote(fastq_fn), (self.split_read_count*4*self.threads), quote(fastq_fn_suffix) )
-    elif fastq_fn.endswith('.bz2'):
-      fastq_fn_suffix = fastq_fn.rstrip('.bz2') + '-'
-      cmd = 'bzcat %s | split -l %d - %s' % ( quote(fastq_fn), (self.split_read_count*4*self.threads), quote(fastq_fn_suffix) )
-    else:
-      cmd = ("split -l %d %s %s" # split -l size file.fq prefix
-             % (self.split_read_count*4*self.threads, quote(fastq_fn), quote(fastq_fn_suffix)))
-    call_subprocess(cmd, shell=True,
-                    tmpdir=self.conf.clusterworkdir,
-                    path=self.conf.clusterpath)
-
-    # glob will try and expand [, ], ? and *; we don't actually want
-    # that.  Here we quote them as per the glob docs in a character
-    # class []. We then run a second search to be sure we're getting all
-    # the files (large files split into *-zaaa and so on).
-    bash_re  = re.compile(r'([?\[\]*])')
-    fq_files =  glob.glob(bash_re.sub(r'[\1]', fastq_fn_suffix) + "??")
-    fq_files += glob.glob(bash_re.sub(r'[\1]', fastq_fn_suffix) + "????")
-    fq_files.sort()
-    for fname in fq_files:
-      LOGGER.debug("Created fastq file: '%s'", fname)
-      if self.group != None:
-        set_file_permissions(self.group, fname)
+    try:
+      compresslevel = int(self.conf.split_fastq_compresslevel)
+    except AttributeError, _err:
+      compresslevel = 0
+
+    if self.dry_run:
+      manifest = plan_fastq_chunks(fastq_fns, chunk_reads=chunk_reads,
+                                   compress=compresslevel > 0,
+                                   path=self.conf.clusterpath)
+      for chunk in manifest:
+        LOGGER.info("Dry run; planned chunk %d: %s (%d reads)", chunk.index,
+                    ", ".join(chunk.filenames), chunk.reads)
+      return manifest
+
+    manifest = split_fastq(fastq_fns, chunk_reads=chunk_reads,
+                           compress=compresslevel > 0,
+                           compresslevel=max(1, compresslevel),
+                           parallel=self.threads,
+                           path=self.conf.clusterpath)
+    write_manifest(manifest, "%s.split.json"
+                   % make_bam_name_without_extension(fastq_fns[0]))
+
+    for chunk in manifest:
+      for fname in chunk.filenames:
+        LOGGER.debug("Created fastq file: '%s' (%d reads)", fname, chunk.reads)
+        if self.group != None:
+          set_file_permissions(self.group, fname)
 
     # Clean up 
     if self.cleanup:
-      os.unlink(fastq_fn)
-      LOGGER.info("Unlinking fq file '%s'", fastq_fn)
-    return fq_files
+      for fastq_fn in fastq_fns:
+        os.unlink(fastq_fn)
+        LOGGER.info("Unlinking fq file '%s'", fastq_fn)
+    return manifest
+
+  def split_fq(self, fastq_fn):
+    '''
+    Splits fastq file to self.split_read_count*self.threads reads per
+    file, returning the list of split file names in order. See
+    split_fastq_files for splitting paired-end files.
+    '''
+    return [ chunk.filenames[0]
+             for chunk in self.split_fastq_files([fastq_fn]) ]
+
+  def split_input_files(self, fastq_fns):
+    '''
+    Split one or two (paired-end) fastq files, returning a tuple
+    (fq_files, fq_files2) listing the chunk files in order. fq_files2
+    is None for single-end input.
+    '''
+    manifest = self.split_fastq_files(fastq_fns)
+    fq_files = [ chunk.filenames[0] for chunk in manifest ]
+    if len(fastq_fns) == 2:
+      return (fq_files, [ chunk.filenames[1] for chunk in manifest ])
+    return (fq_files, None)
 
   def queue_merge(self, bam_files, depend, bam_fn, rcp_target, samplename=None):
     '''
@@ -913,6 +1255,10 @@ class AlignmentManager(object):
     '''
     Executes command in LSF cluster.
     '''
+    if self.dry_run:
+      LOGGER.info("Dry run; not submitting job %s (depends on %s): %s",
+                  jobname, depend, command)
+      return ''
     jobid = self.bsub.submit_command(command, jobname=jobname,
                                      depend_jobs=depend, mem=mem,
                                      path=self.conf.clusterpath,
@@ -931,91 +1277,49 @@ class AlignmentManager(object):
 
     raise NotImplementedError()
 
+  def _merge_mode(self):
+    '''
+    Return the bam merge mode set by the bam_merge_mode config
+    option (see build_merge_pipeline); the default is 'samtools'.
+    '''
+    try:
+      mode = self.conf.bam_merge_mode
+    except AttributeError, _err:
+      mode = 'samtools'
+    if mode not in MERGE_MODES:
+      raise StandardError("Unrecognised bam_merge_mode config option: %s" % mode)
+    return mode
+
   def _merge_files(self, output_fn, input_fns, samplename=None):
     '''
-    Merges list of bam files.
-    '''
-    if len(input_fns) == 1:
-
-      # If sample name is provided we still need to add read group info.
-      if samplename is not None:
-        # We will run picard in npiper wrapper with no compression to compress with samtools for the advantage of more than one compression threads
-        m1 = "%s_m1" % bash_quote(output_fn)
-        m2 = "%s_m2" % bash_quote(output_fn)
-        cmd = "mknod %s p && mknod %s p" % (m1, m2)
-        ncmd = ("%s view -@ %d -b -u %s > %s\n"
-              % (self.samtools_prog, self.threads, input_fns[0], m1))
-        # Prepare read group information
-        (libcode, facility, lanenum, _pipeline) = parse_repository_filename(output_fn)
-        if libcode is None:
-          LOGGER.warn("Applying dummy read group information to output bam.")
-          libcode  = os.path.basename(output_fn)
-          facility = 'Unknown'
-          lanenum  = 0
-        # Command for adding read groups
-        ncmd += "picard AddOrReplaceReadGroups VALIDATION_STRINGENCY=SILENT COMPRESSION_LEVEL=0 INPUT=%s OUTPUT=%s RGLB=%s RGSM=%s RGCN=%s RGPU=%d RGPL=illumina\n" % (m1, m2, libcode, samplename, facility, int(lanenum))
-        # Command for compressing the file
-        ncmd += "samtools view -b -@ %d %s > %s\n" % (self.threads, m2, bash_quote(output_fn))
-      
-        LOGGER.debug(ncmd)
-        nfname = os.path.join(self.conf.clusterworkdir, "%s.nfile" % output_fn)
-        ret = write_to_remote_file(ncmd, nfname, self.conf.clusteruser, self.conf.cluster)
-        if ret > 0:
-          LOGGER.error("Failed to create %s:%s" % (self.conf.cluster, nfname))
-          sys.exit(1)
-        cmd += " && npiper -i %s && rm %s %s %s" % (nfname, m1, m2, nfname)
-      
-        LOGGER.debug(cmd)
-        pout = call_subprocess(cmd, shell=True,
-                               tmpdir=self.conf.clusterworkdir,
-                               path=self.conf.clusterpath)
-        for line in pout:
-          LOGGER.warn("SAMTOOLS: %s", line[:-1])
-
-      # Samplename was not provided. Just rename the file
-      else:
-        LOGGER.warn("Moving file: %s to %s", input_fns[0], output_fn)
-        move(input_fns[0], bash_quote(output_fn))
+    Merges list of bam files, setting the read group of the output. A
+    single input file without a sample name is simply renamed.
+    '''
+    if len(input_fns) == 1 and samplename is None:
+      LOGGER.warn("Moving file: %s to %s", input_fns[0], output_fn)
+      move(input_fns[0], output_fn)
 
-    # More than one input files, hence need to merge and set the read group
     else:
-      
-      m1 = "%s_m1" % bash_quote(output_fn)
-      m2 = "%s_m2" % bash_quote(output_fn)
-      cmd = "mknod %s p && mknod %s p" % (m1, m2)
-      # NB! samtools merge does not like naped pipe as output file. Hence the extra step of writing to stdout and cating to named pipe.
-      ncmd = ("%s merge -u - %s > %s\n" # assumes sorted input bams.
-              % (self.samtools_prog, " ".join([ bash_quote(x) for x in input_fns]), m1))
-      # Prepare read group information
-      (libcode, facility, lanenum, _pipeline) = parse_repository_filename(output_fn)
-      if libcode is None:
-        LOGGER.warn("Applying dummy read group information to output bam.")
-        libcode  = os.path.basename(output_fn)
-        facility = 'Unknown'
-        lanenum  = 0
-      if samplename is not None:
-        sample = samplename
-      else:
-        samplename = libcode
-      # Command for adding read groups
-      ncmd += "picard AddOrReplaceReadGroups VALIDATION_STRINGENCY=SILENT COMPRESSION_LEVEL=0 INPUT=%s OUTPUT=%s RGLB=%s RGSM=%s RGCN=%s RGPU=%d RGPL=illumina\n" % (m1, m2, libcode, sample, facility, int(lanenum))
-      # Command for compressing the file
-      ncmd += "samtools view -b -@ %d %s > %s\n" % (self.threads, m2, bash_quote(output_fn))
-      
-      LOGGER.debug(ncmd)
-      nfname = os.path.join(self.conf.clusterworkdir, "%s.nfile" % output_fn)
-      ret = write_to_remote_file(ncmd, nfname, self.conf.clusteruser, self.conf.cluster)
-      if ret > 0:
-        LOGGER.error("Failed to create %s:%s" % (self.conf.cluster, nfname))
-        sys.exit(1)
-      cmd += " && npiper -i %s && rm %s %s %s" % (nfname, m1, m2, nfname)
-      
+      graph = build_merge_pipeline(output_fn, input_fns,
+                                   readgroup_fields(output_fn, samplename),
+                                   threads=self.threads,
+                                   mode=self._merge_mode(),
+                                   samtools_prog=self.samtools_prog,
+                                   workdir=self.conf.clusterworkdir)
+      LOGGER.debug(graph.plan())
+      script = os.path.join(self.conf.clusterworkdir,
+                            "%s.merge.sh" % os.path.basename(output_fn))
+      with open(script, 'w') as out:
+        out.write(graph.render())
+
+      cmd = "bash %s && rm %s" % (bash_quote(script), bash_quote(script))
       LOGGER.debug(cmd)
       pout = call_subprocess(cmd, shell=True,
                              tmpdir=self.conf.clusterworkdir,
                              path=self.conf.clusterpath)
       for line in pout:
         LOGGER.warn("SAMTOOLS: %s", line[:-1])
+
     if not os.path.isfile(output_fn):
       LOGGER.error("expected output file '%s' cannot be found.", output_fn)
       sys.exit("File access error.")
@@ -1169,213 +1473,158 @@ class BwaAlignmentManager(AlignmentManager):
     else:
       self.nocc = ''
     
-  def _run_pairedend_bwa_aln(self, fqname, fqname2, genome, jobtag, output_fn, samplename, delay=0, compress_output=False):
+  def _output_bam_base(self, fqname, output_fn, samplename):
     '''
-    Run bwa aln on paired-ended sequencing data.
+    Returns (read group string, output bam name without extension)
+    for an alignment job. Read group information is only added at
+    this stage if the input has not been split; otherwise it is
+    added during the merge.
     '''
-    jobname_bam = "%s_bam" % (jobtag,)
-    outbambase  = bash_quote(fqname)
-    outbam      = outbambase + ".bam"
-
-    readgroup = ""
+    if self.split is False:
+      readgroup = self._make_readgroup_string(output_fn, samplename)
+      outbambase = output_fn[:-4] if output_fn.endswith('.bam') else output_fn
+      return (readgroup, outbambase)
+    return (None, bash_quote(fqname))
 
-    quoted_fqnames = [bash_quote(fqname), bash_quote(fqname2), bash_quote(fqname), bash_quote(fqname2)]
-    ncommands = ""
-    cmd = ""
-    acmd = ""
-    
-    readgroup = "-r %s" % self._make_readgroup_string(output_fn, samplename)
-    outbam     = output_fn
-    outbambase = outbam.rstrip('.bam')
-
-    # Named pipes for handling fq files
-    p011 = "%s_p011" % bash_quote(fqname)
-    p012 = "%s_p012" % bash_quote(fqname)
-    p021 = "%s_p021" % bash_quote(fqname2)
-    p022 = "%s_p022" % bash_quote(fqname2)
-    # Named pipes for handling sai files
-    sai_file1 = "%s_sai1" % bash_quote(fqname)
-    sai_file2 = "%s_sai2" % bash_quote(fqname2)
-    # Named pipes for sorting and tiding up bam with picard.
-    p1 = "%s_p1" % bash_quote(fqname)
-    p2 = "%s_p2" % bash_quote(fqname)
-    p3 = "%s_p3" % bash_quote(fqname)
-    # Command for creating all named pipes
-    cmd = "mknod %s p && mknod %s p && mknod %s p && mknod %s p && mknod %s p && mknod %s p && mknod %s p && mknod %s p  && mknod %s p && sleep 1" % (p011, p012, p021, p022, sai_file1, sai_file2, p1, p2, p3)
-    # Command for removing all named pipes in the end
-    acmd = "rm %s %s %s %s %s %s %s %s %s" % (p011, p012, p021, p022, sai_file1, sai_file2, p1, p2, p3)
-    quoted_fqnames = [p011, p021, p012, p022, sai_file1, sai_file2, p1, p2, p3]
-    
-    # in case files were not split, commands may need to be added to uncompress files on fly
-    # NB! Assuming that fqname2 has been similarly compressed
-    if fqname.endswith('.gz'):
-      ncommands += "zcat %s > %s\n" % (bash_quote(fqname), p011)
-      ncommands += "zcat %s > %s\n" % (bash_quote(fqname), p012)
-      ncommands += "zcat %s > %s\n" % (bash_quote(fqname2), p021)
-      ncommands += "zcat %s > %s\n" % (bash_quote(fqname2), p022)
+  def _fastq_source(self, graph, fqname, name):
+    '''
+    bwa reads plain and gzipped fastq files directly. Bzipped files
+    are decompressed by a separate pipeline source stage, whose name
+    is returned (or None if no such stage is needed).
+    '''
     if fqname.endswith('.bz2'):
-      ncommands += "pzcat %s > %s\n" % (bash_quote(fqname), p011)
-      ncommands += "pzcat %s > %s\n" % (bash_quote(fqname), p012)
-      ncommands += "pzcat %s > %s\n" % (bash_quote(fqname2), p021)
-      ncommands += "pzcat %s > %s\n" % (bash_quote(fqname2), p022)
-      
-    # Run bwa aln
-    ncommands += "%s aln -t %d %s %s > %s\n" % (self.bwa_prog, int(self.threads/2), genome,
-                                  quoted_fqnames[0], quoted_fqnames[4])
-    ncommands += "%s aln -t %d %s %s > %s\n" % (self.bwa_prog, int(self.threads/2), genome,
-                                  quoted_fqnames[1], quoted_fqnames[5])
+      graph.add_stage(name, "bzcat %s > {out}" % bash_quote(fqname))
+      return name
+    return None
 
-    # Variables for picard tools
+  def _add_bam_stages(self, graph, source, outbambase, compress_output=False):
+    '''
+    Add the stages converting bwa SAM output into a sorted bam file:
+    samtools view, picard CleanSam and FixMateInformation, and
+    samtools sort. Sorting uses the 'sort' thread pool and the
+    clustersortmem config option.
+    '''
     # Some options are universal. Consider also adding QUIET=true, VERBOSITY=ERROR, TMP_DIR=DBCONF.tmpdir.
     # Though, no the picard commands below should not require write of any temporary files.
-    picard_common_args = ('VALIDATION_STRINGENCY=SILENT', 'COMPRESSION_LEVEL=0')
-        
-    # Run bwa sampe
-    ncommands += ("%s sampe %s %s %s %s %s %s %s"
-             % (self.bwa_prog, readgroup, self.nocc, genome, quoted_fqnames[4], quoted_fqnames[5], quoted_fqnames[2], quoted_fqnames[3]))
+    picard_common_args = ' '.join(('VALIDATION_STRINGENCY=SILENT', 'COMPRESSION_LEVEL=0'))
+
+    graph.add_stage('view', "%s view -b -S -u {in0} > {out}" % self.samtools_prog,
+                    [source])
+    graph.add_stage('cleansam', "picard CleanSam INPUT={in0} OUTPUT={out} %s"
+                    % picard_common_args, ['view'])
+    graph.add_stage('fixmate', "picard FixMateInformation ASSUME_SORTED=true"
+                    + " INPUT={in0} OUTPUT={out} %s" % picard_common_args,
+                    ['cleansam'])
+
+    def _sort_command(stage):
+      # If less than 300MB of ram per thread, do not bother specifying.
+      mem = int(round(float(stage.memory) / stage.threads, -2))
+      memopt = " -m %dM" % mem if mem > 300 else ""
+      # Output is only compressed here if there is to be no merge step.
+      level  = "" if compress_output else " -l 0"
+      return ("%s sort%s -@ {threads}%s -o %s.bam {in0}"
+              % (self.samtools_prog, level, memopt, outbambase))
+    graph.add_stage('sort', _sort_command, ['fixmate'], weight=1, pool='sort',
+                    memory=int(self.conf.clustersortmem))
+
+  def _new_pipeline(self, prefix):
+    '''
+    Create an empty PipelineGraph sharing num_threads between the
+    alignment stages and num_threads_sort between the sort stages.
+    '''
+    return PipelineGraph(prefix, workdir=self.conf.clusterworkdir,
+                         pools={ 'main' : self.threads,
+                                 'sort' : self.sortthreads })
 
-    # Convert to bam
-    ncommands += (" | %s view -b -S -u - > %s\n" % (self.samtools_prog, p1))
-        
-    # Run picard CleanSam
-    ncommands += ("picard CleanSam INPUT=%s OUTPUT=%s %s\n" % (p1, p2, ' '.join(picard_common_args)))
-
-    # Run picard FixMateInformation
-    ncommands += ("picard FixMateInformation ASSUME_SORTED=true INPUT=%s OUTPUT=%s %s\n" % (p2, p3, ' '.join(picard_common_args)))
-
-    # Run samtools sort
-    # depending on number of threads, determine how much memory to allocate per thread.
-    mem_string = ""
-    mem = int(round((int(self.conf.clustersortmem)/self.sortthreads),-2))
-    if mem > 300:
-      mem_string = " -m %dM" % mem
-    if compress_output:
-      ncommands += ("%s sort -@ %d%s -o %s.bam %s\n" % (self.samtools_prog, self.sortthreads, mem_string, outbambase, p3))
+  def _submit_pipeline(self, graph, jobname, remove=(), delay=0, depend=None):
+    '''
+    Write the pipeline script to the cluster working directory and
+    submit it, deleting the script and the listed files on
+    success. Returns the job ID.
+    '''
+    script = os.path.join(self.conf.clusterworkdir, "%s.pipeline.sh" % graph.prefix)
+    LOGGER.debug(graph.plan())
+    if self.dry_run:
+      LOGGER.info("Dry run; %s:\n%s", graph.plan(), graph.render())
     else:
-      ncommands += ("%s sort -l 0 -@ %d%s -o %s.bam %s\n" % (self.samtools_prog, self.sortthreads, mem_string, outbambase, p3))
+      with open(script, 'w') as out:
+        out.write(graph.render())
+    cmd = "bash %s && rm %s" % (bash_quote(script), " ".join(
+        [ bash_quote(script) ] + [ bash_quote(fname) for fname in remove ]))
+    return self._submit_lsfjob(cmd, jobname, depend=depend, sleep=delay,
+                               mem=int(self.conf.clustermem), threads=self.threads)
 
-    # write ncommands to nfname
-    nfname = os.path.join(self.conf.clusterworkdir, "%s.nfile" % fqname)
-    ret = write_to_remote_file(ncommands, nfname, self.conf.clusteruser, self.conf.cluster)
-    if ret > 0:
-      LOGGER.error("Failed to create %s:%s" % (self.conf.cluster, nfname))
-      sys.exit(1)
-
-    cmd += " && npiper -i %s && rm %s %s && %s" % (nfname, bash_quote(fqname), bash_quote(fqname2), acmd)
+  def _run_pairedend_bwa_aln(self, fqname, fqname2, genome, jobtag, output_fn, samplename, delay=0, compress_output=False):
+    '''
+    Run bwa aln on paired-ended sequencing data.
+    '''
+    jobname_bam = "%s_bam" % (jobtag,)
+    (readgroup, outbambase) = self._output_bam_base(fqname, output_fn, samplename)
+    graph = self._new_pipeline(fqname)
+
+    # Each bwa aln process gets half of the available threads.
+    sources = [ self._fastq_source(graph, fqname,  'fastq1'),
+                self._fastq_source(graph, fqname2, 'fastq2') ]
+    for (num, fqn) in enumerate((fqname, fqname2)):
+      graph.add_stage('aln%d' % (num + 1),
+                      "%s aln -t {threads} %s %s > {out}"
+                      % (self.bwa_prog, genome,
+                         '{in0}' if sources[num] else bash_quote(fqn)),
+                      [ x for x in sources[num:num+1] if x ], weight=1)
+
+    inputs = ['aln1', 'aln2']
+    fqrefs = []
+    for (fqn, src) in zip((fqname, fqname2), sources):
+      if src:
+        inputs.append(src)
+        fqrefs.append('{in%d}' % (len(inputs) - 1))
+      else:
+        fqrefs.append(bash_quote(fqn))
+    rgopt = "-r %s " % readgroup if readgroup else ""
+    graph.add_stage('sampe', "%s sampe %s%s %s {in0} {in1} %s > {out}"
+                    % (self.bwa_prog, rgopt, self.nocc, genome, " ".join(fqrefs)),
+                    inputs)
+    self._add_bam_stages(graph, 'sampe', outbambase, compress_output)
 
     LOGGER.info("Starting bwa aln / sampe / picard CleanSam / picard FixMateInformation | samtools sort on '%s' and '%s'", fqname, fqname2)
-    
-    jobid = self._submit_lsfjob(cmd, jobname_bam, sleep=delay, mem=int(self.conf.clustermem), threads=self.threads)
+    jobid = self._submit_pipeline(graph, jobname_bam, remove=(fqname, fqname2), delay=delay)
     LOGGER.debug("got job id '%s'", jobid)
 
-    return(jobid, outbam)
+    return(jobid, "%s.bam" % outbambase)
 
   def _run_singleend_bwa_aln(self, fqname, genome, jobtag, output_fn, samplename, delay=0, compress_output=False):
     '''
     Run bwa aln on single-ended sequencing data.
     '''
     jobname_bam = "%s_bam" % (jobtag,)
-    outbambase  = bash_quote(fqname)
-    outbam      = outbambase + ".bam"
-    
-    readgroup = ""
-
-    quoted_fqname = [bash_quote(fqname), bash_quote(fqname)]
-    ncommands = ""
-    cmd = ""
-    acmd = ""
-        
-    # Check if readgroup information should be added by bwa
-    if self.split is False:
-      readgroup = "-R %s" % self._make_readgroup_string(output_fn, samplename)
-      outbam     = output_fn
-      outbambase = outbam.rstrip('.bam')
-
-      # in case files were not split, commands may need to be added to uncompress files on fly
-      if fqname.endswith('.gz'):
-        p01 = "%s_p01" % fqname
-        p02 = "%s_p02" % fqname
-        cmd = "mknod %s p && mknod %s p && sleep 1 && " % (p01, p02)
-        ncommands += "zcat %s > %s\n" % (bash_quote(fqname), p01)
-        ncommands += "zcat %s > %s\n" % (bash_quote(fqname), p02)
-        acmd = "&& rm %s %s" % (p01, p02)
-        quoted_fqname = [p01, p02]
-      if fqname.endswith('.bz2'):
-        p01 = "%s_p01" % fqname
-        p02 = "%s_p02" % fqname
-        cmd = "mknod %s p && mknod %s p && sleep 1 && " % (p01, p02)
-        ncommands += "bzcat %s > %s\n" % (bash_quote(fqname), p01)
-        ncommands += "bzcat %s > %s\n" % (bash_quote(fqname), p02)
-        acmd = "&& rm %s %s" % (p01, p02)
-        quoted_fqname = [p01, p02]
-
-    # Variables for picard tools
-    # Some options are universal. Consider also adding QUIET=true, VERBOSITY=ERROR, TMP_DIR=DBCONF.tmpdir.
-    # Though, no the picard commands below should not require write of any temporary files.
-    picard_common_args = ('VALIDATION_STRINGENCY=SILENT', 'COMPRESSION_LEVEL=0')
-    
-    # Create named pipes for running commands in npiper
-    p1 = "%s_p1" % fqname
-    p2 = "%s_p2" % fqname
-    p3 = "%s_p3" % fqname
-
-    cmd += "mknod %s p && mknod %s p && mknod %s p && sleep 1" % (p1, p2, p3)
-    
-    # Run bwa aln
-    ncommands += ("%s aln -t %d %s %s %s" % (self.bwa_prog, self.threads, readgroup, genome, quoted_fqname[0]))
-
-    # Run bwa samse
-    ncommands += (" | %s samse %s %s - %s" % (self.bwa_prog, self.nocc,
-                                        genome, quoted_fqname[1]))
-    # Convert to bam
-    ncommands += (" | %s view -b -S -u - > %s\n" % (self.samtools_prog, p1))
-    
-    # Run picard CleanSam
-    ncommands += ("picard CleanSam INPUT=%s OUTPUT=%s %s\n" % (p1, p2, ' '.join(picard_common_args)))
+    (readgroup, outbambase) = self._output_bam_base(fqname, output_fn, samplename)
+    graph = self._new_pipeline(fqname)
+
+    source = self._fastq_source(graph, fqname, 'fastq')
+    fqref  = '{in0}' if source else bash_quote(fqname)
+    graph.add_stage('aln', "%s aln -t {threads} %s %s > {out}"
+                    % (self.bwa_prog, genome, fqref),
+                    [ source ] if source else [], weight=1)
+
+    # Read group information is added by samse (bwa aln has no such option).
+    rgopt = "-r %s " % readgroup if readgroup else ""
+    graph.add_stage('samse', "%s samse %s%s %s {in0} %s > {out}"
+                    % (self.bwa_prog, rgopt, self.nocc, genome,
+                       '{in1}' if source else fqref),
+                    [ 'aln', source ] if source else [ 'aln' ])
+    self._add_bam_stages(graph, 'samse', outbambase, compress_output)
 
-    # Run picard FixMateInformation
-    ncommands += ("picard FixMateInformation ASSUME_SORTED=true INPUT=%s OUTPUT=%s %s\n" % (p2, p3, ' '.join(picard_common_args)))
-    
-    # depending on RAM available, we can allocate more for sorting
-    mem_string = ""
-    mem = int(round((int(self.conf.clustersortmem)/self.sortthreads),-2))
-    # if less than 300MB of ram left, do not bother specifying
-    if mem > 300:
-      mem_string = "-m %dM " % mem
-    # Run samtools sort
-    if compress_output:
-      ncommands += ("%s sort -@ %d %s -o %s.bam %s\n" % (self.samtools_prog, self.sortthreads, mem_string, outbambase, p3))
-    else:
-      ncommands += ("%s sort -l 0 -@ %d %s -o %s.bam %s\n" % (self.samtools_prog, self.sortthreads, mem_string, outbambase, p3))
-    
-    # write ncommands to nfname
-    nfname = os.path.join(self.conf.clusterworkdir, "%s.nfile" % fqname)
-    ret = write_to_remote_file(ncommands, nfname, self.conf.clusteruser, self.conf.cluster)
-    if ret > 0:
-      LOGGER.error("Failed to create %s:%s" % (self.conf.cluster, nfname))
-      sys.exit(1)
-
-    cmd += " && npiper -i %s && rm %s %s %s %s %s %s" % (nfname, bash_quote(fqname), p1, p2, p3, nfname, acmd)
-    
     LOGGER.info("starting bwa on '%s'", fqname)
-    LOGGER.debug(cmd)
-    jobid_bam = self._submit_lsfjob(cmd, jobname_bam, sleep=delay, mem=int(self.conf.clustermem), threads=self.threads)
+    jobid_bam = self._submit_pipeline(graph, jobname_bam, remove=(fqname,), delay=delay)
     LOGGER.debug("got job id '%s'", jobid_bam)
-    
-    return(jobid_bam, outbam)
+
+    return(jobid_bam, "%s.bam" % outbambase)
 
   def _make_readgroup_string(self, fname, samplename):
 
     # set readgroup information for the file
-    (libcode, facility, lanenum, _pipeline) = parse_repository_filename(fname)
-    if libcode is None:
-      LOGGER.warn("Applying dummy read group information to output bam.")
-      libcode  = os.path.basename(fname)
-      facility = 'Unknown'
-      lanenum  = 0
-    sample = samplename if samplename is not None else libcode    
-
-    return "\'@RG\tID:%d\tPL:%s\tPU:%d\tLB:%s\tSM:%s\tCN:%s\'" % (int(lanenum),'illumina',int(lanenum), libcode, sample, facility)
+    fields = readgroup_fields(fname, samplename)
+    return "\'%s\'" % "\t".join([ "@RG" ] + [ "%s:%s" % x for x in fields ])
   
   def _run_bwa_mem(self, fqnames, genome, jobtag, output_fn, samplename, delay=0, compress_output=False):
     '''
@@ -1385,103 +1634,31 @@ class BwaAlignmentManager(AlignmentManager):
     assert(len(fqnames) in (1, 2))
 
     jobname_bam = "%s_bam" % (jobtag,)
-    outbambase  = bash_quote(fqnames[0])
-    outbam      = outbambase + ".bam"
-    
-    readgroup = ""
-
-    ncommands = ""
-    cmd = ""
-    acmd = ""
-    quoted_fqnames = " ".join([ bash_quote(fqn) for fqn in fqnames ])
-
-    # Check if readgroup information should be added by bwa
-    if self.split is False:
-      readgroup = "-R %s" % self._make_readgroup_string(output_fn, samplename)
-      outbam     = output_fn
-      outbambase = outbam.rstrip('.bam')
-
-      # in case files were not split, commands may need to be added to uncompress files on fly
-      if fqnames[0].endswith('.gz'):
-        p01 = "%s_p01" % fqnames[0]
-        cmd += "mknod %s p && sleep 1 && " % (p01)
-        ncommands += "zcat %s > %s\n" % (bash_quote(fqnames[0]), p01)
-        quoted_fqnames = "%s" % (p01)
-        acmd = "&& rm %s" % (bash_quote(fqnames[0]))
-        if len(fqnames) == 2:
-          p02 = "%s_p02" % fqnames[0]
-          cmd += "mknod %s p && sleep 1 && " % (p02)
-          ncommands += "zcat %s > %s\n" % (bash_quote(fqnames[1]), p02)
-          quoted_fqnames += " %s" % (p02)
-          acmd += " %s" % (bash_quote(fqnames[1]))
-      if fqnames[0].endswith('.bz2'):
-        p01 = "%s_p01" % fqnames[0]
-        cmd += "mknod %s p && sleep 1 && " % (p01)
-        ncommands += "bzcat %s > %s\n" % (bash_quote(fqnames[0]),p01)
-        quoted_fqnames = "%s" % (p01)
-        acmd = "&& rm %s" % (bash_quote(fqnames[0]))
-        if len(fqnames) == 2:
-          p02 = "%s_p02" % fqnames[0]
-          cmd += "mknod %s p && sleep 1 && " % (p02)
-          ncommands += "bzcat %s > %s\n" % (bash_quote(fqnames[1]),p02)
-          quoted_fqnames += " %s" % (p02)
-          acmd += " %s" % (bash_quote(fqnames[1]))
-
-    # Variables for picard tools
-    # Some options are universal. Consider also adding QUIET=true, VERBOSITY=ERROR, TMP_DIR=DBCONF.tmpdir.
-    # Though, no the picard commands below should not require write of any temporary files.
-    picard_common_args = ('VALIDATION_STRINGENCY=SILENT', 'COMPRESSION_LEVEL=0')
-          
-    # Create named pipes for running commands in npiper
-    p1 = "%s_p1" % fqnames[0]
-    p2 = "%s_p2" % fqnames[0]
-    p3 = "%s_p3" % fqnames[0]
-
-    cmd += "mknod %s p && mknod %s p && mknod %s p && sleep 1" % (p1, p2, p3)
-
-    # Run bwa mem
-    ncommands += "%s mem %s -t %d %s %s" % (self.bwa_prog, readgroup, self.threads, genome, quoted_fqnames)
-
-    # Run sam to bam conversion
-    ncommands += (" | %s view -b -S -u - > %s\n" % (self.samtools_prog, p1))
-    
-    # Run picard CleanSam
-    ncommands += ("picard CleanSam INPUT=%s OUTPUT=%s %s\n" % (p1, p2, ' '.join(picard_common_args)))
-
-    # Run picard FixMateInformation
-    ncommands += ("picard FixMateInformation ASSUME_SORTED=true INPUT=%s OUTPUT=%s %s\n" % (p2, p3, ' '.join(picard_common_args)))
-
-    # depending on RAM available, allocate more per thread
-    mem_string = ""
-    mem = int(round((int(self.conf.clustersortmem)/self.sortthreads),-2))
-    # if less than 300MB of ram per thread, do not bother specifying
-    if mem > 300:
-      mem_string = "-m %dM " % mem
-    
-    # Run samtools sort
-    # If files have not been split, compress output
-    if compress_output:
-      ncommands += ("%s sort -@ %d %s -o %s.bam %s\n" % (self.samtools_prog, self.sortthreads, mem_string, outbambase, p3))
-    else:
-      ncommands += ("%s sort -l 0 -@ %d %s -o %s.bam %s\n" % (self.samtools_prog, self.sortthreads, mem_string, outbambase, p3))
+    (readgroup, outbambase) = self._output_bam_base(fqnames[0], output_fn, samplename)
+    graph = self._new_pipeline(fqnames[0])
+
+    inputs = []
+    fqrefs = []
+    for (num, fqn) in enumerate(fqnames):
+      source = self._fastq_source(graph, fqn, 'fastq%d' % (num + 1))
+      if source:
+        inputs.append(source)
+        fqrefs.append('{in%d}' % (len(inputs) - 1))
+      else:
+        fqrefs.append(bash_quote(fqn))
 
-    # write ncommands to nfname
-    nfname = os.path.join(self.conf.clusterworkdir, "%s.nfile" % fqnames[0])
-    ret = write_to_remote_file(ncommands, nfname, self.conf.clusteruser, self.conf.cluster)
-    if ret > 0:
-      LOGGER.error("Failed to create %s:%s" % (self.conf.cluster, nfname))
-      sys.exit(1)
+    # bwa mem gets all the non-sort threads.
+    rgopt = "-R %s " % readgroup if readgroup else ""
+    graph.add_stage('mem', "%s mem %s-t {threads} %s %s > {out}"
+                    % (self.bwa_prog, rgopt, genome, " ".join(fqrefs)),
+                    inputs, weight=1)
+    self._add_bam_stages(graph, 'mem', outbambase, compress_output)
 
-    # Run npiper and clean up temporary files.
-#    cmd += " && npiper -i %s && rm %s %s %s %s %s %s" % (nfname, p1, p2, p3, nfname, quoted_fqnames, acmd)
-    cmd += " && npiper -i %s && rm %s %s %s %s %s %s" % (nfname, p1, p2, p3, nfname, quoted_fqnames, acmd)
-    
-    LOGGER.info("Starting bwa mem on fastq files: %s", quoted_fqnames)
-    LOGGER.debug(cmd)
-    jobid_bam = self._submit_lsfjob(cmd, jobname_bam, sleep=delay, mem=int(self.conf.clustermem), threads=self.threads)
+    LOGGER.info("Starting bwa mem on fastq files: %s", ", ".join(fqnames))
+    jobid_bam = self._submit_pipeline(graph, jobname_bam, remove=fqnames, delay=delay)
     LOGGER.debug("got job id '%s'", jobid_bam)
 
-    return(jobid_bam, outbam)
+    return(jobid_bam, "%s.bam" % outbambase)
 
   def run_bwas(self, genome, paired, fq_files, fq_files2, output_fn, samplename):
     '''
@@ -1594,30 +1771,25 @@ class BwaAlignmentManager(AlignmentManager):
     # Transfer files in.
     local_files = []
     for fn in files:
-      if fileshost is not None:
+      if fileshost is not None and self.dry_run:
+        LOGGER.info("Dry run; not transferring %s from %s", fn, fileshost)
+      elif fileshost is not None:
         # Throw an error in case files host is specified but no path to the files.
         self._get_foreign_file(fn, fileshost)
       (path, fname) = os.path.split(fn)
       local_files.append(fname)
 
     # Split file(s)
+    if len(local_files) not in (1, 2):
+      LOGGER.error("Too many files specified.")
+      sys.exit("Unexpected number of files passed to script.")
+    paired = len(local_files) == 2
     if self.split:      
       assert( self.merge_prog is not None )
-      fq_files = self.split_fq(local_files[0])
-    else:
-      fq_files = [local_files[0]]
-    if len(local_files) == 2:
-      if self.split:
-        fq_files2 = self.split_fq(local_files[1])
-      else:
-        fq_files2 = [local_files[1]]
-      paired = True
-    elif len(local_files) == 1:
-        fq_files2 = None
-        paired = False
+      (fq_files, fq_files2) = self.split_input_files(local_files)
     else:
-      LOGGER.error("Too many files specified.")
-      sys.exit("Unexpected number of files passed to script.")
+      fq_files  = [local_files[0]]
+      fq_files2 = [local_files[1]] if paired else None
 
     ## Margus (04.10.2017): Not sure if following if/else statement for output_fn filename creation is need. Looks suspicious as the output_fn for rcp case seems to contain
     ## directory in remote host which can not be right!
@@ -1734,16 +1906,11 @@ class TophatAlignmentManager(AlignmentManager):
     the final bam file.
     '''
     assert( self.merge_prog is not None )
-    fq_files = self.split_fq(files[0])
-    paired = False
-    if len(files) == 2:
-      fq_files2 = self.split_fq(files[1])
-      paired = True
-    elif len(files) == 1:
-      fq_files2 = None
-    else:
+    if len(files) not in (1, 2):
       LOGGER.error("Too many files specified.")
       sys.exit("Unexpected number of files passed to script.")
+    paired = len(files) == 2
+    (fq_files, fq_files2) = self.split_input_files(files)
       
     (job_ids, bam_files) = self.run_tophat(genome, paired, fq_files, fq_files2)
 
@@ -1832,30 +1999,25 @@ class StarAlignmentManager(AlignmentManager):
     # Transfer files in.
     local_files = []
     for fn in files:
-      if fileshost is not None:
+      if fileshost is not None and self.dry_run:
+        LOGGER.info("Dry run; not transferring %s from %s", fn, fileshost)
+      elif fileshost is not None:
         # Throw an error in case files host is specified but no path to the files.
         self._get_foreign_file(fn, fileshost)
       (path, fname) = os.path.split(fn)
       local_files.append(fname)
 
     # Split file(s)
+    if len(local_files) not in (1, 2):
+      LOGGER.error("Too many files specified.")
+      sys.exit("Unexpected number of files passed to script.")
+    paired = len(local_files) == 2
     if self.split:      
       assert( self.merge_prog is not None )
-      fq_files = self.split_fq(local_files[0])
+      (fq_files, fq_files2) = self.split_input_files(local_files)
     else:
-      fq_files = [local_files[0]]
-    if len(local_files) == 2:
-      if self.split:
-        fq_files2 = self.split_fq(local_files[1])
-      else:
-        fq_files2 = [local_files[1]]
-      paired = True
-    elif len(local_files) == 1:
-        fq_files2 = None
-        paired = False
-    else:
-      LOGGER.error("Too many files specified.")
-      sys.exit("Unexpected number of files passed to script.")
+      fq_files  = [local_files[0]]
+      fq_files2 = [local_files[1]] if paired else None
 
     ## Margus (04.10.2017): Not sure if following if/else statement for output_fn filename creation is need. Looks suspicious as the output_fn for rcp case seems to contain
     ## directory in remote host which can not be right!
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqutil python package.
+#
+# The osqutil python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqutil python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqutil python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Streaming demultiplexer for reads whose barcode is recorded either
+in the read header (the index read, as used by demuxIllumina -d) or
+inline at the start of the read sequence. Handles fastq and Illumina
+export input files, matching barcodes against a precomputed Hamming
+distance lookup table.
+'''
+
+import gzip
+import re
+from itertools import islice, combinations, product
+from subprocess import Popen, PIPE
+from distutils import spawn
+
+from .utilities import is_zipped, _find_gzip_decompressor
+from .config import Config
+from .setup_logs import configure_logging
+
+LOGGER = configure_logging('demux')
+CONFIG = Config()
+
+# Where the barcode is found: in the read header, or at the start of
+# the read sequence.
+BARCODE_LOCATIONS = ('header', 'sequence')
+
+################################################################################
+def header_barcode(header):
+  '''
+  Return the index sequence recorded in a fastq read header, in either
+  the older Illumina (@name#ACGT/1) or Casava 1.8 (@name 1:N:0:ACGT)
+  form, or an empty string if there is none. Only the first index of
+  a dual index (ACGT+TTGG) is returned.
+  '''
+  header = header.rstrip()
+  fields = header.split(' ', 1)
+  if len(fields) == 2:
+    code = fields[1].rsplit(':', 1)[-1]
+  elif '#' in header:
+    code = header.rsplit('#', 1)[1].split('/', 1)[0]
+  else:
+    return ''
+  return code.split('+', 1)[0]
+
+################################################################################
+def detect_format(fname):
+  '''
+  Return the input format ('fastq' or 'export') implied by a file
+  name, ignoring any trailing .gz suffix.
+  '''
+  fname = re.sub(r'\.gz$', '', fname)
+  return 'fastq' if re.search(r'\.f(ast)?q$', fname) else 'export'
+
+################################################################################
+def build_barcode_table(codes, max_mismatches=1, alphabet='ACGT'):
+  '''
+  Precompute a dict mapping every sequence within max_mismatches
+  (Hamming distance) of a barcode to a (barcode, distance) tuple.
+  Sequences which lie at the same minimal distance from more than one
+  barcode are ambiguous and are left out of the table.
+  '''
+  codes = [ code.upper() for code in codes ]
+  if len(set([ len(code) for code in codes ])) > 1:
+    raise ValueError("Barcodes must all be of the same length: %s"
+                     % ", ".join(codes))
+
+  table     = {}
+  ambiguous = set()
+  for code in codes:
+    table[code] = (code, 0)
+
+  for distance in range(1, max_mismatches + 1):
+    found = {}
+    for code in codes:
+      for positions in combinations(range(len(code)), distance):
+        choices = [ [ letter for letter in alphabet if letter != code[pos] ]
+                    for pos in positions ]
+        for letters in product(*choices):
+          seq = list(code)
+          for (pos, letter) in zip(positions, letters):
+            seq[pos] = letter
+          seq = ''.join(seq)
+          if seq in table or seq in ambiguous:
+            continue # Already matched at a smaller distance.
+          if seq in found and found[seq] != code:
+            ambiguous.add(seq)
+          else:
+            found[seq] = code
+    for (seq, code) in found.iteritems():
+      if seq not in ambiguous:
+        table[seq] = (code, distance)
+
+  if len(ambiguous) > 0:
+    LOGGER.warning("%d barcode sequences within %d mismatches of more than"
+                   + " one barcode will not be assigned.",
+                   len(ambiguous), max_mismatches)
+
+  return table
+
+################################################################################
+class _OutputFile(object):
+  '''
+  Output file handle which compresses via an external pigz/gzip
+  process where available, so that each output is compressed in
+  parallel with the others (and with the demultiplexing itself).
+  '''
+
+  __slots__ = ('fname', 'handle', 'proc', '_outfd')
+
+  def __init__(self, fname, compress=True, compresslevel=3, path=None):
+    self.fname = fname
+    self.proc  = None
+    self._outfd = None
+    if not compress:
+      self.handle = open(fname, 'wb', 1024*1024)
+      return
+
+    compressor = None
+    for prog in ('pigz', 'gzip'):
+      compressor = spawn.find_executable(prog, path=path or CONFIG.hostpath)
+      if compressor:
+        break
+
+    if compressor:
+      self._outfd = open(fname, 'wb')
+      self.proc   = Popen([compressor, '-%d' % compresslevel, '-c'],
+                          stdin=PIPE, stdout=self._outfd, bufsize=1024*1024)
+      self.handle = self.proc.stdin
+    else:
+      LOGGER.warning("Using python gzip module, which may be quite slow.")
+      self.handle = gzip.open(fname, 'wb', compresslevel)
+
+  def write(self, data):
+    self.handle.write(data)
+
+  def close(self):
+    self.handle.close()
+    if self.proc is not None:
+      retcode = self.proc.wait()
+      self._outfd.close()
+      if retcode != 0:
+        raise IOError("Compression of output file %s failed (exit code %d)."
+                      % (self.fname, retcode))
+
+################################################################################
+class BarcodeDemultiplexer(object):
+  '''
+  Split a fastq or export file into separate files by barcode. By
+  default the barcode is taken from the read header (or the index
+  column of an export file), so that the mates in a pair of files are
+  assigned consistently; with location='sequence' it is taken from
+  the first bases of each read sequence, which are matched separately
+  for each file. Reads are processed in batches, with each batch
+  written to its output files in a single call per file.
+
+  The outputs argument is a dict of barcode -> output filename.
+  Reads matching a barcode with one or more mismatches are written
+  to the same file unless mismatch_outputs (a similar dict) is
+  supplied. Reads which cannot be assigned are written to the
+  unmatched file if given, and are otherwise discarded. The fmt
+  argument may be 'fastq' or 'export'.
+  '''
+
+  __slots__ = ('outputs', 'mismatch_outputs', 'unmatched', 'table', 'codelen',
+               'fmt', 'location', 'batch_size', 'compress', 'compresslevel')
+
+  def __init__(self, outputs, mismatch_outputs=None, unmatched=None,
+               max_mismatches=1, fmt='fastq', location='header',
+               batch_size=100000, compress=True, compresslevel=3):
+    if fmt not in ('fastq', 'export'):
+      raise ValueError("Unsupported input format: %s" % fmt)
+    if location not in BARCODE_LOCATIONS:
+      raise ValueError("Unsupported barcode location: %s" % location)
+    self.outputs          = dict( (code.upper(), fname)
+                                  for (code, fname) in outputs.iteritems() )
+    self.mismatch_outputs = dict( (code.upper(), fname) for (code, fname)
+                                  in (mismatch_outputs or {}).iteritems() )
+    self.unmatched        = unmatched
+    self.table            = build_barcode_table(self.outputs.keys(),
+                                                max_mismatches)
+    self.codelen          = len(self.outputs.keys()[0])
+    self.fmt              = fmt
+    self.location         = location
+    self.batch_size       = batch_size
+    self.compress         = compress
+    self.compresslevel    = compresslevel
+
+  def _open_input(self, infile):
+    '''
+    Open the input file, decompressing via an external pipe where
+    possible.
+    '''
+    if is_zipped(infile):
+      decompressor = _find_gzip_decompressor()
+      if decompressor is not None:
+        proc = Popen([decompressor, '-dc', infile], stdout=PIPE,
+                     bufsize=1024*1024)
+        return (proc.stdout, proc)
+      return (gzip.open(infile, 'rb'), None)
+    return (open(infile, 'rb', 1024*1024), None)
+
+  def _iter_batches(self, handle):
+    '''
+    Yield lists of (barcode sequence, record text) tuples. The
+    barcode sequence may extend beyond the barcode itself.
+    '''
+    inline = self.location == 'sequence'
+    if self.fmt == 'fastq':
+      while True:
+        lines = list(islice(handle, 4 * self.batch_size))
+        if len(lines) == 0:
+          break
+        if len(lines) % 4 != 0:
+          raise ValueError("Truncated fastq record at end of input.")
+        yield [ (lines[num+1] if inline else header_barcode(lines[num]),
+                 ''.join(lines[num:num+4]))
+                for num in xrange(0, len(lines), 4) ]
+    else:
+      column = 8 if inline else 6
+      while True:
+        lines = list(islice(handle, self.batch_size))
+        if len(lines) == 0:
+          break
+        yield [ (line.split("\t", 9)[column], line) for line in lines ]
+
+  def run(self, infile):
+    '''
+    Demultiplex the input file. Returns a dict of per-barcode counts,
+    keyed by barcode; each value is a list of read counts by number
+    of mismatches. Unassigned reads are counted under 'unmatched'.
+    '''
+    targets = {}
+    for (code, fname) in self.outputs.iteritems():
+      targets[(code, False)] = fname
+      targets[(code, True)]  = self.mismatch_outputs.get(code, fname)
+    if self.unmatched is not None:
+      targets[None] = self.unmatched
+
+    handles = {}
+    for fname in set(targets.values()):
+      handles[fname] = _OutputFile(fname, compress=self.compress,
+                                   compresslevel=self.compresslevel)
+    writers = dict( (key, handles[fname]) for (key, fname)
+                    in targets.iteritems() )
+
+    maxdist = max([ dist for (_code, dist) in self.table.values() ])
+    counts  = dict( (code, [0] * (maxdist + 1)) for code in self.outputs )
+    counts['unmatched'] = 0
+
+    table   = self.table
+    codelen = self.codelen
+    (inhandle, proc) = self._open_input(infile)
+    try:
+      for batch in self._iter_batches(inhandle):
+        chunks = dict( (key, []) for key in writers )
+        for (seq, record) in batch:
+          hit = table.get(seq[0:codelen].upper())
+          if hit is None:
+            counts['unmatched'] += 1
+            if None in chunks:
+              chunks[None].append(record)
+          else:
+            (code, dist) = hit
+            counts[code][dist] += 1
+            chunks[(code, dist > 0)].append(record)
+        for (key, records) in chunks.iteritems():
+          if len(records) > 0:
+            writers[key].write(''.join(records))
+    finally:
+      inhandle.close()
+      if proc is not None:
+        proc.wait()
+      for handle in handles.values():
+        handle.close()
+
+    if proc is not None and proc.returncode != 0:
+      raise IOError("Decompression of input file %s failed (exit code %d)."
+                    % (infile, proc.returncode))
+
+    for code in sorted(self.outputs):
+      LOGGER.info("Barcode %s: %s reads (by mismatch count).", code,
+                  ", ".join([ str(num) for num in counts[code] ]))
+    LOGGER.info("Unassigned reads: %d", counts['unmatched'])
+
+    return counts
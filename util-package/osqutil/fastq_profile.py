@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqutil python package.
+#
+# The osqutil python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqutil python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqutil python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Single-pass fastq file profiling. Collects read count, read length
+distribution, per-cycle quality means and standard deviations (for
+all reads and for those passing the Illumina chastity filter), a
+duplicate sequence estimate and the sequencing run number, so that
+the file need only be read once during ingest.
+'''
+
+import os
+import gzip
+import multiprocessing
+from math import sqrt
+from itertools import islice, izip_longest
+from subprocess import Popen, PIPE
+
+from .utilities import is_zipped, _find_gzip_decompressor
+from .setup_logs import configure_logging
+
+LOGGER = configure_logging('fastq_profile')
+
+# Number of reads (per chunk) used to estimate sequence duplication.
+DUP_SAMPLE_SIZE = 100000
+
+# Number of passed and failed read sequences retained as examples.
+SEQ_SAMPLE_SIZE = 100
+
+################################################################################
+class CycleStats(object):
+  '''
+  Accumulates per-cycle quality score sums, from which the mean and
+  standard deviation at each cycle can be derived.
+  '''
+  __slots__ = ('counts', 'sums', 'sumsq')
+
+  def __init__(self):
+    self.counts = []
+    self.sums   = []
+    self.sumsq  = []
+
+  def _extend(self, length):
+    while len(self.counts) < length:
+      self.counts.append(0)
+      self.sums.append(0)
+      self.sumsq.append(0)
+
+  def add(self, quals, phred_offset=33):
+    '''
+    Add a list of quality strings. The strings are transposed so that
+    each cycle is tallied with a handful of str.count() calls rather
+    than a python loop over every base.
+    '''
+    if len(quals) == 0:
+      return
+    self._extend(max([ len(qual) for qual in quals ]))
+    for (cycle, column) in enumerate(izip_longest(*quals, fillvalue=' ')):
+      column = ''.join(column)
+      for char in set(column):
+        if char == ' ':
+          continue
+        num  = column.count(char)
+        qual = ord(char) - phred_offset
+        self.counts[cycle] += num
+        self.sums[cycle]   += num * qual
+        self.sumsq[cycle]  += num * qual * qual
+
+  def merge(self, other):
+    '''
+    Add the tallies from another CycleStats object to this one.
+    '''
+    self._extend(len(other.counts))
+    for cycle in range(len(other.counts)):
+      self.counts[cycle] += other.counts[cycle]
+      self.sums[cycle]   += other.sums[cycle]
+      self.sumsq[cycle]  += other.sumsq[cycle]
+
+  @property
+  def mean(self):
+    return [ float(total) / num if num > 0 else 0.0
+             for (total, num) in zip(self.sums, self.counts) ]
+
+  @property
+  def stdev(self):
+    stdev = []
+    for (total, totsq, num) in zip(self.sums, self.sumsq, self.counts):
+      if num == 0:
+        stdev.append(0.0)
+      else:
+        mean = float(total) / num
+        stdev.append(sqrt(max(0.0, float(totsq) / num - mean * mean)))
+    return stdev
+
+################################################################################
+class FastqProfile(object):
+  '''
+  Summary statistics for a fastq file, or a chunk thereof. Profiles
+  for successive chunks of a file may be combined using merge().
+  '''
+  __slots__ = ('reads', 'passedpf', 'lengths', 'runnumber', 'quals',
+               'qualspf', 'dup_sampled', 'dup_found', 'goodreads', 'badreads',
+               'phred_offset', 'quality', 'dup_sample', '_seen')
+
+  def __init__(self, quality=True, phred_offset=33, dup_sample=DUP_SAMPLE_SIZE):
+    self.reads        = 0
+    self.passedpf     = 0
+    self.lengths      = {}
+    self.runnumber    = None
+    self.quals        = CycleStats()
+    self.qualspf      = CycleStats()
+    self.dup_sampled  = 0
+    self.dup_found    = 0
+    self.goodreads    = []
+    self.badreads     = []
+    self.phred_offset = phred_offset
+    self.quality      = quality
+    self.dup_sample   = dup_sample
+    self._seen        = set()
+
+  def __getstate__(self):
+    # The duplicate-tracking set is only needed while reading.
+    return dict( (key, getattr(self, key))
+                 for key in self.__slots__ if key != '_seen' )
+
+  def __setstate__(self, state):
+    for (key, value) in state.iteritems():
+      setattr(self, key, value)
+    self._seen = set()
+
+  @staticmethod
+  def _parse_header(header):
+    '''
+    Parse a Casava 1.8+ header line (@instrument:run:flowcell:lane:
+    tile:x:y read:filtered:control:index), returning the run number
+    (or None) and whether the read passed the chastity filter. Reads
+    with older-style headers are assumed to have passed.
+    '''
+    fields = header[1:].split()
+    ids    = fields[0].split(':')
+    run    = ids[1] if len(ids) == 7 else None
+    passed = True
+    if len(fields) > 1:
+      flags = fields[1].split(':')
+      if len(flags) > 1 and flags[1] == 'Y':
+        passed = False
+    return (run, passed)
+
+  def add_batch(self, records):
+    '''
+    Add a list of (header, sequence, quality) tuples.
+    '''
+    if len(records) == 0:
+      return
+    if self.runnumber is None:
+      self.runnumber = self._parse_header(records[0][0])[0]
+
+    seqs     = []
+    quals    = []
+    qualspf  = []
+    for (header, seq, qual) in records:
+      seq  = seq.rstrip('\r\n')
+      qual = qual.rstrip('\r\n')
+      passed = self._parse_header(header)[1]
+      if passed:
+        self.passedpf += 1
+        if len(self.goodreads) < SEQ_SAMPLE_SIZE:
+          self.goodreads.append(seq)
+      elif len(self.badreads) < SEQ_SAMPLE_SIZE:
+        self.badreads.append(seq)
+      seqs.append(seq)
+      if self.quality:
+        quals.append(qual)
+        if passed:
+          qualspf.append(qual)
+
+    self.reads += len(seqs)
+    for length in map(len, seqs):
+      self.lengths[length] = self.lengths.get(length, 0) + 1
+
+    if self.dup_sampled < self.dup_sample:
+      seen = self._seen
+      for seq in seqs[:self.dup_sample - self.dup_sampled]:
+        if seq in seen:
+          self.dup_found += 1
+        else:
+          seen.add(seq)
+        self.dup_sampled += 1
+      if self.dup_sampled >= self.dup_sample:
+        self._seen = set()
+
+    if self.quality:
+      self.quals.add(quals, self.phred_offset)
+      self.qualspf.add(qualspf, self.phred_offset)
+
+  def merge(self, other):
+    '''
+    Combine the profile of a subsequent chunk of the file with this
+    one. The duplicate estimate becomes the sum over the per-chunk
+    samples.
+    '''
+    self.reads    += other.reads
+    self.passedpf += other.passedpf
+    for (length, num) in other.lengths.iteritems():
+      self.lengths[length] = self.lengths.get(length, 0) + num
+    if self.runnumber is None:
+      self.runnumber = other.runnumber
+    self.quals.merge(other.quals)
+    self.qualspf.merge(other.qualspf)
+    self.dup_sampled += other.dup_sampled
+    self.dup_found   += other.dup_found
+    self.goodreads += other.goodreads[:SEQ_SAMPLE_SIZE - len(self.goodreads)]
+    self.badreads  += other.badreads[:SEQ_SAMPLE_SIZE - len(self.badreads)]
+
+  @property
+  def readlength(self):
+    '''The maximum read length, or None for an empty file.'''
+    return max(self.lengths) if self.lengths else None
+
+  @property
+  def qualmean(self):
+    return self.quals.mean
+
+  @property
+  def qualstdev(self):
+    return self.quals.stdev
+
+  @property
+  def qualmeanpf(self):
+    return self.qualspf.mean
+
+  @property
+  def qualstdevpf(self):
+    return self.qualspf.stdev
+
+  @property
+  def duplicate_rate(self):
+    '''
+    The fraction of sampled reads whose sequence had already been
+    seen in the sample.
+    '''
+    if self.dup_sampled == 0:
+      return 0.0
+    return float(self.dup_found) / self.dup_sampled
+
+################################################################################
+def _iter_record_batches(handle, batch_size=10000, max_bytes=None,
+                         max_reads=None):
+  '''
+  Yield lists of (header, sequence, quality) tuples from an open fastq
+  file handle. Stops once max_bytes of input have been consumed
+  (checked at record boundaries), or max_reads records returned.
+  '''
+  consumed = 0
+  returned = 0
+  while True:
+    lines = list(islice(handle, 4 * batch_size))
+    if len(lines) == 0:
+      return
+    if len(lines) % 4 != 0:
+      raise ValueError("Truncated fastq record at end of input.")
+    batch = []
+    done  = False
+    for num in xrange(0, len(lines), 4):
+      if max_bytes is not None:
+        if consumed >= max_bytes:
+          done = True
+          break
+        consumed += sum([ len(line) for line in lines[num:num+4] ])
+      if max_reads is not None and returned >= max_reads:
+        done = True
+        break
+      if lines[num][0] != '@':
+        raise ValueError("Unexpected fastq header line: %s" % lines[num])
+      batch.append((lines[num], lines[num+1], lines[num+3]))
+      returned += 1
+    yield batch
+    if done:
+      return
+
+def _find_record_start(handle, offset):
+  '''
+  Return the offset of the first fastq record starting at or after
+  the given offset. Quality lines may begin with '@', so we also
+  require that the line two below the candidate header begins with
+  '+'.
+  '''
+  handle.seek(offset)
+  if offset > 0:
+    handle.readline() # Skip the (probably partial) line.
+  while True:
+    pos   = handle.tell()
+    lines = [ handle.readline() for _num in range(3) ]
+    if lines[2] == '':
+      handle.seek(0, os.SEEK_END)
+      return handle.tell()
+    if lines[0].startswith('@') and lines[2].startswith('+'):
+      return pos
+    handle.seek(pos)
+    handle.readline()
+
+def _profile_chunk(args):
+  '''
+  Worker function used to profile a byte range of an uncompressed
+  fastq file.
+  '''
+  (fname, start, end, kwargs) = args
+  profile = FastqProfile(**kwargs)
+  with open(fname, 'rb') as handle:
+    start = _find_record_start(handle, start)
+    end   = _find_record_start(handle, end)
+    handle.seek(start)
+    for batch in _iter_record_batches(handle, max_bytes=end - start):
+      profile.add_batch(batch)
+  return profile
+
+def profile_fastq(fname, processes=1, max_reads=None, quality=True,
+                  phred_offset=33, dup_sample=DUP_SAMPLE_SIZE):
+  '''
+  Profile a fastq file in a single pass, returning a FastqProfile
+  object. Gzipped files are read via an external pigz/gzip pipe where
+  available. Uncompressed files may be split into byte-range chunks
+  and profiled in parallel by setting processes > 1. If max_reads is
+  set, only the first max_reads records are read. Setting
+  quality=False skips the per-cycle quality tallies.
+  '''
+  kwargs = { 'quality'      : quality,
+             'phred_offset' : phred_offset,
+             'dup_sample'   : dup_sample }
+
+  if processes > 1 and max_reads is None and not is_zipped(fname):
+    size  = os.path.getsize(fname)
+    bound = [ size * num / processes for num in range(processes + 1) ]
+    LOGGER.debug("Profiling fastq file %s in %d chunks.", fname, processes)
+    pool  = multiprocessing.Pool(processes)
+    try:
+      chunks = pool.map(_profile_chunk,
+                        [ (fname, bound[num], bound[num+1], kwargs)
+                          for num in range(processes) ])
+    finally:
+      pool.close()
+      pool.join()
+    profile = chunks[0]
+    for chunk in chunks[1:]:
+      profile.merge(chunk)
+    return profile
+
+  LOGGER.debug("Profiling fastq file %s...", fname)
+  profile = FastqProfile(**kwargs)
+  proc    = None
+  if is_zipped(fname):
+    decompressor = _find_gzip_decompressor()
+    if decompressor is not None:
+      proc   = Popen([decompressor, '-dc', fname], stdout=PIPE,
+                     bufsize=1024*1024)
+      handle = proc.stdout
+    else:
+      handle = gzip.open(fname, 'rb')
+  else:
+    handle = open(fname, 'rb', 1024*1024)
+
+  try:
+    for batch in _iter_record_batches(handle, max_reads=max_reads):
+      profile.add_batch(batch)
+  finally:
+    handle.close()
+    if proc is not None:
+      proc.wait()
+
+  # Closing the pipe early (when max_reads is set) will typically kill
+  # the decompressor with SIGPIPE, which we ignore.
+  if proc is not None and max_reads is None and proc.returncode != 0:
+    raise IOError("Decompression of fastq file %s failed (exit code %d)."
+                  % (fname, proc.returncode))
+
+  return profile
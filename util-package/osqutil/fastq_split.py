@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqutil python package.
+#
+# The osqutil python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqutil python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqutil python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Streaming splitter for (optionally compressed) fastq files, used to
+divide a lane into chunks for parallel alignment. Paired-end files
+are split in lockstep so that each pair of chunks holds the same
+reads in the same order. The split returns a manifest of chunk file
+names and read counts.
+'''
+
+import os
+import bz2
+import gzip
+import json
+from collections import namedtuple
+from itertools import islice
+from subprocess import Popen, PIPE
+from distutils import spawn
+
+from .utilities import is_zipped, is_bzipped
+from .demux import _OutputFile
+from .setup_logs import configure_logging
+
+LOGGER = configure_logging('fastq_split')
+
+FastqChunk = namedtuple('FastqChunk', ('index', 'filenames', 'reads'))
+
+################################################################################
+def _open_fastq(fname, path=None):
+  '''
+  Open a fastq file for reading, decompressing gzip or bzip2 input
+  via an external pipe where possible. Returns a (handle, process)
+  tuple; the process is None unless an external decompressor is used.
+  '''
+  if is_zipped(fname):
+    progs  = ('pigz', 'gzip')
+    opener = gzip.open
+  elif is_bzipped(fname):
+    progs  = ('pbzip2', 'bzip2')
+    opener = bz2.BZ2File
+  else:
+    return (open(fname, 'rb', 1024*1024), None)
+
+  for prog in progs:
+    found = spawn.find_executable(prog, path=path)
+    if found:
+      proc = Popen([found, '-dc', fname], stdout=PIPE, bufsize=1024*1024)
+      return (proc.stdout, proc)
+  return (opener(fname, 'rb'), None)
+
+def _read_id(header):
+  '''
+  Return the read identifier from a fastq header line, omitting any
+  comment and the /1 or /2 pair suffix.
+  '''
+  readid = header.split(None, 1)[0]
+  if readid[-2:] in ('/1', '/2'):
+    readid = readid[:-2]
+  return readid
+
+def chunk_filename(fname, index, compress=False):
+  '''
+  Return the name of the given (one-based) chunk of fname. The
+  compression suffix of the input, if any, is replaced.
+  '''
+  (stem, ext) = os.path.splitext(fname)
+  if ext not in ('.gz', '.bz2'):
+    stem = fname
+  return "%s-%04d%s" % (stem, index, '.gz' if compress else '')
+
+def plan_fastq_chunks(fnames, chunk_reads=1000000, compress=False, path=None):
+  '''
+  Return the manifest which split_fastq would produce for fnames,
+  without writing anything; the reads in the first file are counted
+  to determine the number of chunks. Files which are not present are
+  planned as a single, unsplit chunk.
+  '''
+  if not all([ os.path.exists(fname) for fname in fnames ]):
+    return [ FastqChunk(1, list(fnames), 0) ]
+
+  (handle, proc) = _open_fastq(fnames[0], path)
+  try:
+    reads = sum(1 for _line in handle) // 4
+  finally:
+    handle.close()
+    if proc is not None:
+      proc.wait()
+
+  manifest = []
+  for (num, start) in enumerate(range(0, reads, chunk_reads)):
+    manifest.append(FastqChunk(num + 1,
+                               [ chunk_filename(fname, num + 1, compress)
+                                 for fname in fnames ],
+                               min(chunk_reads, reads - start)))
+  return manifest
+
+def write_manifest(manifest, fname):
+  '''
+  Write a split manifest to fname as JSON.
+  '''
+  with open(fname, 'w') as out:
+    json.dump([ chunk._asdict() for chunk in manifest ], out, indent=1)
+
+def read_manifest(fname):
+  '''
+  Read a split manifest written by write_manifest.
+  '''
+  with open(fname) as handle:
+    return [ FastqChunk(chunk['index'], chunk['filenames'], chunk['reads'])
+             for chunk in json.load(handle) ]
+
+################################################################################
+class FastqSplitter(object):
+  '''
+  Split one fastq file, or a pair of fastq files in lockstep, into
+  chunks of at most chunk_reads reads. The input is read once, in
+  batches of whole records. When compressing output, the parallel
+  argument sets how many chunks are filled at once (batches are
+  dealt round-robin between them) so that their compressors run in
+  parallel; up to that many chunks at the end of the split may
+  therefore be only partly filled. Paired files must list their reads in the same order;
+  a ValueError is raised otherwise.
+  '''
+  __slots__ = ('chunk_reads', 'compress', 'compresslevel', 'parallel',
+               'batch_size', 'path')
+
+  def __init__(self, chunk_reads=1000000, compress=False, compresslevel=1,
+               parallel=1, batch_size=10000, path=None):
+    if chunk_reads < 1:
+      raise ValueError("Chunk size must be at least one read.")
+    self.chunk_reads   = chunk_reads
+    self.compress      = compress
+    self.compresslevel = compresslevel
+    self.parallel      = max(1, parallel) if compress else 1
+    self.batch_size    = min(batch_size, chunk_reads)
+    self.path          = path
+
+  def _read_batch(self, handle, fname):
+    '''
+    Read up to batch_size whole records as a list of 4-line strings.
+    '''
+    lines = list(islice(handle, 4 * self.batch_size))
+    if len(lines) % 4 != 0:
+      raise ValueError("Truncated fastq record at end of file %s." % fname)
+    records = [ ''.join(lines[num:num+4]) for num in xrange(0, len(lines), 4) ]
+    for rec in records:
+      if rec[0] != '@':
+        raise ValueError("Fastq record boundary not found in %s: %s"
+                         % (fname, rec.split('\n', 1)[0]))
+    return records
+
+  def _check_pairs(self, batches, fnames):
+    '''
+    Confirm that a set of batches read from paired files hold the
+    same reads.
+    '''
+    first = batches[0]
+    for (num, other) in enumerate(batches[1:]):
+      if len(other) != len(first):
+        raise ValueError("Paired fastq files contain different numbers"
+                         + " of reads: %s, %s" % (fnames[0], fnames[num+1]))
+      for (rec1, rec2) in zip(first, other):
+        if _read_id(rec1) != _read_id(rec2):
+          raise ValueError("Paired fastq files are out of step at reads"
+                           + " %s and %s." % (rec1.split('\n', 1)[0],
+                                              rec2.split('\n', 1)[0]))
+
+  def _open_chunk(self, index, fnames):
+    '''
+    Open the output files for a chunk; returns a [chunk, outputs] list.
+    '''
+    chunk   = FastqChunk(index, [ chunk_filename(fname, index, self.compress)
+                                  for fname in fnames ], 0)
+    outputs = [ _OutputFile(outname, compress=self.compress,
+                            compresslevel=self.compresslevel, path=self.path)
+                for outname in chunk.filenames ]
+    LOGGER.debug("Writing fastq chunk %d: %s", index, ", ".join(chunk.filenames))
+    return [chunk, outputs]
+
+  def split(self, fnames):
+    '''
+    Split the fastq file(s) listed in fnames. Returns the manifest, a
+    list of FastqChunk tuples (index, filenames, reads) in chunk
+    order. Empty input yields an empty manifest.
+    '''
+    if len(fnames) not in (1, 2):
+      raise ValueError("Expected one or two fastq files, got %d." % len(fnames))
+
+    inputs   = [ _open_fastq(fname, self.path) for fname in fnames ]
+    manifest = []
+    active   = []
+    turn     = 0
+    try:
+      while True:
+        batches = [ self._read_batch(handle, fname)
+                    for ((handle, _proc), fname) in zip(inputs, fnames) ]
+        if len(fnames) > 1:
+          self._check_pairs(batches, fnames)
+        if len(batches[0]) == 0:
+          break
+
+        start = 0
+        while start < len(batches[0]):
+          # New chunks are written to as soon as they are opened, so
+          # that none is left empty.
+          if len(active) < self.parallel:
+            active.append(self._open_chunk(len(manifest) + len(active) + 1,
+                                           fnames))
+            turn = len(active) - 1
+          turn  = turn % len(active)
+          slot  = active[turn]
+          count = min(len(batches[0]) - start,
+                      self.chunk_reads - slot[0].reads)
+          for (out, batch) in zip(slot[1], batches):
+            out.write(''.join(batch[start:start+count]))
+          slot[0] = slot[0]._replace(reads=slot[0].reads + count)
+          start  += count
+          if slot[0].reads == self.chunk_reads:
+            for out in slot[1]:
+              out.close()
+            manifest.append(slot[0])
+            active.pop(turn)
+          else:
+            turn += 1
+    except:
+      for (_chunk, outputs) in active:
+        for out in outputs:
+          out.close()
+      raise
+    finally:
+      for (handle, proc) in inputs:
+        handle.close()
+        if proc is not None:
+          proc.wait()
+
+    for (chunk, outputs) in active:
+      for out in outputs:
+        out.close()
+      manifest.append(chunk)
+
+    for ((_handle, proc), fname) in zip(inputs, fnames):
+      if proc is not None and proc.returncode != 0:
+        raise IOError("Decompression of %s failed (exit code %d)."
+                      % (fname, proc.returncode))
+
+    manifest.sort(key=lambda x: x.index)
+    LOGGER.info("Split %d reads from %s into %d chunks.",
+                sum([ chunk.reads for chunk in manifest ]),
+                ", ".join(fnames), len(manifest))
+    return manifest
+
+def split_fastq(fnames, chunk_reads=1000000, compress=False, compresslevel=1,
+                parallel=1, path=None):
+  '''
+  Convenience function wrapping FastqSplitter.split().
+  '''
+  splitter = FastqSplitter(chunk_reads=chunk_reads, compress=compress,
+                           compresslevel=compresslevel, parallel=parallel,
+                           path=path)
+  return splitter.split(fnames)
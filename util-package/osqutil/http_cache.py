@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqutil python package.
+#
+# The osqutil python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqutil python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqutil python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+A small on-disk cache of HTTP response bodies, keyed by URL. Each
+entry records the ETag and Last-Modified headers sent with the
+response so that a stale entry can be revalidated with a conditional
+request rather than downloaded again. The cache is an sqlite database
+so that it persists between invocations of short-lived (e.g. cron)
+processes, and may be shared between threads.
+'''
+
+import os
+import time
+import sqlite3
+import threading
+
+from .setup_logs import configure_logging
+
+LOGGER = configure_logging('http_cache')
+
+# Entries not refreshed for this many seconds are discarded.
+DEFAULT_MAX_AGE = 30 * 24 * 60 * 60
+
+################################################################################
+class CachedResponse(object):
+
+  '''
+  Simple container for a cached response body and its validators.
+  '''
+
+  __slots__ = ('url', 'body', 'etag', 'last_modified', 'fetched')
+
+  def __init__(self, url, body, etag=None, last_modified=None, fetched=None):
+    self.url           = url
+    self.body          = body
+    self.etag          = etag
+    self.last_modified = last_modified
+    self.fetched       = fetched
+
+  def age(self):
+    '''
+    The number of seconds since this response was last fetched or
+    revalidated.
+    '''
+    return time.time() - self.fetched
+
+  def conditional_headers(self):
+    '''
+    Return the HTTP headers needed to revalidate this response.
+    '''
+    headers = {}
+    if self.etag is not None:
+      headers['If-None-Match'] = self.etag
+    if self.last_modified is not None:
+      headers['If-Modified-Since'] = self.last_modified
+    return headers
+
+class ResponseCache(object):
+
+  '''
+  Persistent store of HTTP response bodies. Each thread (and each
+  forked child process) opens its own sqlite connection.
+  '''
+
+  __slots__ = ('dbfile', 'max_age', '_local')
+
+  def __init__(self, dbfile, max_age=DEFAULT_MAX_AGE):
+    self.dbfile  = dbfile
+    self.max_age = int(max_age)
+    self._local  = threading.local()
+
+  @property
+  def conn(self):
+    '''
+    Lazily open the sqlite connection for the current thread.
+    '''
+    conn = getattr(self._local, 'conn', None)
+    if conn is None or self._local.pid != os.getpid():
+      conn = sqlite3.connect(self.dbfile, timeout=60)
+      with conn:
+        conn.execute(
+          '''CREATE TABLE IF NOT EXISTS responses (
+               url           TEXT NOT NULL PRIMARY KEY,
+               body          BLOB NOT NULL,
+               etag          TEXT,
+               last_modified TEXT,
+               fetched       REAL NOT NULL)''')
+      self._local.conn = conn
+      self._local.pid  = os.getpid()
+    return conn
+
+  def lookup(self, url):
+    '''
+    Return the CachedResponse for url, or None if there is no entry.
+    '''
+    row = self.conn.execute(
+      '''SELECT body, etag, last_modified, fetched FROM responses
+           WHERE url=?''', (url,)).fetchone()
+    if row is None:
+      return None
+    return CachedResponse(url, str(row[0]), row[1], row[2], row[3])
+
+  def store(self, url, body, etag=None, last_modified=None):
+    '''
+    Record the response body for url, along with its validators.
+    '''
+    now = time.time()
+    with self.conn:
+      self.conn.execute(
+        '''INSERT OR REPLACE INTO responses
+             (url, body, etag, last_modified, fetched)
+             VALUES (?, ?, ?, ?, ?)''',
+        (url, sqlite3.Binary(body), etag, last_modified, now))
+      self.conn.execute('DELETE FROM responses WHERE fetched < ?',
+                        (now - self.max_age,))
+
+  def touch(self, url):
+    '''
+    Mark the entry for url as fresh, typically following a successful
+    revalidation.
+    '''
+    with self.conn:
+      self.conn.execute('UPDATE responses SET fetched=? WHERE url=?',
+                        (time.time(), url))
+
+  def __len__(self):
+    return self.conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
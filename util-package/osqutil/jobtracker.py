@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqutil python package.
+#
+# The osqutil python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqutil python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqutil python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Tracking of LSF and SLURM cluster job states. Job states are polled
+in batches (one scheduler query per poll for all outstanding jobs)
+until every job has finished, failed, or a timeout is reached.
+'''
+
+import re
+import time
+from collections import namedtuple
+from subprocess import CalledProcessError
+
+from .config import Config
+from .setup_logs import configure_logging
+
+LOGGER = configure_logging('jobtracker')
+
+# Normalised job states.
+PENDING  = 'PENDING'
+RUNNING  = 'RUNNING'
+DONE     = 'DONE'
+FAILED   = 'FAILED'
+UNKNOWN  = 'UNKNOWN'
+
+FINISHED_STATES = (DONE, FAILED)
+
+LSF_STATES = {
+  'PEND'  : PENDING,
+  'PSUSP' : PENDING,
+  'WAIT'  : PENDING,
+  'RUN'   : RUNNING,
+  'USUSP' : RUNNING,
+  'SSUSP' : RUNNING,
+  'PROV'  : RUNNING,
+  'DONE'  : DONE,
+  'EXIT'  : FAILED,
+  'ZOMBI' : FAILED,
+  'UNKWN' : UNKNOWN,
+}
+
+SLURM_STATES = {
+  'PENDING'       : PENDING,
+  'CONFIGURING'   : PENDING,
+  'REQUEUED'      : PENDING,
+  'RESIZING'      : PENDING,
+  'RUNNING'       : RUNNING,
+  'COMPLETING'    : RUNNING,
+  'SUSPENDED'     : RUNNING,
+  'STOPPED'       : RUNNING,
+  'COMPLETED'     : DONE,
+  'FAILED'        : FAILED,
+  'CANCELLED'     : FAILED,
+  'TIMEOUT'       : FAILED,
+  'NODE_FAIL'     : FAILED,
+  'PREEMPTED'     : FAILED,
+  'BOOT_FAIL'     : FAILED,
+  'DEADLINE'      : FAILED,
+  'OUT_OF_MEMORY' : FAILED,
+}
+
+LSF_JOBID_RE = re.compile(r'^Job\s*<(\d+)>')
+LSF_EXIT_RE  = re.compile(r'Exited with exit code (\d+)')
+
+JobStatus = namedtuple('JobStatus', ('jobid', 'state', 'exit_code', 'raw_state'))
+
+# The default time limit (in seconds) on waiting for cluster jobs,
+# used unless the cluster_wait_timeout config option is set.
+DEFAULT_WAIT_TIMEOUT = 172800
+
+class ClusterJobError(StandardError):
+  '''
+  Exception raised when waiting on cluster jobs times out or the
+  scheduler cannot be queried.
+  '''
+  pass
+
+################################################################################
+class ClusterJobTracker(object):
+  '''
+  Polls the cluster scheduler for the state of a set of jobs. The
+  runner argument should be a JobRunner instance (e.g. a
+  ClusterJobRunner for a remote head node) whose run_command method
+  returns the command stdout as a file handle. Scheduler commands are
+  found on the clusterpath config option by default.
+
+  Jobs which the scheduler no longer reports, having never been seen
+  to finish, are marked FAILED after lost_polls consecutive polls.
+  '''
+  __slots__ = ('runner', 'clustertype', 'path', 'interval', 'timeout',
+               'max_query_failures', 'lost_polls')
+
+  def __init__(self, runner, clustertype=None, path=None, interval=None,
+               timeout=None, max_query_failures=5, lost_polls=3):
+    conf = Config()
+    self.runner      = runner
+    self.clustertype = conf.clustertype if clustertype is None else clustertype
+    if self.clustertype not in ('LSF', 'SLURM'):
+      raise ValueError("Unknown cluster type '%s'." % self.clustertype)
+    if path is None:
+      path = conf.clusterpath
+    self.path        = path
+    if interval is None:
+      try:
+        interval = int(conf.cluster_poll_interval)
+      except AttributeError, _err:
+        interval = 60
+    self.interval    = interval
+    if timeout is None:
+      try:
+        timeout = int(conf.cluster_wait_timeout)
+      except AttributeError, _err:
+        timeout = DEFAULT_WAIT_TIMEOUT
+    self.timeout     = timeout
+    self.max_query_failures = max_query_failures
+    self.lost_polls  = lost_polls
+
+  def _run(self, cmd):
+    LOGGER.debug(cmd)
+    with self.runner.run_command(cmd, path=self.path) as ofh:
+      return [ line.rstrip('\n') for line in ofh if line.strip() ]
+
+  def _query_lsf(self, jobids):
+    '''
+    Query bjobs for the given job IDs. Jobs unknown to LSF (e.g. those
+    purged after completion) are omitted from the result. We use the
+    wide default output format rather than "bjobs -o", which is not
+    available in older LSF versions; exit codes for failed jobs are
+    taken from "bjobs -l".
+    '''
+    # Unknown job IDs cause a non-zero exit status, hence '|| true'.
+    cmd = ("bjobs -a -w %s 2>/dev/null || true"
+           % " ".join([ str(x) for x in jobids ]))
+    states = {}
+    for line in self._run(cmd):
+      fields = line.split()
+      if len(fields) < 3 or not fields[0].isdigit():
+        continue # Header line.
+      jobid = int(fields[0])
+      state = LSF_STATES.get(fields[2], UNKNOWN)
+      states[jobid] = JobStatus(jobid, state,
+                                0 if state == DONE else None, fields[2])
+
+    failed = [ x for x in states if states[x].state == FAILED ]
+    if failed:
+      cmd = ("bjobs -l %s 2>/dev/null || true"
+             % " ".join([ str(x) for x in sorted(failed) ]))
+      jobid = None
+      for line in self._run(cmd):
+        matchobj = LSF_JOBID_RE.search(line)
+        if matchobj:
+          jobid = int(matchobj.group(1))
+        matchobj = LSF_EXIT_RE.search(line)
+        if matchobj and jobid in states:
+          states[jobid] = states[jobid]._replace(exit_code=int(matchobj.group(1)))
+    return states
+
+  def _query_slurm(self, jobids):
+    '''
+    Query squeue for active jobs, and sacct for any no longer in the
+    queue.
+    '''
+    idlist = ",".join([ str(x) for x in jobids ])
+    states = {}
+    cmd = "squeue -h -o '%%i|%%T' -j %s 2>/dev/null || true" % idlist
+    for line in self._run(cmd):
+      fields = line.split('|')
+      if len(fields) != 2 or not fields[0].isdigit():
+        continue
+      states[int(fields[0])] = JobStatus(int(fields[0]),
+                                         SLURM_STATES.get(fields[1], UNKNOWN),
+                                         None, fields[1])
+
+    missing = [ x for x in jobids if x not in states ]
+    if missing:
+      cmd = ("sacct -n -P -X -o JobID,State,ExitCode -j %s"
+             % ",".join([ str(x) for x in missing ]))
+      for line in self._run(cmd):
+        fields = line.split('|')
+        if len(fields) != 3 or not fields[0].isdigit():
+          continue
+        # States such as "CANCELLED by 1234" are reduced to the first word.
+        raw   = fields[1].split()[0] if fields[1] else ''
+        state = SLURM_STATES.get(raw, UNKNOWN)
+        exit_code = None
+        if state in FINISHED_STATES:
+          exit_code = int(fields[2].split(':')[0])
+        states[int(fields[0])] = JobStatus(int(fields[0]), state,
+                                           exit_code, fields[1])
+    return states
+
+  def query(self, jobids):
+    '''
+    Return a dict of JobStatus objects keyed by job ID, in a single
+    scheduler query. Jobs not reported by the scheduler are omitted.
+    '''
+    jobids = [ int(x) for x in jobids ]
+    if len(jobids) == 0:
+      return {}
+    if self.clustertype == 'LSF':
+      return self._query_lsf(jobids)
+    return self._query_slurm(jobids)
+
+  def wait(self, jobids, interval=None, timeout=None):
+    '''
+    Wait for all the specified jobs to finish. Returns a dict of
+    final JobStatus objects keyed by job ID. Raises ClusterJobError if
+    the timeout (in seconds) is exceeded, or if the scheduler query
+    fails max_query_failures times in succession.
+    '''
+    if self.runner.test_mode:
+      return {}
+    interval = self.interval if interval is None else interval
+    timeout  = self.timeout  if timeout  is None else timeout
+    start    = time.time()
+    final    = {}
+    lost     = {}
+    failures = 0
+    pending  = set([ int(x) for x in jobids ])
+
+    LOGGER.info("Waiting on %d cluster jobs...", len(pending))
+    while pending:
+      try:
+        states   = self.query(sorted(pending))
+        failures = 0
+      except (CalledProcessError, OSError), err:
+        failures += 1
+        LOGGER.warning("Cluster job query failed (%d/%d): %s",
+                       failures, self.max_query_failures, err)
+        if failures >= self.max_query_failures:
+          raise ClusterJobError("Unable to query cluster job states: %s" % err)
+        states = None
+
+      if states is not None:
+        for jobid in sorted(pending):
+          status = states.get(jobid)
+          if status is None:
+            lost[jobid] = lost.get(jobid, 0) + 1
+            if lost[jobid] >= self.lost_polls:
+              LOGGER.warning("Job %d is no longer known to the scheduler.", jobid)
+              status = JobStatus(jobid, FAILED, None, None)
+            else:
+              continue
+          else:
+            lost.pop(jobid, None)
+          if status.state in FINISHED_STATES:
+            log = LOGGER.info if status.state == DONE else LOGGER.warning
+            log("Cluster job %d finished: %s (exit code %s)",
+                jobid, status.raw_state, status.exit_code)
+            final[jobid] = status
+            pending.discard(jobid)
+
+      if not pending:
+        break
+      if timeout is not None and time.time() - start + interval > timeout:
+        raise ClusterJobError("Timed out waiting on cluster jobs: %s"
+                              % ", ".join([ str(x) for x in sorted(pending) ]))
+      time.sleep(interval)
+
+    return final
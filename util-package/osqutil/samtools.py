@@ -24,6 +24,7 @@ e.g. to convert between bam and bed file formats.'''
 import os
 import sys
 import re
+from subprocess import Popen, PIPE, CalledProcessError
 
 from .utilities import read_file_to_key_value, call_subprocess
 from .config import Config
@@ -71,15 +72,24 @@ def identify_bwa_algorithm(bam):
       fields = dict( field.split(':', 1) for field in bits
                      if not re.match('^@', field) )
       if 'CL' in fields:
-        (prog, algo, rest) = fields['CL'].split(" ", 2)
-        if prog != 'bwa':
-          raise ValueError("Expected bwa aligner, found %s" % prog)
-        if algo == 'samse': # aln is implied
-          algo = 'aln'
+        algo = bwa_algorithm_from_command(fields['CL'])
         break # Just take the first PG group
 
   return algo
 
+def bwa_algorithm_from_command(cmdline):
+  '''
+  Given the command line from a bam file @PG header (CL field),
+  return the bwa algorithm used ('aln' or 'mem'). Raises a ValueError
+  if the command was not a bwa command.
+  '''
+  (prog, algo, _rest) = cmdline.split(" ", 2)
+  if prog != 'bwa':
+    raise ValueError("Expected bwa aligner, found %s" % prog)
+  if algo == 'samse': # aln is implied
+    algo = 'aln'
+  return algo
+
 class BamToBedConverter(object):
 
   '''Class holding code which uses samtools to convert from bam to bed
@@ -89,18 +99,46 @@ class BamToBedConverter(object):
   chrom_sizes, a string designating a chromosome sizes file as
   downloaded from UCSC using fetchChromSizes. The latter option may be
   used to remove overhanging reads which fall outside the range of the
-  chromosome coordinates.'''
+  chromosome coordinates. Subclasses may override _iter_alignments to
+  supply alignment records from a source other than samtools view
+  (see osqpipe.pipeline.bampy).'''
 
   __slots__ = ('tc1', 'chrom_sizes')
 
   def __init__(self, tc1=False, chrom_sizes=None):
     self.tc1 = tc1
     if chrom_sizes is not None:
-      self.chrom_sizes = read_file_to_key_value(chrom_sizes, "\t")
+      self.chrom_sizes = dict( (chrom, int(size)) for (chrom, size)
+                               in read_file_to_key_value(chrom_sizes, "\t").iteritems() )
     else:
       # Deactivate the overhanging read filter.
       self.chrom_sizes = None
 
+  def _iter_alignments(self, in_fn):
+    '''
+    Generator yielding (flag, reference name, 0-based leftmost
+    position, query name, mapping quality, sequence length) for every
+    alignment in the bam file. The output of samtools view is streamed
+    directly from the pipe rather than spooled to disk.
+    '''
+    cmd = [ 'samtools', 'view', in_fn ]
+    kid = Popen(cmd, stdout=PIPE, bufsize=-1,
+                env=dict(os.environ, PATH=CONFIG.hostpath))
+
+    try:
+      for line in kid.stdout:
+        if line[0] == '@':
+          continue
+        flds = line.split("\t", 10)
+        yield (int(flds[1]), flds[2], int(flds[3])-1, flds[0],
+               flds[4], len(flds[9]))
+    finally:
+      kid.stdout.close()
+      retcode = kid.wait()
+
+    if retcode != 0:
+      raise CalledProcessError(retcode, " ".join(cmd))
+
   def convert(self, in_fn, out_fn):
 
     '''Actually run the conversion. Takes an input and output
@@ -108,20 +146,10 @@ class BamToBedConverter(object):
     from that specified if the tc1 genome has been used in the
     alignment).'''
 
-    # Start parsing the sam file with the help of converting bam to
-    # sam with samtools view
     LOGGER.info("Converting bam file %s to bed file %s", in_fn, out_fn)
 
     out_fns = []
 
-    # FIXME this should be trivial to implement via pysam.
-    cmd = [ 'samtools', 'view', in_fn ]
-
-    # call_subprocess seems to function approximately as fast
-    # as a straight pipe from subprocess.Popen, despite its writing
-    # interim data to disk. Bear this in mind if we run into
-    # performance issues, though.
-    in_fd   = call_subprocess(cmd, bufsize=1, path=CONFIG.hostpath)
     out_fd1 = open(out_fn, "w")
 
     out_fn2 = None
@@ -138,14 +166,11 @@ class BamToBedConverter(object):
     unmapped = 0
     skipped = 0
 
-    for line in in_fd:
+    chrom_sizes = self.chrom_sizes
+
+    for (flag, refname, left, qname, mapq, qlen) in self._iter_alignments(in_fn):
 
-      # The core of the samtools view output parser.
-      if line[0] == '@':
-        continue
       count += 1
-      flds = line.split()
-      flag = int(flds[1])
       if flag & 0x0004:
         unmapped += 1
         continue # read is unmapped
@@ -156,24 +181,22 @@ class BamToBedConverter(object):
       if flag & 0x0010:
         strand = '-'
 
-      left  = int(flds[3])-1
-      right = left + len(flds[9])
+      right = left + qlen
 
       # Check for overhanging reads and drop them.
-      chrlen = None
-      if self.chrom_sizes is not None:
-        chrlen = self.chrom_sizes.get(flds[2], None)
-        if chrlen is None or left > int(chrlen) or right > int(chrlen):
+      if chrom_sizes is not None:
+        chrlen = chrom_sizes.get(refname, None)
+        if chrlen is None or left > chrlen or right > chrlen:
           skipped = skipped + 1
           continue
 
       # Actually write out the line.
-      if self.tc1 and flds[2] == "chr21":
-        out_fd2.write("%s\t%d\t%d\t%s\t%s\t%s\n" % (flds[2], left, right,
-                                                    flds[0], flds[4], strand))
+      if self.tc1 and refname == "chr21":
+        out_fd2.write("%s\t%d\t%d\t%s\t%s\t%s\n" % (refname, left, right,
+                                                    qname, mapq, strand))
       else:
-        out_fd1.write("%s\t%d\t%d\t%s\t%s\t%s\n" % (flds[2], left, right,
-                                                    flds[0], flds[4], strand))
+        out_fd1.write("%s\t%d\t%d\t%s\t%s\t%s\n" % (refname, left, right,
+                                                    qname, mapq, strand))
 
       # Some user-friendly feedback.
       if count % 100000 == 0:
@@ -182,10 +205,10 @@ class BamToBedConverter(object):
     if self.chrom_sizes is not None:
       LOGGER.info("%d overhanging reads removed.", skipped)
 
-    in_fd.close()
     out_fd1.close()
     out_fns.append(out_fn)
     if(self.tc1):
+      out_fd2.close()
       out_fns.append(out_fn2)
     LOGGER.info("read %d, wrote %d (%d unmapped)\n", count, mapped, unmapped)
 
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqutil python package.
+#
+# The osqutil python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqutil python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqutil python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Pooling of ssh connections using OpenSSH connection multiplexing
+(ControlMaster). The first ssh or scp call to a given (user, host,
+port) starts a master connection which persists in the background;
+subsequent calls are run as sessions over that connection, avoiding a
+fresh TCP and authentication handshake each time. Multi-file copies
+are batched into a single tar stream.
+'''
+
+import os
+import shutil
+import tempfile
+from pipes import quote
+from subprocess import Popen, PIPE, CalledProcessError
+
+from .config import Config
+from .setup_logs import configure_logging
+
+LOGGER = configure_logging('sshpool')
+
+# Default time (in seconds) for which an idle master connection is kept open.
+DEFAULT_CONTROL_PERSIST = 300
+
+# ControlPath used for connections made *from* the cluster
+# (e.g. returning files to localhost). The %-tokens are expanded by ssh.
+REMOTE_CONTROL_PATH = '/tmp/osqssh-%r@%h:%p'
+
+################################################################################
+class SshConnectionPool(object):
+  '''
+  Builds ssh and scp command lines which share one multiplexed master
+  connection per (user, host, port), and counts how many connections
+  were opened and how many calls reused an existing connection. The
+  control_persist argument (seconds) defaults to the
+  ssh_control_persist config option; a value of zero disables
+  multiplexing altogether.
+  '''
+  __slots__ = ('control_dir', 'control_persist', 'opened', 'reused', 'counts')
+
+  def __init__(self, control_dir=None, control_persist=None):
+    if control_persist is None:
+      try:
+        control_persist = int(Config().ssh_control_persist)
+      except AttributeError, _err:
+        control_persist = DEFAULT_CONTROL_PERSIST
+    self.control_persist = control_persist
+    if control_dir is None:
+      control_dir = os.path.join(tempfile.gettempdir(),
+                                 'osqssh-%d' % os.getuid())
+    self.control_dir = control_dir
+    self.opened = 0
+    self.reused = 0
+    self.counts = {}
+
+  @property
+  def enabled(self):
+    '''
+    True if connection multiplexing is in use.
+    '''
+    return self.control_persist > 0
+
+  def control_path(self, user, host, port=22):
+    '''
+    Return the path of the control socket for the given connection.
+    '''
+    return os.path.join(self.control_dir, "%s@%s:%s" % (user, host, port))
+
+  def _checkout(self, user, host, port):
+    '''
+    Record the use of a connection, and return the ssh options needed
+    to share it.
+    '''
+    key = (user, host, str(port))
+    (opened, reused) = self.counts.get(key, (0, 0))
+    if not self.enabled:
+      self.opened += 1
+      self.counts[key] = (opened + 1, reused)
+      return []
+
+    if not os.path.isdir(self.control_dir):
+      os.makedirs(self.control_dir, 0700)
+    path = self.control_path(user, host, port)
+    if os.path.exists(path):
+      self.reused += 1
+      self.counts[key] = (opened, reused + 1)
+      LOGGER.debug("Reusing ssh connection to %s@%s:%s", user, host, port)
+    else:
+      self.opened += 1
+      self.counts[key] = (opened + 1, reused)
+      LOGGER.debug("Opening ssh connection to %s@%s:%s", user, host, port)
+    return ['-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=%s' % path,
+            '-o', 'ControlPersist=%d' % self.control_persist]
+
+  def ssh_args(self, user, host, port=22, sshkey=None, options=()):
+    '''
+    Return an ssh argument list (excluding any remote command) for
+    the given connection. Extra ssh -o options may be passed as a
+    list of strings.
+    '''
+    args = ['ssh'] + self._checkout(user, host, port)
+    for opt in options:
+      args += ['-o', opt]
+    if sshkey is not None:
+      args += ['-i', sshkey]
+    return args + ['-p', str(port), '%s@%s' % (user, host)]
+
+  def ssh_command(self, user, host, port=22, sshkey=None, options=()):
+    '''
+    As ssh_args, but returns a string suitable for use with a shell.
+    '''
+    return " ".join([ quote(x) for x in
+                      self.ssh_args(user, host, port, sshkey, options) ])
+
+  def scp_command(self, user, host, port=22, sshkey=None, same_permissions=False):
+    '''
+    Return an scp command prefix (excluding source and destination)
+    which uses the pooled connection to the given host.
+    '''
+    args = ['scp'] + self._checkout(user, host, port) + ['-P', str(port)]
+    if same_permissions:
+      args += ['-p']
+    if sshkey is not None:
+      args += ['-i', sshkey]
+    return " ".join([ quote(x) for x in args ] + ['-q'])
+
+  def copy_files(self, filenames, destnames, user, host, destdir, port=22,
+                 sshkey=None, same_permissions=False, path=None):
+    '''
+    Copy a set of local files to destdir on the remote host, renaming
+    them to destnames, in a single transfer. The files are streamed
+    as a tar archive over one ssh session. Raises CalledProcessError
+    on failure.
+    '''
+    if len(filenames) != len(destnames):
+      raise ValueError("The destnames list must be the same length"
+                       + " as the filenames list.")
+
+    # The tar archive is built from a directory of symlinks named
+    # after the destination files; tar -h archives their targets.
+    staging = tempfile.mkdtemp(prefix='osqssh')
+    env = os.environ.copy()
+    if path is not None:
+      env['PATH'] = ":".join(path) if type(path) is list else path
+    try:
+      for (fromfn, destfn) in zip(filenames, destnames):
+        link = os.path.join(staging, destfn)
+        if not os.path.isdir(os.path.dirname(link)):
+          os.makedirs(os.path.dirname(link))
+        os.symlink(os.path.abspath(fromfn), link)
+
+      untar = "mkdir -p %s && tar -x%sf - -C %s" \
+          % (quote(destdir), 'p' if same_permissions else '', quote(destdir))
+      sshcmd = self.ssh_args(user, host, port, sshkey) + [untar]
+      tarcmd = ['tar', '-chf', '-', '-C', staging] + list(destnames)
+      LOGGER.debug("%s | %s", " ".join(tarcmd), " ".join(sshcmd))
+
+      tar = Popen(tarcmd, stdout=PIPE, env=env)
+      ssh = Popen(sshcmd, stdin=tar.stdout, stdout=PIPE, stderr=PIPE, env=env)
+      tar.stdout.close() # So that tar receives SIGPIPE if ssh exits.
+      (_stdout, stderr) = ssh.communicate()
+      tar_ret = tar.wait()
+    finally:
+      shutil.rmtree(staging)
+
+    if ssh.returncode != 0:
+      LOGGER.error(stderr)
+      raise CalledProcessError(ssh.returncode, " ".join(sshcmd))
+    if tar_ret != 0:
+      raise CalledProcessError(tar_ret, " ".join(tarcmd))
+
+  def close(self, user, host, port=22):
+    '''
+    Shut down the master connection to the given host, if any.
+    '''
+    path = self.control_path(user, host, port)
+    if os.path.exists(path):
+      cmd = ['ssh', '-o', 'ControlPath=%s' % path, '-O', 'exit',
+             '-p', str(port), '%s@%s' % (user, host)]
+      LOGGER.debug(" ".join(cmd))
+      Popen(cmd, stdout=PIPE, stderr=PIPE).communicate()
+
+  def close_all(self):
+    '''
+    Shut down all the master connections opened via this pool. Note
+    that idle masters exit by themselves after control_persist
+    seconds, so calling this is not usually necessary.
+    '''
+    for (user, host, port) in self.counts.keys():
+      self.close(user, host, port)
+
+  def stats(self):
+    '''
+    Return a dict of (opened, reused) connection counts keyed by
+    (user, host, port).
+    '''
+    return dict(self.counts)
+
+def remote_multiplex_options(control_persist=60):
+  '''
+  Return ssh -o option strings enabling connection sharing for ssh
+  and scp calls which are run *on* a remote host (e.g. cluster jobs
+  returning their output files). These use a ControlPath in the
+  remote /tmp directory.
+  '''
+  return " ".join([ '-o ControlMaster=auto',
+                    '-o ControlPath=%s' % REMOTE_CONTROL_PATH,
+                    '-o ControlPersist=%d' % control_persist ])
+
+_POOL = None
+
+def get_ssh_pool():
+  '''
+  Return the process-wide SshConnectionPool instance.
+  '''
+  global _POOL
+  if _POOL is None:
+    _POOL = SshConnectionPool()
+  return _POOL
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqutil python package.
+#
+# The osqutil python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqutil python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqutil python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Tests for in-place bam header editing.
+'''
+
+from unittest import TestCase
+import os
+import gzip
+import struct
+import zlib
+import random
+import shutil
+import tempfile
+
+from .. import bamheader
+from ..bamheader import BamHeaderEditor, _make_block
+from ..checksum_cache import ChecksumCache
+from ..utilities import checksum_file
+import logging
+from ..setup_logs import configure_logging
+LOGGER = configure_logging()
+
+HEADER = ("@HD\tVN:1.4\tSO:coordinate\n@SQ\tSN:chr1\tLN:1000\n"
+          + "@RG\tID:1\tPL:illumina\tPU:1\tLB:do1234\tSM:sample\tCN:CRI\n")
+
+def _deflate(data):
+  comp = zlib.compressobj(6, zlib.DEFLATED, -15)
+  return comp.compress(data) + comp.flush()
+
+class TestBamHeaderEditor(TestCase):
+
+  def setUp(self):
+    LOGGER.setLevel(logging.FATAL) # For verbose testing, set this to DEBUG.
+    self.tmpdir = tempfile.mkdtemp()
+    self.bam    = os.path.join(self.tmpdir, 'test.bam')
+
+    # A minimal BGZF file with the start of the records in the header
+    # block, as written by some tools.
+    rnd = random.Random(42)
+    self.records = ''.join([ struct.pack('<iiH', rnd.randint(0, 1000), num, 0x4a)
+                             + 'ACGT' * rnd.randint(5, 20) for num in range(8000) ])
+    refs   = struct.pack('<i', 1) + struct.pack('<i', 5) + 'chr1\x00' \
+        + struct.pack('<i', 1000)
+    self.first = 'BAM\x01' + struct.pack('<i', len(HEADER)) + HEADER + refs
+    with open(self.bam, 'wb') as out:
+      for data in (self.first + self.records[:500], self.records[500:60000],
+                   self.records[60000:], ''):
+        out.write(_make_block(data, _deflate(data)))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _content(self):
+    handle = gzip.open(self.bam)
+    try:
+      return handle.read()
+    finally:
+      handle.close()
+
+  def test_read(self):
+    editor = BamHeaderEditor(self.bam)
+    self.assertEqual(editor.text, HEADER)
+    self.assertEqual(editor.tail, self.records[:500])
+
+  def test_replace(self):
+    size   = os.stat(self.bam).st_size
+    oldsum = checksum_file(self.bam, unzip=False, trust_cache=False)
+    for sample in ('liver', 'a much longer sample name', 'x'):
+      newtext = HEADER.replace('SM:sample', 'SM:%s' % sample)
+      editor  = BamHeaderEditor(self.bam)
+      newsum  = editor.replace(newtext, checksum=oldsum)
+      self.assertNotEqual(newsum, None)
+      self.assertEqual(os.stat(self.bam).st_size, size)
+      self.assertEqual(newsum, checksum_file(self.bam, unzip=False,
+                                             trust_cache=False))
+      self.assertEqual(BamHeaderEditor(self.bam).text, newtext)
+      content = self._content()
+      self.assertTrue(content.endswith(self.records))
+      self.assertTrue(("SM:%s\t" % sample) in content)
+      oldsum = newsum
+    self.assertFalse(os.path.exists("%s.hdrbak" % self.bam))
+
+  def test_cache_update(self):
+    cache = ChecksumCache(os.path.join(self.tmpdir, 'cache.sqlite'))
+    get_cache = bamheader.get_checksum_cache
+    bamheader.get_checksum_cache = lambda: cache
+    try:
+      newsum = BamHeaderEditor(self.bam).replace(HEADER.replace('SM:sample', 'SM:liver'))
+    finally:
+      bamheader.get_checksum_cache = get_cache
+    self.assertNotEqual(newsum, None)
+
+    # Both the default checksum_file key and the unzip=False key are updated.
+    self.assertEqual(cache.lookup(self.bam), newsum)
+    self.assertEqual(cache.lookup(self.bam, unzip=False), newsum)
+    self.assertEqual(checksum_file(self.bam, trust_cache=False), newsum)
+
+  def test_no_fit(self):
+    editor = BamHeaderEditor(self.bam)
+    before = checksum_file(self.bam, unzip=False, trust_cache=False)
+    # Incompressible text cannot fit into the original blocks.
+    rnd    = random.Random(1)
+    noise  = ''.join([ chr(rnd.randint(65, 90)) for _num in range(4000) ])
+    self.assertEqual(editor.replace(HEADER + "@CO\t%s\n" % noise), None)
+    self.assertEqual(checksum_file(self.bam, unzip=False, trust_cache=False),
+                     before)
+    self.assertRaises(ValueError, editor.replace, HEADER, checksum='0' * 32)
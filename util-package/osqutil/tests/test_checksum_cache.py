@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqutil python package.
+#
+# The osqutil python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqutil python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqutil python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Tests for the persistent checksum cache.
+'''
+
+from unittest import TestCase
+import os
+import time
+import shutil
+import tempfile
+
+from ..checksum_cache import ChecksumCache
+import logging
+from ..setup_logs import configure_logging
+LOGGER = configure_logging()
+
+class TestChecksumCache(TestCase):
+
+  def setUp(self):
+    LOGGER.setLevel(logging.FATAL) # For verbose testing, set this to DEBUG.
+    self.tmpdir = tempfile.mkdtemp()
+    self.cache  = ChecksumCache(os.path.join(self.tmpdir, 'cache.sqlite'),
+                                max_entries=3)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _make_file(self, name, content='ACGT\n'):
+    fname = os.path.join(self.tmpdir, name)
+    with open(fname, 'wb') as out:
+      out.write(content)
+    return fname
+
+  def test_lookup(self):
+    fname = self._make_file('test.fq')
+    self.assertEqual(self.cache.lookup(fname), None)
+    self.cache.store(fname, 'abc123', os.stat(fname))
+    self.assertEqual(self.cache.lookup(fname), 'abc123')
+    self.assertEqual(self.cache.lookup(fname, unzip=False), None)
+
+  def test_stale_entry(self):
+    fname = self._make_file('test.fq')
+    self.cache.store(fname, 'abc123', os.stat(fname))
+    self._make_file('test.fq', 'ACGTACGT\n')
+    self.assertEqual(self.cache.lookup(fname), None)
+    self.assertEqual(len(self.cache), 0)
+
+  def test_eviction(self):
+    fnames = [ self._make_file('test%d.fq' % num) for num in range(5) ]
+    for fname in fnames:
+      self.cache.store(fname, os.path.basename(fname), os.stat(fname))
+      time.sleep(0.01)
+    self.assertEqual(len(self.cache), 3)
+    self.assertEqual(self.cache.lookup(fnames[0]), None)
+    self.assertEqual(self.cache.lookup(fnames[4]), 'test4.fq')
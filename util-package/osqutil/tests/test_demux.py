@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqutil python package.
+#
+# The osqutil python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqutil python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqutil python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Tests for the inline barcode demultiplexer.
+'''
+
+from unittest import TestCase
+import os
+import gzip
+import shutil
+import tempfile
+
+from ..demux import build_barcode_table, header_barcode, detect_format, \
+    BarcodeDemultiplexer
+import logging
+from ..setup_logs import configure_logging
+LOGGER = configure_logging()
+
+FQ_RECORD = "@read%d\n%sACGTACGT\n+\nIIIIIIIIIIII\n"
+HEADER_RECORD = "@read%d 1:N:0:%s\nTTTTACGTACGT\n+\nIIIIIIIIIIII\n"
+
+class TestBarcodeTable(TestCase):
+
+  def setUp(self):
+    LOGGER.setLevel(logging.FATAL) # For verbose testing, set this to DEBUG.
+
+  def test_off_by_one(self):
+    table = build_barcode_table(['ACGT', 'TTTT'])
+    self.assertEqual(table['ACGT'], ('ACGT', 0))
+    self.assertEqual(table['ACGA'], ('ACGT', 1))
+    self.assertEqual(table['TATT'], ('TTTT', 1))
+    self.assertFalse('AAAA' in table)
+    self.assertEqual(len(table), 2 * (1 + 4 * 3))
+
+  def test_ambiguous(self):
+    table = build_barcode_table(['AAAA', 'AAAC'])
+    self.assertFalse('AAAG' in table)
+    self.assertEqual(table['AAAC'], ('AAAC', 0))
+    self.assertEqual(build_barcode_table(['AAAA', 'AAAC'], 0),
+                     {'AAAA': ('AAAA', 0), 'AAAC': ('AAAC', 0)})
+
+  def test_unequal_lengths(self):
+    self.assertRaises(ValueError, build_barcode_table, ['ACGT', 'ACG'])
+
+  def test_detect_format(self):
+    self.assertEqual(detect_format('x_CRI01.fq'), 'fastq')
+    self.assertEqual(detect_format('x_CRI01.fastq'), 'fastq')
+    self.assertEqual(detect_format('x_CRI01.fq.gz'), 'fastq')
+    self.assertEqual(detect_format('x_CRI01.export.txt.gz'), 'export')
+    self.assertEqual(detect_format('x_CRI01.export'), 'export')
+
+class TestBarcodeDemultiplexer(TestCase):
+
+  def setUp(self):
+    LOGGER.setLevel(logging.FATAL)
+    self.tmpdir = tempfile.mkdtemp()
+    self.infile = os.path.join(self.tmpdir, 'input.fq.gz')
+    self.codes  = ['ACGT', 'ACGA', 'TTTT', 'GGGG', 'CCCC']
+    with gzip.open(self.infile, 'wb') as out:
+      for (num, code) in enumerate(self.codes * 3):
+        out.write(FQ_RECORD % (num, code))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _read(self, fname):
+    with gzip.open(fname) as fdesc:
+      return [ line for (num, line) in enumerate(fdesc) if num % 4 == 1 ]
+
+  def test_run(self):
+    outputs   = dict( (code, os.path.join(self.tmpdir, code + '.fq.gz'))
+                      for code in ('ACGT', 'TTTT') )
+    unmatched = os.path.join(self.tmpdir, 'other.fq.gz')
+    demux     = BarcodeDemultiplexer(outputs, unmatched=unmatched,
+                                     location='sequence', batch_size=4)
+    counts    = demux.run(self.infile)
+
+    self.assertEqual(counts['ACGT'], [3, 3])
+    self.assertEqual(counts['TTTT'], [3, 0])
+    self.assertEqual(counts['unmatched'], 6)
+    self.assertEqual(len(self._read(outputs['ACGT'])), 6)
+    self.assertEqual(set(self._read(outputs['TTTT'])), set(['TTTTACGTACGT\n']))
+    self.assertEqual(len(self._read(unmatched)), 6)
+
+  def test_header(self):
+    self.assertEqual(header_barcode("@HWI-1:5:1:1:1#ACGT/1\n"), 'ACGT')
+    self.assertEqual(header_barcode("@M1:5:FC:1:1:1:1 2:N:0:ACGTAC+TTGGCC\n"), 'ACGTAC')
+    self.assertEqual(header_barcode("@read1\n"), '')
+
+    # Every read sequence starts with TTTT; the barcode is in the header.
+    infile = os.path.join(self.tmpdir, 'header.fq.gz')
+    with gzip.open(infile, 'wb') as out:
+      for (num, code) in enumerate(self.codes * 3):
+        out.write(HEADER_RECORD % (num, code))
+    outputs   = dict( (code, os.path.join(self.tmpdir, code + '.fq.gz'))
+                      for code in ('ACGT', 'TTTT') )
+    unmatched = os.path.join(self.tmpdir, 'other.fq.gz')
+    counts    = BarcodeDemultiplexer(outputs, unmatched=unmatched).run(infile)
+    self.assertEqual(counts['ACGT'], [3, 3])
+    self.assertEqual(counts['TTTT'], [3, 0])
+    self.assertEqual(counts['unmatched'], 6)
+    self.assertEqual(len(self._read(unmatched)), 6)
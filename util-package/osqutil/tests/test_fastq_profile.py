@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqutil python package.
+#
+# The osqutil python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqutil python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqutil python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Tests for the single-pass fastq profiler.
+'''
+
+from unittest import TestCase
+import os
+import gzip
+import shutil
+import tempfile
+
+from ..fastq_profile import profile_fastq
+from ..utilities import determine_readlength
+import logging
+from ..setup_logs import configure_logging
+LOGGER = configure_logging()
+
+# Quality lines deliberately start with '@' to exercise chunk
+# boundary detection.
+FQ_RECORD = "@M00123:42:000000000-A1B2C:1:1101:%d:1000 1:%s:0:1\n%s\n+\n%s\n"
+
+class TestFastqProfile(TestCase):
+
+  def setUp(self):
+    LOGGER.setLevel(logging.FATAL) # For verbose testing, set this to DEBUG.
+    self.tmpdir = tempfile.mkdtemp()
+    records = []
+    for num in range(1000):
+      if num % 10 == 0:
+        records.append(FQ_RECORD % (num, 'Y', 'ACGT', '@@@@'))
+      else:
+        records.append(FQ_RECORD % (num, 'N', 'ACGTAC' if num % 2 else 'TTGTAC',
+                                     '@@IIII'))
+    self.plain = os.path.join(self.tmpdir, 'test.fq')
+    with open(self.plain, 'wb') as out:
+      out.write(''.join(records))
+    self.zipped = os.path.join(self.tmpdir, 'test.fq.gz')
+    with gzip.open(self.zipped, 'wb') as out:
+      out.write(''.join(records))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _check_profile(self, profile):
+    self.assertEqual(profile.reads, 1000)
+    self.assertEqual(profile.passedpf, 900)
+    self.assertEqual(profile.runnumber, '42')
+    self.assertEqual(profile.lengths, {4: 100, 6: 900})
+    self.assertEqual(profile.readlength, 6)
+    self.assertEqual(profile.qualmeanpf, [31.0, 31.0, 40.0, 40.0, 40.0, 40.0])
+    self.assertEqual(profile.qualstdevpf, [0.0] * 6)
+    self.assertEqual(profile.qualmean[0], 31.0)
+    self.assertAlmostEqual(profile.qualmean[2], (100 * 31.0 + 900 * 40) / 1000)
+    self.assertTrue(profile.qualstdev[2] > 0)
+    self.assertEqual(profile.qualmean[4], 40.0)
+    self.assertEqual(len(profile.badreads), 100)
+    self.assertTrue(profile.duplicate_rate > 0.9)
+
+  def test_profile(self):
+    self._check_profile(profile_fastq(self.plain))
+    self._check_profile(profile_fastq(self.zipped))
+
+  def test_parallel_profile(self):
+    self._check_profile(profile_fastq(self.plain, processes=3))
+
+  def test_readlength(self):
+    self.assertEqual(determine_readlength(self.zipped, max_reads=1), 4)
+    self.assertEqual(determine_readlength(self.plain), 6)
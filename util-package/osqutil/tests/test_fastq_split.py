@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqutil python package.
+#
+# The osqutil python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqutil python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqutil python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Tests for the streaming fastq splitter.
+'''
+
+from unittest import TestCase
+import os
+import gzip
+import shutil
+import tempfile
+
+from ..fastq_split import FastqSplitter, split_fastq, write_manifest, \
+    read_manifest, plan_fastq_chunks
+import logging
+from ..setup_logs import configure_logging
+LOGGER = configure_logging()
+
+def _record(num, end):
+  return "@READ:%d/%d\nACGTACGT\n+\nIIIIIIII\n" % (num, end)
+
+class TestFastqSplit(TestCase):
+
+  def setUp(self):
+    LOGGER.setLevel(logging.FATAL) # For verbose testing, set this to DEBUG.
+    self.tmpdir = tempfile.mkdtemp()
+    self.fq1 = os.path.join(self.tmpdir, 'lane_p1.fq.gz')
+    self.fq2 = os.path.join(self.tmpdir, 'lane_p2.fq')
+    out1 = gzip.open(self.fq1, 'wb')
+    with open(self.fq2, 'w') as out2:
+      for num in range(25):
+        out1.write(_record(num, 1))
+        out2.write(_record(num, 2))
+    out1.close()
+    self.path = "/usr/bin:/bin"
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _reads(self, fname, opener=open):
+    handle = opener(fname)
+    try:
+      return [ line.strip() for line in handle if line.startswith('@') ]
+    finally:
+      handle.close()
+
+  def test_paired(self):
+    manifest = split_fastq([self.fq1, self.fq2], chunk_reads=10,
+                           path=self.path)
+    self.assertEqual([ chunk.reads for chunk in manifest ], [10, 10, 5])
+    self.assertEqual(manifest[0].filenames,
+                     [ os.path.join(self.tmpdir, 'lane_p1.fq-0001'),
+                       os.path.join(self.tmpdir, 'lane_p2.fq-0001') ])
+    reads1 = []
+    for chunk in manifest:
+      first  = self._reads(chunk.filenames[0])
+      second = self._reads(chunk.filenames[1])
+      self.assertEqual([ x[:-2] for x in first ], [ x[:-2] for x in second ])
+      reads1 += first
+    self.assertEqual(reads1, [ "@READ:%d/1" % num for num in range(25) ])
+
+    mfile = os.path.join(self.tmpdir, 'manifest.json')
+    write_manifest(manifest, mfile)
+    self.assertEqual(read_manifest(mfile), manifest)
+
+  def test_parallel_compressed(self):
+    splitter = FastqSplitter(chunk_reads=10, compress=True, parallel=2,
+                             batch_size=3, path=self.path)
+    manifest = splitter.split([self.fq1])
+    self.assertEqual(sum([ chunk.reads for chunk in manifest ]), 25)
+    # Up to two chunks may be part-filled when the input runs out.
+    self.assertTrue(len(manifest) in (3, 4))
+    self.assertEqual([ chunk.index for chunk in manifest ],
+                     range(1, len(manifest) + 1))
+    self.assertEqual(max([ chunk.reads for chunk in manifest ]), 10)
+    reads = []
+    for chunk in manifest:
+      self.assertTrue(chunk.filenames[0].endswith('.gz'))
+      chunk_reads = self._reads(chunk.filenames[0], gzip.open)
+      self.assertEqual(len(chunk_reads), chunk.reads)
+      reads += chunk_reads
+    self.assertEqual(sorted(reads),
+                     sorted([ "@READ:%d/1" % num for num in range(25) ]))
+
+  def test_out_of_step(self):
+    with open(self.fq2, 'a') as out:
+      out.write(_record(99, 2))
+    self.assertRaises(ValueError, split_fastq, [self.fq1, self.fq2],
+                      chunk_reads=10, path=self.path)
+
+  def test_plan(self):
+    plan = plan_fastq_chunks([self.fq1, self.fq2], chunk_reads=10,
+                             path=self.path)
+    self.assertEqual(plan, split_fastq([self.fq1, self.fq2], chunk_reads=10,
+                                       path=self.path))
+    missing = os.path.join(self.tmpdir, 'missing.fq')
+    self.assertEqual(plan_fastq_chunks([missing], chunk_reads=10),
+                     [ (1, [missing], 0) ])
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqutil python package.
+#
+# The osqutil python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqutil python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqutil python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Tests for the persistent HTTP response cache.
+'''
+
+from unittest import TestCase
+import os
+import time
+import shutil
+import tempfile
+import threading
+
+from ..http_cache import ResponseCache
+import logging
+from ..setup_logs import configure_logging
+LOGGER = configure_logging()
+
+class TestResponseCache(TestCase):
+
+  def setUp(self):
+    LOGGER.setLevel(logging.FATAL) # For verbose testing, set this to DEBUG.
+    self.tmpdir = tempfile.mkdtemp()
+    self.dbfile = os.path.join(self.tmpdir, 'cache.sqlite')
+    self.cache  = ResponseCache(self.dbfile, max_age=60)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_lookup(self):
+    url = 'http://lims/fullDetailsOfRun?runId=1'
+    self.assertEqual(self.cache.lookup(url), None)
+    self.cache.store(url, '<run>\xc3\xa9</run>', etag='"abc"')
+    entry = ResponseCache(self.dbfile).lookup(url)
+    self.assertEqual(entry.body, '<run>\xc3\xa9</run>')
+    self.assertEqual(entry.conditional_headers(), { 'If-None-Match' : '"abc"' })
+    self.assertTrue(entry.age() < 5)
+
+  def test_expiry(self):
+    self.cache.store('http://lims/a', 'a')
+    self.cache.conn.execute('UPDATE responses SET fetched=?', (time.time() - 120,))
+    self.assertTrue(self.cache.lookup('http://lims/a').age() > 60)
+    self.cache.touch('http://lims/a')
+    self.assertTrue(self.cache.lookup('http://lims/a').age() < 5)
+    self.cache.conn.execute('UPDATE responses SET fetched=?', (time.time() - 120,))
+    self.cache.store('http://lims/b', 'b', last_modified='Mon, 01 Jan 2018 00:00:00 GMT')
+    self.assertEqual(self.cache.lookup('http://lims/a'), None)
+    self.assertEqual(len(self.cache), 1)
+
+  def test_threads(self):
+    def store(num):
+      self.cache.store('http://lims/%d' % num, str(num))
+    threads = [ threading.Thread(target=store, args=(num,)) for num in range(8) ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(len(self.cache), 8)
+    self.assertEqual(self.cache.lookup('http://lims/7').body, '7')
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqutil python package.
+#
+# The osqutil python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqutil python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqutil python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Tests for the cluster job tracker, using fake scheduler commands.
+'''
+
+from unittest import TestCase
+import os
+import stat
+import shutil
+import tempfile
+
+from ..jobtracker import ClusterJobTracker, ClusterJobError, DONE, FAILED
+from ..utilities import call_subprocess
+import logging
+from ..setup_logs import configure_logging
+LOGGER = configure_logging()
+
+# Each fake command reports jobs as running on the first call, and
+# finished thereafter. Job 103/203 is never reported.
+FAKE_BJOBS = """#!/bin/sh
+count=$(cat bjobs.count 2>/dev/null || echo 0)
+if [ "$1" = "-l" ]; then
+  echo "Job <202>, User <fnc>, Status <EXIT>"
+  echo "Tue Oct 18 10:00:00: Exited with exit code 2."
+  exit 0
+fi
+echo "JOBID   USER    STAT  QUEUE"
+if [ "$count" = "0" ]; then
+  echo "201     fnc     RUN   dolab"
+  echo "202     fnc     PEND  dolab"
+else
+  echo "201     fnc     DONE  dolab"
+  echo "202     fnc     EXIT  dolab"
+fi
+echo $((count + 1)) > bjobs.count
+echo "Job <203> is not found" >&2
+exit 255
+"""
+
+FAKE_SQUEUE = """#!/bin/sh
+count=$(cat squeue.count 2>/dev/null || echo 0)
+if [ "$count" = "0" ]; then
+  echo "101|RUNNING"
+  echo "102|PENDING"
+fi
+echo $((count + 1)) > squeue.count
+"""
+
+FAKE_SACCT = """#!/bin/sh
+echo "101|COMPLETED|0:0"
+echo "102|CANCELLED by 1234|0:15"
+"""
+
+class LocalRunner(object):
+  '''Stand-in for ClusterJobRunner which runs commands locally.'''
+  test_mode = False
+
+  def __init__(self, wdir):
+    self.wdir = wdir
+
+  def run_command(self, cmd, path=None):
+    return call_subprocess("cd %s && %s" % (self.wdir, cmd), shell=True,
+                           path=path, tmpdir=self.wdir)
+
+class TestClusterJobTracker(TestCase):
+
+  def setUp(self):
+    LOGGER.setLevel(logging.FATAL) # For verbose testing, set this to DEBUG.
+    self.tmpdir = tempfile.mkdtemp()
+    for (name, content) in (('bjobs', FAKE_BJOBS), ('squeue', FAKE_SQUEUE),
+                            ('sacct', FAKE_SACCT)):
+      fname = os.path.join(self.tmpdir, name)
+      with open(fname, 'w') as out:
+        out.write(content)
+      os.chmod(fname, stat.S_IRWXU)
+    self.path   = "%s:/usr/bin:/bin" % self.tmpdir
+    self.runner = LocalRunner(self.tmpdir)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_lsf(self):
+    tracker = ClusterJobTracker(self.runner, clustertype='LSF', path=self.path,
+                                interval=0, lost_polls=2)
+    states = tracker.wait([201, 202, 203])
+    self.assertEqual(states[201].state, DONE)
+    self.assertEqual(states[201].exit_code, 0)
+    self.assertEqual(states[202].state, FAILED)
+    self.assertEqual(states[202].exit_code, 2)
+    self.assertEqual(states[203].state, FAILED)
+
+  def test_slurm(self):
+    tracker = ClusterJobTracker(self.runner, clustertype='SLURM', path=self.path,
+                                interval=0)
+    states = tracker.query([101, 102])
+    self.assertEqual(states[101].raw_state, 'RUNNING')
+    states = tracker.wait([101, 102])
+    self.assertEqual(states[101].state, DONE)
+    self.assertEqual(states[102].state, FAILED)
+    self.assertEqual(states[102].exit_code, 0)
+
+  def test_timeout(self):
+    tracker = ClusterJobTracker(self.runner, clustertype='LSF', path=self.path,
+                                interval=1, timeout=1, lost_polls=10)
+    self.assertRaises(ClusterJobError, tracker.wait, [203])
+
+  def test_default_timeout(self):
+    # Lost jobs must never leave the pipeline waiting forever.
+    tracker = ClusterJobTracker(self.runner, clustertype='LSF', path=self.path)
+    self.assertTrue(tracker.timeout > 0)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqutil python package.
+#
+# The osqutil python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqutil python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqutil python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Tests for the pipeline graph used to build cluster alignment jobs.
+'''
+
+from unittest import TestCase
+import os
+import re
+import shutil
+import tempfile
+from subprocess import Popen, PIPE
+
+from ..cluster import PipelineGraph, build_merge_pipeline, readgroup_fields
+import logging
+from ..setup_logs import configure_logging
+LOGGER = configure_logging()
+
+class TestPipelineGraph(TestCase):
+
+  def setUp(self):
+    LOGGER.setLevel(logging.FATAL) # For verbose testing, set this to DEBUG.
+    self.tmpdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _paired_graph(self):
+    # Mirrors the bwa aln/sampe topology with bzipped input.
+    graph = PipelineGraph('lane', workdir=self.tmpdir,
+                          pools={ 'main' : 8, 'sort' : 3 })
+    graph.add_stage('fastq1', "bzcat r1.fq.bz2 > {out}")
+    graph.add_stage('fastq2', "bzcat r2.fq.bz2 > {out}")
+    graph.add_stage('aln1', "bwa aln -t {threads} g {in0} > {out}", ['fastq1'], weight=1)
+    graph.add_stage('aln2', "bwa aln -t {threads} g {in0} > {out}", ['fastq2'], weight=1)
+    graph.add_stage('sampe', "bwa sampe g {in0} {in1} {in2} {in3} > {out}",
+                    ['aln1', 'aln2', 'fastq1', 'fastq2'])
+    graph.add_stage('sort', "samtools sort -@ {threads} -o out.bam {in0}",
+                    ['sampe'], weight=1, pool='sort')
+    return graph
+
+  def test_topology(self):
+    graph  = self._paired_graph()
+    script = graph.render()
+    self.assertEqual(graph.stage('aln1').threads, 4)
+    self.assertEqual(graph.stage('sort').threads, 3)
+    self.assertTrue("bzcat r1.fq.bz2 > /dev/stdout | bwa aln -t 4 g /dev/stdin"
+                    + " > /dev/stdout | bwa sampe g /dev/stdin" in script)
+    # Three named pipes: the second sai file and the two fastq re-reads.
+    fifos = set(re.findall(r'[^\s\'"]+\.fifo', script))
+    self.assertEqual(sorted([ os.path.basename(x) for x in fifos ]),
+                     ['lane.aln2.fifo', 'lane.fastq1.2.fifo', 'lane.fastq2.2.fifo'])
+    self.assertTrue('mkfifo' in script)
+    plan = graph.plan()
+    self.assertTrue('4 concurrent chain(s), 3 named pipe(s)' in plan)
+    self.assertTrue('pool main: 8 of 8 threads allocated' in plan)
+
+  def test_thread_weights(self):
+    graph = PipelineGraph('x', pools={ 'main' : 7 })
+    graph.add_stage('a', "a {threads} > {out}", weight=2)
+    graph.add_stage('b', "b {threads} {in0}", ['a'], weight=1)
+    graph.allocate_threads()
+    self.assertEqual((graph.stage('a').threads, graph.stage('b').threads), (5, 2))
+
+  def test_invalid(self):
+    graph = PipelineGraph('x')
+    graph.add_stage('a', "a > {out}")
+    self.assertRaises(KeyError, graph.add_stage, 'b', "b {in0}", ['missing'])
+    self.assertRaises(ValueError, graph.add_stage, 'a', "a")
+    graph.add_stage('b', "tr a b < {in0} > {out}", ['a'])
+    graph.add_stage('c', "cat {in0}", ['b'])
+    graph.add_stage('d', "cat {in0}", ['b'])
+    self.assertRaises(ValueError, graph.render)
+
+  def test_run(self):
+    infile  = os.path.join(self.tmpdir, 'in.txt')
+    outfile = os.path.join(self.tmpdir, 'out.txt')
+    with open(infile, 'w') as out:
+      out.write("c\na\nb\n")
+    graph = PipelineGraph('run', workdir=self.tmpdir)
+    graph.add_stage('src', "cat %s > {out}" % infile)
+    graph.add_stage('upper', "tr a-z A-Z < {in0} > {out}", ['src'])
+    graph.add_stage('paste', "paste {in0} {in1} > {out}", ['upper', 'src'])
+    graph.add_stage('sort', "sort {in0} > %s" % outfile, ['paste'])
+    proc = Popen(['bash', '-c', graph.render()], stdout=PIPE, stderr=PIPE)
+    proc.communicate()
+    self.assertEqual(proc.returncode, 0)
+    with open(outfile) as fh:
+      self.assertEqual(fh.read(), "A\ta\nB\tb\nC\tc\n")
+    self.assertEqual([ x for x in os.listdir(self.tmpdir) if x.endswith('.fifo') ], [])
+
+  def test_failure(self):
+    graph = PipelineGraph('fail', workdir=self.tmpdir)
+    graph.add_stage('src', "cat /nonexistent/file > {out}")
+    graph.add_stage('other', "echo x > {out}")
+    graph.add_stage('join', "paste {in0} {in1}", ['other', 'src'])
+    proc = Popen(['bash', '-c', graph.render()], stdout=PIPE, stderr=PIPE)
+    proc.communicate()
+    self.assertNotEqual(proc.returncode, 0)
+
+  def test_merge_modes(self):
+    readgroup = readgroup_fields('do1234_hg38_CRI03.bam', 'liver 1')
+    self.assertEqual(readgroup[0], ('ID', 3))
+    self.assertEqual(readgroup[4], ('SM', 'liver 1'))
+    graph  = build_merge_pipeline('out.bam', ['a.bam', 'b.bam'], readgroup,
+                                  threads=8, workdir=self.tmpdir)
+    script = graph.render()
+    # One merge piped into a single read group + compression pass.
+    self.assertTrue("samtools merge -u -@ 2 - a.bam b.bam > /dev/stdout"
+                    + " | samtools addreplacerg -@ 6 -m overwrite_all -r ID:3" in script)
+    self.assertTrue("-r 'SM:liver 1'" in script)
+    self.assertFalse('picard' in script)
+    graph  = build_merge_pipeline('out.bam', ['a.bam'], readgroup, mode='picard')
+    script = graph.render()
+    self.assertTrue("INPUT=a.bam OUTPUT=/dev/stdout" in script)
+    self.assertTrue("RGSM='liver 1'" in script)
+    self.assertFalse('samtools merge' in script)
+    self.assertRaises(ValueError, build_merge_pipeline, 'out.bam', ['a.bam'],
+                      readgroup, mode='other')
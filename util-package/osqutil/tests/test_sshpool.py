@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqutil python package.
+#
+# The osqutil python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqutil python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqutil python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Tests for the ssh connection pool, using a local stand-in for ssh.
+'''
+
+from unittest import TestCase
+import os
+import stat
+import shutil
+import tempfile
+
+from ..sshpool import SshConnectionPool
+from ..utilities import call_subprocess
+import logging
+from ..setup_logs import configure_logging
+LOGGER = configure_logging()
+
+# Runs the remote command locally. A ControlMaster call creates the
+# control socket path, as the real master connection would.
+FAKE_SSH = """#!/bin/sh
+while [ $# -gt 1 ]; do
+  case "$1" in
+    -o) case "$2" in ControlPath=*) touch "${2#ControlPath=}";; esac
+        shift 2;;
+    -p|-i) shift 2;;
+    *) break;;
+  esac
+done
+echo "$1" >> ssh.log
+shift
+exec sh -c "$*"
+"""
+
+class TestSshConnectionPool(TestCase):
+
+  def setUp(self):
+    LOGGER.setLevel(logging.FATAL) # For verbose testing, set this to DEBUG.
+    self.tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(self.tmpdir, 'ssh')
+    with open(fname, 'w') as out:
+      out.write(FAKE_SSH)
+    os.chmod(fname, stat.S_IRWXU)
+    self.path = "%s:/usr/bin:/bin" % self.tmpdir
+    self.pool = SshConnectionPool(control_dir=os.path.join(self.tmpdir, 'ctl'),
+                                  control_persist=60)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _run(self, cmd):
+    with call_subprocess("cd %s && %s" % (self.tmpdir, cmd), shell=True,
+                         path=self.path, tmpdir=self.tmpdir) as ofh:
+      return ofh.read()
+
+  def test_reuse(self):
+    for _num in range(3):
+      sshcmd = self.pool.ssh_command('fnc', 'cluster', 2222)
+      self.assertTrue('ControlMaster=auto' in sshcmd)
+      self.assertEqual(self._run("%s 'echo hello'" % sshcmd), "hello\n")
+    self.pool.ssh_command('fnc', 'transfer')
+    self.assertEqual(self.pool.opened, 2)
+    self.assertEqual(self.pool.reused, 2)
+    self.assertEqual(self.pool.stats()[('fnc', 'cluster', '2222')], (1, 2))
+
+  def test_disabled(self):
+    pool = SshConnectionPool(control_dir=os.path.join(self.tmpdir, 'ctl'),
+                             control_persist=0)
+    self.assertFalse('ControlMaster' in pool.ssh_command('fnc', 'cluster'))
+    pool.ssh_command('fnc', 'cluster')
+    self.assertEqual((pool.opened, pool.reused), (2, 0))
+
+  def test_copy_files(self):
+    srcs = []
+    for name in ('a.fq', 'b.fq', 'c.fq'):
+      srcs.append(os.path.join(self.tmpdir, name))
+      with open(srcs[-1], 'w') as out:
+        out.write(name)
+    destdir = os.path.join(self.tmpdir, 'remote dir')
+    oldcwd  = os.getcwd()
+    os.chdir(self.tmpdir)
+    try:
+      self.pool.copy_files(srcs, ['x_a.fq', 'x_b.fq', 'sub/x_c.fq'],
+                           'fnc', 'cluster', destdir, path=self.path)
+    finally:
+      os.chdir(oldcwd)
+    with open(os.path.join(destdir, 'sub', 'x_c.fq')) as fh:
+      self.assertEqual(fh.read(), 'c.fq')
+    self.assertTrue(os.path.exists(os.path.join(destdir, 'x_a.fq')))
+    with open(os.path.join(self.tmpdir, 'ssh.log')) as fh:
+      self.assertEqual(fh.read(), "fnc@cluster\n")
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqutil python package.
+#
+# The osqutil python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqutil python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqutil python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Tests for the file checksumming utility functions.
+'''
+
+from unittest import TestCase
+import os
+import gzip
+import hashlib
+import shutil
+import tempfile
+from distutils import spawn
+
+from ..utilities import checksum_file, checksum_files, _checksum_gzip_pipe
+import logging
+from ..setup_logs import configure_logging
+LOGGER = configure_logging()
+
+FQ_RECORD = "@read%d\nACGTACGTACGTNACGT\n+\nIIIIIIIIIIIIIIIII\n"
+
+class TestChecksum(TestCase):
+
+  def setUp(self):
+    LOGGER.setLevel(logging.FATAL) # For verbose testing, set this to DEBUG.
+    self.tmpdir  = tempfile.mkdtemp()
+    self.content = "".join([ FQ_RECORD % num for num in range(5000) ])
+    self.md5     = hashlib.md5(self.content).hexdigest()
+
+    self.plain = os.path.join(self.tmpdir, 'test.fq')
+    with open(self.plain, 'wb') as out:
+      out.write(self.content)
+
+    # Multi-member gzip file, as produced by concatenating gzipped fastq.
+    self.zipped = os.path.join(self.tmpdir, 'test.fq.gz')
+    half = len(self.content) / 2
+    for chunk in (self.content[:half], self.content[half:]):
+      with gzip.open(os.path.join(self.tmpdir, 'part.gz'), 'wb') as out:
+        out.write(chunk)
+      with open(self.zipped, 'ab') as out:
+        with open(os.path.join(self.tmpdir, 'part.gz'), 'rb') as part:
+          out.write(part.read())
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_checksum_file(self):
+    self.assertEqual(checksum_file(self.plain), self.md5)
+    self.assertEqual(checksum_file(self.zipped), self.md5)
+    self.assertEqual(checksum_file(self.plain, blocksize=1000), self.md5)
+    self.assertNotEqual(checksum_file(self.zipped, unzip=False), self.md5)
+
+  def test_checksum_gzip_pipe(self):
+    gzip_exe = spawn.find_executable('gzip')
+    if gzip_exe is None:
+      self.skipTest("gzip executable not available.")
+    self.assertEqual(_checksum_gzip_pipe(self.zipped, gzip_exe), self.md5)
+
+  def test_checksum_files(self):
+    missing = os.path.join(self.tmpdir, 'missing.fq')
+    sums    = checksum_files([self.plain, self.zipped, missing], processes=2)
+    self.assertEqual(sums[self.plain],  self.md5)
+    self.assertEqual(sums[self.zipped], self.md5)
+    self.assertEqual(sums[missing], None)
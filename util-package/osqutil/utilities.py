@@ -40,8 +40,12 @@ import hashlib
 from subprocess import Popen, CalledProcessError, PIPE
 from distutils import spawn
 import threading
+import multiprocessing
 import socket
+import sqlite3
 from .config import Config
+from .checksum_cache import get_checksum_cache
+from .sshpool import get_ssh_pool
 from .setup_logs import configure_logging
 from functools import wraps
 
@@ -207,7 +211,11 @@ def flexi_open(filename, *args, **kwargs):
 
   handle.close()
 
-def _checksum_fileobj(fileobj, blocksize=65536):
+# Default read size used when checksumming files. Large reads reduce
+# the per-call overhead considerably on multi-GB fastq and bam files.
+CHECKSUM_BLOCKSIZE = 4 * 1024 * 1024
+
+def _checksum_fileobj(fileobj, blocksize=CHECKSUM_BLOCKSIZE):
   '''
   Use the hashlib.md5() function to calculate MD5 checksum on a file
   object, in a reasonably memory-efficient way.
@@ -220,22 +228,172 @@ def _checksum_fileobj(fileobj, blocksize=65536):
 
   return hasher.hexdigest()
 
-def checksum_file(fname, unzip=True):
+def _find_gzip_decompressor():
+  '''
+  Return the path to an external gzip decompressor, preferring pigz
+  over gzip. Returns None if neither is available on DBCONF.hostpath.
+  '''
+  for prog in ('pigz', 'gzip'):
+    found = spawn.find_executable(prog, path=DBCONF.hostpath)
+    if found:
+      return found
+  return None
+
+def _checksum_gzip_pipe(fname, decompressor, blocksize=CHECKSUM_BLOCKSIZE):
+  '''
+  Calculate the MD5 checksum of the uncompressed content of a gzipped
+  file by reading from an external decompressor pipe. Note that
+  gzip/pigz handle multi-member gzip files (e.g. concatenated fastq
+  files) correctly.
+  '''
+  # Decompressor stderr output is minimal, so we can safely leave it
+  # in the pipe until stdout has been consumed.
+  kid = Popen([decompressor, '-dc', fname], stdout=PIPE, stderr=PIPE,
+              bufsize=blocksize)
+  try:
+    md5 = _checksum_fileobj(kid.stdout, blocksize)
+  finally:
+    kid.stdout.close()
+    stderr  = kid.stderr.read()
+    retcode = kid.wait()
+
+  if retcode != 0:
+    sys.stderr.write("\nSubprocess STDERR:\n%s\n" % (stderr,))
+    raise CalledProcessError(retcode, "%s -dc %s" % (decompressor, fname))
+
+  return md5
+
+def _log_checksum_throughput(fname, elapsed):
+  '''
+  Report checksum throughput (based on the on-disk file size) for a
+  single file.
+  '''
+  size = os.path.getsize(fname) / float(1024 * 1024)
+  rate = size / elapsed if elapsed > 0 else size
+  LOGGER.info("Checksummed %s (%.1f MB on disk) in %.1f seconds (%.1f MB/s).",
+              fname, size, elapsed, rate)
+
+def checksum_file(fname, unzip=True, blocksize=CHECKSUM_BLOCKSIZE,
+                  trust_cache=True):
   '''
   Calculate the MD5 checksum for a file. Handles gzipped files by
   decompressing on the fly (i.e., the returned checksum is of the
   uncompressed data, to avoid gzip timestamps changing the MD5 sum).
+  Decompression is piped from external pigz or gzip where available,
+  falling back to the (slower) gzip module otherwise.
+
+  If a checksum cache has been configured (see
+  osqutil.checksum_cache) it is consulted first, unless trust_cache
+  is False; newly calculated checksums are always stored in the cache.
   '''
-  # FIXME consider piping from external gzip (where available) rather
-  # than using gzip module?
+  cache = get_checksum_cache()
+  if cache is not None:
+    try:
+      fstat = os.stat(fname)
+      if trust_cache:
+        md5 = cache.lookup(fname, unzip=unzip)
+        if md5 is not None:
+          return md5
+    except sqlite3.Error, err:
+      LOGGER.warning("Checksum cache lookup failed for %s: %s", fname, err)
+
+  start_time = time.time()
   if unzip and is_zipped(fname):
-    with gzip.open(fname, 'rb') as fileobj:
-      md5 = _checksum_fileobj(fileobj)
+    decompressor = _find_gzip_decompressor()
+    if decompressor is not None:
+      md5 = _checksum_gzip_pipe(fname, decompressor, blocksize)
+    else:
+      LOGGER.warning("Using python gzip module, which may be quite slow.")
+      with gzip.open(fname, 'rb') as fileobj:
+        md5 = _checksum_fileobj(fileobj, blocksize)
   else:
     with open(fname, 'rb') as fileobj:
-      md5 = _checksum_fileobj(fileobj)
+      md5 = _checksum_fileobj(fileobj, blocksize)
+
+  _log_checksum_throughput(fname, time.time() - start_time)
+
+  if cache is not None:
+    try:
+      cache.store(fname, md5, fstat, unzip=unzip)
+    except sqlite3.Error, err:
+      LOGGER.warning("Unable to store checksum for %s in cache: %s",
+                     fname, err)
+
   return md5
 
+def _checksum_file_worker(args):
+  '''
+  Process pool worker function for iter_checksum_files. Exceptions
+  are caught and returned so that one unreadable file does not
+  abort the whole batch.
+  '''
+  (fname, unzip, trust_cache) = args
+  try:
+    return (fname,
+            checksum_file(fname, unzip=unzip, trust_cache=trust_cache),
+            None)
+  except Exception, err:
+    return (fname, None, "%s: %s" % (type(err).__name__, err))
+
+def iter_checksum_files(fnames, unzip=True, processes=None, trust_cache=True):
+  '''
+  Generator which calculates MD5 checksums for many files
+  concurrently using a process pool, yielding (fname, md5) tuples in
+  order of completion. Files which could not be checksummed are
+  logged and yield an md5 of None; callers can therefore record
+  progress as results arrive and resubmit just the failures. The
+  number of worker processes defaults to the checksum_processes
+  config option, or the number of available CPUs.
+  '''
+  fnames = list(fnames)
+  if len(fnames) == 0:
+    return
+
+  if processes is None:
+    try:
+      processes = int(DBCONF.checksum_processes)
+    except AttributeError, _err:
+      processes = multiprocessing.cpu_count()
+  processes = max(1, min(processes, len(fnames)))
+
+  start_time = time.time()
+  totalsize  = 0
+  jobs = [ (fname, unzip, trust_cache) for fname in fnames ]
+
+  if processes == 1:
+    results = ( _checksum_file_worker(job) for job in jobs )
+    pool    = None
+  else:
+    pool    = multiprocessing.Pool(processes)
+    results = pool.imap_unordered(_checksum_file_worker, jobs)
+
+  try:
+    for (fname, md5, err) in results:
+      if err is not None:
+        LOGGER.error("Unable to checksum file %s (%s).", fname, err)
+      else:
+        totalsize += os.path.getsize(fname)
+      yield (fname, md5)
+  finally:
+    if pool is not None:
+      pool.terminate()
+      pool.join()
+
+  elapsed = time.time() - start_time
+  size    = totalsize / float(1024 * 1024)
+  LOGGER.info("Checksummed %d files (%.1f MB on disk) using %d processes"
+              + " in %.1f seconds (%.1f MB/s).", len(fnames), size,
+              processes, elapsed, size / elapsed if elapsed > 0 else size)
+
+def checksum_files(fnames, unzip=True, processes=None, trust_cache=True):
+  '''
+  Calculate MD5 checksums for a list of files concurrently (see
+  iter_checksum_files). Returns a dict keyed by filename; files which
+  could not be checksummed map to None.
+  '''
+  return dict(iter_checksum_files(fnames, unzip=unzip, processes=processes,
+                                  trust_cache=trust_cache))
+
 def parse_repository_filename(fname):
   '''
   Retrieve key information from a given filename.
@@ -519,21 +677,17 @@ def sanitize_samplename(samplename):
   sanity_re = re.compile(r'([ \\\/\(\)\"\*:;&|<>]+)')
   return(sanity_re.sub('_', samplename))
 
-def determine_readlength(fastq):
+def determine_readlength(fastq, max_reads=10000):
   '''
-  Guess the length of the reads in the fastq file. Assumes that the
-  first read in the file is representative.
+  Guess the length of the reads in the fastq file, as the maximum
+  read length found in the first max_reads records (or the whole
+  file, if max_reads is None).
   '''
-  # Currently just assumes that the second line is the first read, and
-  # that it is representative.
+  # Imported here to avoid a circular import.
+  from .fastq_profile import profile_fastq
   LOGGER.debug("Finding read length from fastq file %s...", fastq)
-  rlen = None
-  with flexi_open(fastq) as reader:
-    for _num in range(2):
-      line = reader.next()
-    rlen = len(line.rstrip('\n'))
-
-  return rlen
+  return profile_fastq(fastq, max_reads=max_reads, quality=False,
+                       dup_sample=0).readlength
 
 def memoize(func):
   '''
@@ -555,17 +709,16 @@ def memoize(func):
     return cache[args]
   return wrap
 
-def write_to_remote_file(txt, remotefname, user, host, append=False, sshkey=None):
+def write_to_remote_file(txt, remotefname, user, host, append=False, sshkey=None, port=22):
 
   a = ''
   if append:
     a = '>'
 
-  if sshkey is None:
-    sshcmd = 'ssh'
-  else:
-    sshcmd = 'ssh -i %s' % sshkey
-  cmd = "%s -o StrictHostKeyChecking=no %s@%s 'cat - %s> %s'" % (sshcmd, user, host, a, remotefname)
+  # Uses the shared ssh connection to this host, if there is one.
+  sshcmd = get_ssh_pool().ssh_command(user, host, port, sshkey,
+                                      options=('StrictHostKeyChecking=no',))
+  cmd = "%s 'cat - %s> %s'" % (sshcmd, a, remotefname)
   p = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE, shell=True)
   p.stdin.write(txt)
   
@@ -589,7 +742,9 @@ def write_to_remote_file(txt, remotefname, user, host, append=False, sshkey=None
 def create_remote_dir(user, host, folder):
 
   # Create folder in remote host
-  cmd = "ssh -o StrictHostKeyChecking=no %s@%s 'mkdir -p %s'" % (user, host, folder)
+  sshcmd = get_ssh_pool().ssh_command(user, host,
+                                      options=('StrictHostKeyChecking=no',))
+  cmd = "%s 'mkdir -p %s'" % (sshcmd, folder)
   subproc = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
   (stdout, stderr) = subproc.communicate()
   retcode = subproc.wait()
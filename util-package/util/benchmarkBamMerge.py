@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Odom Lab, CRUK-CI, University of Cambridge
+#
+# This file is part of the osqutil python package.
+#
+# The osqutil python package is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# The osqutil python package is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the osqutil python package.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''Benchmark the bam merge modes used by the alignment pipeline on a
+set of split-lane bam files. Each mode merges the inputs and sets the
+read group as AlignmentManager._merge_files would; wall-clock and CPU
+time (user + system, summed over all the child processes) are
+reported for each mode, along with the time saved per lane relative
+to the picard mode. The read counts of the outputs are compared as a
+sanity check.'''
+
+import os
+import sys
+import time
+import resource
+import tempfile
+from subprocess import Popen, PIPE
+
+from osqutil.cluster import build_merge_pipeline, readgroup_fields, MERGE_MODES
+from osqutil.setup_logs import configure_logging
+LOGGER = configure_logging()
+
+###############################################################################
+
+def _child_cpu():
+  usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+  return usage.ru_utime + usage.ru_stime
+
+def run_mode(mode, output_fn, input_fns, sample, threads, workdir):
+  '''
+  Run a single merge, returning (wall seconds, CPU seconds).
+  '''
+  graph = build_merge_pipeline(output_fn, input_fns,
+                               readgroup_fields(output_fn, sample),
+                               threads=threads, mode=mode, workdir=workdir)
+  LOGGER.info(graph.plan())
+  cpu   = _child_cpu()
+  start = time.time()
+  proc  = Popen(['bash', '-c', graph.render()], stderr=PIPE)
+  (_stdout, stderr) = proc.communicate()
+  wall  = time.time() - start
+  if proc.returncode != 0:
+    sys.exit("Merge mode %s failed:\n%s" % (mode, stderr))
+  return (wall, _child_cpu() - cpu)
+
+def count_reads(bam):
+  '''
+  Return the number of records in a bam file.
+  '''
+  proc = Popen(['samtools', 'view', '-c', bam], stdout=PIPE)
+  return int(proc.communicate()[0])
+
+def benchmark(input_fns, lane_fn, sample=None, threads=1, modes=MERGE_MODES,
+              repeats=1):
+  '''
+  Benchmark each merge mode, printing a summary table to stdout.
+  '''
+  workdir = tempfile.mkdtemp(prefix='bammerge')
+  results = {}
+  counts  = {}
+  try:
+    for mode in modes:
+      output_fn = os.path.join(workdir, mode, lane_fn)
+      os.mkdir(os.path.dirname(output_fn))
+      times = [ run_mode(mode, output_fn, input_fns, sample, threads, workdir)
+                for _num in range(repeats) ]
+      results[mode] = (min([ x[0] for x in times ]), min([ x[1] for x in times ]))
+      counts[mode]  = count_reads(output_fn)
+      os.unlink(output_fn)
+      os.rmdir(os.path.dirname(output_fn))
+  finally:
+    os.rmdir(workdir)
+
+  print "%-10s %10s %10s %12s" % ('mode', 'wall (s)', 'CPU (s)', 'reads')
+  for mode in modes:
+    print "%-10s %10.1f %10.1f %12d" % ((mode,) + results[mode] + (counts[mode],))
+  if len(set(counts.values())) > 1:
+    LOGGER.error("Merge modes produced different numbers of reads.")
+
+  if 'picard' in results:
+    for mode in modes:
+      if mode != 'picard':
+        print ("%s saves %.1f wall-clock seconds and %.1f CPU seconds per lane."
+               % (mode, results['picard'][0] - results[mode][0],
+                  results['picard'][1] - results[mode][1]))
+
+if __name__ == '__main__':
+
+  import argparse
+
+  PARSER = argparse.ArgumentParser(
+    description='Compare the run times of the bam merge modes.')
+
+  PARSER.add_argument('infiles', metavar='<input BAM file(s)>', type=str, nargs='+',
+                      help='The sorted, split-lane BAM files to merge.')
+
+  PARSER.add_argument('--lane-file', type=str, dest='lanefile', default='merged.bam',
+                      help='The repository file name of the merged lane, used'
+                      + ' to derive its read group.')
+
+  PARSER.add_argument('--sample', type=str, dest='sample',
+                      help='The sample name used to tag the output bam read group.')
+
+  PARSER.add_argument('-t', '--threads', type=int, dest='threads', default=1,
+                      help='The number of threads to use.')
+
+  PARSER.add_argument('--modes', type=str, dest='modes', default=",".join(MERGE_MODES),
+                      help='Comma-separated list of merge modes to compare.')
+
+  PARSER.add_argument('--repeats', type=int, dest='repeats', default=1,
+                      help='Number of runs per mode (the fastest is reported).')
+
+  ARGS = PARSER.parse_args()
+
+  benchmark(ARGS.infiles, os.path.basename(ARGS.lanefile), sample=ARGS.sample,
+            threads=ARGS.threads, modes=ARGS.modes.split(","),
+            repeats=ARGS.repeats)
@@ -18,84 +18,79 @@
 # along with the osqutil python package.  If not, see
 # <http://www.gnu.org/licenses/>.
 
-'''Code of uncertain function and provenance.'''
+'''Split an Illumina export (or fastq) file into separate files by
+the inline barcode at the start of each read. Exact matches are
+written to <base>_<code>_<lane>.<suffix>, reads with mismatches to
+<base>_<code>_ob1_<lane>.<suffix>, and unassigned reads to
+<base>_other_<lane>.<suffix>. Per-barcode read counts are written to
+stdout as JSON.'''
 
 import sys
 import re
+import json
 
+from osqutil.demux import BarcodeDemultiplexer, detect_format
 from osqutil.setup_logs import configure_logging
 LOGGER = configure_logging()
 
 ###############################################################################
 
-def make_buckets(tags):
-  offByOne = {}
-  for tag in tags:
-    for pos in range(0, len(tag)):
-      for letter in "ACGT":
-        if tag[pos] != letter:
-          err = tag[0:pos] + letter + tag[pos+1:]
-          offByOne[err] = tag
-  return offByOne
-
-def split_barcoded(codeStr, inFN):
-  namePat = re.compile(r"^(.+)_(CRI\d\d)(_.+)?\.(\w+)$")
+def split_barcoded(codeStr, inFN, max_mismatches=1, compress=False):
+  namePat = re.compile(r"^(.+)_(CRI\d\d)(_.+?)?\.(\w+)(\.gz)?$")
   nameMO = namePat.match(inFN)
   if not nameMO:
-    print >> sys.stderr, "ERROR: failed to parse input name."
+    LOGGER.error("Failed to parse input name.")
     sys.exit("Unexpected file naming convention.")
   base = nameMO.group(1)
   lane = nameMO.group(2)
   middle = nameMO.group(3)
   suff = nameMO.group(4)
+  if compress:
+    suff += '.gz'
   codeNames = codeStr.upper().split(",")
-  codelen = len(codeNames[0])
   codes = {}
-  counts = {}
   ob1codes = {}
-  ob1counts = {}
   for code in codeNames:
-    fname = "%s%s_%s_%s.%s" % (base, middle if middle else "",
-                               code, lane, suff)
-    fdesc = file(fname, "w")
-    codes[code] = fdesc
-    counts[code] = 0
-    fname = "%s%s_%s_ob1_%s.%s" % (base, middle if middle else "",
-                                   code, lane, suff)
-    fdesc = file(fname, "w")
-    ob1codes[code] = fdesc
-    ob1counts[code] = 0
-  fname = "%s%s_other_%s.%s" % (base, middle if middle else "",
+    codes[code] = "%s%s_%s_%s.%s" % (base, middle if middle else "",
+                                     code, lane, suff)
+    ob1codes[code] = "%s%s_%s_ob1_%s.%s" % (base, middle if middle else "",
+                                            code, lane, suff)
+  other = "%s%s_other_%s.%s" % (base, middle if middle else "",
                                 lane, suff)
-  fdesc = file(fname, "w")
-  codes['other'] = fdesc
-  counts['other'] = 0
-  inFD = file(inFN)
-  buckets = make_buckets(codeNames)
-  for line in inFD:
-    seq = line.split("\t")[8]
-    code = seq[0:codelen].upper()
-    if code in codes:
-      codes[code].write(line)
-      counts[code] += 1
-    elif code in buckets:
-      ob1codes[buckets[code]].write(line)
-      ob1counts[buckets[code]] += 1
-    else:
-      codes['other'].write(line)
-      counts['other'] += 1
-  total = 0
-  for code in codes:
-    codes[code].close()
-    total += counts[code]
-    if code != 'other':
-      print >> sys.stderr, "%s\t%d" % (code, counts[code])
-  print >> sys.stderr, "other\t%d" % (counts['other'],)
-  print "total\t%d" % (total,)
+
+  fmt = detect_format(inFN)
+  demux = BarcodeDemultiplexer(codes, mismatch_outputs=ob1codes, unmatched=other,
+                               max_mismatches=max_mismatches, fmt=fmt,
+                               location='sequence', compress=compress)
+  counts = demux.run(inFN)
+  counts['total'] = sum([ sum(counts[code]) for code in codeNames ]) \
+      + counts['unmatched']
+  return counts
 
 ###############################################################################
 
 if __name__ == '__main__':
-  (CODESTR, INFN) = sys.argv[1:]
-  split_barcoded(CODESTR, INFN)
 
+  from argparse import ArgumentParser
+
+  PARSER = ArgumentParser(description='Split a barcoded export or fastq file by'
+                          + ' the inline barcode at the start of each read.')
+
+  PARSER.add_argument('codes', metavar='<barcodes>', type=str,
+                      help='Comma-separated list of barcodes.')
+
+  PARSER.add_argument('infile', metavar='<input file>', type=str,
+                      help='The export or fastq file to split.')
+
+  PARSER.add_argument('-m', '--mismatches', dest='mismatches', type=int, default=1,
+                      help='The maximum number of barcode mismatches allowed (default=1).')
+
+  PARSER.add_argument('-z', '--gzip', dest='compress', action='store_true',
+                      help='Write gzipped output files.')
+
+  ARGS = PARSER.parse_args()
+
+  COUNTS = split_barcoded(ARGS.codes, ARGS.infile,
+                          max_mismatches=ARGS.mismatches, compress=ARGS.compress)
+  json.dump(COUNTS, sys.stdout, indent=2, sort_keys=True)
+  sys.stdout.write("\n")